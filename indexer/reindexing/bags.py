@@ -1,3 +1,6 @@
+import concurrent.futures
+import itertools
+
 from tqdm import tqdm
 
 from messaging import publish_notifications
@@ -8,14 +11,72 @@ def get_table_count(dynamodb_client, *, table_name):
     return resp["Table"]["ItemCount"]
 
 
-def scan_table(dynamodb_client, *, TableName, **kwargs):
-    paginator = dynamodb_client.get_paginator("scan")
+# How many Scan requests to have in flight at once.  A single-threaded
+# scan is limited by the latency of one request at a time; with enough
+# workers, we're limited by the table's read capacity instead.
+DEFAULT_SCAN_WORKERS = 8
+
+
+def parallel_scan_table(
+    dynamodb_client, *, TableName, max_workers=DEFAULT_SCAN_WORKERS, **kwargs
+):
+    """
+    Generates all the items in a DynamoDB table, using a segmented scan
+    with up to ``max_workers`` requests in flight at once.
+
+    Items come back in whatever order the pages arrive, so don't rely on
+    the order.  Other keyword arguments (including ``TotalSegments``) are
+    passed to the Scan operation.
+    See https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Scan.html#Scan.ParallelScan
+    """
+    # Using more segments than workers means a slow segment doesn't hold
+    # up the end of the scan.
+    total_segments = kwargs.pop("TotalSegments", max_workers * 4)
+
+    segments = iter(
+        {
+            **kwargs,
+            "TableName": TableName,
+            "Segment": segment,
+            "TotalSegments": total_segments,
+        }
+        for segment in range(total_segments)
+    )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(dynamodb_client.scan, **scan_params): scan_params
+            for scan_params in itertools.islice(segments, max_workers)
+        }
+
+        while futures:
+            done, _ = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+
+            for fut in done:
+                scan_params = futures.pop(fut)
+                resp = fut.result()
 
-    for page in paginator.paginate(TableName=TableName, **kwargs):
-        yield from page["Items"]
+                # Carry on with this segment if there are more pages, or
+                # start on the next segment if there aren't.
+                if "LastEvaluatedKey" in resp:
+                    next_params = {
+                        **scan_params,
+                        "ExclusiveStartKey": resp["LastEvaluatedKey"],
+                    }
+                else:
+                    next_params = next(segments, None)
 
+                if next_params is not None:
+                    futures[
+                        executor.submit(dynamodb_client.scan, **next_params)
+                    ] = next_params
 
-def get_latest_bags(dynamodb_client, *, table_name):
+                yield from resp["Items"]
+
+
+def get_latest_bags(dynamodb_client, *, table_name, max_workers=DEFAULT_SCAN_WORKERS):
     total_bags = get_table_count(dynamodb_client, table_name=table_name)
 
     print(f"\nGetting latest version of bags from {table_name}")
@@ -23,9 +84,18 @@ def get_latest_bags(dynamodb_client, *, table_name):
     bags = {}
     seen_bags = 0
 
-    for item in tqdm(
-        scan_table(dynamodb_client, TableName=table_name), total=total_bags
-    ):
+    # We only need the ID and version of each manifest, so we don't fetch
+    # the rest of the row.  ``version`` is a DynamoDB reserved word, so it
+    # has to go through an attribute name placeholder.
+    items = parallel_scan_table(
+        dynamodb_client,
+        TableName=table_name,
+        max_workers=max_workers,
+        ProjectionExpression="#id, #version",
+        ExpressionAttributeNames={"#id": "id", "#version": "version"},
+    )
+
+    for item in tqdm(items, total=total_bags):
         dynamo_id = item["id"]["S"]
         version = int(item["version"]["N"])
 
@@ -10,7 +10,7 @@ import datetime
 from tqdm import tqdm
 from elasticsearch.helpers import scan
 
-from bags import scan_table, get_table_count
+from bags import parallel_scan_table, get_table_count
 from clients import create_aws_client, create_es_client
 from chunked_diff import chunked_diff
 from messaging import publish_notifications
@@ -57,7 +57,8 @@ def get_ingests(dynamodb_client, *, table_name):
 
     deserializer = TypeDeserializer()
     for item in tqdm(
-        scan_table(dynamodb_client, TableName=table_name), total=total_ingests
+        parallel_scan_table(dynamodb_client, TableName=table_name),
+        total=total_ingests,
     ):
         ingest = {k: deserializer.deserialize(v) for k, v in item.items()}["payload"]
 
@@ -0,0 +1,651 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the client and the downloader.
+
+Everything runs against local stand-ins: S3 is mocked with moto, and the
+bags API is a small HTTP server in this process that serves synthetic
+storage manifests.  The numbers aren't comparable to production, but
+they are comparable between releases run on the same machine.
+
+    python benchmarks/run_benchmarks.py           # the full suite
+    python benchmarks/run_benchmarks.py --quick   # smaller inputs, for CI
+
+Results are saved to ``benchmarks/results/v{version}.json``, and compared
+to the results for the most recent earlier version, if there are any.
+Anything more than 20% slower is flagged as a regression.
+
+This needs Python 3.7+ and the ``s3`` extra, plus moto.
+"""
+
+import argparse
+import contextlib
+import datetime
+import gc
+import hashlib
+import http.server
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import boto3
+import moto
+import requests
+
+from wellcome_storage_service import (
+    RequestsStorageServiceClient,
+    StorageManifest,
+    build_bag,
+    download_bag,
+    download_compressed_bag,
+)
+from wellcome_storage_service.manifest import FileTable
+from wellcome_storage_service.streaming import StreamingBag
+from wellcome_storage_service.version import __version__, __version_info__
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# How much slower a benchmark has to be than the previous release before
+# we call it a regression.
+REGRESSION_THRESHOLD = 1.2
+
+BUCKET = "wellcomecollection-storage"
+
+KB = 1024
+MB = 1024 * KB
+
+MANIFEST_SIZES = [10, 1000, 100000, 1000000]
+QUICK_MANIFEST_SIZES = [10, 1000, 10000]
+
+# How many files to put in the FileTable benchmarks, and how many to
+# look up in each.
+FILE_TABLE_SIZES = [200000]
+QUICK_FILE_TABLE_SIZES = [10000]
+FILE_TABLE_LOOKUPS = 10000
+
+# Mixes of (number of files, size of each file) for the download benchmarks.
+FILE_MIXES = {
+    "small": [(2000, 4 * KB)],
+    "mixed": [(500, 4 * KB), (50, 256 * KB), (4, 16 * MB)],
+    "large": [(4, 32 * MB)],
+}
+QUICK_FILE_MIXES = {
+    "small": [(200, 4 * KB)],
+    "mixed": [(50, 4 * KB), (10, 256 * KB), (1, 8 * MB)],
+    "large": [(1, 16 * MB)],
+}
+
+
+def synthetic_bag(file_count, space="digitised", external_identifier="b12345"):
+    """
+    Returns a bags API response with ``file_count`` payload files, shaped
+    like the ones we store for digitised books.
+    """
+
+    def _manifest_file(name):
+        return {
+            "checksum": hashlib.sha256(name.encode("utf8")).hexdigest(),
+            "name": name,
+            "path": "v1/%s" % name,
+            "size": 123456,
+            "type": "File",
+        }
+
+    return {
+        "id": "%s/%s" % (space, external_identifier),
+        "space": {"id": space, "type": "Space"},
+        "info": {"externalIdentifier": external_identifier, "type": "BagInfo"},
+        "manifest": {
+            "checksumAlgorithm": "SHA-256",
+            "files": [
+                _manifest_file("data/objects/%s_%07d.jp2" % (external_identifier, i))
+                for i in range(file_count)
+            ],
+            "type": "BagManifest",
+        },
+        "tagManifest": {
+            "checksumAlgorithm": "SHA-256",
+            "files": [_manifest_file(name) for name in ("bag-info.txt", "bagit.txt")],
+            "type": "BagManifest",
+        },
+        "location": {
+            "provider": {"id": "amazon-s3", "type": "Provider"},
+            "bucket": BUCKET,
+            "path": "%s/%s" % (space, external_identifier),
+            "type": "Location",
+        },
+        "replicaLocations": [],
+        "createdDate": "2019-09-12T20:26:53.094757Z",
+        "version": "v1",
+        "type": "Bag",
+    }
+
+
+class FakeBagsAPI(object):
+    """
+    Serves ``/bags/{space}/{external_identifier}`` from a local HTTP server.
+    If the external identifier ends in ``-{n}``, the bag has ``n`` files.
+    """
+
+    def __init__(self):
+        self._bodies = {}
+
+    def body(self, external_identifier):
+        try:
+            return self._bodies[external_identifier]
+        except KeyError:
+            match = re.search(r"-(\d+)$", external_identifier)
+            file_count = int(match.group(1)) if match else 10
+            body = json.dumps(
+                synthetic_bag(file_count, external_identifier=external_identifier)
+            ).encode("utf8")
+            self._bodies[external_identifier] = body
+            return body
+
+    @contextlib.contextmanager
+    def running(self):
+        api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            # Otherwise every keep-alive request waits for a delayed ACK,
+            # and we'd be measuring that rather than the client.
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                match = re.match(r"^/bags/([^/]+)/(.+)$", path)
+                if match is None:
+                    self.send_error(404)
+                    return
+
+                body = api.body(match.group(2))
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        try:
+            yield "http://127.0.0.1:%d" % server.server_address[1]
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+@contextlib.contextmanager
+def mock_s3():
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+
+    with moto.mock_aws():
+        s3_client = boto3.client("s3")
+        s3_client.create_bucket(
+            Bucket=BUCKET, CreateBucketConfiguration={"LocationConstraint": "eu-west-1"}
+        )
+        yield s3_client
+
+
+def upload_bag(s3_client, mix, external_identifier):
+    """
+    Uploads random files in the given mix to the mock S3, and returns
+    a storage manifest that points to them.
+    """
+    bag = synthetic_bag(0, external_identifier=external_identifier)
+    prefix = bag["location"]["path"]
+
+    def _put(name, body):
+        s3_client.put_object(Bucket=BUCKET, Key="%s/v1/%s" % (prefix, name), Body=body)
+        return {
+            "checksum": hashlib.sha256(body).hexdigest(),
+            "name": name,
+            "path": "v1/%s" % name,
+            "size": len(body),
+            "type": "File",
+        }
+
+    files = []
+    for count, size in mix:
+        for i in range(count):
+            files.append(_put("data/%d/%06d.bin" % (size, i), os.urandom(size)))
+
+    bag["manifest"]["files"] = files
+    bag["tagManifest"]["files"] = [_put("bagit.txt", b"BagIt-Version: 0.97\n")]
+
+    return bag
+
+
+def measure(f, repeat, setup=None):
+    """
+    Runs ``f`` ``repeat`` times, and returns the fastest time in seconds.
+    ``setup`` is called (untimed) before each run.
+    """
+    timings = []
+
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+
+        gc.collect()
+        start = time.perf_counter()
+        f()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def peak_memory(f):
+    """
+    Returns the peak memory allocated (in bytes) while running ``f``.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        f()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak
+
+
+def retained_memory(f):
+    """
+    Returns the memory (in bytes) still allocated to whatever ``f`` returns.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = f()
+        gc.collect()
+        retained, _ = tracemalloc.get_traced_memory()
+        del result
+    finally:
+        tracemalloc.stop()
+
+    return retained
+
+
+def bench_file_table(file_counts, repeat):
+    """
+    Times building a ``FileTable`` from a parsed manifest, and looking up
+    files in it by name, and measures how much memory the table keeps.
+    """
+    results = {}
+
+    for file_count in file_counts:
+        bag_manifest = synthetic_bag(file_count)["manifest"]
+        names = [f["name"] for f in bag_manifest["files"]]
+        lookups = [
+            names[i * 7919 % file_count]
+            for i in range(min(FILE_TABLE_LOOKUPS, file_count))
+        ]
+
+        def _build():
+            return FileTable.from_dict(bag_manifest)
+
+        seconds = measure(_build, repeat=repeat)
+        results["file_table.build[%d]" % file_count] = {
+            "seconds": seconds,
+            "files_per_second": file_count / seconds,
+            "memory": retained_memory(_build),
+        }
+
+        table = _build()
+
+        def _get():
+            for name in lookups:
+                table.get(name)
+
+        seconds = measure(_get, repeat=repeat)
+        results["file_table.get[%d]" % file_count] = {
+            "seconds": seconds,
+            "lookups_per_second": len(lookups) / seconds,
+        }
+
+    return results
+
+
+def bench_manifest_parsing(manifest_sizes, repeat):
+    api = FakeBagsAPI()
+    results = {}
+
+    for file_count in manifest_sizes:
+        text = api.body("b-%d" % file_count).decode("utf8")
+
+        def _from_bag():
+            StorageManifest.from_bag(json.loads(text))
+
+        def _from_streaming_bag():
+            chunks = (text[i:i + 64 * KB] for i in range(0, len(text), 64 * KB))
+            StorageManifest.from_streaming_bag(StreamingBag(chunks))
+
+        for name, f in [("from_bag", _from_bag), ("streaming", _from_streaming_bag)]:
+            seconds = measure(f, repeat=repeat)
+            results["manifest_parse.%s[%d]" % (name, file_count)] = {
+                "seconds": seconds,
+                "files_per_second": file_count / seconds,
+                "peak_memory": peak_memory(f),
+            }
+
+    return results
+
+
+def bench_downloads(file_mixes, repeat):
+    results = {}
+
+    with mock_s3() as s3_client:
+        for mix_name, mix in sorted(file_mixes.items()):
+            bag = upload_bag(s3_client, mix, external_identifier=mix_name)
+            total_size = sum(f["size"] for f in bag["manifest"]["files"])
+
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                out_dir = os.path.join(tmp_dir, "bag")
+                out_path = os.path.join(tmp_dir, "bag.tar.gz")
+
+                def _clean():
+                    shutil.rmtree(out_dir, ignore_errors=True)
+                    if os.path.exists(out_path):
+                        os.unlink(out_path)
+
+                seconds = measure(
+                    lambda: download_bag(bag, out_dir=out_dir),
+                    repeat=repeat,
+                    setup=_clean,
+                )
+                results["download_bag[%s]" % mix_name] = {
+                    "seconds": seconds,
+                    "bytes_per_second": total_size / seconds,
+                }
+
+                for streaming in (False, True):
+                    seconds = measure(
+                        lambda: download_compressed_bag(
+                            bag, out_path=out_path, streaming=streaming
+                        ),
+                        repeat=repeat,
+                        setup=_clean,
+                    )
+                    name = "download_compressed_bag[%s,%s]" % (
+                        mix_name,
+                        "streaming" if streaming else "temp_dir",
+                    )
+                    results[name] = {
+                        "seconds": seconds,
+                        "bytes_per_second": total_size / seconds,
+                    }
+
+    return results
+
+
+def bench_build_bag(file_mixes, repeat):
+    results = {}
+
+    for mix_name, mix in sorted(file_mixes.items()):
+        with tempfile.TemporaryDirectory() as bag_dir:
+            total_size = 0
+            for count, size in mix:
+                os.makedirs(os.path.join(bag_dir, "data", str(size)))
+                for i in range(count):
+                    path = os.path.join(bag_dir, "data", str(size), "%06d.bin" % i)
+                    with open(path, "wb") as outfile:
+                        outfile.write(os.urandom(size))
+                    total_size += size
+
+            for processes in (1, None):
+                seconds = measure(
+                    lambda: build_bag(
+                        bag_dir, algorithms=["sha256", "sha512"], processes=processes
+                    ),
+                    repeat=repeat,
+                )
+                name = "build_bag[%s,processes=%s]" % (
+                    mix_name,
+                    processes or "cpu_count",
+                )
+                results[name] = {
+                    "seconds": seconds,
+                    "bytes_per_second": total_size / seconds,
+                }
+
+    return results
+
+
+def bench_client_calls(call_count, repeat):
+    results = {}
+    api = FakeBagsAPI()
+
+    with api.running() as api_url:
+        client = RequestsStorageServiceClient(api_url=api_url, sess=requests.Session())
+
+        # Warm up the connection and the server's cache of bodies
+        client.get_bag("digitised", "b-10")
+        client.get_bag("digitised", "b-10000")
+
+        seconds = measure(
+            lambda: [client.get_bag("digitised", "b-10") for _ in range(call_count)],
+            repeat=repeat,
+        )
+        results["client.get_bag[sequential]"] = {
+            "seconds": seconds,
+            "calls_per_second": call_count / seconds,
+        }
+
+        def _get_many():
+            for _, result in client.get_bags_many(
+                [("digitised", "b-10")] * call_count, max_concurrency=10
+            ):
+                if isinstance(result, Exception):
+                    raise result
+
+        seconds = measure(_get_many, repeat=repeat)
+        results["client.get_bags_many[concurrency=10]"] = {
+            "seconds": seconds,
+            "calls_per_second": call_count / seconds,
+        }
+
+        seconds = measure(
+            lambda: client.get_storage_manifest("digitised", "b-10000"), repeat=repeat
+        )
+        results["client.get_storage_manifest[10000]"] = {"seconds": seconds}
+
+    return results
+
+
+def bench_import(repeat):
+    """
+    Times a cold ``import wellcome_storage_service`` in a fresh interpreter,
+    which is what a Lambda function pays on every cold start.
+    """
+    def _import():
+        subprocess.check_call(
+            [sys.executable, "-X", "importtime", "-c", "import wellcome_storage_service"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def _baseline():
+        subprocess.check_call([sys.executable, "-c", "pass"])
+
+    # Subtract the cost of starting the interpreter, so we only measure
+    # our own imports.
+    seconds = measure(_import, repeat=repeat) - measure(_baseline, repeat=repeat)
+
+    return {"import wellcome_storage_service": {"seconds": max(seconds, 0)}}
+
+
+def _parse_version(filename):
+    match = re.match(r"^v(\d+)\.(\d+)\.(\d+)\.json$", filename)
+    if match is None:
+        return None
+    return tuple(int(part) for part in match.groups())
+
+
+def previous_results(results_dir):
+    """
+    Returns the saved results for the most recent version before this one,
+    or None if there aren't any.
+    """
+    try:
+        filenames = os.listdir(results_dir)
+    except FileNotFoundError:
+        return None
+
+    versions = sorted(
+        (version, name)
+        for name, version in ((name, _parse_version(name)) for name in filenames)
+        if version is not None and version < __version_info__
+    )
+
+    if not versions:
+        return None
+
+    with open(os.path.join(results_dir, versions[-1][1])) as infile:
+        return json.load(infile)
+
+
+def compare(previous, current):
+    """
+    Prints how each benchmark compares to ``previous``, and returns the
+    names of any that have regressed.
+    """
+    regressions = []
+
+    print("\nCompared to v%s:" % previous["version"])
+
+    for name, result in sorted(current["results"].items()):
+        old = previous["results"].get(name)
+        if old is None:
+            continue
+
+        ratio = result["seconds"] / old["seconds"]
+        flag = ""
+        if ratio > REGRESSION_THRESHOLD:
+            flag = "  <-- REGRESSION"
+            regressions.append(name)
+
+        print(
+            "  %-50s %8.3fs -> %8.3fs (%.2fx)%s"
+            % (name, old["seconds"], result["seconds"], ratio, flag)
+        )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--quick", action="store_true", help="use smaller inputs, e.g. for CI"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="how many times to run each benchmark"
+    )
+    parser.add_argument(
+        "--only",
+        choices=["manifests", "downloads", "build_bag", "client", "import"],
+        action="append",
+        help="only run these benchmarks",
+    )
+    parser.add_argument(
+        "--results-dir", default=RESULTS_DIR, help="where to save the results"
+    )
+    parser.add_argument("--no-save", action="store_true", help="don't save the results")
+    parser.add_argument(
+        "--fail-on-regression",
+        action="store_true",
+        help="exit with an error if anything is slower than the last release",
+    )
+    args = parser.parse_args()
+
+    suites = args.only or ["manifests", "downloads", "build_bag", "client", "import"]
+
+    results = {}
+
+    if "manifests" in suites:
+        results.update(
+            bench_manifest_parsing(
+                QUICK_MANIFEST_SIZES if args.quick else MANIFEST_SIZES,
+                repeat=args.repeat,
+            )
+        )
+        results.update(
+            bench_file_table(
+                QUICK_FILE_TABLE_SIZES if args.quick else FILE_TABLE_SIZES,
+                repeat=args.repeat,
+            )
+        )
+
+    if "downloads" in suites:
+        results.update(
+            bench_downloads(
+                QUICK_FILE_MIXES if args.quick else FILE_MIXES, repeat=args.repeat
+            )
+        )
+
+    if "build_bag" in suites:
+        results.update(
+            bench_build_bag(
+                QUICK_FILE_MIXES if args.quick else FILE_MIXES, repeat=args.repeat
+            )
+        )
+
+    if "client" in suites:
+        results.update(
+            bench_client_calls(100 if args.quick else 1000, repeat=args.repeat)
+        )
+
+    if "import" in suites:
+        results.update(bench_import(repeat=max(args.repeat, 5)))
+
+    current = {
+        "version": __version__,
+        "date": datetime.datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "quick": args.quick,
+        "results": results,
+    }
+
+    for name, result in sorted(results.items()):
+        extra = ", ".join(
+            "%s=%.0f" % (key, value)
+            for key, value in sorted(result.items())
+            if key != "seconds"
+        )
+        print("%-50s %8.3fs  %s" % (name, result["seconds"], extra))
+
+    regressions = []
+    previous = previous_results(args.results_dir)
+    if previous is not None and previous.get("quick") == args.quick:
+        regressions = compare(previous, current)
+
+    if not args.no_save:
+        os.makedirs(args.results_dir, exist_ok=True)
+        out_path = os.path.join(args.results_dir, "v%s.json" % __version__)
+        with open(out_path, "w") as outfile:
+            json.dump(current, outfile, indent=2, sort_keys=True)
+        print("\nSaved results to %s" % out_path)
+
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,8 +26,22 @@ setup(
     packages=find_packages(SOURCE),
     package_dir={"": SOURCE},
     version=__version__,
-    install_requires=["requests_oauthlib>=1.2.0,<2"],
-    extras_require={"s3": ["boto3>=1.9.253,<2"]},
+    install_requires=[
+        "requests_oauthlib>=1.2.0,<2",
+        'futures>=3.3.0,<4; python_version < "3"',
+    ],
+    extras_require={
+        "s3": ["boto3>=1.9.253,<2"],
+        "zstd": ["zstandard>=0.15"],
+        "async": ['aiohttp>=3.6,<4; python_version >= "3.7"'],
+        "azure": ["azure-storage-blob>=12,<13"],
+        "fsspec": ['fsspec>=2021.4.0; python_version >= "3.7"'],
+    },
+    entry_points={
+        "fsspec.specs": [
+            "wellcome-bag = wellcome_storage_service.filesystem:BagFileSystem"
+        ]
+    },
     description="A client for the Wellcome Storage Service",
     long_description=open(README).read(),
     author="Wellcome Trust (Digital Platform Team)",
@@ -1,34 +1,236 @@
+import codecs
+import contextlib
 import functools
+import heapq
+import importlib
+import itertools
 import json
-import os
-
-from oauthlib.oauth2 import BackendApplicationClient
-from oauthlib.oauth2.rfc6749.errors import TokenExpiredError
-from requests_oauthlib import OAuth2Session
-
-from .downloader import download_bag, download_compressed_bag
-from .exceptions import BagNotFound, IngestNotFound, ServerError, UserError
+import sys
+import time
+
+from . import _api
+from ._utils import RateLimiter, backoff_delay, concurrently, default_path
+from .exceptions import (
+    BagDownloadError,
+    BagNotFound,
+    ChecksumMismatch,
+    IngestNotFound,
+    IngestWaitTimeout,
+    ServerError,
+    UserError,
+)
+from .ingests import (
+    DEFAULT_MAX_POLL_INTERVAL,
+    DEFAULT_MIN_POLL_INTERVAL,
+    TERMINAL_STATUSES,
+    FinishedIngest,
+    ingest_stages,
+    ingest_status,
+    next_poll_delay,
+)
+from .metrics import Instrumentation, Metrics, record_request
 from .secrets import get_secrets
+from .tokens import (
+    FileTokenStore,
+    MemoryTokenStore,
+    TokenStore,
+    token_is_fresh,
+    token_key,
+)
 
 
 __all__ = [
+    "build_bag",
+    "FetchEntry",
+    "diff_manifests",
+    "iter_manifest_changes",
+    "FileChange",
+    "ManifestDiff",
     "download_bag",
     "download_compressed_bag",
+    "stream_compressed_bag",
+    "open_bag_file",
+    "upload_bag",
+    "verify_bag",
+    "BagFile",
+    "BagDownloadError",
     "BagNotFound",
+    "ChecksumMismatch",
     "IngestNotFound",
+    "IngestWaitTimeout",
+    "FinishedIngest",
     "ServerError",
     "UserError",
+    "ManifestCache",
+    "ContentStore",
+    "Instrumentation",
+    "Metrics",
+    "ManifestEntry",
+    "ManifestFile",
+    "StorageManifest",
+    "StreamingBag",
+    "TokenStore",
+    "MemoryTokenStore",
+    "FileTokenStore",
     "StorageServiceClient",
 ]
 
 
+# Everything that isn't needed to make requests is imported the first time
+# it's used, so importing this package (e.g. on a Lambda cold start) doesn't
+# load the downloader, the bag tools, or their dependencies.
+_LAZY_ATTRIBUTES = {
+    "FetchEntry": "bag_builder",
+    "build_bag": "bag_builder",
+    "ManifestCache": "cache",
+    "ContentStore": "content_store",
+    "FileChange": "diff",
+    "ManifestDiff": "diff",
+    "diff_manifests": "diff",
+    "iter_manifest_changes": "diff",
+    "download_bag": "downloader",
+    "download_compressed_bag": "downloader",
+    "stream_compressed_bag": "downloader",
+    "BagFile": "files",
+    "open_bag_file": "files",
+    "ManifestFile": "manifest",
+    "StorageManifest": "manifest",
+    "verify_bag": "preflight",
+    "ManifestEntry": "streaming",
+    "StreamingBag": "streaming",
+    "upload_bag": "uploader",
+}
+
+
+def _default_credentials_path():
+    return default_path("oauth-credentials.json")
+
+
+def _import_lazy_attribute(name):
+    module = importlib.import_module("." + _LAZY_ATTRIBUTES[name], __name__)
+    return getattr(module, name)
+
+
+if sys.version_info >= (3, 7):
+
+    def __getattr__(name):
+        if name == "DEFAULT_CREDENTIALS_PATH":
+            return _default_credentials_path()
+
+        if name not in _LAZY_ATTRIBUTES:
+            raise AttributeError(
+                "module %r has no attribute %r" % (__name__, name)
+            )
+
+        value = _import_lazy_attribute(name)
+        globals()[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
+
+else:  # pragma: no cover
+    # Python 2 doesn't support a module-level __getattr__, so import
+    # everything up front.
+    for _name in _LAZY_ATTRIBUTES:
+        globals()[_name] = _import_lazy_attribute(_name)
+
+    DEFAULT_CREDENTIALS_PATH = _default_credentials_path()
+
+
+# The defaults for the bulk lookup methods, ``get_bags_many()`` and
+# ``get_ingests_many()``.
+DEFAULT_MAX_CONCURRENCY = 10
+DEFAULT_MAX_RETRIES = 3
+
+# How much of a response to read at once when streaming it.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _wait_for_due_ingests(pending, deadline):
+    """
+    Sleeps until at least one ingest in the ``pending`` heap is due to be
+    checked, then pops and returns their locations.
+
+    Returns None if we reach the deadline first.
+    """
+    while True:
+        now = time.time()
+
+        if deadline is not None and now >= deadline:
+            return None
+
+        due = []
+        while pending and pending[0][0] <= now:
+            due.append(heapq.heappop(pending)[1])
+
+        if due:
+            return due
+
+        wake_at = pending[0][0]
+        if deadline is not None:
+            wake_at = min(wake_at, deadline)
+        time.sleep(max(0, wake_at - now))
+
+
+def _timed_out_ingests(pending, last_status):
+    """
+    Generates an ``IngestWaitTimeout`` for every ingest still in ``pending``.
+    """
+    for _, location in sorted(pending):
+        yield location, IngestWaitTimeout(
+            location, last_status=last_status.get(location)
+        )
+
+
+def _record_ingest_result(
+    location, result, pending, last_status, min_poll_interval, max_poll_interval
+):
+    """
+    Handles the result of checking an ingest in ``wait_for_ingests()``.
+
+    Returns the result to report if the ingest has finished (or we couldn't
+    get it); otherwise schedules the next check and returns None.
+    """
+    if isinstance(result, Exception):
+        return result
+
+    status = ingest_status(result)
+
+    if status in TERMINAL_STATUSES:
+        return FinishedIngest(
+            ingest=result, status=status, stages=ingest_stages(result)
+        )
+
+    last_status[location] = status
+    checked_at = time.time()
+    delay = next_poll_delay(
+        result,
+        now=checked_at,
+        min_interval=min_poll_interval,
+        max_interval=max_poll_interval,
+    )
+    heapq.heappush(pending, (checked_at + delay, location))
+
+    return None
+
+
 class StorageServiceClientBase(object):
     """
     Client for the Wellcome Storage Service API.
+
+    :param manifest_cache: An optional ``ManifestCache``.  If supplied,
+        ``get_bag()`` looks for storage manifests in the cache before
+        fetching them from the API.
+    :param instrumentation: An optional ``Instrumentation`` (e.g. a
+        ``Metrics``), which is told about every request, retry and token
+        refresh the client makes.
     """
 
-    def __init__(self, api_url):
+    def __init__(self, api_url, manifest_cache=None, instrumentation=None):
         self.api_url = api_url
+        self.manifest_cache = manifest_cache
+        self.instrumentation = instrumentation
 
     def _http_get(self, url):  # pragma: no cover
         """
@@ -45,53 +247,199 @@ class StorageServiceClientBase(object):
         """
         raise NotImplementedError
 
+    def _http_get_stream(self, url):
+        """
+        Make a GET request to the URL.  Returns a status code and an iterable
+        of chunks of the body (as text).
+
+        Subclasses should override this if they can read the body as it
+        arrives; by default it reads the whole body with ``_http_get``.
+        """
+        status_code, body = self._http_get(url)
+        return status_code, iter([body])
+
     def get_ingest_from_location(self, ingest_url):
         """
         Returns the state of an ingest.
         """
         status_code, body = self._http_get(ingest_url)
 
-        if status_code == 404:
-            raise IngestNotFound("Ingests API returned 404 for %s" % ingest_url)
-        elif 400 <= status_code < 500:
-            error = json.loads(body)
-            raise UserError("%s: %s" % (error["label"], error["description"]))
-        elif status_code != 200:
-            raise ServerError()
-        else:
-            return json.loads(body)
+        return _api.parse_ingest_response(
+            ingest_url=ingest_url, status_code=status_code, body=body
+        )
 
     def get_ingest(self, ingest_id):
         """
         Returns the state of an ingest.
         """
         return self.get_ingest_from_location(
-            ingest_url="%s/ingests/%s" % (self.api_url, ingest_id)
+            ingest_url=_api.ingest_url(self.api_url, ingest_id)
         )
 
     def get_bag(self, space, external_identifier, version=None):
         """
         Returns the contents of a bag.
         """
-        bags_url_suffix = "%s/%s" % (space, external_identifier)
-        if version:
-            bags_url_suffix += "?version=%s" % version
+        return self._get_bag(
+            space, external_identifier, version, http_get=self._http_get
+        )
 
-        bags_url = "%s/bags/%s" % (self.api_url, bags_url_suffix)
+    def wait_for_ingests(
+        self,
+        ingest_locations,
+        timeout=None,
+        max_concurrency=DEFAULT_MAX_CONCURRENCY,
+        max_requests_per_second=None,
+        min_poll_interval=DEFAULT_MIN_POLL_INTERVAL,
+        max_poll_interval=DEFAULT_MAX_POLL_INTERVAL,
+    ):
+        """
+        Wait for ingests to succeed or fail.
+
+        :param ingest_locations: An iterable of ingest URLs, as returned by
+            ``create_s3_ingest()``.
+        :param timeout: How long to wait (in seconds) for every ingest to
+            finish, or None to wait forever.
+        :param max_concurrency: The maximum number of requests in flight.
+        :param max_requests_per_second: If set, the maximum number of
+            requests to make per second.
+        :param min_poll_interval: The least time (in seconds) to wait
+            between checks on an ingest.  Ingests that haven't had an event
+            for a while are checked less often, up to ``max_poll_interval``.
+
+        Generates (ingest_location, result) tuples as each ingest finishes.
+        The result is a ``FinishedIngest`` with the final state of the
+        ingest and how long each stage took, or an exception if we couldn't
+        get the ingest or it didn't finish before the timeout (an
+        ``IngestWaitTimeout``).  Check ``result.succeeded`` to see if the
+        ingest succeeded.
+        """
+        start = time.time()
+        deadline = start + timeout if timeout is not None else None
 
-        status_code, body = self._http_get(bags_url)
-        if status_code == 404:
-            if version:
-                raise BagNotFound(
-                    "Bags API returned 404 for bag %s/%s with version %s"
-                    % (space, external_identifier, version)
-                )
-            else:
-                raise BagNotFound(
-                    "Bags API returned 404 for bag %s/%s" % (space, external_identifier)
+        # A heap of (when to next check the ingest, ingest URL)
+        pending = [(start, location) for location in ingest_locations]
+        heapq.heapify(pending)
+        last_status = {}
+
+        rate_limiter = RateLimiter.for_rate(max_requests_per_second)
+
+        def _get_ingest(ingest_url, rate_limiter):
+            status_code, body = self._http_get_with_retries(
+                ingest_url, max_retries=DEFAULT_MAX_RETRIES, rate_limiter=rate_limiter
+            )
+
+            return _api.parse_ingest_response(
+                ingest_url=ingest_url, status_code=status_code, body=body
+            )
+
+        while pending:
+            due = _wait_for_due_ingests(pending, deadline)
+
+            if due is None:
+                for location, result in _timed_out_ingests(pending, last_status):
+                    yield location, result
+                return
+
+            for location, result in self._get_many(
+                _get_ingest,
+                due,
+                max_concurrency=max_concurrency,
+                rate_limiter=rate_limiter,
+            ):
+                result = _record_ingest_result(
+                    location,
+                    result,
+                    pending=pending,
+                    last_status=last_status,
+                    min_poll_interval=min_poll_interval,
+                    max_poll_interval=max_poll_interval,
                 )
-        else:
-            return json.loads(body)
+
+                if result is not None:
+                    yield location, result
+
+    def iter_bag_files(self, space, external_identifier, version=None):
+        """
+        Returns a ``StreamingBag``, which parses the files in a bag as you
+        iterate over it, rather than loading the whole storage manifest
+        into memory.  Use this for really big bags.
+
+        This doesn't use the manifest cache.
+        """
+        bags_url = _api.bag_url(self.api_url, space, external_identifier, version)
+
+        status_code, chunks = self._http_get_stream(bags_url)
+
+        if status_code != 200:
+            _api.parse_bag_response(
+                space=space,
+                external_identifier=external_identifier,
+                version=version,
+                status_code=status_code,
+                body="".join(chunks),
+            )
+
+        from .streaming import StreamingBag
+
+        return StreamingBag(chunks)
+
+    def get_storage_manifest(self, space, external_identifier, version=None):
+        """
+        Returns a bag as a ``StorageManifest``, which takes much less memory
+        than the response from ``get_bag()`` and can look up files by name
+        or path.  The response is parsed as it's read, so the full JSON is
+        never held in memory.
+        """
+        from .manifest import StorageManifest
+
+        return StorageManifest.from_streaming_bag(
+            self.iter_bag_files(space, external_identifier, version=version)
+        )
+
+    def diff_versions(self, space, external_identifier, old_version, new_version):
+        """
+        Returns a ``ManifestDiff`` with the files that were added, removed,
+        modified or moved between two versions of a bag.
+        """
+        from .diff import diff_manifests
+
+        return diff_manifests(
+            self.get_storage_manifest(space, external_identifier, old_version),
+            self.get_storage_manifest(space, external_identifier, new_version),
+        )
+
+    def _get_bag(self, space, external_identifier, version, http_get):
+        if self.manifest_cache is not None:
+            body = self.manifest_cache.get(
+                self.api_url, space, external_identifier, version
+            )
+            if body is not None:
+                return json.loads(body)
+
+        bags_url = _api.bag_url(self.api_url, space, external_identifier, version)
+
+        status_code, body = http_get(bags_url)
+
+        bag = _api.parse_bag_response(
+            space=space,
+            external_identifier=external_identifier,
+            version=version,
+            status_code=status_code,
+            body=body,
+        )
+
+        if self.manifest_cache is not None:
+            self.manifest_cache.put(
+                self.api_url,
+                space,
+                external_identifier,
+                version,
+                body,
+                resolved_version=bag.get("version"),
+            )
+
+        return bag
 
     def create_s3_ingest(
         self,
@@ -108,101 +456,372 @@ class StorageServiceClientBase(object):
         Returns the location of the new ingest if created, or raises an exception
         if not.
         """
-        payload = {
-            "type": "Ingest",
-            "ingestType": {"id": ingest_type, "type": "IngestType"},
-            "space": {"id": space, "type": "Space"},
-            "sourceLocation": {
-                "type": "Location",
-                "provider": {"type": "Provider", "id": "amazon-s3"},
-                "bucket": s3_bucket,
-                "path": s3_key,
-            },
-            "bag": {
-                "type": "Bag",
-                "info": {"type": "BagInfo", "externalIdentifier": external_identifier},
-            },
-        }
-
-        if callback_url is not None:
-            payload["callback"] = {"type": "Callback", "url": callback_url}
+        payload = _api.s3_ingest_payload(
+            space=space,
+            external_identifier=external_identifier,
+            s3_bucket=s3_bucket,
+            s3_key=s3_key,
+            callback_url=callback_url,
+            ingest_type=ingest_type,
+        )
 
         status_code, headers, body = self._http_post(
             url=self.api_url + "/ingests", json=payload
         )
 
-        if 400 <= status_code < 500:
-            error = json.loads(body)
-            raise UserError("%s: %s" % (error["label"], error["description"]))
-        elif status_code == 201:
-            return headers["Location"]
-        # This branch is untested because it needs a reliable way to trigger
-        else:  # pragma: no cover
-            raise ServerError()
+        return _api.parse_create_ingest_response(
+            status_code=status_code, headers=headers, body=body
+        )
+
+    def create_ingest_from_directory(
+        self,
+        space,
+        external_identifier,
+        bag_dir,
+        s3_bucket,
+        s3_key,
+        callback_url=None,
+        ingest_type="create",
+        s3_client=None,
+    ):
+        """
+        Upload the bag in a local directory to S3 as a tar.gz, and create an
+        ingest from it.
+
+        The archive is streamed to S3 as it's compressed, so it's never
+        written to local disk; see ``upload_bag()``.
+
+        Returns the location of the new ingest if created, or raises an
+        exception if not.
+        """
+        from .uploader import upload_bag
+
+        upload_bag(
+            bag_dir,
+            s3_bucket=s3_bucket,
+            s3_key=s3_key,
+            s3_client=s3_client,
+        )
+
+        return self.create_s3_ingest(
+            space=space,
+            external_identifier=external_identifier,
+            s3_bucket=s3_bucket,
+            s3_key=s3_key,
+            callback_url=callback_url,
+            ingest_type=ingest_type,
+        )
+
+    def verify_bag(self, space, external_identifier, path, **kwargs):
+        """
+        Check a bag before you ingest it, using the same rules as the storage
+        service's bag verifier.  Files in ``fetch.txt`` are checked against
+        the versions of the bag that are already stored.
+
+        Returns a list of problems, which is empty if the storage service
+        should accept the bag; see ``verify_bag()``.
+        """
+        from .preflight import verify_bag
+
+        return verify_bag(
+            path,
+            space=space,
+            external_identifier=external_identifier,
+            client=self,
+            **kwargs
+        )
+
+    def _http_get_with_retries(self, url, max_retries, rate_limiter):
+        """
+        Make a GET request to the URL, retrying with jittered backoff if the
+        API is rate limiting us or returns a 5xx error.
+
+        Returns the status code and body of the last attempt.
+        """
+        for attempt in itertools.count():
+            if rate_limiter is not None:
+                rate_limiter.wait()
+
+            status_code, body = self._http_get(url)
+
+            if status_code not in _api.RETRYABLE_STATUS_CODES:
+                return status_code, body
+
+            if attempt >= max_retries:
+                return status_code, body
+
+            if self.instrumentation is not None:
+                self.instrumentation.on_retry("api")
+
+            time.sleep(backoff_delay(attempt))
+
+    def _get_many(self, get_one, inputs, max_concurrency, rate_limiter):
+        def _get_one(input):
+            try:
+                return get_one(input, rate_limiter)
+            except Exception as err:
+                return err
+
+        return concurrently(_get_one, inputs, max_concurrency=max_concurrency)
+
+    def get_bags_many(
+        self,
+        bags,
+        max_concurrency=DEFAULT_MAX_CONCURRENCY,
+        max_requests_per_second=None,
+        max_retries=DEFAULT_MAX_RETRIES,
+    ):
+        """
+        Look up lots of bags at once.
+
+        :param bags: An iterable of (space, external_identifier, version) or
+            (space, external_identifier) tuples.  If the version is omitted
+            or None, you get the latest version of the bag.
+        :param max_concurrency: The maximum number of requests in flight.
+        :param max_requests_per_second: If set, the maximum number of
+            requests to make per second, including retries.
+        :param max_retries: How many times to retry a request if the API
+            returns a 429 or 5xx error.
+
+        Generates (bag, result) tuples as the lookups complete, where ``bag``
+        is the tuple you passed in.  The result is the contents of the bag,
+        or the exception if the lookup failed (e.g. ``BagNotFound``) -- one
+        bad bag doesn't stop the rest of the batch.
+        """
+
+        def _get_bag(bag, rate_limiter):
+            space, external_identifier, version = _api.bag_lookup(bag)
+
+            return self._get_bag(
+                space,
+                external_identifier,
+                version,
+                http_get=lambda url: self._http_get_with_retries(
+                    url, max_retries=max_retries, rate_limiter=rate_limiter
+                ),
+            )
+
+        return self._get_many(
+            _get_bag,
+            bags,
+            max_concurrency=max_concurrency,
+            rate_limiter=RateLimiter.for_rate(max_requests_per_second),
+        )
+
+    def get_ingests_many(
+        self,
+        ingest_ids,
+        max_concurrency=DEFAULT_MAX_CONCURRENCY,
+        max_requests_per_second=None,
+        max_retries=DEFAULT_MAX_RETRIES,
+    ):
+        """
+        Look up lots of ingests at once.
+
+        This takes an iterable of ingest IDs, and generates (ingest_id, result)
+        tuples as the lookups complete.  The result is the state of the ingest,
+        or the exception if the lookup failed (e.g. ``IngestNotFound``).
+
+        The other arguments are the same as ``get_bags_many()``.
+        """
+
+        def _get_ingest(ingest_id, rate_limiter):
+            ingest_url = _api.ingest_url(self.api_url, ingest_id)
+
+            status_code, body = self._http_get_with_retries(
+                ingest_url, max_retries=max_retries, rate_limiter=rate_limiter
+            )
+
+            return _api.parse_ingest_response(
+                ingest_url=ingest_url, status_code=status_code, body=body
+            )
+
+        return self._get_many(
+            _get_ingest,
+            ingest_ids,
+            max_concurrency=max_concurrency,
+            rate_limiter=RateLimiter.for_rate(max_requests_per_second),
+        )
 
 
 class RequestsStorageServiceClient(StorageServiceClientBase):
-    def __init__(self, api_url, sess):
+    def __init__(self, api_url, sess, manifest_cache=None, instrumentation=None):
         self.sess = sess
 
-        super(RequestsStorageServiceClient, self).__init__(api_url=api_url)
+        super(RequestsStorageServiceClient, self).__init__(
+            api_url=api_url,
+            manifest_cache=manifest_cache,
+            instrumentation=instrumentation,
+        )
 
     def _http_get(self, url):
-        resp = self.sess.get(url)
+        resp = record_request(
+            self.instrumentation,
+            "api",
+            lambda: self.sess.get(url),
+            size=lambda resp: len(resp.content),
+        )
         return (resp.status_code, resp.text)
 
     def _http_post(self, url, json):
-        resp = self.sess.post(url, json=json)
+        resp = record_request(
+            self.instrumentation,
+            "api",
+            lambda: self.sess.post(url, json=json),
+            size=lambda resp: len(resp.content),
+        )
         return (resp.status_code, resp.headers, resp.text)
 
+    def _http_get_stream(self, url):
+        start = time.time()
+        resp = self.sess.get(url, stream=True)
+
+        def _chunks():
+            decoder = codecs.getincrementaldecoder(resp.encoding or "utf8")()
+            size = 0
+            error = None
+
+            try:
+                with contextlib.closing(resp):
+                    for chunk in resp.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                        size += len(chunk)
+                        yield decoder.decode(chunk)
+                    yield decoder.decode(b"", final=True)
+            except Exception as err:
+                error = err
+                raise
+            finally:
+                # We record a streamed request once we've read the whole
+                # body, so the latency includes the time to download it.
+                if self.instrumentation is not None:
+                    self.instrumentation.on_request(
+                        "api",
+                        duration=time.time() - start,
+                        size=size,
+                        status_code=resp.status_code,
+                        error=error,
+                    )
+
+        return (resp.status_code, _chunks())
+
 
 def needs_token(f):
     @functools.wraps(f)
     def wrapper(self, *args, **kwargs):
-        if not self.sess.token:
-            self.sess.fetch_token(
-                token_url=self.token_url,
-                client_id=self.client_id,
-                client_secret=self.client_secret,
-            )
+        from oauthlib.oauth2.rfc6749.errors import TokenExpiredError
+
+        # We refresh the token shortly before it expires, so it doesn't
+        # expire while the request is in flight.
+        if not token_is_fresh(self.sess.token):
+            self._refresh_token(stale_token=self.sess.token)
 
-        # We refresh the token if we get a TokenExpiredError from the client.
+        # We also refresh the token if we get a TokenExpiredError from the
+        # client, e.g. if the clock has jumped.
         try:
             return f(self, *args, **kwargs)
         except TokenExpiredError:
-            self.sess.fetch_token(
-                token_url=self.token_url,
-                client_id=self.client_id,
-                client_secret=self.client_secret,
-            )
+            self._refresh_token(stale_token=self.sess.token, force=True)
             return f(self, *args, **kwargs)
 
     return wrapper
 
 
-DEFAULT_CREDENTIALS_PATH = os.path.join(
-    os.environ["HOME"], ".wellcome-storage", "oauth-credentials.json"
-)
+class RequestsOAuthStorageServiceClient(RequestsStorageServiceClient):
+    """
+    A client that authenticates with an OAuth client credentials grant.
 
+    :param token_store: An optional ``TokenStore``, which lets this client
+        share tokens with other clients -- or with other processes, if you
+        use a ``FileTokenStore``.  Only one of them fetches a new token when
+        the current one is about to expire.
+    """
 
-class RequestsOAuthStorageServiceClient(RequestsStorageServiceClient):
-    def __init__(self, api_url, client_id, client_secret, token_url):
+    def __init__(
+        self,
+        api_url,
+        client_id,
+        client_secret,
+        token_url,
+        manifest_cache=None,
+        token_store=None,
+        instrumentation=None,
+    ):
         self.api_url = api_url
         self.client_id = client_id
         self.client_secret = client_secret
         self.token_url = token_url
 
+        if token_store is None:
+            token_store = MemoryTokenStore()
+        self.token_store = token_store
+        self._token_key = token_key(client_id=client_id, token_url=token_url)
+
+        # The OAuth libraries take longer to import than the rest of this
+        # package put together, so we only load them if we need them.
+        from oauthlib.oauth2 import BackendApplicationClient
+        from requests_oauthlib import OAuth2Session
+
         client = BackendApplicationClient(client_id=client_id)
         sess = OAuth2Session(client=client)
 
         super(RequestsOAuthStorageServiceClient, self).__init__(
-            api_url=api_url, sess=sess
+            api_url=api_url,
+            sess=sess,
+            manifest_cache=manifest_cache,
+            instrumentation=instrumentation,
         )
 
     @classmethod
-    def from_path(self, api_url, credentials_path=DEFAULT_CREDENTIALS_PATH):
+    def from_path(
+        self,
+        api_url,
+        credentials_path=None,
+        manifest_cache=None,
+        token_store=None,
+        instrumentation=None,
+    ):
+        if credentials_path is None:
+            credentials_path = _default_credentials_path()
+
         oauth_creds = json.load(open(credentials_path))
-        return RequestsOAuthStorageServiceClient(api_url=api_url, **oauth_creds)
+        return RequestsOAuthStorageServiceClient(
+            api_url=api_url,
+            manifest_cache=manifest_cache,
+            token_store=token_store,
+            instrumentation=instrumentation,
+            **oauth_creds
+        )
+
+    def _refresh_token(self, stale_token, force=False):
+        """
+        Get a new token, unless somebody else has already got one while we
+        were waiting for the lock.
+
+        If ``force`` is True, we don't trust any token that has the same
+        access token as ``stale_token``, even if it hasn't expired.
+        """
+        stale_access_token = (stale_token or {}).get("access_token")
+
+        with self.token_store.lock(self._token_key):
+            token = self.token_store.get(self._token_key)
+
+            if token_is_fresh(token) and not (
+                force and token["access_token"] == stale_access_token
+            ):
+                self.sess.token = token
+                return
+
+            token = record_request(
+                self.instrumentation,
+                "token",
+                lambda: self.sess.fetch_token(
+                    token_url=self.token_url,
+                    client_id=self.client_id,
+                    client_secret=self.client_secret,
+                ),
+            )
+            self.sess.token = token
+            self.token_store.put(self._token_key, token)
 
     @needs_token
     def _http_get(self, url):
@@ -212,22 +831,32 @@ class RequestsOAuthStorageServiceClient(RequestsStorageServiceClient):
     def _http_post(self, url, json):
         return super(RequestsOAuthStorageServiceClient, self)._http_post(url, json)
 
+    @needs_token
+    def _http_get_stream(self, url):
+        return super(RequestsOAuthStorageServiceClient, self)._http_get_stream(url)
+
 
-def prod_client():
+def prod_client(manifest_cache=None, token_store=None, instrumentation=None):
     secrets = get_secrets()
     api_url = "https://api.wellcomecollection.org/storage/v1"
     return RequestsOAuthStorageServiceClient(
         api_url=api_url,
         token_url="https://auth.wellcomecollection.org/oauth2/token",
+        manifest_cache=manifest_cache,
+        token_store=token_store,
+        instrumentation=instrumentation,
         **secrets
     )
 
 
-def staging_client():
+def staging_client(manifest_cache=None, token_store=None, instrumentation=None):
     secrets = get_secrets()
     api_url = "https://api-stage.wellcomecollection.org/storage/v1"
     return RequestsOAuthStorageServiceClient(
         api_url=api_url,
         token_url="https://auth.wellcomecollection.org/oauth2/token",
+        manifest_cache=manifest_cache,
+        token_store=token_store,
+        instrumentation=instrumentation,
         **secrets
     )
@@ -0,0 +1,114 @@
+"""
+Building requests to, and interpreting responses from, the storage service
+APIs.  These are shared by the blocking and asyncio clients, which only
+differ in how they make HTTP requests.
+"""
+
+import json
+
+from .exceptions import BagNotFound, IngestNotFound, ServerError, UserError
+
+
+# Responses with these status codes are worth retrying: the API is either
+# rate limiting us, or has had a (hopefully) temporary problem.
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def _user_error(status_code, body):
+    try:
+        error = json.loads(body)
+        return UserError("%s: %s" % (error["label"], error["description"]))
+    except (ValueError, KeyError, TypeError):
+        # e.g. a 429 from the load balancer, which doesn't have the error
+        # body that the storage service APIs return.
+        return UserError("Storage service returned %d: %s" % (status_code, body))
+
+
+def ingest_url(api_url, ingest_id):
+    return "%s/ingests/%s" % (api_url, ingest_id)
+
+
+def parse_ingest_response(ingest_url, status_code, body):
+    if status_code == 404:
+        raise IngestNotFound("Ingests API returned 404 for %s" % ingest_url)
+    elif 400 <= status_code < 500:
+        raise _user_error(status_code, body)
+    elif status_code != 200:
+        raise ServerError()
+    else:
+        return json.loads(body)
+
+
+def bag_url(api_url, space, external_identifier, version):
+    bags_url_suffix = "%s/%s" % (space, external_identifier)
+    if version:
+        bags_url_suffix += "?version=%s" % version
+
+    return "%s/bags/%s" % (api_url, bags_url_suffix)
+
+
+def parse_bag_response(space, external_identifier, version, status_code, body):
+    if status_code == 404:
+        if version:
+            raise BagNotFound(
+                "Bags API returned 404 for bag %s/%s with version %s"
+                % (space, external_identifier, version)
+            )
+        else:
+            raise BagNotFound(
+                "Bags API returned 404 for bag %s/%s" % (space, external_identifier)
+            )
+    elif 400 <= status_code < 500:
+        raise _user_error(status_code, body)
+    elif status_code >= 500:
+        raise ServerError()
+    else:
+        return json.loads(body)
+
+
+def bag_lookup(bag):
+    """
+    Returns a (space, external_identifier, version) tuple for a bag passed
+    to ``get_bags_many()``, where the version is optional.
+    """
+    if len(bag) == 2:
+        space, external_identifier = bag
+        return space, external_identifier, None
+    else:
+        space, external_identifier, version = bag
+        return space, external_identifier, version
+
+
+def s3_ingest_payload(
+    space, external_identifier, s3_bucket, s3_key, callback_url, ingest_type
+):
+    payload = {
+        "type": "Ingest",
+        "ingestType": {"id": ingest_type, "type": "IngestType"},
+        "space": {"id": space, "type": "Space"},
+        "sourceLocation": {
+            "type": "Location",
+            "provider": {"type": "Provider", "id": "amazon-s3"},
+            "bucket": s3_bucket,
+            "path": s3_key,
+        },
+        "bag": {
+            "type": "Bag",
+            "info": {"type": "BagInfo", "externalIdentifier": external_identifier},
+        },
+    }
+
+    if callback_url is not None:
+        payload["callback"] = {"type": "Callback", "url": callback_url}
+
+    return payload
+
+
+def parse_create_ingest_response(status_code, headers, body):
+    if 400 <= status_code < 500:
+        raise _user_error(status_code, body)
+    elif status_code == 201:
+        return headers["Location"]
+    # This branch is untested because it needs a reliable way to trigger
+    else:  # pragma: no cover
+        raise ServerError()
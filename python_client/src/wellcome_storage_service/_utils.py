@@ -1,5 +1,13 @@
+import calendar
+import collections
+import concurrent.futures
+import datetime
 import errno
+import itertools
 import os
+import random
+import threading
+import time
 
 
 def mkdir_p(path):
@@ -18,3 +26,194 @@ def mkdir_p(path):
             pass
         else:
             raise
+
+
+def remove_if_exists(path):
+    """
+    Delete a file, if it exists.
+    """
+    try:
+        os.unlink(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+def default_path(*parts):
+    """
+    Returns a path inside ``~/.wellcome-storage``, where the client keeps
+    its credentials and caches by default.
+
+    This is worked out when it's needed, not when the package is imported,
+    and it doesn't need ``$HOME`` to be set (which it isn't in AWS Lambda).
+    """
+    return os.path.join(os.path.expanduser("~"), ".wellcome-storage", *parts)
+
+
+def hashlib_name(checksum_algorithm):
+    """
+    Returns the name hashlib uses for a checksum algorithm as written by the
+    storage service, e.g. ``SHA-256`` becomes ``sha256``.
+    """
+    return checksum_algorithm.replace("-", "").lower()
+
+
+def parse_timestamp(date_string):
+    """
+    Returns a date from the storage service (e.g. ``2019-09-12T20:26:53.094Z``)
+    as a Unix timestamp, or None if it can't be parsed.
+    """
+    for date_format in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+        try:
+            parsed = datetime.datetime.strptime(date_string, date_format)
+        except (TypeError, ValueError):
+            continue
+        return calendar.timegm(parsed.utctimetuple()) + parsed.microsecond / 1e6
+
+    return None
+
+
+def concurrently(handler, inputs, max_concurrency=5):
+    """
+    Calls the function ``handler`` on the values ``inputs``.
+
+    ``handler`` should be a function that takes a single input, which is the
+    individual values in the iterable ``inputs``.
+
+    Generates (input, output) tuples as the calls to ``handler`` complete.
+    At most ``max_concurrency`` calls are in flight at once, and ``inputs``
+    is consumed lazily, so this can be used on very large iterables without
+    queueing them all in memory.
+
+    Based on the helper of the same name in the storage-service scripts; see
+    https://alexwlchan.net/2019/10/adventures-with-concurrent-futures/ for an
+    explanation of how this function works.
+    """
+    # Make sure we get a consistent iterator throughout, rather than
+    # getting the first element repeatedly.
+    handler_inputs = iter(inputs)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = {
+            executor.submit(handler, input): input
+            for input in itertools.islice(handler_inputs, max_concurrency)
+        }
+
+        while futures:
+            done, _ = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+
+            for fut in done:
+                original_input = futures.pop(fut)
+                yield original_input, fut.result()
+
+            for input in itertools.islice(handler_inputs, len(done)):
+                fut = executor.submit(handler, input)
+                futures[fut] = input
+
+
+def backoff_delay(attempt, base=0.5, cap=30):
+    """
+    Returns how long to wait (in seconds) before retrying a request that's
+    already failed ``attempt + 1`` times.
+
+    This is exponential backoff with "full jitter", so lots of clients that
+    failed at the same time don't all retry at the same time.  See
+    https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls to ``wait()`` so there are at most ``max_per_second``
+    of them every second, across all the threads that share this object.
+    """
+
+    def __init__(self, max_per_second):
+        self.interval = 1.0 / max_per_second
+        self._lock = threading.Lock()
+        self._next_time = 0
+
+    @classmethod
+    def for_rate(cls, max_per_second):
+        """
+        Returns a ``RateLimiter``, or None if ``max_per_second`` is None.
+        """
+        if max_per_second is None:
+            return None
+        else:
+            return cls(max_per_second)
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            wait_until = max(now, self._next_time)
+            self._next_time = wait_until + self.interval
+
+        if wait_until > now:
+            time.sleep(wait_until - now)
+
+
+class LatencyTracker(object):
+    """
+    Keeps the most recent ``window`` latencies, so we can look up
+    percentiles of recent requests.
+    """
+
+    def __init__(self, window=1000, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p):
+        """
+        Returns the ``p``-th percentile of recent latencies, or None if we
+        haven't seen enough requests to say.
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+
+        if len(samples) < self.min_samples:
+            return None
+
+        index = int(round(p / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+
+class RequestBudget(object):
+    """
+    Allows at most ``ratio`` extra requests for every request we make,
+    e.g. to cap how many hedged or retried requests we send.
+
+    Every call to ``record_request()`` earns a fraction of an extra request,
+    up to a maximum of ``burst`` saved up at once.
+    """
+
+    def __init__(self, ratio, burst=10):
+        self.ratio = ratio
+        self.burst = burst
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.ratio)
+
+    def try_spend(self):
+        """
+        Returns True if we can make an extra request, False otherwise.
+        """
+        with self._lock:
+            # Allow for rounding errors, e.g. ten lots of 0.1 adding up
+            # to 0.9999999999999999.
+            if self._tokens >= 1 - 1e-9:
+                self._tokens -= 1
+                return True
+            else:
+                return False
@@ -0,0 +1,324 @@
+"""
+An asyncio client for the Wellcome Storage Service API.
+
+This has the same methods as ``StorageServiceClientBase``, but they're
+coroutines, so you can make hundreds of API calls concurrently from a
+single process:
+
+    async with AiohttpOAuthStorageServiceClient(...) as client:
+        bags = await asyncio.gather(
+            *(client.get_bag("digitised", b_number) for b_number in b_numbers)
+        )
+
+This module needs Python 3 and the ``async`` extra (which installs aiohttp).
+"""
+
+import asyncio
+import base64
+import json
+import time
+
+from . import _api
+from .tokens import MemoryTokenStore, token_is_fresh, token_key
+
+# The maximum number of connections the client will open at once.
+DEFAULT_MAX_CONNECTIONS = 100
+
+
+class AsyncStorageServiceClientBase(object):
+    """
+    Asyncio client for the Wellcome Storage Service API.
+
+    Subclasses should implement ``_http_get`` and ``_http_post``.
+    """
+
+    def __init__(self, api_url):
+        self.api_url = api_url
+
+    async def _http_get(self, url):  # pragma: no cover
+        """
+        Make a GET request to the URL.  Returns a status code and a body.
+        """
+        raise NotImplementedError
+
+    async def _http_post(self, url, json):  # pragma: no cover
+        """
+        Make a POST request with a given JSON body.
+
+        Returns a status code, headers and a body.
+        """
+        raise NotImplementedError
+
+    async def get_ingest_from_location(self, ingest_url):
+        """
+        Returns the state of an ingest.
+        """
+        status_code, body = await self._http_get(ingest_url)
+
+        return _api.parse_ingest_response(
+            ingest_url=ingest_url, status_code=status_code, body=body
+        )
+
+    async def get_ingest(self, ingest_id):
+        """
+        Returns the state of an ingest.
+        """
+        return await self.get_ingest_from_location(
+            ingest_url=_api.ingest_url(self.api_url, ingest_id)
+        )
+
+    async def get_bag(self, space, external_identifier, version=None):
+        """
+        Returns the contents of a bag.
+        """
+        bags_url = _api.bag_url(self.api_url, space, external_identifier, version)
+
+        status_code, body = await self._http_get(bags_url)
+
+        return _api.parse_bag_response(
+            space=space,
+            external_identifier=external_identifier,
+            version=version,
+            status_code=status_code,
+            body=body,
+        )
+
+    async def create_s3_ingest(
+        self,
+        space,
+        external_identifier,
+        s3_bucket,
+        s3_key,
+        callback_url=None,
+        ingest_type="create",
+    ):
+        """
+        Create an ingest from an object in an S3 bucket.
+
+        Returns the location of the new ingest if created, or raises an exception
+        if not.
+        """
+        payload = _api.s3_ingest_payload(
+            space=space,
+            external_identifier=external_identifier,
+            s3_bucket=s3_bucket,
+            s3_key=s3_key,
+            callback_url=callback_url,
+            ingest_type=ingest_type,
+        )
+
+        status_code, headers, body = await self._http_post(
+            url=self.api_url + "/ingests", json=payload
+        )
+
+        return _api.parse_create_ingest_response(
+            status_code=status_code, headers=headers, body=body
+        )
+
+
+class AiohttpStorageServiceClient(AsyncStorageServiceClientBase):
+    """
+    An asyncio client that makes requests with aiohttp.
+
+    All requests share a single pool of at most ``max_connections``
+    connections, so you can start as many concurrent calls as you like
+    without overwhelming the API.
+
+    :param sess: An existing ``aiohttp.ClientSession``.  If not supplied,
+        the client creates its own, which is closed by ``close()``.
+    """
+
+    def __init__(self, api_url, sess=None, max_connections=DEFAULT_MAX_CONNECTIONS):
+        self.sess = sess
+        self.max_connections = max_connections
+        self._owns_sess = sess is None
+
+        super(AiohttpStorageServiceClient, self).__init__(api_url=api_url)
+
+    def _get_sess(self):
+        # The session has to be created inside a running event loop, so we
+        # create it on first use rather than in the constructor.
+        if self.sess is None:
+            import aiohttp
+
+            self.sess = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections)
+            )
+
+        return self.sess
+
+    def _headers(self):
+        return {}
+
+    async def _http_get(self, url):
+        async with self._get_sess().get(url, headers=self._headers()) as resp:
+            return (resp.status, await resp.text())
+
+    async def _http_post(self, url, json):
+        async with self._get_sess().post(
+            url, json=json, headers=self._headers()
+        ) as resp:
+            return (resp.status, resp.headers, await resp.text())
+
+    async def close(self):
+        if self._owns_sess and self.sess is not None:
+            await self.sess.close()
+            self.sess = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+async def _acquire_in_thread(lock):
+    """
+    Enters the blocking context manager ``lock`` on a thread, so waiting
+    for it (e.g. while another process refreshes a token) doesn't block
+    the event loop.
+
+    If we're cancelled while we wait, the thread carries on waiting, so
+    we release the lock as soon as the thread gets it.
+    """
+    acquire = asyncio.get_running_loop().run_in_executor(None, lock.__enter__)
+
+    try:
+        await asyncio.shield(acquire)
+    except asyncio.CancelledError:
+
+        def _release(fut):
+            if not fut.cancelled() and fut.exception() is None:
+                lock.__exit__(None, None, None)
+
+        acquire.add_done_callback(_release)
+        raise
+
+
+class AiohttpOAuthStorageServiceClient(AiohttpStorageServiceClient):
+    """
+    An asyncio client that authenticates with an OAuth client credentials
+    grant, like ``RequestsOAuthStorageServiceClient``.
+
+    The token is shared by every request, and refreshed shortly before it
+    expires.  Only one refresh happens at a time, however many requests are
+    waiting for it.  If the API rejects the token anyway, it's refreshed and
+    the request is retried once.
+
+    :param token_store: An optional ``TokenStore``, which lets this client
+        share tokens with other clients (including blocking clients), or with
+        other processes if you use a ``FileTokenStore``.
+    """
+
+    def __init__(
+        self,
+        api_url,
+        client_id,
+        client_secret,
+        token_url,
+        sess=None,
+        max_connections=DEFAULT_MAX_CONNECTIONS,
+        token_store=None,
+    ):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_url = token_url
+
+        if token_store is None:
+            token_store = MemoryTokenStore()
+        self.token_store = token_store
+        self._token_key = token_key(client_id=client_id, token_url=token_url)
+
+        self.token = None
+        self._token_lock = None
+
+        super(AiohttpOAuthStorageServiceClient, self).__init__(
+            api_url=api_url, sess=sess, max_connections=max_connections
+        )
+
+    @classmethod
+    def from_path(cls, api_url, credentials_path=None, token_store=None):
+        from . import _default_credentials_path
+
+        with open(credentials_path or _default_credentials_path()) as infile:
+            oauth_creds = json.load(infile)
+
+        return cls(api_url=api_url, token_store=token_store, **oauth_creds)
+
+    def _token_needs_refresh(self):
+        return not token_is_fresh(self.token)
+
+    async def _request_token(self):
+        credentials = base64.b64encode(
+            ("%s:%s" % (self.client_id, self.client_secret)).encode("utf8")
+        )
+
+        async with self._get_sess().post(
+            self.token_url,
+            data={"grant_type": "client_credentials"},
+            headers={"Authorization": "Basic %s" % credentials.decode("ascii")},
+        ) as resp:
+            resp.raise_for_status()
+            token = await resp.json(content_type=None)
+
+        # If the server doesn't say when the token expires, we leave out
+        # ``expires_at`` and treat it as fresh until it's rejected, the same
+        # as the blocking client.
+        if token.get("expires_in") is not None:
+            token["expires_at"] = time.time() + token["expires_in"]
+
+        return token
+
+    async def _fetch_token(self, stale_token=None):
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+
+        async with self._token_lock:
+            # Another task may have refreshed the token while we were waiting
+            # for the lock, in which case we can use that.
+            if self.token is not stale_token and not self._token_needs_refresh():
+                return
+
+            stale_access_token = (stale_token or {}).get("access_token")
+
+            store_lock = self.token_store.lock(self._token_key)
+            await _acquire_in_thread(store_lock)
+
+            try:
+                token = self.token_store.get(self._token_key)
+
+                if not token_is_fresh(token) or (
+                    token["access_token"] == stale_access_token
+                ):
+                    token = await self._request_token()
+                    self.token_store.put(self._token_key, token)
+
+                self.token = token
+            finally:
+                store_lock.__exit__(None, None, None)
+
+    def _headers(self):
+        return {"Authorization": "Bearer %s" % self.token["access_token"]}
+
+    async def _with_token(self, make_request):
+        if self._token_needs_refresh():
+            await self._fetch_token(stale_token=self.token)
+
+        token = self.token
+        response = await make_request()
+
+        # A 401 means the API didn't accept our token -- for example, if it
+        # was revoked early -- so get a new one and try again.
+        if response[0] == 401:
+            await self._fetch_token(stale_token=token)
+            response = await make_request()
+
+        return response
+
+    async def _http_get(self, url):
+        parent = super(AiohttpOAuthStorageServiceClient, self)
+        return await self._with_token(lambda: parent._http_get(url))
+
+    async def _http_post(self, url, json):
+        parent = super(AiohttpOAuthStorageServiceClient, self)
+        return await self._with_token(lambda: parent._http_post(url, json))
@@ -0,0 +1,296 @@
+"""
+Build a BagIt bag from a directory of files, ready to be uploaded and
+ingested into the storage service.
+
+Checksumming the payload is usually the slow part of building a bag, so
+files are hashed on a pool of processes, with every checksum algorithm
+computed in the same pass over the file.  For a big bag on fast storage,
+this means building the bag is limited by how fast we can read the disk,
+not by a single CPU core.
+"""
+
+import collections
+import concurrent.futures
+import datetime
+import hashlib
+import io
+import multiprocessing
+import os
+import re
+
+from ._utils import hashlib_name
+from .version import __version__
+
+
+DEFAULT_ALGORITHMS = ("sha256",)
+
+# How much of a file to read at once when hashing it.  Big reads keep
+# the number of system calls (and trips through the interpreter) down.
+DEFAULT_READ_SIZE = 8 * 1024 * 1024
+
+BAGIT_VERSION = "0.97"
+
+BAG_SOFTWARE_AGENT = (
+    "wellcome_storage_service v%s "
+    "<https://github.com/wellcomecollection/storage-service>" % __version__
+)
+
+
+class FetchEntry(
+    collections.namedtuple("FetchEntry", ["url", "size", "name", "checksums"])
+):
+    """
+    A file that's part of the bag, but is fetched from somewhere else
+    rather than included in the bag directory, e.g. a file from an earlier
+    version of the bag that's already in the storage service.
+
+    ``name`` is its path in the bag (e.g. ``"data/b12345.xml"``), and
+    ``checksums`` is a dict of algorithm to checksum, with an entry for
+    every algorithm the bag uses.
+    """
+
+
+def hash_file(path, algorithms=DEFAULT_ALGORITHMS, read_size=DEFAULT_READ_SIZE):
+    """
+    Returns a dict of algorithm to hex checksum for the file at ``path``,
+    computing all of them in one pass over the file.
+    """
+    hashers = [(algorithm, hashlib.new(algorithm)) for algorithm in algorithms]
+    buf = bytearray(read_size)
+    view = memoryview(buf)
+
+    with io.open(path, "rb", buffering=0) as infile:
+        while True:
+            bytes_read = infile.readinto(buf)
+            if not bytes_read:
+                break
+
+            for _, hasher in hashers:
+                hasher.update(view[:bytes_read])
+
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers}
+
+
+def _hash_file_with_size(args):
+    path, algorithms, read_size = args
+    return os.path.getsize(path), hash_file(path, algorithms, read_size)
+
+
+def _payload_files(bag_dir):
+    """
+    Generates the name of every file in the payload, relative to
+    ``bag_dir``, using forward slashes.
+    """
+    data_dir = os.path.join(bag_dir, "data")
+
+    for dirpath, dirnames, filenames in os.walk(data_dir):
+        dirnames.sort()
+
+        for filename in sorted(filenames):
+            path = os.path.relpath(os.path.join(dirpath, filename), bag_dir)
+            yield path.replace(os.sep, "/")
+
+
+def _encode_path(name):
+    # The BagIt spec says line breaks and percent signs in file paths
+    # have to be percent-encoded in manifests and fetch.txt.
+    return name.replace("%", "%25").replace("\n", "%0A").replace("\r", "%0D")
+
+
+def _write_lines(path, lines):
+    with io.open(path, "w", encoding="utf8", newline="\n") as outfile:
+        for line in lines:
+            outfile.write(line + u"\n")
+
+
+def _hash_payload(bag_dir, names, algorithms, processes, read_size):
+    """
+    Generates (name, size, checksums) for every file in ``names``.
+    """
+    args = [(os.path.join(bag_dir, name), algorithms, read_size) for name in names]
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    if processes == 1:
+        results = (_hash_file_with_size(arg) for arg in args)
+        for name, (size, checksums) in zip(names, results):
+            yield name, size, checksums
+        return
+
+    # Small files are sent to the workers in batches, so we don't spend
+    # longer passing messages than hashing.
+    chunksize = max(1, min(64, len(args) // (4 * processes)))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        for name, (size, checksums) in zip(
+            names, executor.map(_hash_file_with_size, args, chunksize=chunksize)
+        ):
+            yield name, size, checksums
+
+
+def _remove_old_manifests(bag_dir, algorithms):
+    """
+    Remove any manifests for algorithms we're not using, e.g. if the bag
+    was previously built with a different set of algorithms.
+    """
+    for name in os.listdir(bag_dir):
+        match = re.match(r"^(?:tag)?manifest-(.+)\.txt$", name)
+        if match is not None and match.group(1) not in algorithms:
+            os.unlink(os.path.join(bag_dir, name))
+
+
+def _fetch_checksums(entry, algorithms):
+    checksums = {
+        hashlib_name(algorithm): checksum
+        for algorithm, checksum in entry.checksums.items()
+    }
+
+    missing = set(algorithms) - set(checksums)
+    if missing:
+        raise ValueError(
+            "No %s checksum for %s" % (", ".join(sorted(missing)), entry.name)
+        )
+
+    return checksums
+
+
+def _write_manifests(bag_dir, prefix, algorithms, checksums):
+    """
+    Write a manifest for each algorithm, listing the files in ``checksums``
+    (a dict of name to dict of checksums).
+    """
+    for algorithm in algorithms:
+        _write_lines(
+            os.path.join(bag_dir, "%s-%s.txt" % (prefix, algorithm)),
+            [
+                "%s  %s" % (file_checksums[algorithm], _encode_path(name))
+                for name, file_checksums in sorted(checksums.items())
+            ],
+        )
+
+
+def _write_bag_info(bag_dir, bag_info, payload_oxum):
+    info = collections.OrderedDict(
+        [
+            ("Bag-Software-Agent", BAG_SOFTWARE_AGENT),
+            ("Bagging-Date", datetime.date.today().isoformat()),
+        ]
+    )
+    info.update(bag_info or {})
+    info["Payload-Oxum"] = payload_oxum
+
+    lines = []
+    for key, value in info.items():
+        for v in value if isinstance(value, (list, tuple)) else [value]:
+            lines.append("%s: %s" % (key, v))
+
+    _write_lines(os.path.join(bag_dir, "bag-info.txt"), lines)
+
+
+def _write_fetch_file(bag_dir, fetch_entries):
+    """
+    Write ``fetch.txt``, or remove it if there's nothing to fetch.
+    Returns True if the bag has a ``fetch.txt``.
+    """
+    fetch_path = os.path.join(bag_dir, "fetch.txt")
+
+    if fetch_entries:
+        _write_lines(
+            fetch_path,
+            [
+                "%s\t%d\t%s" % (entry.url, entry.size, _encode_path(entry.name))
+                for entry in fetch_entries
+            ],
+        )
+        return True
+    else:
+        if os.path.exists(fetch_path):
+            os.unlink(fetch_path)
+        return False
+
+
+def build_bag(
+    bag_dir,
+    bag_info=None,
+    algorithms=DEFAULT_ALGORITHMS,
+    fetch_entries=(),
+    processes=None,
+    read_size=DEFAULT_READ_SIZE,
+):
+    """
+    Turn ``bag_dir`` into a BagIt bag, by writing ``bagit.txt``,
+    ``bag-info.txt``, the payload and tag manifests, and ``fetch.txt``
+    (if there are any ``fetch_entries``).
+
+    The payload should already be in ``bag_dir/data``.  Any existing tag
+    files are overwritten.
+
+    :param bag_info: A dict of fields for ``bag-info.txt``, e.g.
+        ``{"External-Identifier": "b12345678"}``.  Use a list for a field
+        that appears more than once.  ``Bagging-Date``, ``Payload-Oxum``
+        and ``Bag-Software-Agent`` are filled in for you.
+    :param algorithms: The checksum algorithms to use, e.g.
+        ``("sha256", "sha512")``.  Every algorithm gets its own payload and
+        tag manifest; the files are only read once.
+    :param fetch_entries: ``FetchEntry`` objects for files that should be
+        listed in ``fetch.txt`` rather than included in the bag.
+    :param processes: How many processes to hash files with.  Defaults to
+        the number of CPUs; use 1 to hash files in this process.
+    :param read_size: How much of a file to read at once when hashing it.
+
+    Returns a dict mapping the name of every file in the payload (including
+    fetched files) to a dict of its checksums.
+
+    """
+    algorithms = [hashlib_name(algorithm) for algorithm in algorithms]
+
+    data_dir = os.path.join(bag_dir, "data")
+    if not os.path.isdir(data_dir):
+        raise ValueError("No payload directory at %s" % data_dir)
+
+    names = list(_payload_files(bag_dir))
+
+    checksums = {}
+    total_size = 0
+
+    for name, size, file_checksums in _hash_payload(
+        bag_dir, names, algorithms, processes=processes, read_size=read_size
+    ):
+        checksums[name] = file_checksums
+        total_size += size
+
+    for entry in fetch_entries:
+        if entry.name in checksums:
+            raise ValueError("%s is in the bag and in fetch.txt" % entry.name)
+
+        checksums[entry.name] = _fetch_checksums(entry, algorithms)
+        total_size += entry.size
+
+    _remove_old_manifests(bag_dir, algorithms)
+    _write_manifests(bag_dir, "manifest", algorithms, checksums)
+
+    _write_lines(
+        os.path.join(bag_dir, "bagit.txt"),
+        ["BagIt-Version: %s" % BAGIT_VERSION, "Tag-File-Character-Encoding: UTF-8"],
+    )
+
+    _write_bag_info(
+        bag_dir, bag_info, payload_oxum="%d.%d" % (total_size, len(checksums))
+    )
+
+    tag_files = ["bagit.txt", "bag-info.txt"] + [
+        "manifest-%s.txt" % algorithm for algorithm in algorithms
+    ]
+
+    if _write_fetch_file(bag_dir, fetch_entries):
+        tag_files.append("fetch.txt")
+
+    _write_manifests(
+        bag_dir,
+        "tagmanifest",
+        algorithms,
+        {name: hash_file(os.path.join(bag_dir, name), algorithms) for name in tag_files},
+    )
+
+    return checksums
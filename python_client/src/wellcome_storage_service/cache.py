@@ -0,0 +1,178 @@
+"""
+An on-disk cache of storage manifests, so scripts that look at the same
+bags again and again don't have to fetch them from the API every time.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from ._utils import default_path, mkdir_p, remove_if_exists
+
+
+def _default_cache_dir():
+    return default_path("manifest-cache")
+
+
+# The default directory for a ``ManifestCache``.  This is worked out when
+# it's used rather than when the module is imported, so importing doesn't
+# need $HOME (which isn't set in AWS Lambda).  Python 2 doesn't support a
+# module-level __getattr__, so there we work it out up front.
+if sys.version_info >= (3, 7):
+
+    def __getattr__(name):
+        if name == "DEFAULT_CACHE_DIR":
+            return _default_cache_dir()
+
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+else:  # pragma: no cover
+    DEFAULT_CACHE_DIR = _default_cache_dir()
+
+
+DEFAULT_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
+# How long to keep the response for the latest version of a bag.  Unlike
+# a specific version, this changes whenever somebody ingests a new version.
+DEFAULT_LATEST_TTL = 60
+
+
+class ManifestCache(object):
+    """
+    A size-bounded cache of storage manifests, stored as gzip-compressed
+    JSON files in ``directory`` (``~/.wellcome-storage/manifest-cache`` by
+    default).
+
+    A specific version of a bag never changes once it's been stored, so
+    versioned manifests are kept until they're evicted to make room.
+    Lookups for the latest version of a bag are only cached for
+    ``latest_ttl`` seconds -- but the manifest they return is also cached
+    under its version number, so a later lookup for that version is a hit.
+
+    When the cache grows beyond ``max_size`` bytes (compressed), the least
+    recently used manifests are deleted.  Several processes can share the
+    same directory.
+    """
+
+    def __init__(
+        self,
+        directory=None,
+        max_size=DEFAULT_MAX_SIZE,
+        latest_ttl=DEFAULT_LATEST_TTL,
+    ):
+        if directory is None:
+            directory = _default_cache_dir()
+
+        self.directory = directory
+        self.max_size = max_size
+        self.latest_ttl = latest_ttl
+
+        self._lock = threading.Lock()
+
+        mkdir_p(directory)
+
+    def _path(self, api_url, space, external_identifier, version):
+        key = json.dumps([api_url, space, external_identifier, version])
+        name = hashlib.sha256(key.encode("utf8")).hexdigest()
+
+        # Latest entries are kept apart, so eviction can't mistake a
+        # refresh of the last-used time for a fresh response.
+        if version is None:
+            return os.path.join(self.directory, "%s.latest.json.gz" % name)
+        else:
+            return os.path.join(self.directory, "%s.json.gz" % name)
+
+    def get(self, api_url, space, external_identifier, version=None):
+        """
+        Returns the body of a cached bags API response, or None if we don't
+        have it.
+        """
+        path = self._path(api_url, space, external_identifier, version)
+
+        try:
+            if version is None:
+                if time.time() - os.stat(path).st_mtime > self.latest_ttl:
+                    return None
+            else:
+                # Bump the modified time, which is what we use to decide
+                # which entries were least recently used.
+                os.utime(path, None)
+
+            with gzip.open(path, "rb") as infile:
+                return infile.read().decode("utf8")
+        except (IOError, OSError, EOFError):
+            # The entry doesn't exist, or it's been evicted or truncated
+            # by another process -- either way, it's a miss.
+            return None
+
+    def put(
+        self, api_url, space, external_identifier, version, body, resolved_version=None
+    ):
+        """
+        Store the body of a bags API response.
+
+        If this is the latest version (``version`` is None), pass the
+        version in the response as ``resolved_version``, and it's also
+        cached under that version.
+        """
+        self._write(self._path(api_url, space, external_identifier, version), body)
+
+        if version is None and resolved_version is not None:
+            self._write(
+                self._path(api_url, space, external_identifier, resolved_version),
+                body,
+            )
+
+        self._evict()
+
+    def _write(self, path, body):
+        # Write to a temporary file and rename it into place, so other
+        # readers never see a half-written entry.
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+
+        try:
+            with os.fdopen(fd, "wb") as raw_file:
+                with gzip.GzipFile(fileobj=raw_file, mode="wb") as outfile:
+                    outfile.write(body.encode("utf8"))
+            os.rename(tmp_path, path)
+        except Exception:
+            remove_if_exists(tmp_path)
+            raise
+
+    def _entries(self):
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json.gz"):
+                continue
+
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            yield stat.st_mtime, stat.st_size, path
+
+    def _evict(self):
+        with self._lock:
+            entries = sorted(self._entries())
+            total_size = sum(size for _, size, _ in entries)
+
+            for _, size, path in entries:
+                if total_size <= self.max_size:
+                    break
+
+                remove_if_exists(path)
+                total_size -= size
+
+    def clear(self):
+        """
+        Delete everything in the cache.
+        """
+        with self._lock:
+            for _, _, path in list(self._entries()):
+                remove_if_exists(path)
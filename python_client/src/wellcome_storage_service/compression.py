@@ -0,0 +1,199 @@
+"""
+Writers that compress a stream of bytes on the fly, optionally spreading
+the work across multiple threads.
+"""
+
+import collections
+import concurrent.futures
+import gzip
+import struct
+import sys
+import zlib
+
+
+# How much uncompressed data goes into each independently-compressed block
+# when compressing with multiple threads.  This is the same as pigz's
+# default block size.
+DEFAULT_BLOCK_SIZE = 128 * 1024
+
+DEFAULT_GZIP_LEVEL = 6
+
+# Each block is compressed with the end of the previous block as a preset
+# dictionary, so matches can still reach back across a block boundary.
+# Python 2 doesn't support preset dictionaries, so its blocks compress
+# slightly worse.
+_DICTIONARY_SIZE = 32 * 1024
+_SUPPORTS_ZDICT = sys.version_info >= (3, 3)
+
+# A gzip header with no file name and no modification time, so the output
+# only depends on the input.
+_GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+
+def _deflate_block(block, dictionary, compresslevel, is_last):
+    """
+    Compress ``block`` as raw deflate data.
+
+    Every block but the last ends with a sync flush, which finishes on a
+    byte boundary without marking the end of the stream, so the
+    compressed blocks can be concatenated into a single deflate stream.
+    """
+    args = [compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS]
+    if dictionary:
+        args.extend([zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary])
+
+    compressor = zlib.compressobj(*args)
+    return compressor.compress(block) + compressor.flush(
+        zlib.Z_FINISH if is_last else zlib.Z_SYNC_FLUSH
+    )
+
+
+class ParallelGzipWriter(object):
+    """
+    A writable binary file that gzip-compresses everything written to it,
+    in the style of pigz.
+
+    The input is split into blocks, which are compressed on a thread pool
+    (zlib releases the GIL, so this uses multiple cores) and written to
+    ``out_file`` in order.  The blocks are stitched together into a single
+    gzip member, so the output is an ordinary gzip file that any gzip
+    reader can unpack -- including readers that stop after the first
+    member, like the storage service's unpacker.
+
+    At most ``2 * threads`` blocks are held in memory at once.
+
+    Closing the writer doesn't close ``out_file``.
+    """
+
+    def __init__(
+        self,
+        out_file,
+        threads,
+        block_size=DEFAULT_BLOCK_SIZE,
+        compresslevel=DEFAULT_GZIP_LEVEL,
+    ):
+        self.out_file = out_file
+        self.block_size = block_size
+        self.compresslevel = compresslevel
+
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._max_pending = 2 * threads
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+        # The gzip trailer has the CRC-32 and length of the whole input,
+        # which we keep track of as blocks are submitted.
+        self._crc = 0
+        self._size = 0
+        self._dictionary = b""
+
+        self.out_file.write(_GZIP_HEADER)
+
+    def _submit(self, block, is_last=False):
+        self._pending.append(
+            self._executor.submit(
+                _deflate_block, block, self._dictionary, self.compresslevel, is_last
+            )
+        )
+
+        self._crc = zlib.crc32(block, self._crc)
+        self._size += len(block)
+        if _SUPPORTS_ZDICT:
+            self._dictionary = block[-_DICTIONARY_SIZE:]
+
+        while len(self._pending) > self._max_pending:
+            self.out_file.write(self._pending.popleft().result())
+
+    def write(self, data):
+        data = memoryview(data)
+        position = 0
+
+        # Top up a partly-filled block first...
+        if self._buffer:
+            position = min(self.block_size - len(self._buffer), len(data))
+            self._buffer.extend(data[:position].tobytes())
+
+            if len(self._buffer) < self.block_size:
+                return len(data)
+
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+
+        # ...then cut whole blocks straight out of ``data``, rather than
+        # copying them through the buffer.
+        while len(data) - position >= self.block_size:
+            self._submit(data[position:position + self.block_size].tobytes())
+            position += self.block_size
+
+        self._buffer.extend(data[position:].tobytes())
+        return len(data)
+
+    def close(self):
+        if self._executor is None:
+            return
+
+        # The last block ends the deflate stream, so there's always one,
+        # even if it's empty.
+        self._submit(bytes(self._buffer), is_last=True)
+        self._buffer = bytearray()
+
+        while self._pending:
+            self.out_file.write(self._pending.popleft().result())
+
+        self.out_file.write(
+            struct.pack("<II", self._crc & 0xFFFFFFFF, self._size & 0xFFFFFFFF)
+        )
+
+        self._executor.shutdown()
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _UncompressedWriter(object):
+    """
+    Passes writes straight through to the underlying file, but doesn't
+    close it, so it behaves the same as the compressing writers.
+    """
+
+    def __init__(self, out_file):
+        self.out_file = out_file
+
+    def write(self, data):
+        return self.out_file.write(data)
+
+    def close(self):
+        pass
+
+
+def open_compressed_writer(out_file, compression="gz", threads=1):
+    """
+    Returns a writable binary file that compresses everything written to it,
+    and writes the compressed bytes to ``out_file``.
+
+    :param compression: One of ``"gz"``, ``"zst"`` or None (no compression).
+        zstd compression needs the ``zstandard`` package.
+    :param threads: How many threads to use for compression.
+
+    Closing the returned writer finishes the compressed stream, but doesn't
+    close ``out_file``.
+    """
+    if compression is None:
+        return _UncompressedWriter(out_file)
+    elif compression == "gz" and threads == 1:
+        return gzip.GzipFile(
+            fileobj=out_file, mode="wb", compresslevel=DEFAULT_GZIP_LEVEL
+        )
+    elif compression == "gz":
+        return ParallelGzipWriter(out_file, threads=threads)
+    elif compression == "zst":
+        import zstandard
+
+        compressor = zstandard.ZstdCompressor(threads=threads if threads > 1 else 0)
+        return compressor.stream_writer(out_file, closefd=False)
+    else:
+        raise ValueError("Unsupported compression: %r" % compression)
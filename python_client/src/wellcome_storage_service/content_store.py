@@ -0,0 +1,230 @@
+"""
+A local, content-addressed store of files we've downloaded, so we only
+download each file once, however many bags and versions it appears in.
+"""
+
+import os
+import re
+import shutil
+import stat
+import sys
+import threading
+import uuid
+
+from ._utils import default_path, hashlib_name, mkdir_p, remove_if_exists
+
+
+def _default_store_dir():
+    return default_path("content-store")
+
+
+# Where a ``ContentStore`` keeps its files by default, looked up when it's
+# first used (on Python 2, when the module is imported).
+if sys.version_info >= (3, 7):
+
+    def __getattr__(name):
+        if name == "DEFAULT_STORE_DIR":
+            return _default_store_dir()
+
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+else:  # pragma: no cover
+    DEFAULT_STORE_DIR = _default_store_dir()
+
+
+DEFAULT_MAX_SIZE = 50 * 1024 * 1024 * 1024
+
+# When the store gets too big, we evict files until it's this fraction of
+# ``max_size``, so we aren't evicting something on every download.
+EVICTION_LOW_WATER_MARK = 0.9
+
+# The ioctl for copy-on-write cloning on Linux (btrfs, XFS, etc.).
+FICLONE = 0x40049409
+
+_HEX_RE = re.compile(r"^[0-9a-f]+$")
+
+
+def _reflink(src, dst):
+    import fcntl
+
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+
+def _link_or_copy(src, dst, hard_link=True):
+    """
+    Make ``dst`` a copy of ``src`` as cheaply as we can: a copy-on-write
+    clone if the filesystem supports it, then a hard link, then a full copy.
+
+    Pass ``hard_link=False`` if ``dst`` mustn't share an inode with ``src``.
+    """
+    try:
+        return _reflink(src, dst)
+    except (ImportError, IOError, OSError):
+        remove_if_exists(dst)
+
+    if hard_link:
+        try:
+            return os.link(src, dst)
+        except (AttributeError, OSError):
+            pass
+
+    shutil.copyfile(src, dst)
+
+
+class ContentStore(object):
+    """
+    A size-bounded store of files, keyed by their checksum, in ``directory``
+    (``~/.wellcome-storage/content-store`` by default).
+
+    The downloader adds every file it's verified to the store.  If it needs
+    a file whose checksum is already in the store, it links the file into
+    place rather than downloading it again.  Successive versions of a bag
+    share most of their files, so re-downloading a new version only fetches
+    the files that have changed.
+
+    Files are linked out of the store with a copy-on-write clone if the
+    filesystem supports it (e.g. btrfs or XFS), or a hard link if the store
+    is on the same filesystem as the download, or copied otherwise.  Adding
+    a file clones or copies it, but never hard links it.  Files in the store are
+    read-only, so a hard-linked download can't be edited in place and
+    corrupt the copy in the store.
+
+    When the store grows beyond ``max_size`` bytes, the least recently used
+    files are deleted.  Several processes can share the same directory.
+    """
+
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        if directory is None:
+            directory = _default_store_dir()
+
+        self.directory = directory
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        self._size = None
+
+        mkdir_p(directory)
+
+    def _path(self, checksum_algorithm, checksum):
+        checksum = checksum.lower()
+
+        # We use the checksum as a filename, so make sure it can't
+        # point anywhere outside the store.
+        if not _HEX_RE.match(checksum):
+            return None
+
+        return os.path.join(
+            self.directory, hashlib_name(checksum_algorithm), checksum[:2], checksum
+        )
+
+    def __contains__(self, key):
+        checksum_algorithm, checksum = key
+        path = self._path(checksum_algorithm, checksum)
+        return path is not None and os.path.exists(path)
+
+    def link(self, checksum_algorithm, checksum, out_path):
+        """
+        Put a copy of the file with this checksum at ``out_path``.
+
+        Returns True if the file was in the store, False otherwise.
+        """
+        path = self._path(checksum_algorithm, checksum)
+        if path is None or not os.path.exists(path):
+            return False
+
+        mkdir_p(os.path.dirname(out_path))
+        remove_if_exists(out_path)
+
+        try:
+            _link_or_copy(path, out_path)
+
+            # Bump the modified time, which is what we use to decide which
+            # files were least recently used.
+            os.utime(path, None)
+        except (IOError, OSError):
+            # The file isn't in the store, or it's been evicted by
+            # another process -- either way, it's a miss.
+            remove_if_exists(out_path)
+            return False
+
+        return True
+
+    def add(self, checksum_algorithm, checksum, src_path):
+        """
+        Add a file to the store.  The file should already have been checked
+        against ``checksum``.
+        """
+        path = self._path(checksum_algorithm, checksum)
+        if path is None or os.path.exists(path):
+            return
+
+        mkdir_p(os.path.dirname(path))
+
+        # Copy to a temporary file and rename it into place, so other
+        # readers never see a half-written file.  We don't hard link here:
+        # the file in the store is made read-only, and we mustn't change
+        # the permissions on the caller's file.
+        tmp_path = "%s.%s.tmp" % (path, uuid.uuid4().hex)
+
+        try:
+            _link_or_copy(src_path, tmp_path, hard_link=False)
+            os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.rename(tmp_path, path)
+        except Exception:
+            remove_if_exists(tmp_path)
+            raise
+
+        with self._lock:
+            if self._size is not None:
+                self._size += os.path.getsize(path)
+
+        self._evict()
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.directory):
+            for name in filenames:
+                if name.endswith(".tmp"):
+                    continue
+
+                path = os.path.join(dirpath, name)
+                try:
+                    stat_result = os.stat(path)
+                except OSError:
+                    continue
+
+                yield stat_result.st_mtime, stat_result.st_size, path
+
+    def _evict(self):
+        with self._lock:
+            if self._size is not None and self._size <= self.max_size:
+                return
+
+            entries = sorted(self._entries())
+            total_size = sum(size for _, size, _ in entries)
+
+            if total_size > self.max_size:
+                for _, size, path in entries:
+                    if total_size <= self.max_size * EVICTION_LOW_WATER_MARK:
+                        break
+
+                    remove_if_exists(path)
+                    total_size -= size
+
+            self._size = total_size
+
+    @property
+    def size(self):
+        """
+        The total size of the files in the store, in bytes.
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    def clear(self):
+        """
+        Delete everything in the store.
+        """
+        with self._lock:
+            for _, _, path in list(self._entries()):
+                remove_if_exists(path)
+            self._size = 0
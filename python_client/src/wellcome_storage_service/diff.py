@@ -0,0 +1,187 @@
+"""
+Work out what's changed between two versions of a bag.
+"""
+
+import collections
+
+from .manifest import StorageManifest
+
+
+ADDED = "added"
+REMOVED = "removed"
+MODIFIED = "modified"
+MOVED = "moved"
+
+
+class FileChange(
+    collections.namedtuple("FileChange", ["change", "name", "old", "new"])
+):
+    """
+    A file that's different between two versions of a bag.
+
+    ``change`` is one of ``"added"``, ``"removed"``, ``"modified"`` (same
+    name, different checksum) or ``"moved"`` (same checksum, different name).
+    ``old`` and ``new`` are the ``ManifestFile`` in each version, or None
+    if the file isn't in that version.
+    """
+
+
+def _as_storage_manifest(bag):
+    if isinstance(bag, StorageManifest):
+        return bag
+    else:
+        return StorageManifest.from_bag(bag)
+
+
+def _check_algorithms_match(old_table, new_table):
+    old_algorithm = old_table.checksum_algorithm
+    new_algorithm = new_table.checksum_algorithm
+
+    if old_algorithm is None or new_algorithm is None:
+        return
+
+    if old_algorithm != new_algorithm:
+        raise ValueError(
+            "Can't compare manifests with different checksum algorithms: %s, %s"
+            % (old_algorithm, new_algorithm)
+        )
+
+
+def _table_changes(old_table, new_table):
+    _check_algorithms_match(old_table, new_table)
+
+    # Report any duplicate names before we start
+    old_table.index()
+    new_table.index()
+
+    # We join the tables on the raw names and checksums, and only build
+    # a ManifestFile for files that have changed -- most files in a new
+    # version of a bag are usually the same as the last one.
+    old_entries = list(old_table.iter_raw())
+    old_indexes = {name: i for i, (name, _) in enumerate(old_entries)}
+
+    new_names = set()
+
+    # Files that are only in the new version, keyed by checksum, so we can
+    # match them to removed files with the same contents.
+    only_in_new = collections.OrderedDict()
+
+    for new_index, (name, new_checksum) in enumerate(new_table.iter_raw()):
+        new_names.add(name)
+        old_index = old_indexes.get(name)
+
+        if old_index is None:
+            only_in_new.setdefault(new_checksum, collections.deque()).append(
+                new_index
+            )
+        elif old_entries[old_index][1] != new_checksum:
+            new_file = new_table.file_at(new_index)
+            yield FileChange(
+                MODIFIED, new_file.name, old_table.file_at(old_index), new_file
+            )
+
+    del old_indexes
+
+    for old_index, (name, old_checksum) in enumerate(old_entries):
+        if name in new_names:
+            continue
+
+        old_file = old_table.file_at(old_index)
+        candidates = only_in_new.get(old_checksum)
+        if candidates:
+            new_file = new_table.file_at(candidates.popleft())
+            yield FileChange(MOVED, new_file.name, old_file, new_file)
+        else:
+            yield FileChange(REMOVED, old_file.name, old_file, None)
+
+    for new_indexes in only_in_new.values():
+        for new_index in new_indexes:
+            new_file = new_table.file_at(new_index)
+            yield FileChange(ADDED, new_file.name, None, new_file)
+
+
+def iter_manifest_changes(old, new):
+    """
+    Generates a ``FileChange`` for every file that's different between two
+    versions of a bag.  Unchanged files are skipped.
+
+    ``old`` and ``new`` can be responses from ``get_bag()`` or
+    ``StorageManifest`` instances.  Files are matched by name with a hash
+    join, so this takes time proportional to the number of files.  Modified
+    files come out as soon as they're found; moves can only be matched once
+    we've seen every file, so they come out with removed and added files
+    at the end.
+    """
+    old = _as_storage_manifest(old)
+    new = _as_storage_manifest(new)
+
+    for old_table, new_table in [
+        (old.manifest, new.manifest),
+        (old.tag_manifest, new.tag_manifest),
+    ]:
+        for change in _table_changes(old_table, new_table):
+            yield change
+
+
+class ManifestDiff(object):
+    """
+    The differences between two versions of a bag, grouped by type of change.
+    """
+
+    def __init__(self, changes):
+        self.added = []
+        self.removed = []
+        self.modified = []
+        self.moved = []
+
+        for change in changes:
+            getattr(self, change.change).append(change)
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.modified or self.moved)
+
+    __nonzero__ = __bool__
+
+    @property
+    def bytes_added(self):
+        return sum(c.new.size for c in self.added)
+
+    @property
+    def bytes_removed(self):
+        return sum(c.old.size for c in self.removed)
+
+    @property
+    def bytes_modified(self):
+        """
+        The size of the new versions of every modified file.
+        """
+        return sum(c.new.size for c in self.modified)
+
+    @property
+    def bytes_moved(self):
+        return sum(c.new.size for c in self.moved)
+
+    @property
+    def size_change(self):
+        """
+        How much bigger (or, if negative, smaller) the new version is.
+        """
+        size_change = self.bytes_added - self.bytes_removed
+        size_change += sum(c.new.size - c.old.size for c in self.modified)
+        return size_change
+
+    def __repr__(self):
+        return "<ManifestDiff added=%d removed=%d modified=%d moved=%d>" % (
+            len(self.added),
+            len(self.removed),
+            len(self.modified),
+            len(self.moved),
+        )
+
+
+def diff_manifests(old, new):
+    """
+    Returns a ``ManifestDiff`` with every file that's different between two
+    versions of a bag.  See ``iter_manifest_changes()`` to stream them instead.
+    """
+    return ManifestDiff(iter_manifest_changes(old, new))
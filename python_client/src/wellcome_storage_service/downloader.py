@@ -1,51 +1,422 @@
 import abc
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import io
+import itertools
 import os
+import posixpath
 import shutil
 import tarfile
 import tempfile
+import threading
+import time
 
 try:
     from collections.abc import ABC
 except ImportError:  # Python 2
     from abc import ABCMeta as ABC
 
-from ._utils import mkdir_p
+from ._utils import (
+    LatencyTracker,
+    RequestBudget,
+    concurrently,
+    hashlib_name,
+    mkdir_p,
+    parse_timestamp,
+    remove_if_exists,
+)
+from .compression import open_compressed_writer
+from .exceptions import BagDownloadError, ChecksumMismatch
+from .journal import DownloadJournal
+from .manifest import StorageManifest
+from .metrics import record_request
+
+
+# The default number of files to download at once.  Fetching a file from S3
+# is mostly waiting on the network, so we can have a lot more requests in
+# flight than we have CPUs.
+DEFAULT_MAX_WORKERS = 16
+
+# How many bytes to read from a storage provider at a time.  Reading in
+# larger chunks cuts the per-read Python overhead, which adds up when
+# we're moving gigabytes.
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# Files bigger than this are downloaded as multiple byte ranges in parallel.
+DEFAULT_MULTIPART_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+DEFAULT_MAX_RANGE_WORKERS = 8
+
+DEFAULT_MAX_POOL_CONNECTIONS = DEFAULT_MAX_WORKERS * 2
+
+
+# The Azure storage account for each of our replica containers.  The storage
+# manifest only records the container name, not the account it lives in.
+AZURE_STORAGE_ACCOUNTS = {
+    "wellcomecollection-storage-replica-netherlands": "wecostorageprod",
+    "wellcomecollection-storage-staging-replica-netherlands": "wecostoragestage",
+}
+
+# How expensive it is to read from each storage provider, used to choose
+# which copy of a bag to download from when reading from replicas.  The
+# primary S3 bucket is in the same region as most of our compute; our Azure
+# replica is in another cloud and charges for egress, so we only use it if
+# the S3 copies are unavailable.  See ``ReplicaProvider``.
+DEFAULT_PROVIDER_COSTS = {"amazon-s3": 0, "azure-blob-storage": 1}
+
+# How long to avoid a location after a request to it fails.
+DEFAULT_REPLICA_COOLDOWN = 60
+
+# When hedging reads, we send a second request to another replica if the
+# first hasn't returned any bytes within this percentile of recent requests,
+# and we send at most this many extra requests per request.
+DEFAULT_HEDGE_PERCENTILE = 95
+DEFAULT_MAX_HEDGE_RATIO = 0.05
+
+# How much of a file to read when we're timing how long it takes to get
+# the first bytes of a hedged read.
+HEDGE_FIRST_READ_SIZE = 64 * 1024
 
 
 def _choose_provider(location):
-    if location["provider"]["id"] == "amazon-s3":
-        return S3InfrequentAccessProvider()
-    else:
+    try:
+        provider_class = _PROVIDER_CLASSES[location["provider"]["id"]]
+    except KeyError:
         raise RuntimeError(
             "Unsupported storage provider: %s" % location["provider"]["id"]
         )
 
+    return provider_class()
+
+
+def _choose_bag_provider(
+    storage_manifest,
+    use_replicas=False,
+    providers=None,
+    provider_costs=None,
+    hedge_reads=False,
+):
+    """
+    Returns a provider for downloading the files in a bag from
+    ``storage_manifest["location"]``.
 
-def _all_files(storage_manifest):
-    return (
-        storage_manifest["manifest"]["files"] + storage_manifest["tagManifest"]["files"]
+    If ``use_replicas`` is True and the bag has replicas, this is a
+    ``ReplicaProvider`` that can read from any copy of the bag.
+    """
+    replica_locations = storage_manifest.get("replicaLocations") or []
+
+    if use_replicas and replica_locations:
+        return ReplicaProvider(
+            replica_locations,
+            providers=providers,
+            provider_costs=provider_costs,
+            hedge_reads=hedge_reads,
+        )
+
+    location = storage_manifest["location"]
+
+    try:
+        return providers[location["provider"]["id"]]
+    except (KeyError, TypeError):
+        return _choose_provider(location)
+
+
+def _close_bag_provider(provider):
+    """
+    Releases anything held by a provider from ``_choose_bag_provider()``.
+
+    Providers the caller passed in are left open, so they can be reused.
+    """
+    if isinstance(provider, ReplicaProvider):
+        provider.close()
+
+
+def _all_files_with_algorithm(storage_manifest):
+    """
+    Generates (manifest_file, checksum_algorithm) pairs for every file in
+    a bag.  The payload and tag manifests record their checksum algorithms
+    separately.
+    """
+    if isinstance(storage_manifest, StorageManifest):
+        for file_with_algorithm in storage_manifest.files_with_algorithm():
+            yield file_with_algorithm
+        return
+
+    for manifest_key in ("manifest", "tagManifest"):
+        bag_manifest = storage_manifest[manifest_key]
+        checksum_algorithm = bag_manifest.get("checksumAlgorithm")
+
+        for manifest_file in bag_manifest["files"]:
+            yield manifest_file, checksum_algorithm
+
+
+class VerificationResult(
+    collections.namedtuple(
+        "VerificationResult", ["name", "checksum_algorithm", "expected", "actual"]
     )
+):
+    """
+    The result of checking a downloaded file against the checksum in its
+    storage manifest.
+    """
+
+    @property
+    def verified(self):
+        return self.expected == self.actual
+
+
+def _files_to_download(storage_manifest, out_dir, journal, verify_checksums, results):
+    """
+    Generates (manifest_file, checksum_algorithm) pairs for every file in
+    a bag that we still need to download.  The checksum algorithm is None
+    if we're not verifying checksums.
+
+    If we're resuming a download, files that are already complete are
+    skipped, and their ``VerificationResult`` is added to ``results``.
+    """
+    for manifest_file, checksum_algorithm in _all_files_with_algorithm(
+        storage_manifest
+    ):
+        if journal is not None:
+            entry = journal.completed_file(out_dir, manifest_file)
+        else:
+            entry = None
+
+        # If we're checking checksums, we can only skip files that were
+        # verified when they were downloaded.
+        if entry is not None and not verify_checksums:
+            continue
 
+        if entry is not None and entry["checksum"] is not None:
+            results[manifest_file["name"]] = VerificationResult(
+                name=manifest_file["name"],
+                checksum_algorithm=checksum_algorithm,
+                expected=manifest_file["checksum"],
+                actual=entry["checksum"],
+            )
+            continue
+
+        if verify_checksums:
+            yield manifest_file, checksum_algorithm
+        else:
+            yield manifest_file, None
+
+
+def _link_from_content_store(content_store, out_dir, manifest_file, checksum_algorithm):
+    """
+    Link a file into place from the content store, if it's there.
+
+    Returns a ``VerificationResult`` if we linked the file, or None if we
+    need to download it.  Files are only added to the store once they've
+    been verified, so a file from the store matches its checksum.
+    """
+    if checksum_algorithm is None or "checksum" not in manifest_file:
+        return None
+
+    out_path = os.path.join(out_dir, manifest_file["name"])
+
+    if content_store.link(checksum_algorithm, manifest_file["checksum"], out_path):
+        return VerificationResult(
+            name=manifest_file["name"],
+            checksum_algorithm=checksum_algorithm,
+            expected=manifest_file["checksum"],
+            actual=manifest_file["checksum"],
+        )
+
+    # This may be a read-only link to a file that's since been evicted from
+    # the store, which we couldn't write over.
+    if not os.access(out_path, os.W_OK):
+        remove_if_exists(out_path)
+
+
+def _download_file(
+    provider,
+    location,
+    out_dir,
+    journal,
+    content_store,
+    instrumentation,
+    file_with_algorithm,
+):
+    """
+    Download a single file, and record it in the journal (if any).
 
-def download_bag(storage_manifest, out_dir):
+    Returns the ``VerificationResult``, or the exception if the download
+    failed -- that way one bad file doesn't stop the rest of the bag.
+    """
+    manifest_file, checksum_algorithm = file_with_algorithm
+
+    try:
+        if content_store is not None:
+            result = _link_from_content_store(
+                content_store, out_dir, manifest_file, checksum_algorithm
+            )
+        else:
+            result = None
+
+        if result is None:
+            result = record_request(
+                instrumentation,
+                "download",
+                lambda: provider.download(
+                    out_dir=out_dir,
+                    location=location,
+                    manifest_file=manifest_file,
+                    checksum_algorithm=checksum_algorithm,
+                    journal=journal,
+                ),
+                size=lambda _: manifest_file.get("size"),
+            )
+
+            if content_store is not None and result is not None:
+                content_store.add(
+                    checksum_algorithm,
+                    manifest_file["checksum"],
+                    os.path.join(out_dir, manifest_file["name"]),
+                )
+    except Exception as err:
+        return err
+
+    if journal is not None:
+        journal.record_file(
+            manifest_file, checksum=result.actual if result is not None else None
+        )
+
+    return result
+
+
+def download_bag(
+    storage_manifest,
+    out_dir,
+    max_workers=DEFAULT_MAX_WORKERS,
+    verify_checksums=True,
+    resume=False,
+    use_replicas=False,
+    providers=None,
+    provider_costs=None,
+    hedge_reads=False,
+    content_store=None,
+    instrumentation=None,
+):
     """
     Download all the files in a bag to a given directory.
 
+    Files are downloaded concurrently.  If any of them fail, the rest of the
+    bag is still downloaded, and a ``BagDownloadError`` is raised at the end
+    with the errors for every file that failed.
+
     :param storage_manifest: A storage manifest returned from the storage
         service, as retrieved with ``get_bag()``.
     :param out_dir: The directory to download the bag to.
+    :param max_workers: The maximum number of files to download at once.
+    :param verify_checksums: Whether to check every file against the checksum
+        in the storage manifest as it's downloaded.  Any mismatches are
+        reported as a ``ChecksumMismatch`` in the ``BagDownloadError``.
+    :param resume: Whether to pick up a previous, interrupted download to
+        the same directory.  Progress is recorded in a journal file in
+        ``out_dir``, which is deleted once every file has been downloaded.
+    :param use_replicas: Whether to fall back to the bag's replicas if
+        a file can't be read from its primary location.  This is off by
+        default, so we only read from the primary location.  See
+        ``ReplicaProvider``.
+    :param providers: A dict of provider ID (e.g. ``"azure-blob-storage"``)
+        to the provider to use for that storage, e.g. an ``AzureBlobProvider``
+        with credentials for our Azure replica.
+    :param provider_costs: How to rank the copies of a bag when
+        ``use_replicas`` is True.  Defaults to ``DEFAULT_PROVIDER_COSTS``;
+        see ``ReplicaProvider``.
+    :param hedge_reads: Whether to send a second request to another replica
+        if a file is slow to start downloading.  This only has an effect if
+        ``use_replicas`` is True.  See ``ReplicaProvider``.
+    :param content_store: A ``ContentStore`` of files we've already downloaded.
+        Any file whose checksum is in the store is linked into place rather
+        than downloaded, and new files are added to the store.  Files are
+        always verified when you use a content store, so nothing unverified
+        goes into the store.
+    :param instrumentation: An optional ``Instrumentation`` (e.g. a
+        ``Metrics``), which is told how long each file took to download.
+        Files linked from the content store aren't counted.
+
+    Returns a dict mapping the name of every verified file to its
+    ``VerificationResult``.
 
     """
     location = storage_manifest["location"]
-    provider = _choose_provider(location)
+    provider = _choose_bag_provider(
+        storage_manifest,
+        use_replicas=use_replicas,
+        providers=providers,
+        provider_costs=provider_costs,
+        hedge_reads=hedge_reads,
+    )
 
-    for manifest_file in _all_files(storage_manifest):
-        provider.download(
-            out_dir=out_dir, location=location, manifest_file=manifest_file
-        )
+    results = {}
+    errors = {}
+
+    if resume:
+        mkdir_p(out_dir)
+        journal = DownloadJournal(out_dir)
+    else:
+        journal = None
+
+    files_to_download = _files_to_download(
+        storage_manifest,
+        out_dir=out_dir,
+        journal=journal,
+        verify_checksums=verify_checksums or content_store is not None,
+        results=results,
+    )
+
+    try:
+        for (manifest_file, _), result in concurrently(
+            functools.partial(
+                _download_file,
+                provider,
+                location,
+                out_dir,
+                journal,
+                content_store,
+                instrumentation,
+            ),
+            files_to_download,
+            max_concurrency=max_workers,
+        ):
+            if isinstance(result, Exception):
+                errors[manifest_file["name"]] = result
+            elif result is not None:
+                results[manifest_file["name"]] = result
+    finally:
+        _close_bag_provider(provider)
+
+        if journal is not None:
+            journal.close()
 
+    if errors:
+        raise BagDownloadError(errors)
 
-def download_compressed_bag(storage_manifest, out_path, top_level_dir=None):
+    if journal is not None:
+        journal.remove()
+
+    return results
+
+
+def download_compressed_bag(
+    storage_manifest,
+    out_path,
+    top_level_dir=None,
+    max_workers=DEFAULT_MAX_WORKERS,
+    streaming=False,
+    compress_threads=1,
+    use_replicas=False,
+    providers=None,
+    provider_costs=None,
+    hedge_reads=False,
+    content_store=None,
+    instrumentation=None,
+):
     """
     Download all the files in a bag to a compressed archive.
 
@@ -54,31 +425,502 @@ def download_compressed_bag(storage_manifest, out_path, top_level_dir=None):
     :param out_path: The path to download the tar.gz to.
     :param top_level_dir: Name of top level directory in archive (defaults to
         the bag's external identifier).
+    :param max_workers: The maximum number of files to download at once.
+    :param streaming: If True, write each file straight into the archive as
+        it's downloaded, rather than downloading the whole bag to a temporary
+        directory first.  See ``stream_compressed_bag()``.
+    :param compress_threads: How many threads to use for compression, when
+        ``streaming`` is True.  The archive is a single gzip stream however
+        many threads you use, so the storage service can unpack it.
+    :param use_replicas: See ``download_bag()``.
+    :param providers: See ``download_bag()``.
+    :param provider_costs: See ``download_bag()``.
+    :param hedge_reads: See ``download_bag()``.
+    :param content_store: See ``download_bag()``.  This is ignored if
+        ``streaming`` is True.
+    :param instrumentation: See ``download_bag()``.
 
     """
+    if streaming:
+        completed = False
+
+        try:
+            with open(out_path, "wb") as out_file:
+                stream_compressed_bag(
+                    storage_manifest,
+                    out_file=out_file,
+                    top_level_dir=top_level_dir,
+                    compress_threads=compress_threads,
+                    max_workers=max_workers,
+                    use_replicas=use_replicas,
+                    providers=providers,
+                    provider_costs=provider_costs,
+                    hedge_reads=hedge_reads,
+                    instrumentation=instrumentation,
+                )
+
+            completed = True
+        finally:
+            # Don't leave a partial archive behind, but don't let a
+            # failure to clean it up hide the original error.
+            if not completed:
+                try:
+                    remove_if_exists(out_path)
+                except OSError:
+                    pass
+
+        return
+
     if top_level_dir is None:
         top_level_dir = storage_manifest["info"]["externalIdentifier"]
 
     temp_dir = tempfile.mkdtemp()
-    download_bag(storage_manifest=storage_manifest, out_dir=temp_dir)
 
-    with tarfile.open(out_path, "w:gz") as tf:
-        tf.add(temp_dir, arcname=top_level_dir)
+    try:
+        download_bag(
+            storage_manifest=storage_manifest,
+            out_dir=temp_dir,
+            max_workers=max_workers,
+            use_replicas=use_replicas,
+            providers=providers,
+            provider_costs=provider_costs,
+            hedge_reads=hedge_reads,
+            content_store=content_store,
+            instrumentation=instrumentation,
+        )
+
+        with tarfile.open(out_path, "w:gz") as tf:
+            tf.add(temp_dir, arcname=top_level_dir)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def _created_timestamp(storage_manifest):
+    """
+    Returns the creation date of a storage manifest as a Unix timestamp.
+    """
+    timestamp = parse_timestamp(storage_manifest.get("createdDate", ""))
+
+    if timestamp is None:
+        return int(time.time())
+    else:
+        return int(timestamp)
+
+
+def _prefetch_small_files(provider, location, files, max_workers, max_size):
+    """
+    Generates (manifest_file, checksum_algorithm, read_file_obj) tuples in
+    the same order as ``files``.
+
+    Files up to ``max_size`` bytes are read into memory ahead of time, up to
+    ``max_workers`` at once, so we aren't waiting on the latency of
+    one request at a time for bags with lots of small files.  Bigger files
+    are opened when they're reached, and streamed -- as parallel byte
+    ranges, if they're big enough and the provider supports it.
+    """
+
+    def _read_small_file(manifest_file):
+        read_file_obj = provider.get_fileobj(
+            location=location, manifest_file=manifest_file
+        )
+        with contextlib.closing(read_file_obj):
+            return io.BytesIO(read_file_obj.read())
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        window = collections.deque()
+
+        def _next():
+            manifest_file, checksum_algorithm, fut = window.popleft()
+
+            if fut is not None:
+                read_file_obj = fut.result()
+            elif isinstance(provider, MultipartProvider):
+                read_file_obj = provider.get_streaming_fileobj(
+                    location=location, manifest_file=manifest_file
+                )
+            else:
+                read_file_obj = provider.get_fileobj(
+                    location=location, manifest_file=manifest_file
+                )
+
+            return manifest_file, checksum_algorithm, read_file_obj
+
+        for manifest_file, checksum_algorithm in files:
+            if manifest_file.get("size", max_size + 1) <= max_size:
+                fut = executor.submit(_read_small_file, manifest_file)
+            else:
+                fut = None
+
+            window.append((manifest_file, checksum_algorithm, fut))
+
+            if len(window) > max_workers:
+                yield _next()
+
+        while window:
+            yield _next()
+
+
+class _HashingReader(object):
+    """
+    Wraps a binary file, and updates ``hasher`` with everything read from it.
+    """
+
+    def __init__(self, file_obj, hasher):
+        self.file_obj = file_obj
+        self.hasher = hasher
 
-    shutil.rmtree(temp_dir)
+    def read(self, size=-1):
+        chunk = self.file_obj.read(size)
+        self.hasher.update(chunk)
+        return chunk
+
+
+def _tar_info(name, mtime, size=None):
+    tarinfo = tarfile.TarInfo(name=name)
+    tarinfo.mtime = mtime
+
+    if size is None:
+        tarinfo.type = tarfile.DIRTYPE
+        tarinfo.mode = 0o755
+    else:
+        tarinfo.size = size
+        tarinfo.mode = 0o644
+
+    return tarinfo
+
+
+def _add_parent_dirs(tf, name, written_dirs, mtime):
+    """
+    Add entries for any parent directories of ``name`` that we haven't
+    seen yet, so a streamed archive has the same directory entries as a
+    tar of the bag on disk.
+    """
+    parent_dirs = []
+    parent = os.path.dirname(name)
+    while parent not in written_dirs:
+        parent_dirs.insert(0, parent)
+        parent = os.path.dirname(parent)
+
+    for dirname in parent_dirs:
+        tf.addfile(_tar_info(dirname, mtime=mtime))
+        written_dirs.add(dirname)
+
+
+def _add_bag_to_tar(
+    tf,
+    storage_manifest,
+    top_level_dir,
+    max_workers,
+    verify_checksums,
+    use_replicas,
+    providers,
+    provider_costs,
+    hedge_reads,
+    instrumentation,
+):
+    provider = _choose_bag_provider(
+        storage_manifest,
+        use_replicas=use_replicas,
+        providers=providers,
+        provider_costs=provider_costs,
+        hedge_reads=hedge_reads,
+    )
+
+    try:
+        _write_bag_files_to_tar(
+            tf,
+            provider,
+            storage_manifest=storage_manifest,
+            top_level_dir=top_level_dir,
+            max_workers=max_workers,
+            verify_checksums=verify_checksums,
+            instrumentation=instrumentation,
+        )
+    finally:
+        _close_bag_provider(provider)
+
+
+def _add_file_to_tar(tf, tarinfo, read_file_obj, size, chunk_size):
+    """
+    Adds a file to a tar archive, and returns its size.
+
+    A tar header gives the size of a file before its contents, so if the
+    manifest doesn't tell us the size, we spool the file first to find
+    out -- in memory if it's small, or on disk if not.
+    """
+    if size is not None:
+        tarinfo.size = size
+        tf.addfile(tarinfo, fileobj=read_file_obj)
+        return size
+
+    with tempfile.SpooledTemporaryFile(max_size=chunk_size) as spooled_file:
+        shutil.copyfileobj(read_file_obj, spooled_file, chunk_size)
+        tarinfo.size = spooled_file.tell()
+        spooled_file.seek(0)
+        tf.addfile(tarinfo, fileobj=spooled_file)
+
+    return tarinfo.size
+
+
+def _write_bag_files_to_tar(
+    tf,
+    provider,
+    storage_manifest,
+    top_level_dir,
+    max_workers,
+    verify_checksums,
+    instrumentation,
+):
+    location = storage_manifest["location"]
+    mtime = _created_timestamp(storage_manifest)
+
+    files = sorted(
+        _all_files_with_algorithm(storage_manifest), key=lambda f: f[0]["name"]
+    )
+
+    tf.addfile(_tar_info(top_level_dir, mtime=mtime))
+    written_dirs = {top_level_dir}
+
+    for manifest_file, checksum_algorithm, read_file_obj in _prefetch_small_files(
+        provider,
+        location=location,
+        files=files,
+        max_workers=max_workers,
+        max_size=provider.chunk_size,
+    ):
+        name = "%s/%s" % (top_level_dir, manifest_file["name"])
+        _add_parent_dirs(tf, name, written_dirs=written_dirs, mtime=mtime)
+
+        if verify_checksums:
+            hasher = _new_hasher(manifest_file, checksum_algorithm)
+        else:
+            hasher = None
+
+        with contextlib.closing(read_file_obj):
+            if hasher is not None:
+                read_file_obj = _HashingReader(read_file_obj, hasher)
+
+            record_request(
+                instrumentation,
+                "download",
+                functools.partial(
+                    _add_file_to_tar,
+                    tf,
+                    _tar_info(name, mtime=mtime, size=0),
+                    read_file_obj,
+                    size=manifest_file.get("size"),
+                    chunk_size=provider.chunk_size,
+                ),
+                size=lambda size: size,
+            )
+
+        if hasher is not None:
+            _check_digest(manifest_file, checksum_algorithm, hasher)
+
+
+def stream_compressed_bag(
+    storage_manifest,
+    out_file,
+    top_level_dir=None,
+    compression="gz",
+    compress_threads=1,
+    max_workers=DEFAULT_MAX_WORKERS,
+    verify_checksums=True,
+    use_replicas=False,
+    providers=None,
+    provider_costs=None,
+    hedge_reads=False,
+    instrumentation=None,
+):
+    """
+    Download all the files in a bag and write them as a compressed tar
+    archive to a writable binary file, e.g. an open file, ``sys.stdout``
+    or an S3 upload.
+
+    Each file is written into the archive as it's downloaded, using the
+    sizes in the storage manifest for the tar headers, so this only makes
+    one pass over the bag and doesn't need any temporary disk space.
+
+    :param storage_manifest: A storage manifest returned from the storage
+        service, as retrieved with ``get_bag()``.
+    :param out_file: A writable binary file to write the archive to.  It
+        isn't closed when the archive is complete.
+    :param top_level_dir: Name of top level directory in archive (defaults to
+        the bag's external identifier).
+    :param compression: ``"gz"`` (the default), ``"zst"`` (which needs the
+        ``zstandard`` package), or None for an uncompressed tar.
+    :param compress_threads: How many threads to use for compression.  For
+        gzip, the blocks are compressed in parallel in the style of pigz,
+        but still written as a single gzip stream, so the storage service
+        can unpack it.
+    :param max_workers: How many small files to fetch ahead of the one
+        currently being written to the archive.  Large files are fetched
+        as parallel byte ranges, if the provider supports it; see
+        ``MultipartProvider``.
+    :param verify_checksums: Whether to check every file against the checksum
+        in the storage manifest as it's written.  If a file doesn't match,
+        ``ChecksumMismatch`` is raised and the archive is incomplete.
+    :param use_replicas: See ``download_bag()``.
+    :param providers: See ``download_bag()``.
+    :param provider_costs: See ``download_bag()``.
+    :param hedge_reads: See ``download_bag()``.
+    :param instrumentation: An optional ``Instrumentation``, which is told
+        how long it took to read each file into the archive.  Small files
+        are fetched ahead of time, so this mostly counts the larger ones.
+
+    """
+    if top_level_dir is None:
+        top_level_dir = storage_manifest["info"]["externalIdentifier"]
+
+    writer = open_compressed_writer(
+        out_file, compression=compression, threads=compress_threads
+    )
+
+    try:
+        with tarfile.open(fileobj=writer, mode="w|") as tf:
+            _add_bag_to_tar(
+                tf,
+                storage_manifest=storage_manifest,
+                top_level_dir=top_level_dir,
+                max_workers=max_workers,
+                verify_checksums=verify_checksums,
+                use_replicas=use_replicas,
+                providers=providers,
+                provider_costs=provider_costs,
+                hedge_reads=hedge_reads,
+                instrumentation=instrumentation,
+            )
+    finally:
+        writer.close()
+
+
+def _byte_ranges(size, chunk_size):
+    """
+    Split an object of ``size`` bytes into inclusive (start, end) byte ranges
+    of at most ``chunk_size`` bytes, as used in an HTTP Range header.
+    """
+    return [
+        (start, min(start + chunk_size, size) - 1)
+        for start in range(0, size, chunk_size)
+    ]
+
+
+def _pwrite(file_obj, data, offset):
+    """
+    Write all of ``data`` to ``file_obj`` at ``offset``, without disturbing
+    the position of any other writer.
+    """
+    try:
+        pwrite = os.pwrite
+    except AttributeError:  # Python 2 and Windows
+        file_obj.seek(offset)
+        file_obj.write(data)
+        return
+
+    view = memoryview(data)
+    while view:
+        written = pwrite(file_obj.fileno(), view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _new_hasher(manifest_file, checksum_algorithm):
+    """
+    Returns a hashlib object for checking ``manifest_file``, or None if
+    there's nothing to check it against.
+    """
+    if checksum_algorithm is None or "checksum" not in manifest_file:
+        return None
+
+    return hashlib.new(hashlib_name(checksum_algorithm))
+
+
+def _copy_chunks(read_file_obj, write, chunk_size, hasher=None):
+    """
+    Copy everything from ``read_file_obj`` to the ``write`` function,
+    updating ``hasher`` as we go.  Returns the number of bytes copied.
+
+    This process is deliberately chunked to avoid loading the whole contents
+    of a file into memory at once, when we can stream lazily and keep the
+    memory footprint down.
+    """
+    bytes_copied = 0
+
+    while True:
+        next_chunk = read_file_obj.read(chunk_size)
+        if not next_chunk:
+            break
+        write(next_chunk)
+        bytes_copied += len(next_chunk)
+
+        if hasher is not None:
+            hasher.update(next_chunk)
+
+    return bytes_copied
+
+
+class _RangeReader(object):
+    """
+    Wraps a binary file, and stops reading after ``length`` bytes.
+    """
+
+    def __init__(self, file_obj, length):
+        self.file_obj = file_obj
+        self.remaining = length
+
+    def read(self, size):
+        chunk = self.file_obj.read(min(size, self.remaining))
+        self.remaining -= len(chunk)
+        return chunk
+
+    def close(self):
+        self.file_obj.close()
+
+
+def _check_digest(manifest_file, checksum_algorithm, hasher):
+    result = VerificationResult(
+        name=manifest_file["name"],
+        checksum_algorithm=checksum_algorithm,
+        expected=manifest_file["checksum"],
+        actual=hasher.hexdigest(),
+    )
+
+    if not result.verified:
+        raise ChecksumMismatch(
+            name=result.name,
+            checksum_algorithm=result.checksum_algorithm,
+            expected=result.expected,
+            actual=result.actual,
+        )
+
+    return result
 
 
 class AbstractProvider(object):
     """
     Abstract class for a downloader.
 
-    Subclasses should implement the ``_download_fileobj`` method, which
-    downloads a single ``manifest_file`` from a bag's manifest at ``location``
-    to a writable ``file_obj`` in binary mode.
+    Subclasses should implement the ``get_fileobj`` method, which returns
+    a readable binary file for a single ``manifest_file`` from a bag's
+    manifest at ``location``.  They can also override ``get_range_fileobj``
+    if the underlying storage can fetch part of a file.
+
+    If ``download`` is passed a ``checksum_algorithm`` (e.g. ``"SHA-256"``),
+    the file is hashed as it's written, and compared to the checksum in
+    the manifest.  This means a verified download only reads the bytes once.
+
+    If ``download`` is passed a ``DownloadJournal``, it picks up from the end
+    of any partial copy of the file left by a previous download.
+
+    :param chunk_size: How many bytes to read from the underlying storage
+        at a time.
     """
 
     __metaclass__ = ABC
 
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+
     @abc.abstractmethod
     def get_fileobj(self, location, manifest_file):
         """
@@ -86,39 +928,869 @@ class AbstractProvider(object):
         """
         pass
 
-    def download(self, out_dir, location, manifest_file):
+    def get_range_fileobj(self, location, manifest_file, start, end):
+        """
+        Returns a binary file with the bytes from ``start`` to ``end``
+        (inclusive) of a file.
+
+        This default implementation reads and discards everything before
+        ``start``; subclasses should override it if they can do better.
+        """
+        read_file_obj = self.get_fileobj(location=location, manifest_file=manifest_file)
+
+        to_skip = start
+        while to_skip > 0:
+            skipped = len(read_file_obj.read(min(to_skip, self.chunk_size)))
+            if not skipped:
+                break
+            to_skip -= skipped
+
+        return _RangeReader(read_file_obj, length=end - start + 1)
+
+    def _resume_offset(self, out_path, manifest_file, journal, hasher):
+        """
+        Returns how many bytes of a file we already have from a previous
+        download, or 0 if we need to start from scratch.
+
+        We only pick up a partial file if we're verifying checksums, so the
+        bytes we already have are checked along with the rest of the file.
+        Otherwise we can't tell a half-finished download from a corrupt or
+        unrelated file that happens to be in the way, so we start again.
+        """
+        if hasher is None:
+            return 0
+
+        if journal is None or journal.completed_ranges(manifest_file["name"]):
+            return 0
+
+        size = manifest_file.get("size")
+        if size is None:
+            return 0
+
+        try:
+            offset = os.path.getsize(out_path)
+        except OSError:
+            return 0
+
+        if offset > size:
+            return 0
+
+        return offset
+
+    def download(
+        self, out_dir, location, manifest_file, checksum_algorithm=None, journal=None
+    ):
+        """
+        Download a single file to ``out_dir``.
+
+        Returns a ``VerificationResult`` if the file was checked against
+        its checksum, or raises ``ChecksumMismatch`` if it doesn't match.
+        """
         out_path = os.path.join(out_dir, manifest_file["name"])
 
         mkdir_p(os.path.dirname(out_path))
 
-        with open(out_path, "wb") as write_file_obj:
+        hasher = _new_hasher(manifest_file, checksum_algorithm)
+        offset = self._resume_offset(out_path, manifest_file, journal, hasher)
+
+        if offset > 0:
+            if hasher is not None:
+                with open(out_path, "rb") as existing_file_obj:
+                    _copy_chunks(
+                        existing_file_obj,
+                        write=lambda chunk: None,
+                        chunk_size=self.chunk_size,
+                        hasher=hasher,
+                    )
+
+            if offset < manifest_file["size"]:
+                read_file_obj = self.get_range_fileobj(
+                    location=location,
+                    manifest_file=manifest_file,
+                    start=offset,
+                    end=manifest_file["size"] - 1,
+                )
+            else:
+                read_file_obj = io.BytesIO()
+        else:
             read_file_obj = self.get_fileobj(
                 location=location, manifest_file=manifest_file
             )
 
-            # This process is deliberately chunked to avoid loading the
-            # whole contents of a file into memory at once, when we can
-            # stream lazily and keep the memory footprint down.
-            while True:
-                next_chunk = read_file_obj.read(8096)
-                if not next_chunk:
-                    break
-                write_file_obj.write(next_chunk)
+        with open(out_path, "ab" if offset > 0 else "wb") as write_file_obj:
+            _copy_chunks(
+                read_file_obj,
+                write=write_file_obj.write,
+                chunk_size=self.chunk_size,
+                hasher=hasher,
+            )
+
+        if hasher is None:
+            return
 
+        try:
+            return _check_digest(manifest_file, checksum_algorithm, hasher)
+        except ChecksumMismatch:
+            # If we picked up a partial file, the bytes we already had may
+            # be bad (e.g. if the previous download was killed mid-write),
+            # so try once more from scratch.
+            if offset == 0:
+                raise
 
-class S3InfrequentAccessProvider(AbstractProvider):
-    def __init__(self):
-        import boto3
+        return self.download(
+            out_dir=out_dir,
+            location=location,
+            manifest_file=manifest_file,
+            checksum_algorithm=checksum_algorithm,
+        )
 
-        self.s3_client = boto3.client("s3")
-        super(S3InfrequentAccessProvider, self).__init__()
 
-    def get_fileobj(self, location, manifest_file):
+class MultipartProvider(AbstractProvider):
+    """
+    Abstract class for a downloader that can fetch byte ranges of a file.
+
+    Files bigger than ``multipart_threshold`` are split into byte ranges
+    of ``multipart_chunksize`` bytes, which are fetched in parallel (up to
+    ``max_range_workers`` at once) and written into place in the output file.
+    A single GET is limited by the throughput of one TCP connection, so
+    this is much faster for the multi-GB files in AV and born-digital bags.
+
+    Subclasses should implement ``get_fileobj`` and ``get_range_fileobj``.
+    """
+
+    def __init__(
+        self,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        multipart_threshold=DEFAULT_MULTIPART_THRESHOLD,
+        multipart_chunksize=DEFAULT_MULTIPART_CHUNKSIZE,
+        max_range_workers=DEFAULT_MAX_RANGE_WORKERS,
+    ):
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+        self.max_range_workers = max_range_workers
+        super(MultipartProvider, self).__init__(chunk_size=chunk_size)
+
+    @abc.abstractmethod
+    def get_range_fileobj(self, location, manifest_file, start, end):
+        pass
+
+    def _read_range(self, location, manifest_file, byte_range):
+        start, end = byte_range
+        data = self.get_range_fileobj(
+            location=location, manifest_file=manifest_file, start=start, end=end
+        ).read()
+
+        if len(data) != end - start + 1:
+            raise IOError(
+                "Short read for bytes %d-%d of %s: only got %d bytes"
+                % (start, end, manifest_file["name"], len(data))
+            )
+
+        return data
+
+    def _iter_ranges(self, location, manifest_file):
+        """
+        Generates the contents of a file as consecutive byte ranges, which
+        are fetched up to ``max_range_workers`` at once.
+        """
+        byte_ranges = iter(
+            _byte_ranges(manifest_file["size"], self.multipart_chunksize)
+        )
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_range_workers
+        ) as executor:
+            pending = collections.deque(
+                executor.submit(self._read_range, location, manifest_file, byte_range)
+                for byte_range in itertools.islice(byte_ranges, self.max_range_workers)
+            )
+
+            while pending:
+                data = pending.popleft().result()
+
+                for byte_range in itertools.islice(byte_ranges, 1):
+                    pending.append(
+                        executor.submit(
+                            self._read_range, location, manifest_file, byte_range
+                        )
+                    )
+
+                yield data
+
+    def get_streaming_fileobj(self, location, manifest_file):
+        """
+        Returns a binary file with the contents of a file, for reading
+        from start to finish.
+
+        Files bigger than ``multipart_threshold`` are fetched as byte ranges
+        in parallel, the same as in ``download()``, and read back in order.
+        This holds up to ``max_range_workers`` ranges in memory at once.
+        """
+        size = manifest_file.get("size")
+
+        if size is None or size < self.multipart_threshold:
+            return self.get_fileobj(location=location, manifest_file=manifest_file)
+
+        return _IterReader(self._iter_ranges(location, manifest_file))
+
+    def _remaining_ranges(self, out_path, manifest_file, journal):
+        """
+        Returns the byte ranges of a large file that still need downloading,
+        preallocating the file if we're starting from scratch.
+        """
+        size = manifest_file["size"]
+        byte_ranges = _byte_ranges(size, self.multipart_chunksize)
+
+        if journal is not None:
+            completed_ranges = journal.completed_ranges(manifest_file["name"])
+
+            if completed_ranges and os.path.exists(out_path):
+                if os.path.getsize(out_path) == size:
+                    return [r for r in byte_ranges if r not in completed_ranges]
+
+            journal.forget_ranges(manifest_file["name"])
+
+        # Preallocate the file, so each range can be written straight into
+        # place as soon as it arrives, in whatever order they finish.
+        with open(out_path, "wb") as out_file:
+            out_file.truncate(size)
+
+        return byte_ranges
+
+    def _download_range(self, out_path, location, manifest_file, byte_range):
+        """
+        Downloads a single byte range of a large file, writing it into place
+        in the preallocated file at ``out_path``.
+        """
+        start, end = byte_range
+        read_file_obj = self.get_range_fileobj(
+            location=location, manifest_file=manifest_file, start=start, end=end
+        )
+
+        with contextlib.closing(read_file_obj), open(out_path, "r+b", 0) as out_file:
+            offset = [start]
+
+            def _write(chunk):
+                _pwrite(out_file, chunk, offset[0])
+                offset[0] += len(chunk)
+
+            bytes_copied = _copy_chunks(
+                read_file_obj, write=_write, chunk_size=self.chunk_size
+            )
+
+        if bytes_copied != end - start + 1:
+            raise IOError(
+                "Short read for bytes %d-%d of %s: only got %d bytes"
+                % (start, end, manifest_file["name"], bytes_copied)
+            )
+
+    def download(
+        self, out_dir, location, manifest_file, checksum_algorithm=None, journal=None
+    ):
+        size = manifest_file.get("size")
+
+        if size is None or size < self.multipart_threshold:
+            return super(MultipartProvider, self).download(
+                out_dir=out_dir,
+                location=location,
+                manifest_file=manifest_file,
+                checksum_algorithm=checksum_algorithm,
+                journal=journal,
+            )
+
+        out_path = os.path.join(out_dir, manifest_file["name"])
+        mkdir_p(os.path.dirname(out_path))
+
+        byte_ranges = self._remaining_ranges(out_path, manifest_file, journal)
+        resumed = len(byte_ranges) < len(
+            _byte_ranges(manifest_file["size"], self.multipart_chunksize)
+        )
+
+        def _download_range(byte_range):
+            self._download_range(out_path, location, manifest_file, byte_range)
+
+            if journal is not None:
+                journal.record_range(manifest_file["name"], byte_range)
+
+        for _ in concurrently(
+            _download_range, byte_ranges, max_concurrency=self.max_range_workers
+        ):
+            pass
+
+        # The ranges arrive out of order, so we can't hash them as they're
+        # written.  Instead we read the file back once it's complete -- it
+        # was only just written, so this is usually served from the page
+        # cache rather than the disk.
+        hasher = _new_hasher(manifest_file, checksum_algorithm)
+
+        if hasher is not None:
+            with open(out_path, "rb") as read_file_obj:
+                _copy_chunks(
+                    read_file_obj,
+                    write=lambda chunk: None,
+                    chunk_size=self.chunk_size,
+                    hasher=hasher,
+                )
+
+            try:
+                return _check_digest(manifest_file, checksum_algorithm, hasher)
+            except ChecksumMismatch:
+                # Every range is in the journal by now, so if we kept them
+                # a resumed download would skip straight to the same
+                # mismatch.  If some of the ranges came from a previous
+                # run, they may be the bad ones, so try once more from
+                # scratch.
+                if journal is not None:
+                    journal.forget_ranges(manifest_file["name"])
+
+                if not resumed:
+                    raise
+
+            return self.download(
+                out_dir=out_dir,
+                location=location,
+                manifest_file=manifest_file,
+                checksum_algorithm=checksum_algorithm,
+                journal=journal,
+            )
+
+
+class S3InfrequentAccessProvider(MultipartProvider):
+    """
+    Downloads files from the primary copy of a bag in S3.
+
+    Large files are downloaded as parallel byte ranges; see ``MultipartProvider``.
+
+    :param s3_client: A boto3 S3 client.  If not supplied, one is created
+        with the default credentials.
+    """
+
+    def __init__(self, s3_client=None, **kwargs):
+        if s3_client is None:
+            import boto3
+            from botocore.config import Config
+
+            # The default pool only has 10 connections, which is fewer than
+            # the number of requests we make in parallel.
+            s3_client = boto3.client(
+                "s3", config=Config(max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS)
+            )
+
+        self.s3_client = s3_client
+        super(S3InfrequentAccessProvider, self).__init__(**kwargs)
+
+    def _get_object(self, location, manifest_file, **kwargs):
         assert location["provider"]["id"] == "amazon-s3"
 
         bucket = location["bucket"]
         path_prefix = location["path"]
 
         s3_key = os.path.join(path_prefix, manifest_file["path"])
-        s3_obj = self.s3_client.get_object(Bucket=bucket, Key=s3_key)
+        return self.s3_client.get_object(Bucket=bucket, Key=s3_key, **kwargs)
+
+    def get_fileobj(self, location, manifest_file):
+        return self._get_object(location, manifest_file)["Body"]
+
+    def get_range_fileobj(self, location, manifest_file, start, end):
+        s3_obj = self._get_object(
+            location, manifest_file, Range="bytes=%d-%d" % (start, end)
+        )
         return s3_obj["Body"]
+
+
+class _IterReader(object):
+    """
+    Wraps an iterator of byte strings as a readable binary file.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.current = io.BytesIO()
+
+    def read(self, size=-1):
+        # We read from one chunk at a time, rather than appending chunks to
+        # a buffer and slicing it, which is quadratic for big chunks and
+        # small reads.
+        parts = []
+
+        while size != 0:
+            part = self.current.read(size)
+
+            if part:
+                parts.append(part)
+                if size > 0:
+                    size -= len(part)
+                continue
+
+            try:
+                self.current = io.BytesIO(next(self.chunks))
+            except StopIteration:
+                break
+
+        return b"".join(parts)
+
+    def close(self):
+        close = getattr(self.chunks, "close", None)
+        if close is not None:
+            close()
+
+
+class AzureBlobProvider(MultipartProvider):
+    """
+    Downloads files from a replica of a bag in Azure Blob Storage.
+
+    This needs the ``azure-storage-blob`` package, which you can install
+    with the ``azure`` extra.  Our Azure replica is in the archive tier, so
+    blobs usually need to be rehydrated before they can be read.
+
+    :param blob_service_client: An ``azure.storage.blob.BlobServiceClient``
+        for the storage account with the bag.  If not supplied, one is created
+        for the account in ``AZURE_STORAGE_ACCOUNTS`` that holds the container.
+    :param credential: The credential to use if we're creating the client,
+        e.g. a SAS token.
+    """
+
+    def __init__(self, blob_service_client=None, credential=None, **kwargs):
+        self.blob_service_client = blob_service_client
+        self.credential = credential
+        self._service_clients = {}
+        super(AzureBlobProvider, self).__init__(**kwargs)
+
+    def _service_client(self, container):
+        if self.blob_service_client is not None:
+            return self.blob_service_client
+
+        try:
+            account = AZURE_STORAGE_ACCOUNTS[container]
+        except KeyError:
+            raise RuntimeError(
+                "Unrecognised Azure container: %s (pass a blob_service_client)"
+                % container
+            )
+
+        if account not in self._service_clients:
+            from azure.storage.blob import BlobServiceClient
+
+            self._service_clients[account] = BlobServiceClient(
+                account_url="https://%s.blob.core.windows.net" % account,
+                credential=self.credential,
+            )
+
+        return self._service_clients[account]
+
+    def _download_blob(self, location, manifest_file, **kwargs):
+        assert location["provider"]["id"] == "azure-blob-storage"
+
+        container = location["bucket"]
+        blob_name = posixpath.join(location["path"], manifest_file["path"])
+
+        blob_client = self._service_client(container).get_blob_client(
+            container=container, blob=blob_name
+        )
+        return _IterReader(blob_client.download_blob(**kwargs).chunks())
+
+    def get_fileobj(self, location, manifest_file):
+        return self._download_blob(location, manifest_file)
+
+    def get_range_fileobj(self, location, manifest_file, start, end):
+        return self._download_blob(
+            location, manifest_file, offset=start, length=end - start + 1
+        )
+
+
+_PROVIDER_CLASSES = {
+    "amazon-s3": S3InfrequentAccessProvider,
+    "azure-blob-storage": AzureBlobProvider,
+}
+
+
+class _PrefixedReader(object):
+    """
+    Wraps a binary file, and returns ``prefix`` before anything read from it.
+    """
+
+    def __init__(self, prefix, file_obj):
+        self.prefix = prefix
+        self.file_obj = file_obj
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunk, self.prefix = self.prefix + self.file_obj.read(), b""
+            return chunk
+
+        if len(self.prefix) >= size:
+            chunk, self.prefix = self.prefix[:size], self.prefix[size:]
+            return chunk
+
+        chunk = self.prefix + self.file_obj.read(size - len(self.prefix))
+        self.prefix = b""
+        return chunk
+
+    def close(self):
+        try:
+            self.file_obj.close()
+        except AttributeError:
+            pass
+
+
+def _close_result(fut):
+    """
+    Close the file returned by a future, if it succeeded.
+    """
+    if not fut.cancelled() and fut.exception() is None:
+        fut.result().close()
+
+
+def _location_key(location):
+    return (location["provider"]["id"], location["bucket"], location["path"])
+
+
+class _FailoverReader(object):
+    """
+    Reads bytes ``start`` to ``end`` (inclusive) of a file from a
+    ``ReplicaProvider``.  If a read fails or the stream ends early,
+    it carries on from the same offset in another replica.
+
+    If ``end`` is None, we read the whole file.
+    """
+
+    def __init__(self, replica_provider, location, manifest_file, start, end):
+        self.replica_provider = replica_provider
+        self.location = location
+        self.manifest_file = manifest_file
+        self.offset = start
+
+        self.current_location, self.file_obj = replica_provider._open_range(
+            location, manifest_file, start=start, end=end
+        )
+
+        if end is None and manifest_file.get("size") is not None:
+            self.end = manifest_file["size"] - 1
+        else:
+            self.end = end
+
+    def _failover(self, err):
+        self.replica_provider._record_failure(self.current_location)
+
+        # If we don't know how big the file is, we can't ask another
+        # replica for the rest of it.
+        if self.end is None or not self.replica_provider._has_alternatives(
+            self.location, self.current_location
+        ):
+            raise err
+
+        # Close the broken stream, so we don't leak its connection.  It's
+        # already failed, so we don't mind if closing it fails too.
+        try:
+            self.file_obj.close()
+        except Exception:
+            pass
+
+        self.current_location, self.file_obj = self.replica_provider._open_range(
+            self.location, self.manifest_file, start=self.offset, end=self.end
+        )
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b"".join(
+                iter(lambda: self.read(self.replica_provider.chunk_size), b"")
+            )
+
+        if self.end is not None:
+            size = min(size, self.end - self.offset + 1)
+
+            if size <= 0:
+                return b""
+
+        for _ in range(self.replica_provider.max_failovers + 1):
+            try:
+                chunk = self.file_obj.read(size)
+            except Exception as err:
+                self._failover(err)
+                continue
+
+            if not chunk and self.end is not None and self.offset <= self.end:
+                self._failover(
+                    IOError(
+                        "Short read of %s: stream ended at byte %d"
+                        % (self.manifest_file["name"], self.offset)
+                    )
+                )
+                continue
+
+            self.offset += len(chunk)
+            return chunk
+
+        raise IOError(
+            "Too many failed reads of %s from its replicas" % self.manifest_file["name"]
+        )
+
+    def close(self):
+        try:
+            self.file_obj.close()
+        except AttributeError:
+            pass
+
+
+class ReplicaProvider(MultipartProvider):
+    """
+    Downloads files from whichever copy of a bag is cheapest to read.
+
+    The ``location`` passed to each method is the bag's primary location;
+    ``replica_locations`` are the other copies, as in the ``replicaLocations``
+    of a storage manifest.  Locations are tried in order of ``provider_costs``,
+    so by default we read from S3 before Azure.  Locations with the same cost
+    are tried in the order they're listed, primary location first.
+
+    If a request fails (e.g. because S3 is throttling us, or the object is
+    in a cold storage class), we try the next location.  Reads that fail
+    partway through a file pick up at the same byte in another replica,
+    so we don't lose what we've already downloaded.  A location that's failed
+    is tried after the others for the next ``cooldown`` seconds.
+
+    If ``hedge_reads`` is True, we time how long each request takes to
+    return its first bytes.  If a request is slower than the
+    ``hedge_percentile``-th percentile of recent requests, we send the same
+    request to the next location, use whichever answers first, and close
+    the other.  This cuts the tail latency of bags with lots of small files,
+    where a handful of slow GETs can dominate the total time.  We send at most
+    ``max_hedge_ratio`` extra requests for every request.
+
+    :param providers: A dict of provider ID to the provider for that storage.
+        Providers for any other locations are created when first needed.
+    :param provider_costs: A dict of how expensive it is to read from each
+        location, lowest first.  Keys are either a provider ID (e.g.
+        ``"amazon-s3"``) or a (provider ID, bucket or container) tuple for a
+        single copy of the bag, which takes precedence.  Locations that don't
+        have a cost aren't read.  Defaults to ``DEFAULT_PROVIDER_COSTS``.
+    """
+
+    def __init__(
+        self,
+        replica_locations,
+        providers=None,
+        provider_costs=None,
+        cooldown=DEFAULT_REPLICA_COOLDOWN,
+        max_failovers=5,
+        hedge_reads=False,
+        hedge_percentile=DEFAULT_HEDGE_PERCENTILE,
+        max_hedge_ratio=DEFAULT_MAX_HEDGE_RATIO,
+        **kwargs
+    ):
+        self.replica_locations = list(replica_locations)
+        self.providers = dict(providers or {})
+        self.provider_costs = dict(provider_costs or DEFAULT_PROVIDER_COSTS)
+        self.cooldown = cooldown
+        self.max_failovers = max_failovers
+
+        self.hedge_reads = hedge_reads
+        self.hedge_percentile = hedge_percentile
+        self.first_byte_latency = LatencyTracker()
+        self.hedge_budget = RequestBudget(ratio=max_hedge_ratio)
+        self._hedge_executor = None
+
+        self._failures = {}
+        self._lock = threading.Lock()
+
+        super(ReplicaProvider, self).__init__(**kwargs)
+
+    def _provider(self, location):
+        provider_id = location["provider"]["id"]
+
+        with self._lock:
+            if provider_id not in self.providers:
+                self.providers[provider_id] = _choose_provider(location)
+            return self.providers[provider_id]
+
+    def _record_failure(self, location):
+        with self._lock:
+            self._failures[_location_key(location)] = time.time()
+
+    def _recently_failed(self, location):
+        failed_at = self._failures.get(_location_key(location))
+        return failed_at is not None and time.time() - failed_at < self.cooldown
+
+    def _cost(self, location):
+        """
+        Returns how expensive it is to read from ``location``, or None if
+        we shouldn't read from it.
+        """
+        provider_id = location["provider"]["id"]
+
+        try:
+            return self.provider_costs[(provider_id, location["bucket"])]
+        except KeyError:
+            return self.provider_costs.get(provider_id)
+
+    def _locations(self, location):
+        """
+        Returns every readable location for a bag, in the order we should
+        try them.
+        """
+        candidates = [
+            loc
+            for loc in [location] + self.replica_locations
+            if self._cost(loc) is not None
+        ]
+
+        if not candidates:
+            raise RuntimeError(
+                "Unsupported storage provider: %s" % location["provider"]["id"]
+            )
+
+        # This is a stable sort, so locations with the same cost stay
+        # in the order they appear in the storage manifest.
+        return sorted(
+            candidates, key=lambda loc: (self._recently_failed(loc), self._cost(loc))
+        )
+
+    def _has_alternatives(self, location, failed_location):
+        return any(
+            _location_key(loc) != _location_key(failed_location)
+            for loc in self._locations(location)
+        )
+
+    def _open(self, location, manifest_file, start, end):
+        provider = self._provider(location)
+
+        if start == 0 and end is None:
+            return provider.get_fileobj(location=location, manifest_file=manifest_file)
+        else:
+            return provider.get_range_fileobj(
+                location=location, manifest_file=manifest_file, start=start, end=end
+            )
+
+    def _open_and_read(self, location, manifest_file, start, end):
+        """
+        Opens a file and reads the first bytes, recording how long it took.
+        """
+        started = time.time()
+
+        file_obj = self._open(location, manifest_file, start, end)
+        first_chunk = file_obj.read(HEDGE_FIRST_READ_SIZE)
+
+        self.first_byte_latency.record(time.time() - started)
+
+        return _PrefixedReader(first_chunk, file_obj)
+
+    def _executor(self):
+        with self._lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=DEFAULT_MAX_POOL_CONNECTIONS
+                )
+            return self._hedge_executor
+
+    def close(self):
+        """
+        Shuts down the threads used for hedged reads, if we started any.
+        """
+        with self._lock:
+            executor = self._hedge_executor
+            self._hedge_executor = None
+
+        if executor is not None:
+            executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _open_hedged(self, location, backup_locations, manifest_file, start, end):
+        """
+        Returns (location, file_obj) for ``location``, or for the first
+        of ``backup_locations`` if ``location`` is slow and we have
+        budget for another request.
+
+        If we send a hedged request, its location is removed from
+        ``backup_locations``.
+        """
+        self.hedge_budget.record_request()
+        hedge_after = self.first_byte_latency.percentile(self.hedge_percentile)
+
+        started = threading.Event()
+
+        def _open_and_read():
+            started.set()
+            return self._open_and_read(location, manifest_file, start, end)
+
+        executor = self._executor()
+        futures = {executor.submit(_open_and_read): location}
+
+        # Only start the timer once a thread has picked up the request:
+        # time spent queueing behind other reads doesn't mean this
+        # location is slow.
+        started.wait()
+        done, _ = concurrent.futures.wait(futures, timeout=hedge_after)
+
+        if not done and backup_locations and self.hedge_budget.try_spend():
+            backup = backup_locations.pop(0)
+            futures[
+                executor.submit(self._open_and_read, backup, manifest_file, start, end)
+            ] = backup
+
+        errors = []
+        pending = set(futures)
+
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+
+            for fut in done:
+                try:
+                    file_obj = fut.result()
+                except Exception as err:
+                    self._record_failure(futures[fut])
+                    errors.append(err)
+                    continue
+
+                # We don't need the other request any more; close it if it's
+                # already started.
+                for other in pending:
+                    if not other.cancel():
+                        other.add_done_callback(_close_result)
+
+                return futures[fut], file_obj
+
+        raise errors[0]
+
+    def _open_range(self, location, manifest_file, start, end):
+        """
+        Returns (location, file_obj) for the first copy of a file we can
+        open, or raises the error from the preferred location if we
+        can't open any of them.
+        """
+        errors = []
+        candidates = self._locations(location)
+
+        while candidates:
+            candidate = candidates.pop(0)
+
+            try:
+                if self.hedge_reads:
+                    return self._open_hedged(
+                        candidate, candidates, manifest_file, start, end
+                    )
+                else:
+                    return (
+                        candidate,
+                        self._open(candidate, manifest_file, start, end),
+                    )
+            except Exception as err:
+                self._record_failure(candidate)
+                errors.append(err)
+
+        raise errors[0]
+
+    def get_fileobj(self, location, manifest_file):
+        return _FailoverReader(
+            self, location=location, manifest_file=manifest_file, start=0, end=None
+        )
+
+    def get_range_fileobj(self, location, manifest_file, start, end):
+        return _FailoverReader(
+            self, location=location, manifest_file=manifest_file, start=start, end=end
+        )
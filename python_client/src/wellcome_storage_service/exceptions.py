@@ -26,3 +26,59 @@ class UserError(StorageServiceException):
     """Raised if we get a 4xx User Error from the storage service."""
 
     pass
+
+
+class IngestWaitTimeout(StorageServiceException):
+    """Raised if an ingest doesn't finish before ``wait_for_ingests()`` times out."""
+
+    def __init__(self, ingest_url, last_status):
+        self.ingest_url = ingest_url
+        self.last_status = last_status
+
+        super(IngestWaitTimeout, self).__init__(
+            "Timed out waiting for ingest %s (last status: %s)"
+            % (ingest_url, last_status)
+        )
+
+
+class BagDownloadError(StorageServiceException):
+    """
+    Raised if one or more files in a bag couldn't be downloaded.
+
+    The ``errors`` attribute is a dict mapping the name of each file that
+    failed to the exception raised while downloading it.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+
+        # Only include the first few errors in the message -- if something
+        # has gone wrong with every file in a large bag, the full list would
+        # be unreadable.  The complete set is always available on ``errors``.
+        shown = sorted(errors)[:5]
+        message = "Errors downloading %d file%s from bag: %s" % (
+            len(errors),
+            "" if len(errors) == 1 else "s",
+            "; ".join("%s: %s" % (name, errors[name]) for name in shown),
+        )
+        if len(errors) > len(shown):
+            message += "; ..."
+
+        super(BagDownloadError, self).__init__(message)
+
+
+class ChecksumMismatch(StorageServiceException):
+    """
+    Raised if a downloaded file doesn't match the checksum in its manifest.
+    """
+
+    def __init__(self, name, checksum_algorithm, expected, actual):
+        self.name = name
+        self.checksum_algorithm = checksum_algorithm
+        self.expected = expected
+        self.actual = actual
+
+        super(ChecksumMismatch, self).__init__(
+            "%s checksum of %s does not match: expected %s, got %s"
+            % (checksum_algorithm, name, expected, actual)
+        )
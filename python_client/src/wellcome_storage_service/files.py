@@ -0,0 +1,285 @@
+"""
+Seekable, read-only file objects for the files in a bag, which fetch
+byte ranges from storage as they're needed.
+"""
+
+import collections
+import errno
+import io
+
+from .downloader import _all_files_with_algorithm, _choose_bag_provider
+from .manifest import StorageManifest
+
+
+# How many bytes to fetch from storage at a time, and how many of those
+# blocks to keep in memory.
+DEFAULT_BLOCK_SIZE = 256 * 1024
+DEFAULT_MAX_BLOCKS = 64
+
+# If a file is being read sequentially, we fetch up to this many blocks
+# ahead in a single request.
+DEFAULT_MAX_READAHEAD_BLOCKS = 32
+
+
+class BagFile(io.RawIOBase):
+    """
+    A seekable, read-only binary file for a single ``manifest_file`` in a bag.
+
+    Nothing is downloaded until you read from the file; then we fetch the
+    ``block_size`` blocks that cover the bytes you asked for, using ranged
+    requests.  The most recently used ``max_blocks`` blocks are kept in
+    memory, so libraries that jump around a file (``zipfile``, ``tarfile``,
+    ``lxml``, PIL) only fetch the parts they need, and only fetch them once.
+
+    If you read a file from start to finish, we fetch more blocks at a time,
+    so we aren't waiting for a request every ``block_size`` bytes.
+
+    A ``BagFile`` isn't safe to share between threads; open one per thread.
+    """
+
+    def __init__(
+        self,
+        provider,
+        location,
+        manifest_file,
+        block_size=DEFAULT_BLOCK_SIZE,
+        max_blocks=DEFAULT_MAX_BLOCKS,
+        max_readahead_blocks=DEFAULT_MAX_READAHEAD_BLOCKS,
+    ):
+        super(BagFile, self).__init__()
+
+        self.provider = provider
+        self.location = location
+        self.manifest_file = manifest_file
+        self.name = manifest_file["name"]
+        self.size = manifest_file["size"]
+
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.max_readahead_blocks = min(max_readahead_blocks, max_blocks)
+
+        self._blocks = collections.OrderedDict()
+        self._position = 0
+        self._last_read_end = None
+        self._readahead_blocks = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError("Invalid whence (%r)" % whence)
+
+        if position < 0:
+            raise ValueError("Negative seek position %d" % position)
+
+        self._position = position
+        return position
+
+    def close(self):
+        self._blocks.clear()
+        super(BagFile, self).close()
+
+    def _fetch(self, first_block, last_block):
+        """
+        Fetch blocks ``first_block`` to ``last_block`` (inclusive) in a single
+        request, and returns a list of their contents.
+        """
+        start = first_block * self.block_size
+        end = min((last_block + 1) * self.block_size, self.size) - 1
+
+        data = self.provider.get_range_fileobj(
+            location=self.location,
+            manifest_file=self.manifest_file,
+            start=start,
+            end=end,
+        ).read(end - start + 1)
+
+        if len(data) != end - start + 1:
+            raise IOError(
+                "Short read for bytes %d-%d of %s: only got %d bytes"
+                % (start, end, self.name, len(data))
+            )
+
+        return [
+            data[i:i + self.block_size] for i in range(0, len(data), self.block_size)
+        ]
+
+    def _cache(self, index, block):
+        self._blocks[index] = block
+
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+
+    def _readahead_end(self, last_block, readahead_blocks):
+        """
+        Returns the last block to fetch if we're reading ``readahead_blocks``
+        past ``last_block``.  We stop early at the end of the file, or at a
+        block that's already cached.
+        """
+        final_block = (self.size - 1) // self.block_size
+        readahead_end = min(last_block + readahead_blocks, final_block)
+
+        end = last_block
+        while end < readahead_end and end + 1 not in self._blocks:
+            end += 1
+
+        return end
+
+    def _get_blocks(self, first_block, last_block, readahead_blocks):
+        """
+        Returns the contents of blocks ``first_block`` to ``last_block``,
+        fetching any that aren't in the cache.  Runs of missing blocks are
+        fetched with a single request, and the final run is extended by
+        ``readahead_blocks``.
+        """
+        blocks = {}
+        missing = []
+
+        for index in range(first_block, last_block + 1):
+            try:
+                # Move this block to the most-recently-used end of the cache
+                blocks[index] = self._blocks.pop(index)
+                self._blocks[index] = blocks[index]
+            except KeyError:
+                missing.append(index)
+
+        runs = _contiguous_runs(missing)
+
+        if runs and runs[-1][1] == last_block:
+            runs[-1][1] = self._readahead_end(last_block, readahead_blocks)
+
+        for run_start, run_end in runs:
+            for index, block in enumerate(
+                self._fetch(run_start, run_end), start=run_start
+            ):
+                if index <= last_block:
+                    blocks[index] = block
+                self._cache(index, block)
+
+        return [blocks[index] for index in range(first_block, last_block + 1)]
+
+    def readinto(self, buf):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+
+        start = self._position
+        end = min(start + len(buf), self.size)
+
+        if start >= end:
+            return 0
+
+        # If we're reading the file in order, fetch more and more blocks
+        # ahead of where we are.
+        if start == self._last_read_end:
+            self._readahead_blocks = min(
+                max(1, self._readahead_blocks * 2), self.max_readahead_blocks
+            )
+        else:
+            self._readahead_blocks = 0
+
+        first_block = start // self.block_size
+        last_block = (end - 1) // self.block_size
+
+        view = memoryview(buf)
+        written = 0
+
+        for index, block in enumerate(
+            self._get_blocks(first_block, last_block, self._readahead_blocks),
+            start=first_block,
+        ):
+            block_start = index * self.block_size
+            chunk_start = max(start, block_start) - block_start
+            chunk_end = min(end - block_start, len(block))
+            chunk = block[chunk_start:chunk_end]
+            view[written:written + len(chunk)] = chunk
+            written += len(chunk)
+
+        self._position = end
+        self._last_read_end = end
+        return written
+
+
+def _contiguous_runs(indexes):
+    """
+    Groups a sorted list of block indexes into [first, last] runs of
+    consecutive blocks, e.g. [1, 2, 3, 7, 8] becomes [[1, 3], [7, 8]].
+    """
+    runs = []
+
+    for index in indexes:
+        if runs and runs[-1][1] == index - 1:
+            runs[-1][1] = index
+        else:
+            runs.append([index, index])
+
+    return runs
+
+
+def _find_manifest_file(storage_manifest, name):
+    if isinstance(storage_manifest, StorageManifest):
+        manifest_file = storage_manifest.get_file(name)
+        if manifest_file is not None:
+            return manifest_file.as_dict()
+    else:
+        for manifest_file, _ in _all_files_with_algorithm(storage_manifest):
+            if manifest_file["name"] == name:
+                return manifest_file
+
+    raise IOError(errno.ENOENT, "No such file in bag", name)
+
+
+def open_bag_file(
+    storage_manifest,
+    name,
+    block_size=DEFAULT_BLOCK_SIZE,
+    max_blocks=DEFAULT_MAX_BLOCKS,
+    use_replicas=False,
+    providers=None,
+    provider_costs=None,
+):
+    """
+    Open a file in a bag for reading, without downloading the whole file.
+    Returns a seekable ``BagFile``.
+
+    :param storage_manifest: A storage manifest returned from the storage
+        service, as retrieved with ``get_bag()``, or a ``StorageManifest``.
+    :param name: The name of the file in the bag, e.g. ``"data/b12345.xml"``.
+    :param block_size: How many bytes to fetch at a time.
+    :param max_blocks: How many blocks to keep in memory.
+    :param use_replicas: See ``download_bag()``.
+    :param providers: See ``download_bag()``.
+    :param provider_costs: See ``download_bag()``.
+
+    """
+    manifest_file = _find_manifest_file(storage_manifest, name)
+
+    provider = _choose_bag_provider(
+        storage_manifest,
+        use_replicas=use_replicas,
+        providers=providers,
+        provider_costs=provider_costs,
+    )
+
+    return BagFile(
+        provider,
+        location=storage_manifest["location"],
+        manifest_file=manifest_file,
+        block_size=block_size,
+        max_blocks=max_blocks,
+    )
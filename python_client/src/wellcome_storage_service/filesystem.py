@@ -0,0 +1,245 @@
+"""
+A read-only fsspec filesystem for a bag in the storage service, so tools
+like pandas, Dask and Jupyter can read files straight out of a stored bag:
+
+    import pandas as pd
+
+    df = pd.read_csv(
+        "wellcome-bag://digitised/b12345678?version=v3/data/metadata.csv",
+        storage_options={"client": client},
+    )
+
+URLs are ``wellcome-bag://{space}/{external_identifier}/{name}``, with an
+optional ``?version=`` after the external identifier.  If the external
+identifier contains a slash, it needs to be percent-encoded.
+
+This needs the ``fsspec`` package, which you can install with the
+``fsspec`` extra.
+"""
+
+import re
+from urllib.parse import unquote
+
+from fsspec import AbstractFileSystem
+from fsspec.utils import stringify_path
+
+from .downloader import _choose_bag_provider
+from .files import DEFAULT_BLOCK_SIZE, DEFAULT_MAX_BLOCKS, BagFile
+from .manifest import StorageManifest
+
+
+PROTOCOL = "wellcome-bag"
+
+_BAG_URL_RE = re.compile(
+    r"^%s://(?P<space>[^/]+)/(?P<external_identifier>[^/?]+)"
+    r"(?:\?version=(?P<version>[^/]+))?(?:/(?P<name>.*))?$" % PROTOCOL
+)
+
+
+def parse_bag_url(url):
+    """
+    Returns (space, external_identifier, version, name) for a
+    ``wellcome-bag://`` URL.  The version is None if it isn't specified.
+    """
+    match = _BAG_URL_RE.match(url)
+    if match is None:
+        raise ValueError("Not a %s:// URL: %s" % (PROTOCOL, url))
+
+    return (
+        unquote(match.group("space")),
+        unquote(match.group("external_identifier")),
+        match.group("version"),
+        (match.group("name") or "").strip("/"),
+    )
+
+
+class BagFileSystem(AbstractFileSystem):
+    """
+    A read-only view of a single version of a bag.
+
+    Paths are the names of files in the bag, e.g. ``"data/b12345678.xml"``.
+    Directory listings come from the storage manifest, so we never list
+    the underlying bucket.  Files are opened as a ``BagFile``, which fetches
+    byte ranges as they're read.
+
+    :param client: A storage service client to fetch the bag with.  If not
+        supplied, we use ``prod_client()``.
+    :param version: The version of the bag, e.g. ``"v3"``.  If not supplied,
+        we use the latest version at the time the filesystem is created.
+    :param use_replicas: See ``download_bag()``.
+    :param providers: See ``download_bag()``.
+    :param provider_costs: See ``download_bag()``.
+    """
+
+    protocol = PROTOCOL
+    root_marker = ""
+
+    def __init__(
+        self,
+        space,
+        external_identifier,
+        version=None,
+        client=None,
+        use_replicas=False,
+        providers=None,
+        provider_costs=None,
+        **kwargs
+    ):
+        super(BagFileSystem, self).__init__(**kwargs)
+
+        if client is None:
+            from . import prod_client
+
+            client = prod_client()
+
+        self.manifest = StorageManifest.from_bag(
+            client.get_bag(space, external_identifier, version=version)
+        )
+        self.version = self.manifest["version"]
+
+        self.provider = _choose_bag_provider(
+            self.manifest,
+            use_replicas=use_replicas,
+            providers=providers,
+            provider_costs=provider_costs,
+        )
+
+    @classmethod
+    def _strip_protocol(cls, path):
+        if isinstance(path, list):
+            return [cls._strip_protocol(p) for p in path]
+
+        path = stringify_path(path)
+
+        if path.startswith(PROTOCOL + "://"):
+            _, _, _, path = parse_bag_url(path)
+
+        return path.strip("/")
+
+    @staticmethod
+    def _get_kwargs_from_urls(path):
+        space, external_identifier, version, _ = parse_bag_url(stringify_path(path))
+        return {
+            "space": space,
+            "external_identifier": external_identifier,
+            "version": version,
+        }
+
+    def _file_info(self, manifest_file):
+        return {
+            "name": manifest_file.name,
+            "size": manifest_file.size,
+            "type": "file",
+            "checksum": manifest_file.checksum,
+        }
+
+    def _directory_info(self, name):
+        return {"name": name, "size": 0, "type": "directory"}
+
+    def _entries(self, path, maxdepth=None):
+        """
+        Generates (name, info) for every file and directory below ``path``,
+        down to ``maxdepth`` levels.  Directories come before their contents.
+        """
+        prefix = path + "/" if path else ""
+        seen_dirs = set()
+
+        for manifest_file in self.manifest.files_with_prefix(prefix):
+            parts = manifest_file.name[len(prefix):].split("/")
+
+            for depth in range(1, len(parts)):
+                if maxdepth is not None and depth > maxdepth:
+                    break
+
+                dirname = prefix + "/".join(parts[:depth])
+                if dirname not in seen_dirs:
+                    seen_dirs.add(dirname)
+                    yield dirname, self._directory_info(dirname)
+
+            if maxdepth is None or len(parts) <= maxdepth:
+                yield manifest_file.name, self._file_info(manifest_file)
+
+    def info(self, path, **kwargs):
+        path = self._strip_protocol(path)
+
+        manifest_file = self.manifest.get_file(path)
+        if manifest_file is not None:
+            return self._file_info(manifest_file)
+
+        if path == "" or any(self.manifest.files_with_prefix(path + "/")):
+            return self._directory_info(path)
+
+        raise FileNotFoundError(path)
+
+    def ls(self, path, detail=True, **kwargs):
+        path = self._strip_protocol(path)
+
+        entries = sorted(
+            (info for _, info in self._entries(path, maxdepth=1)),
+            key=lambda info: info["name"],
+        )
+
+        if not entries:
+            # ``ls`` on a file returns the file itself
+            entries = [self.info(path)]
+
+        if detail:
+            return entries
+        else:
+            return [info["name"] for info in entries]
+
+    def find(self, path, maxdepth=None, withdirs=False, detail=False, **kwargs):
+        # The storage manifest has every file in the bag, so we can find
+        # them all at once, rather than listing one directory at a time.
+        path = self._strip_protocol(path)
+
+        if self.isfile(path):
+            entries = {path: self.info(path)}
+        else:
+            entries = {
+                name: info
+                for name, info in self._entries(path, maxdepth=maxdepth)
+                if withdirs or info["type"] == "file"
+            }
+
+            if withdirs and path:
+                entries[path] = self.info(path)
+
+        names = sorted(entries)
+
+        if detail:
+            return {name: entries[name] for name in names}
+        else:
+            return names
+
+    def _open(
+        self,
+        path,
+        mode="rb",
+        block_size=None,
+        autocommit=True,
+        cache_options=None,
+        **kwargs
+    ):
+        if mode != "rb":
+            raise NotImplementedError("%s is read-only" % PROTOCOL)
+
+        path = self._strip_protocol(path)
+
+        manifest_file = self.manifest.get_file(path)
+        if manifest_file is None:
+            raise FileNotFoundError(path)
+
+        if block_size in (None, "default"):
+            block_size = DEFAULT_BLOCK_SIZE
+
+        return BagFile(
+            self.provider,
+            location=self.manifest["location"],
+            manifest_file=manifest_file.as_dict(),
+            block_size=block_size,
+            max_blocks=(cache_options or {}).get("max_blocks", DEFAULT_MAX_BLOCKS),
+        )
+
+    def ukey(self, path):
+        return self.info(path)["checksum"]
@@ -0,0 +1,124 @@
+"""
+Helpers for following ingests through the storage service until they
+succeed or fail.
+"""
+
+import collections
+import random
+
+from ._utils import parse_timestamp
+
+
+TERMINAL_STATUSES = {"succeeded", "failed"}
+
+# How often to poll an ingest that's waiting for ``wait_for_ingests()``.
+# We poll busy ingests (ones with a recent event) more often than ingests
+# that have been quiet for a while.
+DEFAULT_MIN_POLL_INTERVAL = 5
+DEFAULT_MAX_POLL_INTERVAL = 300
+
+
+class IngestStage(
+    collections.namedtuple("IngestStage", ["description", "started", "duration"])
+):
+    """
+    One step of an ingest, as recorded in its ``events``.
+
+    ``started`` is a Unix timestamp.  ``duration`` is the number of seconds
+    until the next event, or None for the last event.
+    """
+
+
+class FinishedIngest(
+    collections.namedtuple("FinishedIngest", ["ingest", "status", "stages"])
+):
+    """
+    An ingest that's reached a terminal status, as returned by
+    ``wait_for_ingests()``.
+    """
+
+    @property
+    def succeeded(self):
+        return self.status == "succeeded"
+
+    @property
+    def duration(self):
+        """
+        How long (in seconds) from the ingest being created to its last event.
+        """
+        created = parse_timestamp(self.ingest.get("createdDate"))
+        if created is None or not self.stages:
+            return None
+        return self.stages[-1].started - created
+
+
+def ingest_status(ingest):
+    return ingest["status"]["id"]
+
+
+def _events_in_order(ingest):
+    events = []
+
+    for event in ingest.get("events", []):
+        started = parse_timestamp(event.get("createdDate"))
+        if started is not None:
+            events.append((started, event["description"]))
+
+    return sorted(events, key=lambda e: e[0])
+
+
+def ingest_stages(ingest):
+    """
+    Returns a list of ``IngestStage`` for every event on an ingest, in the
+    order they happened.
+    """
+    events = _events_in_order(ingest)
+
+    return [
+        IngestStage(
+            description=description,
+            started=started,
+            duration=(events[i + 1][0] - started) if i + 1 < len(events) else None,
+        )
+        for i, (started, description) in enumerate(events)
+    ]
+
+
+def last_activity(ingest):
+    """
+    Returns the Unix timestamp of the most recent event on an ingest, or
+    when it was created if there are no events yet.
+    """
+    events = _events_in_order(ingest)
+    if events:
+        return events[-1][0]
+    else:
+        return parse_timestamp(ingest.get("createdDate"))
+
+
+def next_poll_delay(
+    ingest,
+    now,
+    min_interval=DEFAULT_MIN_POLL_INTERVAL,
+    max_interval=DEFAULT_MAX_POLL_INTERVAL,
+):
+    """
+    Returns how long to wait before we check an ingest again.
+
+    An ingest that had an event a few seconds ago is probably moving
+    through the pipeline, so we check again soon.  One that's been quiet
+    for a while is probably waiting for something slow (a big bag being
+    verified or replicated), so we back off -- we wait about a quarter of
+    the time it's been quiet.  A little jitter stops lots of ingests that
+    were submitted together from being polled in lockstep.
+    """
+    last_event = last_activity(ingest)
+
+    if last_event is None:
+        delay = min_interval
+    else:
+        delay = (now - last_event) / 4.0
+
+    delay = min(max_interval, max(min_interval, delay))
+
+    return delay * random.uniform(0.9, 1.1)
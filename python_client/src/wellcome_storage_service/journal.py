@@ -0,0 +1,133 @@
+"""
+A record of the progress of a bag download, so an interrupted download can
+be resumed without fetching everything again.
+"""
+
+import collections
+import json
+import os
+import threading
+
+
+JOURNAL_NAME = ".wellcome-storage-download-journal"
+
+
+class DownloadJournal(object):
+    """
+    An append-only journal of the files (and byte ranges of large files)
+    that have been completely downloaded to a directory.
+
+    Each line is a JSON object, which is one of:
+
+    -   ``{"name": ..., "size": ..., "checksum": ...}`` for a complete file,
+        where ``checksum`` is the verified checksum, or ``null`` if the file
+        wasn't verified
+    -   ``{"name": ..., "range": [start, end]}`` for a byte range of a file
+        that's being downloaded in parts
+    -   ``{"name": ..., "range": null}`` if we've started downloading a file
+        in parts again, so any ranges recorded before it are out-of-date
+
+    Lines are only written once the data they describe has been written
+    to disk, so if the process dies, the worst case is that a few entries
+    are missing and the corresponding files get fetched again.
+    """
+
+    def __init__(self, out_dir):
+        self.path = os.path.join(out_dir, JOURNAL_NAME)
+
+        self._lock = threading.Lock()
+        self._files = {}
+        self._ranges = collections.defaultdict(set)
+
+        self._load()
+        self._journal_file = open(self.path, "a")
+
+    def _load(self):
+        try:
+            journal_file = open(self.path)
+        except IOError:
+            return
+
+        with journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # This is probably a line that was only half-written
+                    # when the previous download stopped.
+                    continue
+
+                if "range" in entry and entry["range"] is None:
+                    self._ranges.pop(entry["name"], None)
+                elif "range" in entry:
+                    self._ranges[entry["name"]].add(tuple(entry["range"]))
+                else:
+                    self._files[entry["name"]] = entry
+
+    def _append(self, entry):
+        with self._lock:
+            self._journal_file.write(json.dumps(entry) + "\n")
+            self._journal_file.flush()
+
+    def completed_file(self, out_dir, manifest_file):
+        """
+        Returns the journal entry for ``manifest_file`` if it's already been
+        downloaded to ``out_dir``, or None if it needs to be fetched.
+        """
+        entry = self._files.get(manifest_file["name"])
+
+        if entry is None or entry["size"] != manifest_file.get("size"):
+            return None
+
+        if entry["checksum"] not in (None, manifest_file.get("checksum")):
+            return None
+
+        out_path = os.path.join(out_dir, manifest_file["name"])
+
+        try:
+            if os.path.getsize(out_path) != entry["size"]:
+                return None
+        except OSError:
+            return None
+
+        return entry
+
+    def completed_ranges(self, name):
+        """
+        Returns the set of (start, end) byte ranges of a file that have
+        already been written to disk.
+        """
+        return self._ranges.get(name, set())
+
+    def record_file(self, manifest_file, checksum=None):
+        entry = {
+            "name": manifest_file["name"],
+            "size": manifest_file.get("size"),
+            "checksum": checksum,
+        }
+        self._files[entry["name"]] = entry
+        self._append(entry)
+
+    def record_range(self, name, byte_range):
+        with self._lock:
+            self._ranges[name].add(tuple(byte_range))
+        self._append({"name": name, "range": list(byte_range)})
+
+    def forget_ranges(self, name):
+        """
+        Discard the recorded ranges of a file, e.g. because we're about to
+        start downloading it from scratch.
+        """
+        with self._lock:
+            self._ranges.pop(name, None)
+        self._append({"name": name, "range": None})
+
+    def close(self):
+        self._journal_file.close()
+
+    def remove(self):
+        """
+        Close and delete the journal, once the download is complete.
+        """
+        self.close()
+        os.unlink(self.path)
@@ -0,0 +1,534 @@
+"""
+A compact, indexed representation of a storage manifest.
+
+The bags API returns every file in a bag as a JSON object, which becomes a
+dict with five string values in Python.  For a bag with a million files,
+that's gigabytes of memory.  Here we store the files column-wise instead:
+
+-   names are stored as UTF-8 in one byte string, and looked up by binary
+    search over an array of row numbers sorted by name, rather than in a
+    dict of string objects
+-   paths are stored as an index into a small table of prefixes (usually
+    just ``v1/``, ``v2/``, ...), because a path is almost always the name
+    of the file in a version directory
+-   sizes are stored in an ``array``, at 4 bytes each (or 8 if the bag has
+    a file bigger than 4GB)
+-   checksums are stored as fixed-width binary digests in one ``bytearray``,
+    rather than as hex strings
+
+For a typical bag, this is about a seventh of the memory of the parsed JSON.
+Most of what's left is the names and checksums themselves.
+
+"""
+
+import array
+import binascii
+import collections
+import itertools
+
+
+# Python 2 doesn't have the "Q" (unsigned long long) typecode.
+try:
+    array.array("Q")
+    _SIZE_TYPECODE = "Q"
+except ValueError:  # pragma: no cover
+    _SIZE_TYPECODE = "L"
+
+# When a value doesn't fit in an array, the typecode to switch to.
+_WIDER_TYPECODES = {"B": "I", "I": _SIZE_TYPECODE}
+
+
+def _append_int(values, value):
+    """
+    Append ``value`` to an array of ints, switching to a wider type if it
+    doesn't fit.  Returns the array, which may be a new one.
+    """
+    try:
+        values.append(value)
+    except OverflowError:
+        values = array.array(_WIDER_TYPECODES[values.typecode], values)
+        values.append(value)
+
+    return values
+
+
+class ManifestFile(
+    collections.namedtuple("ManifestFile", ["name", "path", "size", "checksum"])
+):
+    """
+    A single file in a ``StorageManifest``.  The checksum is a hex string.
+    """
+
+    def as_dict(self):
+        """
+        Returns the file in the same shape as the bags API.
+        """
+        return {
+            "checksum": self.checksum,
+            "name": self.name,
+            "path": self.path,
+            "size": self.size,
+            "type": "File",
+        }
+
+
+class FileTable(object):
+    """
+    The files in one of the manifests in a bag (either the payload or the
+    tag manifest), with their checksum algorithm.
+
+    Files are indexed by name the first time you look one up, which is when
+    any duplicate names are reported; ``from_dict()`` indexes the table
+    straight away.
+    """
+
+    def __init__(self, checksum_algorithm=None):
+        self.checksum_algorithm = checksum_algorithm
+        self.total_size = 0
+
+        self._name_bytes = bytearray()
+        self._name_ends = array.array("I")
+
+        self._prefixes = []
+        self._prefix_ids = {}
+        self._path_prefix = array.array("B")
+
+        # The few files whose path isn't (prefix + name) keep their full path
+        self._odd_paths = {}
+        self._rows_by_odd_path = {}
+
+        self._sizes = array.array("I")
+
+        self._digest_size = None
+        self._checksums = bytearray()
+
+        self._sorted_rows = None
+
+    @classmethod
+    def from_dict(cls, bag_manifest):
+        """
+        Build a table from a manifest in the bags API (e.g. ``bag["manifest"]``).
+        """
+        table = cls(checksum_algorithm=bag_manifest.get("checksumAlgorithm"))
+
+        for manifest_file in bag_manifest["files"]:
+            table.append(manifest_file)
+
+        table._rows_in_name_order()
+
+        return table
+
+    def append(self, manifest_file):
+        """
+        Add a file, as a dict in the same shape as the bags API.
+        """
+        name = manifest_file["name"]
+        path = manifest_file["path"]
+
+        row = len(self)
+
+        if path.endswith(name):
+            prefix = path[: len(path) - len(name)]
+        else:
+            prefix = ""
+            self._odd_paths[row] = path
+            self._rows_by_odd_path[path] = row
+
+        try:
+            prefix_id = self._prefix_ids[prefix]
+        except KeyError:
+            prefix_id = self._prefix_ids[prefix] = len(self._prefixes)
+            self._prefixes.append(prefix)
+
+        digest = binascii.unhexlify(manifest_file["checksum"])
+        if self._digest_size is None:
+            self._digest_size = len(digest)
+        elif len(digest) != self._digest_size:
+            raise ValueError(
+                "Checksum of %s is %d bytes, expected %d"
+                % (name, len(digest), self._digest_size)
+            )
+
+        # The names are frozen as ``bytes`` while the table is indexed
+        if not isinstance(self._name_bytes, bytearray):
+            self._name_bytes = bytearray(self._name_bytes)
+
+        self._name_bytes.extend(name.encode("utf8"))
+        self._name_ends.append(len(self._name_bytes))
+
+        self._path_prefix = _append_int(self._path_prefix, prefix_id)
+        self._sizes = _append_int(self._sizes, manifest_file["size"])
+        self._checksums.extend(digest)
+
+        self.total_size += manifest_file["size"]
+        self._sorted_rows = None
+
+    def _name_bytes_at(self, row):
+        start = self._name_ends[row - 1] if row > 0 else 0
+        return self._name_bytes[start:self._name_ends[row]]
+
+    def _name(self, row):
+        return self._name_bytes_at(row).decode("utf8")
+
+    def _checksum_bytes_at(self, row):
+        start = row * self._digest_size
+        return bytes(self._checksums[start:start + self._digest_size])
+
+    def _names_by_row(self):
+        """
+        Returns a list of the UTF-8 names, in the order they were added.
+        """
+        name_bytes = bytes(self._name_bytes)
+        return [
+            name_bytes[start:end]
+            for start, end in zip(
+                itertools.chain([0], self._name_ends), self._name_ends
+            )
+        ]
+
+    def _rows_in_name_order(self):
+        """
+        Returns an array of row numbers, sorted by name.
+        """
+        if self._sorted_rows is not None:
+            return self._sorted_rows
+
+        # Freeze the names: searching the index compares against slices of
+        # them, and a slice of ``bytes`` is one allocation where a slice of
+        # a ``bytearray`` is two (the object and its buffer).
+        self._name_bytes = bytes(self._name_bytes)
+
+        # UTF-8 sorts in the same order as the strings it encodes, so we
+        # can sort (and later search) the names without decoding them.
+        names = self._names_by_row()
+
+        sorted_rows = sorted(range(len(names)), key=names.__getitem__)
+
+        for row, next_row in zip(sorted_rows, sorted_rows[1:]):
+            if names[row] == names[next_row]:
+                raise ValueError(
+                    "Duplicate file in manifest: %s" % names[row].decode("utf8")
+                )
+
+        self._sorted_rows = array.array("I", sorted_rows)
+        return self._sorted_rows
+
+    def _bisect_left(self, key):
+        """
+        Returns the position in the index where the UTF-8 name ``key``
+        would go, as ``bisect.bisect_left()`` would.
+        """
+        sorted_rows = self._rows_in_name_order()
+        name_bytes = self._name_bytes
+        name_ends = self._name_ends
+
+        # This is bisect_left(), but it slices each name straight out of
+        # the buffer, rather than going through a sequence object's
+        # __getitem__ for every comparison.
+        lo, hi = 0, len(sorted_rows)
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            row = sorted_rows[mid]
+
+            if name_bytes[name_ends[row - 1] if row else 0:name_ends[row]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def _name_starts_with(self, row, key):
+        """
+        Returns True if the UTF-8 name in ``row`` starts with ``key``,
+        without copying it out of the buffer.
+        """
+        start = self._name_ends[row - 1] if row else 0
+        return self._name_bytes.startswith(key, start, self._name_ends[row])
+
+    def _row(self, name):
+        """
+        Returns the row number of the file with this name, or None.
+        """
+        key = name.encode("utf8")
+        i = self._bisect_left(key)
+
+        if i < len(self):
+            row = self._sorted_rows[i]
+            start = self._name_ends[row - 1] if row else 0
+
+            if self._name_ends[row] - start == len(key) and self._name_starts_with(
+                row, key
+            ):
+                return row
+
+        return None
+
+    def _file(self, row):
+        name = self._name(row)
+
+        try:
+            path = self._odd_paths[row]
+        except KeyError:
+            path = self._prefixes[self._path_prefix[row]] + name
+
+        digest = self._checksum_bytes_at(row)
+
+        return ManifestFile(
+            name=name,
+            path=path,
+            size=self._sizes[row],
+            checksum=binascii.hexlify(digest).decode("ascii"),
+        )
+
+    def __len__(self):
+        return len(self._name_ends)
+
+    def index(self):
+        """
+        Index the files by name, if they aren't already.
+
+        This happens the first time you look up a file, but you can call it
+        to report duplicate names (with a ValueError) up front.
+        """
+        self._rows_in_name_order()
+
+    def file_at(self, i):
+        """
+        Returns the ``i``-th file, in the order they were added.
+        """
+        if not 0 <= i < len(self):
+            raise IndexError("File index out of range: %d" % i)
+
+        return self._file(i)
+
+    def iter_raw(self):
+        """
+        Generates a (name, digest) pair for every file, in the order they
+        were added.  The name is UTF-8 and the digest is the binary checksum.
+
+        This doesn't build a ``ManifestFile`` for each file, so it's much
+        quicker if you only need to compare files; use ``file_at()`` to
+        get the ones you're interested in.
+        """
+        names = self._names_by_row()
+        checksums = bytes(self._checksums)
+        digest_size = self._digest_size
+
+        for row, name in enumerate(names):
+            start = row * digest_size
+            yield name, checksums[start:start + digest_size]
+
+    def __contains__(self, name):
+        return self._row(name) is not None
+
+    def __iter__(self):
+        """
+        Generates every file, in the order they were added.
+        """
+        for row in range(len(self)):
+            yield self._file(row)
+
+    def get(self, name):
+        """
+        Returns the file with this name, or None if there isn't one.
+        """
+        row = self._row(name)
+        if row is None:
+            return None
+        return self._file(row)
+
+    def get_by_path(self, path):
+        """
+        Returns the file with this path, or None if there isn't one.
+        """
+        if path in self._rows_by_odd_path:
+            return self._file(self._rows_by_odd_path[path])
+
+        # There are only a handful of prefixes, one per version of the bag
+        # that files come from.
+        for prefix_id, prefix in enumerate(self._prefixes):
+            if not path.startswith(prefix):
+                continue
+
+            row = self._row(path[len(prefix):])
+            if row is None or row in self._odd_paths:
+                continue
+
+            if self._path_prefix[row] == prefix_id:
+                return self._file(row)
+
+        return None
+
+    def with_prefix(self, prefix):
+        """
+        Generates every file whose name starts with ``prefix``, in name order.
+        """
+        key = prefix.encode("utf8")
+
+        for i in range(self._bisect_left(key), len(self)):
+            row = self._sorted_rows[i]
+            if not self._name_starts_with(row, key):
+                break
+            yield self._file(row)
+
+    def size_with_prefix(self, prefix):
+        """
+        Returns the total size of every file whose name starts with ``prefix``.
+        """
+        return sum(f.size for f in self.with_prefix(prefix))
+
+    def as_dict(self):
+        """
+        Returns the manifest in the same shape as the bags API.
+        """
+        return {
+            "checksumAlgorithm": self.checksum_algorithm,
+            "files": [f.as_dict() for f in self],
+            "type": "BagManifest",
+        }
+
+
+class StorageManifest(object):
+    """
+    A compact, indexed version of a storage manifest from the bags API.
+
+    The payload and tag files are in ``manifest`` and ``tag_manifest``.
+    Everything else in the bag can be looked up like a dict, e.g.
+    ``storage_manifest["location"]``, so you can pass this to the download
+    functions in place of the response from ``get_bag()``.
+    """
+
+    def __init__(self, metadata, manifest, tag_manifest):
+        self.metadata = metadata
+        self.manifest = manifest
+        self.tag_manifest = tag_manifest
+
+    @classmethod
+    def from_bag(cls, bag):
+        """
+        Build a manifest from a bags API response, as returned by ``get_bag()``.
+        """
+        metadata = {
+            key: value
+            for key, value in bag.items()
+            if key not in ("manifest", "tagManifest")
+        }
+
+        return cls(
+            metadata=metadata,
+            manifest=FileTable.from_dict(bag["manifest"]),
+            tag_manifest=FileTable.from_dict(bag["tagManifest"]),
+        )
+
+    @classmethod
+    def from_streaming_bag(cls, streaming_bag):
+        """
+        Build a manifest from a ``StreamingBag``, as returned by
+        ``iter_bag_files()``.  The full response is never held in memory.
+        """
+        tables = {}
+
+        for entry in streaming_bag:
+            try:
+                table = tables[entry.manifest]
+            except KeyError:
+                table = tables[entry.manifest] = FileTable(
+                    checksum_algorithm=entry.checksum_algorithm
+                )
+
+            table.append(entry.file)
+
+        metadata = dict(streaming_bag.finish())
+
+        for key in ("manifest", "tagManifest"):
+            manifest_metadata = metadata.pop(key, {})
+            table = tables.setdefault(key, FileTable())
+            if "checksumAlgorithm" in manifest_metadata:
+                table.checksum_algorithm = manifest_metadata["checksumAlgorithm"]
+
+            table._rows_in_name_order()
+
+        return cls(
+            metadata=metadata,
+            manifest=tables["manifest"],
+            tag_manifest=tables["tagManifest"],
+        )
+
+    def __getitem__(self, key):
+        return self.metadata[key]
+
+    def get(self, key, default=None):
+        return self.metadata.get(key, default)
+
+    def __len__(self):
+        return len(self.manifest) + len(self.tag_manifest)
+
+    def __iter__(self):
+        """
+        Generates every file in the bag, payload files first.
+        """
+        for table in (self.manifest, self.tag_manifest):
+            for manifest_file in table:
+                yield manifest_file
+
+    def files_with_algorithm(self):
+        """
+        Generates (file, checksum_algorithm) pairs for every file in the bag,
+        where the file is a dict in the same shape as the bags API.
+        """
+        for table in (self.manifest, self.tag_manifest):
+            for manifest_file in table:
+                yield manifest_file.as_dict(), table.checksum_algorithm
+
+    @property
+    def total_size(self):
+        return self.manifest.total_size + self.tag_manifest.total_size
+
+    def __contains__(self, name):
+        return name in self.manifest or name in self.tag_manifest
+
+    def get_file(self, name):
+        """
+        Returns the file with this name, or None if there isn't one.
+        """
+        manifest_file = self.manifest.get(name)
+        if manifest_file is None:
+            manifest_file = self.tag_manifest.get(name)
+        return manifest_file
+
+    def get_file_by_path(self, path):
+        """
+        Returns the file with this path, or None if there isn't one.
+        """
+        manifest_file = self.manifest.get_by_path(path)
+        if manifest_file is None:
+            manifest_file = self.tag_manifest.get_by_path(path)
+        return manifest_file
+
+    def files_with_prefix(self, prefix):
+        """
+        Generates every file whose name starts with ``prefix``, e.g. all
+        the files in ``data/objects/``.
+        """
+        for table in (self.manifest, self.tag_manifest):
+            for manifest_file in table.with_prefix(prefix):
+                yield manifest_file
+
+    def size_with_prefix(self, prefix):
+        """
+        Returns the total size of every file whose name starts with ``prefix``.
+        """
+        return sum(
+            table.size_with_prefix(prefix)
+            for table in (self.manifest, self.tag_manifest)
+        )
+
+    def as_dict(self):
+        """
+        Returns the manifest in the same shape as the bags API.
+        """
+        bag = dict(self.metadata)
+        bag["manifest"] = self.manifest.as_dict()
+        bag["tagManifest"] = self.tag_manifest.as_dict()
+        return bag
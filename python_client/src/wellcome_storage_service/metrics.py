@@ -0,0 +1,363 @@
+"""
+Instrumentation for the client and the downloader, so you can see where
+the time goes: API calls, token refreshes, retries and file downloads.
+
+    metrics = Metrics()
+
+    client = prod_client(instrumentation=metrics)
+    bag = client.get_bag("digitised", "b12345678")
+    download_bag(bag, out_dir="b12345678", instrumentation=metrics)
+
+    print(metrics.summary())
+
+To send events somewhere else (e.g. your own monitoring), subclass
+``Instrumentation`` and pass that instead.
+"""
+
+import atexit
+import json
+import sys
+import threading
+import time
+
+
+# The upper bounds (in seconds) of the latency histogram buckets.  These
+# are the Prometheus client defaults, with a few more for slow downloads.
+DEFAULT_LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.075,
+    0.1,
+    0.25,
+    0.5,
+    0.75,
+    1.0,
+    2.5,
+    5.0,
+    7.5,
+    10.0,
+    30.0,
+    60.0,
+    300.0,
+)
+
+
+class Instrumentation(object):
+    """
+    Receives events from the client and the downloader.
+
+    The methods here do nothing; override the ones you're interested in.
+    They may be called from several threads at once, so they should be
+    quick and thread-safe.
+    """
+
+    def on_request(self, kind, duration, size=0, status_code=None, error=None):
+        """
+        Called when a request finishes.
+
+        :param kind: What sort of request it was: ``"api"`` for a call to
+            the storage service API, ``"token"`` for fetching an OAuth
+            token, or ``"download"`` for downloading a file in a bag.
+        :param duration: How long it took, in seconds.
+        :param size: How many bytes we received.
+        :param status_code: The HTTP status code, if there was one.
+        :param error: The exception, if the request failed.
+        """
+
+    def on_retry(self, kind):
+        """
+        Called when we retry a request of this kind.
+        """
+
+
+def record_request(instrumentation, kind, make_request, size=None):
+    """
+    Calls ``make_request()``, reports it to ``instrumentation`` (if it's
+    not None), and returns the result.
+
+    ``size`` is a function that returns the number of bytes in the result,
+    or None if we don't know; unknown sizes are reported as 0 bytes.
+    """
+    if instrumentation is None:
+        return make_request()
+
+    start = time.time()
+
+    try:
+        result = make_request()
+    except Exception as err:
+        instrumentation.on_request(kind, duration=time.time() - start, error=err)
+        raise
+
+    result_size = size(result) if size is not None else None
+
+    instrumentation.on_request(
+        kind,
+        duration=time.time() - start,
+        size=result_size if result_size is not None else 0,
+        status_code=getattr(result, "status_code", None),
+    )
+
+    return result
+
+
+class Histogram(object):
+    """
+    Counts observations in buckets with fixed upper bounds, like a
+    Prometheus histogram, so it uses the same memory however many
+    observations it gets.
+    """
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                break
+        else:
+            i = len(self.buckets)
+
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """
+        Returns a list of (upper bound, number of observations <= bound),
+        ending with ``float("inf")``.
+        """
+        result = []
+        running_total = 0
+
+        for upper_bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            running_total += count
+            result.append((upper_bound, running_total))
+
+        return result
+
+    def percentile(self, p):
+        """
+        Estimates the ``p``-th percentile by interpolating within the bucket
+        it falls in, or returns None if there are no observations.
+        """
+        if self.count == 0:
+            return None
+
+        rank = p / 100.0 * self.count
+        lower_bound, below = 0.0, 0
+
+        for upper_bound, cumulative in self.cumulative_counts():
+            if cumulative >= rank:
+                # Anything in the overflow bucket is reported as the largest
+                # bound, since we don't know how big it was.
+                if upper_bound == float("inf"):
+                    return lower_bound
+
+                in_bucket = cumulative - below
+                fraction = (rank - below) / in_bucket if in_bucket else 1.0
+                return lower_bound + (upper_bound - lower_bound) * fraction
+
+            lower_bound, below = upper_bound, cumulative
+
+
+class _KindStats(object):
+    def __init__(self, buckets):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.latency = Histogram(buckets)
+
+
+class Metrics(Instrumentation):
+    """
+    Collects the latency, size and outcome of every request, grouped by
+    kind, and reports them as a summary, JSON, or in the Prometheus text
+    format.
+
+    Throughput is the bytes received since the ``Metrics`` was created,
+    divided by the time since then.
+    """
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.started_at = time.time()
+
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _get_stats(self, kind):
+        try:
+            return self._stats[kind]
+        except KeyError:
+            stats = self._stats[kind] = _KindStats(self.buckets)
+            return stats
+
+    def on_request(self, kind, duration, size=0, status_code=None, error=None):
+        with self._lock:
+            stats = self._get_stats(kind)
+            stats.requests += 1
+            stats.bytes += size
+            stats.latency.observe(duration)
+
+            if error is not None or (status_code is not None and status_code >= 500):
+                stats.errors += 1
+
+    def on_retry(self, kind):
+        with self._lock:
+            self._get_stats(kind).retries += 1
+
+    def as_dict(self):
+        """
+        Returns the metrics as a JSON-serialisable dict.
+        """
+        with self._lock:
+            elapsed = time.time() - self.started_at
+
+            return {
+                "elapsed": elapsed,
+                "requests": {
+                    kind: {
+                        "count": stats.requests,
+                        "errors": stats.errors,
+                        "retries": stats.retries,
+                        "bytes": stats.bytes,
+                        "throughput": stats.bytes / elapsed if elapsed else 0,
+                        "latency": {
+                            "sum": stats.latency.sum,
+                            "p50": stats.latency.percentile(50),
+                            "p95": stats.latency.percentile(95),
+                            "p99": stats.latency.percentile(99),
+                        },
+                    }
+                    for kind, stats in self._stats.items()
+                },
+            }
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def to_prometheus(self, prefix="wellcome_storage"):
+        """
+        Returns the metrics in the Prometheus text exposition format, e.g.
+        to write to a file for the node exporter's textfile collector.
+        """
+        lines = []
+
+        def _metric(name, metric_type, help_text, samples):
+            lines.append("# HELP %s_%s %s" % (prefix, name, help_text))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, metric_type))
+            for suffix, labels, value in samples:
+                label_str = ",".join('%s="%s"' % kv for kv in labels)
+                lines.append("%s_%s%s{%s} %s" % (prefix, name, suffix, label_str, value))
+
+        with self._lock:
+            stats = sorted(self._stats.items())
+
+            _metric(
+                "requests_total",
+                "counter",
+                "Requests made.",
+                [("", [("kind", k)], s.requests) for k, s in stats],
+            )
+            _metric(
+                "request_errors_total",
+                "counter",
+                "Requests that failed.",
+                [("", [("kind", k)], s.errors) for k, s in stats],
+            )
+            _metric(
+                "retries_total",
+                "counter",
+                "Requests that were retried.",
+                [("", [("kind", k)], s.retries) for k, s in stats],
+            )
+            _metric(
+                "received_bytes_total",
+                "counter",
+                "Bytes received.",
+                [("", [("kind", k)], s.bytes) for k, s in stats],
+            )
+
+            histogram_samples = []
+            for kind, s in stats:
+                for upper_bound, count in s.latency.cumulative_counts():
+                    le = "+Inf" if upper_bound == float("inf") else repr(upper_bound)
+                    histogram_samples.append(
+                        ("_bucket", [("kind", kind), ("le", le)], count)
+                    )
+                histogram_samples.append(("_sum", [("kind", kind)], s.latency.sum))
+                histogram_samples.append(
+                    ("_count", [("kind", kind)], s.latency.count)
+                )
+
+            _metric(
+                "request_duration_seconds",
+                "histogram",
+                "How long requests took.",
+                histogram_samples,
+            )
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Returns a human-readable summary, one line per kind of request.
+        """
+        metrics = self.as_dict()
+        lines = ["%.1fs elapsed" % metrics["elapsed"]]
+
+        for kind, stats in sorted(metrics["requests"].items()):
+            latency = stats["latency"]
+            lines.append(
+                "%s: %d requests (%d errors, %d retries), %s received (%s/s), "
+                "latency p50=%s p95=%s p99=%s"
+                % (
+                    kind,
+                    stats["count"],
+                    stats["errors"],
+                    stats["retries"],
+                    _human_bytes(stats["bytes"]),
+                    _human_bytes(stats["throughput"]),
+                    _human_seconds(latency["p50"]),
+                    _human_seconds(latency["p95"]),
+                    _human_seconds(latency["p99"]),
+                )
+            )
+
+        return "\n".join(lines)
+
+    def print_summary_at_exit(self, out_file=None):
+        """
+        Print the summary when the process exits, e.g. at the end of a
+        script.  Prints to stderr unless ``out_file`` is supplied.
+        """
+
+        def _print_summary():
+            (out_file or sys.stderr).write(self.summary() + "\n")
+
+        atexit.register(_print_summary)
+
+
+def _human_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+
+    return "%.1f TB" % size
+
+
+def _human_seconds(seconds):
+    if seconds is None:
+        return "-"
+    elif seconds < 1:
+        return "%.0fms" % (seconds * 1000)
+    else:
+        return "%.2fs" % seconds
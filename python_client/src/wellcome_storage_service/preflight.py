@@ -0,0 +1,1055 @@
+"""
+Check a bag on the local disk (or in a tar archive) before ingesting it,
+using the same rules as the storage service's bag verifier.
+
+A bag that fails verification in the storage service has already been
+uploaded, unpacked and passed along the pipeline before anybody finds out.
+These checks catch the same mistakes in seconds, before you call
+``create_s3_ingest()``, and report them with the same messages the storage
+service would put on the ingest.
+"""
+
+import collections
+import concurrent.futures
+import datetime
+import hashlib
+import io
+import os
+import posixpath
+import re
+import tarfile
+
+try:  # pragma: no cover
+    from urllib.parse import unquote, urlparse
+except ImportError:  # pragma: no cover
+    from urllib import unquote
+    from urlparse import urlparse
+
+from ._utils import hashlib_name
+from .bag_builder import DEFAULT_READ_SIZE, _hash_payload
+from .exceptions import BagNotFound
+from .manifest import StorageManifest
+
+
+# The checksum algorithms the storage service understands, in its order
+# of preference.  A bag must have a manifest for at least one of the
+# algorithms that aren't deprecated.
+SUPPORTED_ALGORITHMS = ("sha512", "sha256", "sha1", "md5")
+NON_DEPRECATED_ALGORITHMS = ("sha512", "sha256")
+
+# The storage service won't read a bagit.txt bigger than this.
+MAX_BAG_DECLARATION_SIZE = 1000
+
+# How much of a file in a tar archive to read at once.  Each chunk is
+# hashed while we decompress the next one.
+STREAM_READ_SIZE = 1024 * 1024
+
+_TAG_FILE_RE = re.compile(r"^(?:bagit|bag-info|fetch|(?:tag)?manifest-[a-z0-9]+)\.txt$")
+
+_VERSION_LINE_RE = re.compile(r"BagIt-Version: \d\.\d+\Z")
+_ENCODING_LINE = "Tag-File-Character-Encoding: UTF-8"
+
+_BAG_INFO_FIELD_RE = re.compile(r"([^:]+)\s*:\s(.+)\s*\Z")
+_BAG_INFO_LABEL_ONLY_RE = re.compile(r"([^:]+)\s*:\s*\Z")
+_PAYLOAD_OXUM_RE = re.compile(r"([0-9]+)\.([0-9]+)\s*\Z")
+_BAGGING_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}\Z")
+
+_MANIFEST_LINE_RE = re.compile(r"([0-9a-fA-F]+?)\s+(.+)\Z")
+_FETCH_LINE_RE = re.compile(r"(.*)[ \t]+(\d*|-)[ \t]+(.*)")
+
+_EXTERNAL_IDENTIFIER_RULES = [
+    (
+        lambda ident: ident.endswith("/versions"),
+        "External identifier cannot end with /versions",
+    ),
+    (
+        lambda ident: re.match(r"^.*/v\d+\Z", ident),
+        "External identifier cannot end with a version string",
+    ),
+    (
+        lambda ident: re.match(r"^.*/v\d+/.*\Z", ident),
+        "External identifier cannot contain a version string",
+    ),
+    (
+        lambda ident: re.match(r"^v\d+/.*\Z", ident),
+        "External identifier cannot start with a version string",
+    ),
+    (
+        lambda ident: ident.startswith("/"),
+        "External identifier cannot start with a slash",
+    ),
+    (
+        lambda ident: ident.endswith("/"),
+        "External identifier cannot end with a slash",
+    ),
+    (
+        lambda ident: "//" in ident,
+        "External identifier cannot contain consecutive slashes",
+    ),
+    (
+        lambda ident: "  " in ident,
+        "External identifier cannot contain consecutive spaces",
+    ),
+    (
+        lambda ident: not (ident[0].isalnum() and ident[0] <= "z"),
+        "External identifier must begin with a Basic Latin letter or digit",
+    ),
+    (
+        lambda ident: not (ident[-1].isalnum() and ident[-1] <= "z"),
+        "External identifier must end with a Basic Latin letter or digit",
+    ),
+    (
+        lambda ident: not re.match(r"[-_/ .a-zA-Z0-9]+\Z", ident),
+        "External identifier can only contain characters in the class [-_/ .a-zA-Z0-9]",
+    ),
+]
+
+_MANIFEST_ERRORS = {
+    "manifest": (
+        "Could not find any payload manifests in the bag",
+        "Payload manifests are inconsistent: every payload file must be "
+        "listed in every payload manifest",
+        "Payload manifests only use deprecated checksums: add a payload "
+        "manifest using SHA-256 or SHA-512",
+    ),
+    "tagmanifest": (
+        "Could not find any tag manifests in the bag",
+        "Tag manifests are inconsistent: each tag manifest should list the "
+        "same set of tag files",
+        "Tag manifests only use weak checksums: add a tag manifest using "
+        "SHA-256 or SHA-512",
+    ),
+}
+
+
+class _BagUnavailable(Exception):
+    """
+    Raised if the bag can't be read at all, so there's no point checking
+    anything else.
+    """
+
+
+_BagInfo = collections.namedtuple(
+    "_BagInfo", ["external_identifier", "payload_bytes", "payload_files"]
+)
+
+_Bag = collections.namedtuple(
+    "_Bag",
+    ["declaration", "info", "algorithms", "payload_manifest", "tag_manifest", "fetch"],
+)
+
+
+def _split_lines(text):
+    # The same as reading lines in Java: a trailing line break doesn't
+    # start another (empty) line.
+    lines = re.split(r"\r\n|\r|\n", text)
+    if lines[-1] == "":
+        lines.pop()
+    return lines
+
+
+def _tag_file_lines(tag_files, name):
+    """
+    Returns the non-empty lines of a tag file, or None if there's no such file.
+    """
+    try:
+        body = tag_files[name]
+    except KeyError:
+        return None
+
+    return [line for line in _split_lines(body.decode("utf8", "replace")) if line]
+
+
+def _load_optional(tag_files, name, parse):
+    lines = _tag_file_lines(tag_files, name)
+    if lines is None:
+        return None
+
+    try:
+        return parse(lines)
+    except ValueError as err:
+        raise _BagUnavailable("Error loading %s: %s" % (name, err))
+
+
+def _load_required(tag_files, name, parse):
+    result = _load_optional(tag_files, name, parse)
+    if result is None:
+        raise _BagUnavailable("Error loading %s: no such file!" % name)
+    return result
+
+
+def _external_identifier_problem(external_identifier):
+    if not external_identifier:
+        return "External identifier cannot be empty"
+
+    for is_broken, message in _EXTERNAL_IDENTIFIER_RULES:
+        if is_broken(external_identifier):
+            return "%s, was %s" % (message, external_identifier)
+
+    return None
+
+
+def _bag_info_metadata(lines):
+    """
+    Returns a dict of label to the (distinct) values of that label.
+    """
+    metadata = collections.OrderedDict()
+    unparseable = []
+
+    for line in lines:
+        match = _BAG_INFO_FIELD_RE.match(line) or _BAG_INFO_LABEL_ONLY_RE.match(line)
+        if match is None:
+            unparseable.append(line)
+            continue
+
+        label, value = (match.groups() + ("",))[:2]
+        values = metadata.setdefault(label, [])
+        if value not in values:
+            values.append(value)
+
+    if unparseable:
+        raise ValueError(
+            "Unable to parse the following lines in bag-info.txt: %s"
+            % ", ".join(unparseable)
+        )
+
+    return metadata
+
+
+def _single_value(metadata, label):
+    values = metadata.get(label)
+
+    if not values:
+        raise ValueError("Missing key in bag-info.txt: %s" % label)
+    if len(values) > 1:
+        raise ValueError(
+            "Multiple values for %s in bag-info.txt: %s" % (label, ", ".join(values))
+        )
+
+    return values[0]
+
+
+def _parse_bag_info(lines):
+    metadata = _bag_info_metadata(lines)
+
+    external_identifier = _single_value(metadata, "External-Identifier")
+    problem = _external_identifier_problem(external_identifier)
+    if problem is not None:
+        raise ValueError(
+            "Unable to parse External-Identifier in bag-info.txt: %s" % problem
+        )
+
+    payload_oxum = _single_value(metadata, "Payload-Oxum")
+    match = _PAYLOAD_OXUM_RE.match(payload_oxum)
+    if match is None:
+        raise ValueError(
+            "Unable to parse Payload-Oxum in bag-info.txt: %s" % payload_oxum
+        )
+
+    bagging_date = _single_value(metadata, "Bagging-Date")
+    try:
+        if not _BAGGING_DATE_RE.match(bagging_date):
+            raise ValueError(bagging_date)
+        datetime.datetime.strptime(bagging_date, "%Y-%m-%d")
+    except ValueError:
+        raise ValueError(
+            "Unable to parse Bagging-Date in bag-info.txt: %s" % bagging_date
+        )
+
+    return _BagInfo(
+        external_identifier=external_identifier,
+        payload_bytes=int(match.group(1)),
+        payload_files=int(match.group(2)),
+    )
+
+
+def _parse_manifest(lines):
+    """
+    Returns a dict of path to (lowercase) checksum.
+    """
+    entries = {}
+    unparseable = []
+    duplicates = []
+
+    for line in lines:
+        match = _MANIFEST_LINE_RE.match(line)
+        if match is None:
+            unparseable.append(line)
+            continue
+
+        path = match.group(2).strip()
+        if path in entries:
+            duplicates.append(path)
+        entries[path] = match.group(1).lower()
+
+    if unparseable:
+        raise ValueError(
+            "Failed to parse the following lines: %s" % ", ".join(unparseable)
+        )
+    if duplicates:
+        raise ValueError(
+            "Manifest contains duplicate paths: %s" % ", ".join(duplicates)
+        )
+
+    return entries
+
+
+def _load_manifests(tag_files, prefix):
+    """
+    Load every payload manifest (``prefix="manifest"``) or every tag
+    manifest (``prefix="tagmanifest"``) in the bag.
+
+    Returns a dict of path to a dict of checksums, and the set of
+    algorithms used.
+    """
+    manifests = {}
+    for algorithm in SUPPORTED_ALGORITHMS:
+        entries = _load_optional(
+            tag_files, "%s-%s.txt" % (prefix, algorithm), _parse_manifest
+        )
+        if entries is not None:
+            manifests[algorithm] = entries
+
+    none_found, inconsistent, only_deprecated = _MANIFEST_ERRORS[prefix]
+
+    if not manifests:
+        raise _BagUnavailable(none_found)
+    if len(set(frozenset(entries) for entries in manifests.values())) > 1:
+        raise _BagUnavailable(inconsistent)
+    if not set(manifests) & set(NON_DEPRECATED_ALGORITHMS):
+        raise _BagUnavailable(only_deprecated)
+
+    paths = next(iter(manifests.values()))
+    checksums = {
+        path: {algorithm: entries[path] for algorithm, entries in manifests.items()}
+        for path in paths
+    }
+
+    return checksums, set(manifests)
+
+
+def _decode_fetch_path(path):
+    return path.replace("%0A", "\n").replace("%0D", "\r").replace("%25", "%")
+
+
+def _check_fetch_paths(paths):
+    tag_files = [path for path in paths if not path.startswith("data/")]
+    if tag_files:
+        raise ValueError(
+            "fetch.txt should not contain tag files: %s" % ", ".join(tag_files)
+        )
+
+    counts = collections.Counter(paths)
+    duplicates = sorted(path for path, count in counts.items() if count > 1)
+    if duplicates:
+        raise ValueError(
+            "fetch.txt contains duplicate paths: %s" % ", ".join(duplicates)
+        )
+
+
+def _parse_fetch(lines):
+    """
+    Returns an ordered dict of path to (url, length), where length is None
+    if it isn't given.
+    """
+    entries = []
+
+    lines = [line for line in lines if line.strip()]
+
+    for line_no, line in enumerate(lines, start=1):
+        match = _FETCH_LINE_RE.search(line)
+        if match is None:
+            raise ValueError("Line <<%s>> is incorrectly formatted!" % line)
+
+        url, length, path = match.groups()
+        if " " in url:
+            raise ValueError(
+                "URI is incorrectly formatted on line %d. "
+                "Spaces should be URI-encoded: %s" % (line_no, line)
+            )
+
+        entries.append(
+            (_decode_fetch_path(path), (url, None if length == "-" else int(length)))
+        )
+
+    _check_fetch_paths([path for path, _ in entries])
+
+    return collections.OrderedDict(entries)
+
+
+def _parse_bag(tag_files):
+    info = _load_required(tag_files, "bag-info.txt", _parse_bag_info)
+
+    payload_manifest, payload_algorithms = _load_manifests(tag_files, "manifest")
+    tag_manifest, tag_algorithms = _load_manifests(tag_files, "tagmanifest")
+
+    if payload_algorithms != tag_algorithms:
+        raise _BagUnavailable(
+            "Manifests are inconsistent: tag manifests should use the same "
+            "algorithms as the payload manifests in the bag"
+        )
+
+    return _Bag(
+        declaration=tag_files.get("bagit.txt"),
+        info=info,
+        algorithms=sorted(payload_algorithms),
+        payload_manifest=payload_manifest,
+        tag_manifest=tag_manifest,
+        fetch=_load_optional(tag_files, "fetch.txt", _parse_fetch) or {},
+    )
+
+
+def _find_bag_root(names):
+    """
+    Returns the root of the bag in a set of file names -- either ``""`` or
+    a single top-level directory (with a trailing slash) -- or None if we
+    can't find it.
+
+    These are the same rules the storage service uses: the root is the
+    directory with ``bag-info.txt``, which has to be at the top of the
+    archive, or inside its only directory.
+    """
+    if "bag-info.txt" in names:
+        return ""
+
+    directories = set(name.split("/", 1)[0] for name in names if "/" in name)
+    if len(directories) == 1:
+        directory = directories.pop()
+        if directory + "/bag-info.txt" in names:
+            return directory + "/"
+
+    return None
+
+
+def _is_tag_file(name, max_depth=0):
+    """
+    Could this be a tag file in the root of the bag?  ``max_depth`` is how
+    many directories deep the root might be.
+    """
+    return name.count("/") <= max_depth and _TAG_FILE_RE.match(
+        posixpath.basename(name)
+    )
+
+
+def _list_files(path):
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            name = os.path.relpath(os.path.join(dirpath, filename), path)
+            yield name.replace(os.sep, "/")
+
+
+def _read_file(path):
+    with open(path, "rb") as infile:
+        return infile.read()
+
+
+def _read_directory(path, algorithms, processes, read_size):
+    """
+    Returns the bag in ``path``, and a dict of name to (size, checksums)
+    for every file in it.
+    """
+    names = set(_list_files(path))
+
+    root = _find_bag_root(names)
+    if root is None:
+        raise _BagUnavailable("Unable to locate root of bag")
+
+    root_dir = os.path.join(path, root)
+    names = sorted(name[len(root):] for name in names if name.startswith(root))
+
+    # Read the tag files first, so we don't spend time hashing the payload
+    # of a bag we can't even read.
+    bag = _parse_bag(
+        {
+            name: _read_file(os.path.join(root_dir, name))
+            for name in names
+            if _is_tag_file(name)
+        }
+    )
+
+    if algorithms is None:
+        algorithms = bag.algorithms
+
+    files = {
+        name: (size, checksums)
+        for name, size, checksums in _hash_payload(
+            root_dir, names, algorithms, processes=processes, read_size=read_size
+        )
+    }
+
+    return bag, files
+
+
+def _hash_stream(infile, algorithms, executor, read_size):
+    """
+    Returns the size and a dict of checksums for everything in ``infile``.
+
+    Each algorithm is updated on its own thread, while we read the next
+    chunk -- hashlib and zlib both release the GIL, so reading a compressed
+    archive and hashing it with several algorithms can use several cores.
+    """
+    hashers = [hashlib.new(algorithm) for algorithm in algorithms]
+    pending = []
+    size = 0
+
+    while True:
+        chunk = infile.read(read_size)
+        if not chunk:
+            break
+
+        size += len(chunk)
+
+        for fut in pending:
+            fut.result()
+        pending = [executor.submit(hasher.update, chunk) for hasher in hashers]
+
+    for fut in pending:
+        fut.result()
+
+    return size, {
+        algorithm: hasher.hexdigest() for algorithm, hasher in zip(algorithms, hashers)
+    }
+
+
+def _iter_archive(fileobj):
+    """
+    Generates (name, file object) for every file in a tar archive, as a
+    stream, without extracting it.
+    """
+    names = set()
+
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tf:
+        for member in tf:
+            if not member.isfile():
+                continue
+
+            # The storage service ignores a leading ./ when it unpacks an archive
+            name = member.name[2:] if member.name.startswith("./") else member.name
+            if name in names:
+                raise _BagUnavailable(
+                    "The archive is malformed or has a duplicate entry (%s)"
+                    % member.name
+                )
+            names.add(name)
+
+            yield name, tf.extractfile(member)
+
+
+def _scan_tag_files(fileobj):
+    """
+    Read the names of every file in a tar archive, and the contents of
+    anything that might be a tag file, without hashing anything.
+    """
+    names = set()
+    tag_files = {}
+
+    for name, infile in _iter_archive(fileobj):
+        names.add(name)
+        if _is_tag_file(name, max_depth=1):
+            tag_files[name] = infile.read()
+
+    return names, tag_files
+
+
+def _scan_tarball(fileobj, algorithms, read_size):
+    """
+    Read every file in a tar archive, as a stream, without extracting it.
+
+    Returns a dict of name to (size, checksums) for every file, and a dict
+    of name to contents for anything that might be a tag file.
+    """
+    files = {}
+    tag_files = {}
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(algorithms))
+
+    with executor:
+        for name, infile in _iter_archive(fileobj):
+            if _is_tag_file(name, max_depth=1):
+                tag_files[name] = infile.read()
+                infile = io.BytesIO(tag_files[name])
+
+            files[name] = _hash_stream(infile, algorithms, executor, read_size)
+
+    return files, tag_files
+
+
+def _parse_archived_bag(names, tag_files):
+    """
+    Returns the root of the bag in an archive, and the bag.
+    """
+    root = _find_bag_root(names)
+    if root is None:
+        raise _BagUnavailable("Unable to locate root of bag")
+
+    bag = _parse_bag(
+        {
+            name[len(root):]: body
+            for name, body in tag_files.items()
+            if name.startswith(root)
+        }
+    )
+
+    return root, bag
+
+
+def _archive_algorithms(fileobj):
+    """
+    Returns the algorithms to hash the files in an archive with.
+
+    If we can rewind ``fileobj``, we read it once for the tag files, so we
+    only compute the algorithms the bag's manifests use.  Otherwise we
+    compute every algorithm the storage service supports.
+    """
+    seekable = getattr(fileobj, "seekable", None)
+    if seekable is None or not seekable():
+        return SUPPORTED_ALGORITHMS
+
+    start = fileobj.tell()
+    names, tag_files = _scan_tag_files(fileobj)
+    fileobj.seek(start)
+
+    _, bag = _parse_archived_bag(names, tag_files)
+    return bag.algorithms
+
+
+def _read_archive(fileobj, algorithms, read_size):
+    if algorithms is None:
+        algorithms = _archive_algorithms(fileobj)
+
+    files, tag_files = _scan_tarball(fileobj, algorithms, read_size)
+    root, bag = _parse_archived_bag(set(files), tag_files)
+
+    files = {
+        name[len(root):]: result
+        for name, result in files.items()
+        if name.startswith(root)
+    }
+
+    return bag, files
+
+
+def _read_tarball(path, algorithms, read_size):
+    """
+    Returns the bag in a tar archive (which can be compressed), and a dict
+    of name to (size, checksums) for every file in it.
+
+    We don't know which algorithms the bag uses until we've seen its
+    manifests, which could be anywhere in the archive.  Unless you pass
+    ``algorithms``, we read the archive twice: once for the manifests,
+    then again to hash every file with the algorithms they use.  If the
+    archive is a file object we can't rewind, every file is hashed with
+    every algorithm the storage service supports.
+    """
+    if hasattr(path, "read"):
+        return _read_archive(path, algorithms, read_size)
+
+    with io.open(path, "rb") as fileobj:
+        return _read_archive(fileobj, algorithms, read_size)
+
+
+def _bag_declaration_problem(body):
+    if body is None:
+        return "no such file!"
+
+    if len(body) > MAX_BAG_DECLARATION_SIZE:
+        return "too large"
+
+    try:
+        lines = _split_lines(body.decode("utf8"))
+    except UnicodeDecodeError:
+        return "could not be decoded as UTF-8"
+
+    if len(lines) != 2:
+        return "expected 2 lines, got %d" % len(lines)
+
+    version_line, encoding_line = lines
+    version_is_correct = _VERSION_LINE_RE.match(version_line) is not None
+
+    if version_is_correct and encoding_line == _ENCODING_LINE:
+        return None
+    elif version_is_correct and encoding_line.startswith(
+        "Tag-File-Character-Encoding:"
+    ):
+        return "encoding must be UTF-8"
+    elif version_is_correct:
+        return "encoding line was not correct"
+    elif encoding_line == _ENCODING_LINE:
+        return "version line was not correct"
+    else:
+        return "not correctly formatted"
+
+
+def _check_filenames(bag):
+    problems = []
+
+    outside_data = sorted(p for p in bag.payload_manifest if not p.startswith("data/"))
+    if outside_data:
+        problems.append(
+            "Not all payload files are in the data/ directory: %s"
+            % ", ".join(outside_data)
+        )
+
+    outside_root = sorted(p for p in bag.tag_manifest if "/" in p)
+    if outside_root:
+        problems.append(
+            "Not all tag files are in the root directory: %s" % ", ".join(outside_root)
+        )
+
+    # Azure Blob Storage doesn't allow blob names that end with a dot
+    ends_with_a_dot = sorted(
+        p
+        for p in list(bag.payload_manifest) + list(bag.tag_manifest)
+        if p.endswith(".")
+    )
+    if ends_with_a_dot:
+        problems.append(
+            "Filenames cannot end with a .: %s" % ", ".join(ends_with_a_dot)
+        )
+
+    return problems
+
+
+def _fetch_location(url):
+    """
+    Returns the (scheme, bucket, key) of a URL in fetch.txt.
+    """
+    parsed = urlparse(url)
+    return parsed.scheme, parsed.netloc, unquote(parsed.path).lstrip("/")
+
+
+def _check_fetch_prefixes(fetch, space, external_identifier, bucket):
+    """
+    Files in fetch.txt can only come from earlier versions of the same bag.
+    """
+    prefix = "%s/%s/" % (space, external_identifier)
+
+    mismatched = []
+    for path, (url, _) in fetch.items():
+        scheme, fetch_bucket, key = _fetch_location(url)
+
+        is_s3 = scheme == "s3"
+        in_bucket = bucket is None or fetch_bucket == bucket
+        in_prefix = space is None or key.startswith(prefix)
+
+        if not (is_s3 and in_bucket and in_prefix):
+            mismatched.append(path)
+
+    if mismatched:
+        return [
+            "fetch.txt refers to paths in a mismatched prefix or with a "
+            "non-S3 URI scheme: %s" % ", ".join(mismatched)
+        ]
+    else:
+        return []
+
+
+class _ExistingVersions(object):
+    """
+    Looks up files from fetch.txt in the versions of the bag that are
+    already in the storage service, fetching each version at most once.
+    """
+
+    def __init__(self, client, space, external_identifier):
+        self.client = client
+        self.space = space
+        self.external_identifier = external_identifier
+        self.prefix = "%s/%s/" % (space, external_identifier)
+        self._versions = {}
+
+    def _get_version(self, version):
+        try:
+            return self._versions[version]
+        except KeyError:
+            pass
+
+        try:
+            bag = self.client.get_bag(self.space, self.external_identifier, version)
+        except BagNotFound:
+            storage_manifest = None
+        else:
+            storage_manifest = StorageManifest.from_bag(bag)
+
+        self._versions[version] = storage_manifest
+        return storage_manifest
+
+    def bucket(self, fetch):
+        """
+        Returns the bucket that holds the versions fetch.txt refers to.
+        """
+        for url, _ in fetch.values():
+            _, _, key = _fetch_location(url)
+            if key.startswith(self.prefix):
+                version = key[len(self.prefix):].split("/")[0]
+                storage_manifest = self._get_version(version)
+                if storage_manifest is not None:
+                    return storage_manifest["location"]["bucket"]
+
+        return None
+
+    def get_file(self, url):
+        """
+        Returns the file at ``url`` as a ``ManifestFile``, and the checksum
+        algorithm of its bag, or (None, None) if it doesn't exist.  The
+        algorithm is None if the storage manifest doesn't record one.
+        """
+        _, bucket, key = _fetch_location(url)
+        if not key.startswith(self.prefix):
+            return None, None
+
+        path = key[len(self.prefix):]
+        storage_manifest = self._get_version(path.split("/")[0])
+        if storage_manifest is None:
+            return None, None
+        if storage_manifest["location"]["bucket"] != bucket:
+            return None, None
+
+        # The payload and tag manifests use the same algorithm, so if the
+        # payload manifest doesn't say, we use the tag manifest's.
+        algorithm = storage_manifest.manifest.checksum_algorithm
+        if algorithm is None:
+            algorithm = storage_manifest.tag_manifest.checksum_algorithm
+
+        return (
+            storage_manifest.manifest.get_by_path(path),
+            hashlib_name(algorithm) if algorithm is not None else None,
+        )
+
+
+def _check_fetched_file(existing_versions, expected_checksums, url, length):
+    """
+    Returns the size of a file in fetch.txt, or raises ValueError if it's
+    not the file the bag expects.
+    """
+    if existing_versions is None:
+        return length
+
+    manifest_file, algorithm = existing_versions.get_file(url)
+
+    if manifest_file is None:
+        raise ValueError("no such file")
+    if length is not None and length != manifest_file.size:
+        raise ValueError("wrong size")
+    if algorithm is None:
+        raise ValueError("unverifiable checksum")
+    expected_checksum = expected_checksums.get(algorithm, manifest_file.checksum)
+    if expected_checksum != manifest_file.checksum:
+        raise ValueError("wrong checksum")
+
+    return manifest_file.size
+
+
+def _check_local_file(files, path, expected_checksums):
+    """
+    Returns the size of a file in the bag, or raises ValueError if it's
+    missing or has the wrong checksum.
+    """
+    try:
+        size, checksums = files[path]
+    except KeyError:
+        raise ValueError("no such file")
+
+    for algorithm, checksum in checksums.items():
+        if expected_checksums.get(algorithm, checksum) != checksum:
+            raise ValueError("wrong checksum")
+
+    return size
+
+
+def _check_fixity(bag, files, existing_versions):
+    """
+    Check every file in the manifests.  Returns a list of files that we
+    couldn't verify, and a dict of name to size for the rest.
+    """
+    errors = []
+    sizes = {}
+
+    manifest = dict(bag.payload_manifest)
+    manifest.update(bag.tag_manifest)
+
+    for path, expected_checksums in sorted(manifest.items()):
+        try:
+            if path in bag.fetch:
+                url, length = bag.fetch[path]
+                sizes[path] = _check_fetched_file(
+                    existing_versions, expected_checksums, url, length
+                )
+            else:
+                sizes[path] = _check_local_file(files, path, expected_checksums)
+        except ValueError:
+            errors.append(path)
+
+    return errors, sizes
+
+
+def _check_unreferenced_files(bag, files):
+    # Nothing refers to the tag manifests, so they're allowed to be
+    # unreferenced.
+    expected = set(bag.payload_manifest) | set(bag.tag_manifest)
+    expected.update(
+        "tagmanifest-%s.txt" % algorithm for algorithm in SUPPORTED_ALGORITHMS
+    )
+
+    unreferenced = sorted(name for name in files if name not in expected)
+
+    if not unreferenced:
+        return []
+    elif len(unreferenced) == 1:
+        return [
+            "Bag contains a file which is not referenced in the manifest: %s"
+            % unreferenced[0]
+        ]
+    else:
+        return [
+            "Bag contains %d files which are not referenced in the manifest: %s"
+            % (len(unreferenced), ", ".join(unreferenced))
+        ]
+
+
+def _check_payload_oxum_size(bag, sizes):
+    payload_sizes = [sizes[path] for path in bag.payload_manifest]
+
+    # We don't know the size of files in fetch.txt without a length, unless
+    # we can look them up in the storage service.
+    if None in payload_sizes:
+        return []
+
+    actual_size = sum(payload_sizes)
+    if actual_size == bag.info.payload_bytes:
+        return []
+    else:
+        return [
+            "Payload-Oxum has the wrong octetstream sum: %d bytes, but bag "
+            "actually contains %d bytes" % (bag.info.payload_bytes, actual_size)
+        ]
+
+
+def _check_contents(bag, files, existing_versions):
+    """
+    Check the files in the bag match the manifests.
+    """
+    unexpected_fetch = sorted(set(bag.fetch) - set(bag.payload_manifest))
+    if unexpected_fetch:
+        return [
+            "fetch.txt refers to paths that aren't in the bag manifest: %s"
+            % ", ".join(unexpected_fetch)
+        ]
+
+    errors, sizes = _check_fixity(bag, files, existing_versions)
+
+    if len(errors) == 1:
+        return ["Unable to verify one file in the bag: %s" % errors[0]]
+    elif errors:
+        return [
+            "Unable to verify %d files in the bag: %s"
+            % (len(errors), ", ".join(errors))
+        ]
+
+    problems = []
+
+    concrete = sorted(path for path in bag.fetch if path in files)
+    if concrete:
+        problems.append(
+            "Files referred to in the fetch.txt also appear in the bag: %s"
+            % ", ".join(concrete)
+        )
+
+    problems.extend(_check_unreferenced_files(bag, files))
+    problems.extend(_check_payload_oxum_size(bag, sizes))
+
+    return problems
+
+
+def _check_bag(bag, files, space, external_identifier, client):
+    problems = []
+
+    declaration_problem = _bag_declaration_problem(bag.declaration)
+    if declaration_problem is not None:
+        problems.append(
+            "Error loading Bag Declaration (bagit.txt): %s" % declaration_problem
+        )
+
+    if external_identifier is None:
+        external_identifier = bag.info.external_identifier
+    elif bag.info.external_identifier != external_identifier:
+        problems.append(
+            "External identifier in bag-info.txt does not match request: "
+            "%s is not %s" % (bag.info.external_identifier, external_identifier)
+        )
+
+    if bag.info.payload_files != len(bag.payload_manifest):
+        problems.append(
+            "Payload-Oxum has the wrong number of payload files: %d, but bag "
+            "manifest has %d" % (bag.info.payload_files, len(bag.payload_manifest))
+        )
+
+    problems.extend(_check_filenames(bag))
+
+    if client is not None and space is not None and bag.fetch:
+        existing_versions = _ExistingVersions(client, space, external_identifier)
+        bucket = existing_versions.bucket(bag.fetch)
+    else:
+        existing_versions = None
+        bucket = None
+
+    problems.extend(
+        _check_fetch_prefixes(bag.fetch, space, external_identifier, bucket)
+    )
+    problems.extend(_check_contents(bag, files, existing_versions))
+
+    return problems
+
+
+def verify_bag(
+    path,
+    space=None,
+    external_identifier=None,
+    client=None,
+    algorithms=None,
+    processes=None,
+    read_size=None,
+):
+    """
+    Check a bag before you ingest it, using the same rules as the storage
+    service's bag verifier.
+
+    Returns a list of problems with the bag, which is empty if the storage
+    service should accept it.  The problems are described with the same
+    messages the storage service would use.
+
+    :param path: A directory containing a bag, a path to a tar archive
+        (optionally compressed) or a binary file object to read a tar
+        archive from.  Archives are read as a stream, and never extracted.
+        As in the storage service, the bag can be at the top of the archive,
+        or inside its only directory.
+    :param space: The space the bag will be ingested into.  If supplied,
+        every file in ``fetch.txt`` has to be in an earlier version of the
+        same bag.
+    :param external_identifier: The external identifier you'll use for the
+        ingest.  If supplied, it has to match ``bag-info.txt``.
+    :param client: A storage service client.  If supplied with ``space``,
+        every file in ``fetch.txt`` is looked up in the existing versions of
+        the bag with ``get_bag()``, and its size and checksum are checked.
+    :param algorithms: The checksum algorithms to recompute.  By default we
+        use the algorithms from the bag's manifests.  For an archive, that
+        means reading it twice; if it's a file object we can't rewind (e.g.
+        a pipe), every supported algorithm is computed instead.
+    :param processes: How many processes to hash the files in a directory
+        with.  Defaults to the number of CPUs.  The files in an archive are
+        hashed with a thread per algorithm as they're read.
+
+    """
+    if algorithms is not None:
+        algorithms = [hashlib_name(algorithm) for algorithm in algorithms]
+
+    try:
+        if not hasattr(path, "read") and os.path.isdir(path):
+            bag, files = _read_directory(
+                path, algorithms, processes, read_size or DEFAULT_READ_SIZE
+            )
+        else:
+            bag, files = _read_tarball(path, algorithms, read_size or STREAM_READ_SIZE)
+    except _BagUnavailable as err:
+        return [str(err)]
+
+    return _check_bag(bag, files, space, external_identifier, client)
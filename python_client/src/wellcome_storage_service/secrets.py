@@ -2,6 +2,14 @@
 Fetches credentials for the dev client from Secrets Manager.
 """
 
+import threading
+
+
+# Fetching the secrets means assuming a role and two calls to Secrets
+# Manager, so we only do it once per process.
+_secrets = None
+_secrets_lock = threading.Lock()
+
 
 def get_session():
     """
@@ -23,6 +31,16 @@ def get_session():
 
 
 def get_secrets():
+    global _secrets
+
+    with _secrets_lock:
+        if _secrets is None:
+            _secrets = _fetch_secrets()
+
+    return dict(_secrets)
+
+
+def _fetch_secrets():
     session = get_session()
     secrets_client = session.client("secretsmanager")
 
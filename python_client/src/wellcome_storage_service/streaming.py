@@ -0,0 +1,229 @@
+"""
+Incremental parsing of bags API responses, so we can work through the
+files in a bag without holding the whole storage manifest in memory.
+
+The standard library doesn't have a streaming JSON parser, but the bags
+API responses have a predictable shape: it's only the ``files`` lists in
+the two manifests that get big.  We walk the structure of the response by
+hand, and use ``json.JSONDecoder.raw_decode`` to decode everything else --
+including each of the individual files -- one (small) value at a time.
+"""
+
+import collections
+import json
+import re
+
+
+class ManifestEntry(
+    collections.namedtuple("ManifestEntry", ["manifest", "checksum_algorithm", "file"])
+):
+    """
+    A single file from a storage manifest.
+
+    ``manifest`` is ``"manifest"`` for files in the payload manifest, or
+    ``"tagManifest"`` for tag files.
+    """
+
+
+_WHITESPACE = " \t\n\r"
+
+# Characters that could be the rest of a number that's been cut off at the
+# end of a chunk, e.g. "12" + "34", "12." + "5" or "1e" + "5".
+_NUMBER_TAIL = re.compile(r"[0-9eE+\-.]*\Z")
+
+
+class _JSONTextStream(object):
+    """
+    A cursor over some JSON text that arrives in chunks.
+
+    We only keep the text we haven't parsed yet, plus at most one chunk.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _read_more(self):
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._eof = True
+            return False
+
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """
+        Returns the next non-whitespace character, or an empty string if
+        we've reached the end of the text.
+        """
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+                self._pos += 1
+
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+
+            if not self._read_more():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(
+                "Expected %r at position %d, got %r" % (char, self._pos, self.peek())
+            )
+        self._pos += 1
+
+    def skip(self, char):
+        """
+        Consume the next character if it's ``char``, and return True;
+        otherwise return False.
+        """
+        if self.peek() == char:
+            self._pos += 1
+            return True
+        else:
+            return False
+
+    def decode(self):
+        """
+        Decode the next complete JSON value.
+        """
+        self.peek()
+
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                # Probably the value runs into the next chunk
+                if self._read_more():
+                    continue
+                raise
+
+            # A number that runs up to the end of the buffer might carry on
+            # into the next chunk, and raw_decode() happily decodes a prefix
+            # of it (e.g. "12" from "12." or "1e"), so we only trust a number
+            # once we've seen the character after it.
+            is_number = self._buf[self._pos] in "-0123456789"
+            might_continue = is_number and not self._eof
+
+            if might_continue and _NUMBER_TAIL.match(self._buf, end):
+                if self._read_more():
+                    continue
+
+            self._pos = end
+            return value
+
+
+def _object_keys(stream):
+    """
+    Generates the keys of the JSON object at the cursor.  The caller must
+    consume each value before asking for the next key.
+    """
+    stream.expect("{")
+    if stream.skip("}"):
+        return
+
+    while True:
+        key = stream.decode()
+        stream.expect(":")
+        yield key
+
+        if not stream.skip(","):
+            stream.expect("}")
+            return
+
+
+def _array_items(stream):
+    """
+    Generates the values in the JSON array at the cursor.
+    """
+    stream.expect("[")
+    if stream.skip("]"):
+        return
+
+    while True:
+        yield stream.decode()
+
+        if not stream.skip(","):
+            stream.expect("]")
+            return
+
+
+class StreamingBag(object):
+    """
+    A bag whose files are parsed from a bags API response as you iterate
+    over it.
+
+    Iterating generates a ``ManifestEntry`` for every file in the payload
+    and tag manifests.  You can only iterate once.
+
+    Everything else in the response (``info``, ``location``,
+    ``replicaLocations``, and so on) goes in ``metadata`` as it's parsed.
+    Some of these fields come after the manifests in the response, so
+    ``metadata`` is only complete once you've iterated over every file;
+    the ``manifest`` and ``tagManifest`` entries have everything except
+    their ``files``.
+    """
+
+    def __init__(self, chunks):
+        self.metadata = {}
+        self._entries = self._parse(_JSONTextStream(chunks))
+
+    def _parse_manifest(self, stream, manifest_key):
+        manifest = self.metadata[manifest_key] = {}
+
+        # The bags API puts ``checksumAlgorithm`` before ``files``, so we can
+        # usually stream the files as we parse them.  JSON doesn't promise
+        # that order, so if we reach the files first, we hold on to them
+        # until we've seen the whole manifest.
+        held_files = []
+
+        for key in _object_keys(stream):
+            if key == "files" and "checksumAlgorithm" in manifest:
+                for manifest_file in _array_items(stream):
+                    yield ManifestEntry(
+                        manifest=manifest_key,
+                        checksum_algorithm=manifest["checksumAlgorithm"],
+                        file=manifest_file,
+                    )
+            elif key == "files":
+                held_files.extend(_array_items(stream))
+            else:
+                manifest[key] = stream.decode()
+
+        for manifest_file in held_files:
+            yield ManifestEntry(
+                manifest=manifest_key,
+                checksum_algorithm=manifest.get("checksumAlgorithm"),
+                file=manifest_file,
+            )
+
+    def _parse(self, stream):
+        for key in _object_keys(stream):
+            if key in ("manifest", "tagManifest"):
+                for entry in self._parse_manifest(stream, key):
+                    yield entry
+            else:
+                self.metadata[key] = stream.decode()
+
+        if stream.peek() != "":
+            raise ValueError("Unexpected data after the end of the bag")
+
+    def __iter__(self):
+        return self._entries
+
+    def finish(self):
+        """
+        Parse the rest of the response, skipping any files we haven't
+        seen yet, and return the complete ``metadata``.
+        """
+        for _ in self._entries:
+            pass
+
+        return self.metadata
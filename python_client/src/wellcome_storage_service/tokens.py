@@ -0,0 +1,179 @@
+"""
+Stores for OAuth tokens, so a token can be shared by every client in a
+process -- or every process on a machine -- rather than each one fetching
+its own.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from ._utils import default_path, mkdir_p
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # e.g. on Windows, where we fall back to only locking within a process
+    fcntl = None
+
+
+def _default_token_dir():
+    return default_path("tokens")
+
+
+# Where a ``FileTokenStore`` keeps tokens by default.  As with the other
+# default paths, it's only looked up when it's used.
+if sys.version_info >= (3, 7):
+
+    def __getattr__(name):
+        if name == "DEFAULT_TOKEN_DIR":
+            return _default_token_dir()
+
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+else:  # pragma: no cover
+    DEFAULT_TOKEN_DIR = _default_token_dir()
+
+
+# Refresh a token if it expires in less than this many seconds, so it
+# doesn't expire while a request is in flight.
+TOKEN_EXPIRY_MARGIN = 60
+
+
+def token_key(client_id, token_url):
+    """
+    Returns the key for tokens issued to a given client by a given server.
+    """
+    key = json.dumps([client_id, token_url])
+    return hashlib.sha256(key.encode("utf8")).hexdigest()
+
+
+def token_is_fresh(token, margin=TOKEN_EXPIRY_MARGIN):
+    """
+    Returns True if a token isn't going to expire in the next ``margin``
+    seconds.
+    """
+    if not token or "access_token" not in token:
+        return False
+
+    try:
+        return token["expires_at"] - time.time() >= margin
+    except KeyError:
+        # If the server didn't tell us when the token expires, assume it's
+        # still good; if it isn't, we'll find out when a request fails.
+        return True
+
+
+class TokenStore(object):
+    """
+    Somewhere to keep OAuth tokens.
+
+    Subclasses should implement ``get()`` and ``put()``, and can override
+    ``lock()`` to stop several clients refreshing the same token at once.
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def get(self, key):  # pragma: no cover
+        """
+        Returns the token stored under ``key``, or None if there isn't one.
+        """
+        raise NotImplementedError
+
+    def put(self, key, token):  # pragma: no cover
+        """
+        Store a token under ``key``.
+        """
+        raise NotImplementedError
+
+    def lock(self, key):
+        """
+        Returns a context manager that's held while a client refreshes the
+        token stored under ``key``.
+
+        By default, this only excludes other threads in the same process.
+        """
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+
+class MemoryTokenStore(TokenStore):
+    """
+    Keeps tokens in memory, so they can be shared between clients in the
+    same process.
+    """
+
+    def __init__(self):
+        super(MemoryTokenStore, self).__init__()
+        self._tokens = {}
+
+    def get(self, key):
+        return self._tokens.get(key)
+
+    def put(self, key, token):
+        self._tokens[key] = token
+
+
+class FileTokenStore(TokenStore):
+    """
+    Keeps tokens in JSON files in ``directory`` (``~/.wellcome-storage/tokens``
+    by default), so they can be shared between processes.
+
+    The files are only readable by the current user.  Refreshes are
+    serialised across processes with a lock file, where the platform
+    supports ``fcntl``.
+    """
+
+    def __init__(self, directory=None):
+        super(FileTokenStore, self).__init__()
+
+        if directory is None:
+            directory = _default_token_dir()
+
+        self.directory = directory
+
+        mkdir_p(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, "%s.json" % key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as infile:
+                return json.load(infile)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, token):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+
+        try:
+            # mkstemp creates the file with mode 0600, so the token is never
+            # readable by anybody else.
+            with os.fdopen(fd, "w") as outfile:
+                json.dump(token, outfile)
+            os.rename(tmp_path, self._path(key))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        with super(FileTokenStore, self).lock(key):
+            if fcntl is None:  # pragma: no cover
+                yield
+                return
+
+            with open(self._path(key) + ".lock", "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,218 @@
+"""
+Upload a bag to S3 as a compressed tar archive, without writing the archive
+to disk first.
+
+The bag is read from disk, tarred and compressed as a stream, and the
+compressed bytes are uploaded as the parts of an S3 multipart upload,
+several at a time.  Compression and upload overlap, and the only extra
+memory used is the parts waiting to be uploaded.
+"""
+
+import collections
+import concurrent.futures
+import gzip
+import logging
+import os
+import tarfile
+
+from .compression import DEFAULT_GZIP_LEVEL
+
+
+logger = logging.getLogger(__name__)
+
+# The size of the first parts of a multipart upload.  S3 requires every
+# part except the last to be at least 5 MB.
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+
+DEFAULT_MAX_UPLOAD_WORKERS = 4
+
+# S3 allows at most 10,000 parts in an upload.  We don't know how big the
+# archive will be when we start, so we double the part size every time we
+# use up this many parts -- with the default part size, that's enough for
+# archives of well over a terabyte.
+PARTS_PER_SIZE = 1000
+
+
+class S3MultipartWriter(object):
+    """
+    A writable binary file that uploads everything written to it to S3,
+    as a multipart upload.
+
+    Writes are split into parts, which are uploaded by ``max_workers``
+    threads.  At most ``max_workers`` parts are in flight at once, and a
+    write blocks until there's room for another, so this holds at most
+    ``max_workers + 1`` parts in memory.
+
+    Closing the writer completes the upload.  If anything goes wrong, call
+    ``abort()``, so S3 doesn't keep the parts we've already uploaded.
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        bucket,
+        key,
+        part_size=DEFAULT_PART_SIZE,
+        max_workers=DEFAULT_MAX_UPLOAD_WORKERS,
+    ):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_workers = max_workers
+
+        self.upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key)[
+            "UploadId"
+        ]
+
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._parts = []
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def _current_part_size(self):
+        part_number = len(self._parts) + len(self._pending) + 1
+        return self.part_size * 2 ** ((part_number - 1) // PARTS_PER_SIZE)
+
+    def _upload_part(self, part_number, body):
+        resp = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+
+        return {"PartNumber": part_number, "ETag": resp["ETag"]}
+
+    def _submit(self, body):
+        part_number = len(self._parts) + len(self._pending) + 1
+        self._pending.append(
+            self._executor.submit(self._upload_part, part_number, body)
+        )
+
+        while len(self._pending) > self.max_workers:
+            self._parts.append(self._pending.popleft().result())
+
+    def write(self, data):
+        self._buffer.extend(data)
+
+        while len(self._buffer) >= self._current_part_size():
+            part_size = self._current_part_size()
+            self._submit(bytes(self._buffer[:part_size]))
+            del self._buffer[:part_size]
+
+        return len(data)
+
+    def close(self):
+        if self._executor is None:
+            return
+
+        # S3 won't complete an upload with no parts, so an empty file
+        # still gets one (empty) part.
+        if self._buffer or not (self._parts or self._pending):
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+
+        while self._pending:
+            self._parts.append(self._pending.popleft().result())
+
+        self._executor.shutdown()
+        self._executor = None
+
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self._parts},
+        )
+
+    def abort(self):
+        if self._executor is not None:
+            for fut in self._pending:
+                fut.cancel()
+            self._executor.shutdown()
+            self._executor = None
+
+        self.s3_client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+        )
+
+
+def _abort_upload(uploader):
+    """
+    Abort a multipart upload after something else went wrong.  If we can't
+    abort it, we log the error rather than raising it, so the caller sees
+    the original error.
+    """
+    try:
+        uploader.abort()
+    except Exception:
+        logger.exception(
+            "Unable to abort multipart upload %s to s3://%s/%s",
+            uploader.upload_id,
+            uploader.bucket,
+            uploader.key,
+        )
+
+
+def _add_directory_to_tar(tf, bag_dir, top_level_dir):
+    if top_level_dir is not None:
+        tf.add(bag_dir, arcname=top_level_dir)
+    else:
+        for name in sorted(os.listdir(bag_dir)):
+            tf.add(os.path.join(bag_dir, name), arcname=name)
+
+
+def upload_bag(
+    bag_dir,
+    s3_bucket,
+    s3_key,
+    s3_client=None,
+    top_level_dir=None,
+    part_size=DEFAULT_PART_SIZE,
+    max_workers=DEFAULT_MAX_UPLOAD_WORKERS,
+):
+    """
+    Upload the bag in ``bag_dir`` to S3 as a compressed tar archive, ready
+    to be ingested with ``create_s3_ingest()``.
+
+    The archive is streamed straight to S3 as a multipart upload, so it
+    never touches the local disk.  If the upload fails, the multipart upload
+    is aborted and nothing is left in the bucket.
+
+    :param bag_dir: The directory containing the bag (with ``bagit.txt``).
+    :param s3_client: A boto3 S3 client.  If not supplied, one is created
+        with the default credentials.
+    :param top_level_dir: If supplied, the bag is put in a directory with
+        this name inside the archive.  Otherwise the bag's files are at the
+        top of the archive.
+    :param part_size: The size of each part of the upload.  Parts are held
+        in memory until they're uploaded.
+    :param max_workers: How many parts to upload at once.
+
+    """
+    if s3_client is None:
+        import boto3
+
+        s3_client = boto3.client("s3")
+
+    uploader = S3MultipartWriter(
+        s3_client,
+        bucket=s3_bucket,
+        key=s3_key,
+        part_size=part_size,
+        max_workers=max_workers,
+    )
+
+    try:
+        with gzip.GzipFile(
+            fileobj=uploader, mode="wb", compresslevel=DEFAULT_GZIP_LEVEL
+        ) as writer:
+            with tarfile.open(fileobj=writer, mode="w|") as tf:
+                _add_directory_to_tar(tf, bag_dir, top_level_dir=top_level_dir)
+
+        uploader.close()
+    except BaseException:
+        _abort_upload(uploader)
+        raise
@@ -1,14 +1,29 @@
+import hashlib
 import json
 import os
+import sys
 
 import betamax
 from betamax.cassette import cassette
 from betamax_serializers.pretty_json import PrettyJSONSerializer
+import boto3
 import pytest
 
+try:
+    import moto
+except ImportError:  # pragma: no cover
+    # moto only supports Python 3; tests that need S3 are skipped on Python 2.
+    moto = None
+
 from wellcome_storage_service import RequestsOAuthStorageServiceClient
 
 
+# The asyncio client uses syntax that Python 2 can't parse, and fsspec
+# only supports Python 3.
+if sys.version_info < (3, 7):
+    collect_ignore = ["test_aio.py", "test_filesystem.py"]
+
+
 # Remove our OAuth authorization token from betamax recordings.  This is
 # based on an example from the Betamax docs:
 # https://betamax.readthedocs.io/en/latest/configuring.html#filtering-sensitive-data
@@ -66,3 +81,97 @@ def client(request):
     # See https://stackoverflow.com/q/17726954/1558022
     with betamax.Betamax(ss_client.sess).use_cassette(request.node.name):
         yield ss_client
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    """
+    An S3 client for an in-memory mock of S3.  Any boto3 clients created
+    while this fixture is active (e.g. in the downloader) will also talk
+    to the mock.
+    """
+    if moto is None:  # pragma: no cover
+        pytest.skip("moto isn't available on this version of Python")
+
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-west-1")
+
+    with moto.mock_aws():
+        yield boto3.client("s3")
+
+
+@pytest.fixture
+def make_bag(s3_client):
+    """
+    Returns a function that uploads the given files to the mock S3, and
+    returns a storage manifest (in the same shape as the bags API) that
+    points to them.
+
+    Files should be passed as a dict of (name -> bytes) pairs.
+    """
+
+    def _make_bag(
+        files,
+        tag_files=None,
+        bucket="wellcomecollection-storage",
+        space="digitised",
+        external_identifier="b12345",
+        version="v1",
+    ):
+        if tag_files is None:
+            tag_files = {"bagit.txt": b"BagIt-Version: 0.97\n"}
+
+        try:
+            s3_client.create_bucket(
+                Bucket=bucket,
+                CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+            )
+        except s3_client.exceptions.BucketAlreadyOwnedByYou:
+            pass
+
+        prefix = "%s/%s" % (space, external_identifier)
+
+        def _manifest(contents):
+            manifest_files = []
+
+            for name, body in sorted(contents.items()):
+                path = "%s/%s" % (version, name)
+                s3_client.put_object(
+                    Bucket=bucket, Key="%s/%s" % (prefix, path), Body=body
+                )
+                manifest_files.append(
+                    {
+                        "checksum": hashlib.sha256(body).hexdigest(),
+                        "name": name,
+                        "path": path,
+                        "size": len(body),
+                        "type": "File",
+                    }
+                )
+
+            return {
+                "checksumAlgorithm": "SHA-256",
+                "files": manifest_files,
+                "type": "BagManifest",
+            }
+
+        return {
+            "id": "%s/%s" % (space, external_identifier),
+            "space": {"id": space, "type": "Space"},
+            "info": {"externalIdentifier": external_identifier, "type": "BagInfo"},
+            "manifest": _manifest(files),
+            "tagManifest": _manifest(tag_files),
+            "location": {
+                "provider": {"id": "amazon-s3", "type": "Provider"},
+                "bucket": bucket,
+                "path": prefix,
+                "type": "Location",
+            },
+            "replicaLocations": [],
+            "createdDate": "2019-09-12T20:26:53.094757Z",
+            "version": version,
+            "type": "Bag",
+        }
+
+    return _make_bag
@@ -0,0 +1,348 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestServer  # noqa: E402
+
+from wellcome_storage_service import (  # noqa: E402
+    BagNotFound,
+    IngestNotFound,
+    ServerError,
+    UserError,
+)
+from wellcome_storage_service.aio import (  # noqa: E402
+    AiohttpOAuthStorageServiceClient,
+    AiohttpStorageServiceClient,
+    _acquire_in_thread,
+)
+from wellcome_storage_service.tokens import MemoryTokenStore  # noqa: E402
+
+
+class FakeStorageService(object):
+    """
+    A minimal stand-in for the bags/ingests APIs and the token endpoint.
+    """
+
+    def __init__(self, token_lifetime=3600):
+        self.token_lifetime = token_lifetime
+        self.tokens_issued = 0
+        self.valid_tokens = set()
+        self.requests = []
+        self.max_concurrent_requests = 0
+        self._concurrent_requests = 0
+
+    def _authorized(self, request):
+        auth = request.headers.get("Authorization", "")
+        return not self.valid_tokens or auth[len("Bearer "):] in self.valid_tokens
+
+    async def token(self, request):
+        assert request.headers["Authorization"].startswith("Basic ")
+        assert (await request.post())["grant_type"] == "client_credentials"
+
+        self.tokens_issued += 1
+        token = "token-%d" % self.tokens_issued
+        self.valid_tokens.add(token)
+
+        body = {"access_token": token, "token_type": "Bearer"}
+        if self.token_lifetime is not None:
+            body["expires_in"] = self.token_lifetime
+
+        return web.json_response(body)
+
+    async def get_bag(self, request):
+        self.requests.append(request.path_qs)
+        self._concurrent_requests += 1
+        self.max_concurrent_requests = max(
+            self.max_concurrent_requests, self._concurrent_requests
+        )
+
+        try:
+            await asyncio.sleep(0.01)
+
+            if not self._authorized(request):
+                return web.Response(status=401)
+
+            space = request.match_info["space"]
+            external_identifier = request.match_info["external_identifier"]
+
+            if external_identifier == "doesnotexist":
+                return web.json_response({}, status=404)
+
+            return web.json_response(
+                {
+                    "id": "%s/%s" % (space, external_identifier),
+                    "version": request.query.get("version", "v1"),
+                }
+            )
+        finally:
+            self._concurrent_requests -= 1
+
+    async def get_ingest(self, request):
+        ingest_id = request.match_info["ingest_id"]
+
+        if ingest_id == "doesnotexist":
+            return web.json_response({}, status=404)
+        elif ingest_id == "bad_request":
+            return web.json_response(
+                {"label": "Bad Request", "description": "Invalid ID"}, status=400
+            )
+        elif ingest_id == "server_error":
+            return web.Response(status=500)
+
+        return web.json_response({"id": ingest_id})
+
+    async def create_ingest(self, request):
+        payload = await request.json()
+
+        if payload["space"]["id"] == "bad space":
+            return web.json_response(
+                {"label": "Bad Request", "description": "Invalid space"}, status=400
+            )
+
+        return web.Response(
+            status=201, headers={"Location": "%s/ingests/1234" % request.url.origin()}
+        )
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/token", self.token)
+        app.router.add_get("/bags/{space}/{external_identifier}", self.get_bag)
+        app.router.add_get("/ingests/{ingest_id}", self.get_ingest)
+        app.router.add_post("/ingests", self.create_ingest)
+        return app
+
+
+def run_with_server(fake, test_fn):
+    async def _run():
+        async with TestServer(fake.app()) as server:
+            await test_fn(str(server.make_url("")).rstrip("/"))
+
+    asyncio.run(_run())
+
+
+def oauth_client(api_url, **kwargs):
+    return AiohttpOAuthStorageServiceClient(
+        api_url=api_url,
+        client_id="client_id",
+        client_secret="client_secret",
+        token_url=api_url + "/token",
+        **kwargs
+    )
+
+
+def test_can_get_bags_and_ingests():
+    fake = FakeStorageService()
+
+    async def _test(api_url):
+        async with AiohttpStorageServiceClient(api_url) as client:
+            bag = await client.get_bag("digitised", "b1234", version="v2")
+            assert bag == {"id": "digitised/b1234", "version": "v2"}
+
+            ingest = await client.get_ingest("1234")
+            assert ingest == {"id": "1234"}
+
+            location = await client.create_s3_ingest(
+                space="digitised",
+                external_identifier="b1234",
+                s3_bucket="bucket",
+                s3_key="b1234.tar.gz",
+            )
+            assert location.endswith("/ingests/1234")
+
+            ingest = await client.get_ingest_from_location(location)
+            assert ingest == {"id": "1234"}
+
+    run_with_server(fake, _test)
+
+
+def test_errors_match_the_blocking_client():
+    fake = FakeStorageService()
+
+    async def _test(api_url):
+        async with AiohttpStorageServiceClient(api_url) as client:
+            with pytest.raises(BagNotFound, match="digitised/doesnotexist"):
+                await client.get_bag("digitised", "doesnotexist")
+
+            with pytest.raises(IngestNotFound):
+                await client.get_ingest("doesnotexist")
+
+            with pytest.raises(UserError, match="Bad Request: Invalid ID"):
+                await client.get_ingest("bad_request")
+
+            with pytest.raises(ServerError):
+                await client.get_ingest("server_error")
+
+            with pytest.raises(UserError, match="Bad Request: Invalid space"):
+                await client.create_s3_ingest(
+                    space="bad space",
+                    external_identifier="b1234",
+                    s3_bucket="bucket",
+                    s3_key="b1234.tar.gz",
+                )
+
+    run_with_server(fake, _test)
+
+
+def test_limits_concurrent_connections():
+    fake = FakeStorageService()
+
+    async def _test(api_url):
+        async with AiohttpStorageServiceClient(api_url, max_connections=5) as client:
+            bags = await asyncio.gather(
+                *(client.get_bag("digitised", "b%d" % i) for i in range(50))
+            )
+
+        assert len(bags) == 50
+        assert fake.max_concurrent_requests == 5
+
+    run_with_server(fake, _test)
+
+
+def test_fetches_one_token_for_concurrent_requests():
+    fake = FakeStorageService()
+
+    async def _test(api_url):
+        async with oauth_client(api_url) as client:
+            await asyncio.gather(
+                *(client.get_bag("digitised", "b%d" % i) for i in range(50))
+            )
+            location = await client.create_s3_ingest(
+                space="digitised",
+                external_identifier="b1234",
+                s3_bucket="bucket",
+                s3_key="b1234.tar.gz",
+            )
+            assert location.endswith("/ingests/1234")
+
+        assert fake.tokens_issued == 1
+
+    run_with_server(fake, _test)
+
+
+def test_refreshes_a_token_before_it_expires():
+    # This token expires inside the refresh margin, so every request that
+    # comes after the refresh needs a new one.
+    fake = FakeStorageService(token_lifetime=30)
+
+    async def _test(api_url):
+        async with oauth_client(api_url) as client:
+            await client.get_bag("digitised", "b1")
+            await client.get_bag("digitised", "b2")
+
+        assert fake.tokens_issued == 2
+
+    run_with_server(fake, _test)
+
+
+def test_refreshes_a_rejected_token_and_retries():
+    fake = FakeStorageService()
+
+    async def _test(api_url):
+        async with oauth_client(api_url) as client:
+            await client.get_bag("digitised", "b1")
+
+            # Revoke the token
+            fake.valid_tokens = {"something-else"}
+
+            bag = await client.get_bag("digitised", "b2")
+            assert bag["id"] == "digitised/b2"
+
+        assert fake.tokens_issued == 2
+        assert fake.requests == [
+            "/bags/digitised/b1",
+            "/bags/digitised/b2",
+            "/bags/digitised/b2",
+        ]
+
+    run_with_server(fake, _test)
+
+
+def test_handles_a_token_without_an_expiry():
+    fake = FakeStorageService(token_lifetime=None)
+
+    async def _test(api_url):
+        async with oauth_client(api_url) as client:
+            await client.get_bag("digitised", "b1")
+            await client.get_bag("digitised", "b2")
+
+        assert fake.tokens_issued == 1
+
+    run_with_server(fake, _test)
+
+
+def test_shares_tokens_through_a_token_store():
+    fake = FakeStorageService()
+    token_store = MemoryTokenStore()
+
+    async def _test(api_url):
+        async with oauth_client(api_url, token_store=token_store) as client:
+            await client.get_bag("digitised", "b1")
+
+        async with oauth_client(api_url, token_store=token_store) as client:
+            await client.get_bag("digitised", "b2")
+
+        assert fake.tokens_issued == 1
+
+    run_with_server(fake, _test)
+
+
+def test_releases_the_store_lock_if_cancelled_while_waiting():
+    lock = threading.Lock()
+    lock.acquire()
+
+    async def _test():
+        task = asyncio.ensure_future(_acquire_in_thread(lock))
+        await asyncio.sleep(0.05)
+
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        # The thread is still waiting; once it gets the lock, it lets go
+        lock.release()
+        await asyncio.sleep(0.1)
+
+    asyncio.run(_test())
+
+    assert lock.acquire(timeout=1)
+
+
+def test_can_use_an_existing_session():
+    fake = FakeStorageService()
+
+    async def _test(api_url):
+        async with aiohttp.ClientSession() as sess:
+            async with AiohttpStorageServiceClient(api_url, sess=sess) as client:
+                await client.get_bag("digitised", "b1")
+
+            # The client doesn't close a session it didn't create
+            assert not sess.closed
+
+    run_with_server(fake, _test)
+
+
+def test_can_get_oauth_client_from_path(tmpdir):
+    credentials_path = tmpdir / "oauth_credentials.json"
+    credentials_path.write(
+        json.dumps(
+            {
+                "client_id": "client_id",
+                "client_secret": "client_secret",
+                "token_url": "https://example.org/api/v1/token",
+            }
+        )
+    )
+
+    client = AiohttpOAuthStorageServiceClient.from_path(
+        api_url="https://example.org/api/v1/storage",
+        credentials_path=str(credentials_path),
+    )
+
+    assert client.client_id == "client_id"
+    assert client.client_secret == "client_secret"
+    assert client.token_url == "https://example.org/api/v1/token"
@@ -0,0 +1,188 @@
+import hashlib
+import os
+
+import pytest
+
+from wellcome_storage_service import FetchEntry, build_bag
+from wellcome_storage_service.bag_builder import hash_file
+
+
+def sha256(body):
+    return hashlib.sha256(body).hexdigest()
+
+
+def sha512(body):
+    return hashlib.sha512(body).hexdigest()
+
+
+def read_manifest(path):
+    with open(path) as infile:
+        return dict(
+            reversed(line.rstrip("\n").split("  ", 1)) for line in infile if line.strip()
+        )
+
+
+def read_bag_info(path):
+    with open(path) as infile:
+        return [tuple(line.rstrip("\n").split(": ", 1)) for line in infile]
+
+
+@pytest.fixture
+def payload():
+    return {
+        "data/b12345.xml": b"<mets/>",
+        "data/objects/b12345_0001.jp2": os.urandom(1000),
+        "data/objects/b12345_0002.jp2": os.urandom(2000),
+    }
+
+
+@pytest.fixture
+def bag_dir(tmpdir, payload):
+    for name, body in payload.items():
+        tmpdir.join(name).write_binary(body, ensure=True)
+    return tmpdir
+
+
+@pytest.mark.parametrize("read_size", [1, 7, 1024 * 1024])
+def test_hash_file_computes_every_algorithm(tmpdir, read_size):
+    body = os.urandom(5000)
+    tmpdir.join("a.bin").write_binary(body)
+
+    assert hash_file(
+        str(tmpdir.join("a.bin")), algorithms=["sha256", "sha512"], read_size=read_size
+    ) == {"sha256": sha256(body), "sha512": sha512(body)}
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_builds_a_bag(bag_dir, payload, processes):
+    checksums = build_bag(
+        str(bag_dir),
+        bag_info={"External-Identifier": "b12345"},
+        processes=processes,
+    )
+
+    assert checksums == {name: {"sha256": sha256(body)} for name, body in payload.items()}
+
+    assert read_manifest(str(bag_dir.join("manifest-sha256.txt"))) == {
+        name: sha256(body) for name, body in payload.items()
+    }
+
+    assert bag_dir.join("bagit.txt").read() == (
+        "BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n"
+    )
+
+    bag_info = dict(read_bag_info(str(bag_dir.join("bag-info.txt"))))
+    assert bag_info["External-Identifier"] == "b12345"
+    assert bag_info["Payload-Oxum"] == "3007.3"
+    assert "Bagging-Date" in bag_info
+
+    assert read_manifest(str(bag_dir.join("tagmanifest-sha256.txt"))) == {
+        name: sha256(bag_dir.join(name).read_binary())
+        for name in ["bagit.txt", "bag-info.txt", "manifest-sha256.txt"]
+    }
+
+
+def test_uses_several_algorithms_at_once(bag_dir, payload):
+    build_bag(str(bag_dir), algorithms=["sha256", "SHA-512"], processes=1)
+
+    assert read_manifest(str(bag_dir.join("manifest-sha512.txt"))) == {
+        name: sha512(body) for name, body in payload.items()
+    }
+    assert sorted(read_manifest(str(bag_dir.join("tagmanifest-sha512.txt")))) == [
+        "bag-info.txt",
+        "bagit.txt",
+        "manifest-sha256.txt",
+        "manifest-sha512.txt",
+    ]
+
+
+def test_removes_manifests_for_unused_algorithms(bag_dir):
+    build_bag(str(bag_dir), algorithms=["sha256", "sha512"], processes=1)
+    build_bag(str(bag_dir), algorithms=["sha256"], processes=1)
+
+    assert not bag_dir.join("manifest-sha512.txt").exists()
+    assert not bag_dir.join("tagmanifest-sha512.txt").exists()
+
+
+def test_repeated_fields_in_bag_info(bag_dir):
+    build_bag(
+        str(bag_dir),
+        bag_info={"Contact-Name": ["Henry Wellcome", "Another Person"]},
+        processes=1,
+    )
+
+    bag_info = read_bag_info(str(bag_dir.join("bag-info.txt")))
+    assert ("Contact-Name", "Henry Wellcome") in bag_info
+    assert ("Contact-Name", "Another Person") in bag_info
+
+
+def test_writes_a_fetch_file(bag_dir, payload):
+    fetched = FetchEntry(
+        url="s3://wellcomecollection-storage/digitised/b12345/v1/data/old.jp2",
+        size=500,
+        name="data/old.jp2",
+        checksums={"SHA-256": "a" * 64},
+    )
+
+    checksums = build_bag(str(bag_dir), fetch_entries=[fetched], processes=1)
+
+    assert checksums["data/old.jp2"] == {"sha256": "a" * 64}
+    assert bag_dir.join("fetch.txt").read() == (
+        "s3://wellcomecollection-storage/digitised/b12345/v1/data/old.jp2"
+        "\t500\tdata/old.jp2\n"
+    )
+    assert read_manifest(str(bag_dir.join("manifest-sha256.txt")))[
+        "data/old.jp2"
+    ] == "a" * 64
+    assert "fetch.txt" in read_manifest(str(bag_dir.join("tagmanifest-sha256.txt")))
+
+    bag_info = dict(read_bag_info(str(bag_dir.join("bag-info.txt"))))
+    assert bag_info["Payload-Oxum"] == "3507.4"
+
+    # Rebuilding without any fetch entries removes the fetch file
+    build_bag(str(bag_dir), processes=1)
+    assert not bag_dir.join("fetch.txt").exists()
+
+
+def test_fetch_entries_need_every_checksum(bag_dir):
+    fetched = FetchEntry(
+        url="s3://bucket/old.jp2",
+        size=500,
+        name="data/old.jp2",
+        checksums={"sha256": "a" * 64},
+    )
+
+    with pytest.raises(ValueError, match="No sha512 checksum for data/old.jp2"):
+        build_bag(
+            str(bag_dir),
+            algorithms=["sha256", "sha512"],
+            fetch_entries=[fetched],
+            processes=1,
+        )
+
+
+def test_fetched_files_cant_also_be_in_the_bag(bag_dir):
+    fetched = FetchEntry(
+        url="s3://bucket/b12345.xml",
+        size=7,
+        name="data/b12345.xml",
+        checksums={"sha256": "a" * 64},
+    )
+
+    with pytest.raises(ValueError, match="in the bag and in fetch.txt"):
+        build_bag(str(bag_dir), fetch_entries=[fetched], processes=1)
+
+
+def test_percent_encodes_awkward_filenames(tmpdir):
+    tmpdir.join("data", "100% cotton.txt").write_binary(b"a", ensure=True)
+
+    build_bag(str(tmpdir), processes=1)
+
+    assert "data/100%25 cotton.txt" in read_manifest(
+        str(tmpdir.join("manifest-sha256.txt"))
+    )
+
+
+def test_needs_a_payload_directory(tmpdir):
+    with pytest.raises(ValueError, match="No payload directory"):
+        build_bag(str(tmpdir))
@@ -0,0 +1,196 @@
+import json
+import threading
+import time
+
+import mock
+import pytest
+
+from wellcome_storage_service import (
+    BagNotFound,
+    IngestNotFound,
+    ServerError,
+    StorageServiceClientBase,
+    UserError,
+)
+
+
+class FakeStorageServiceClient(StorageServiceClientBase):
+    """
+    A client that returns canned responses, rather than talking to the API.
+
+    ``responses`` is a dict mapping URL suffixes to a list of (status, body)
+    pairs, which are returned in turn by successive requests.
+    """
+
+    def __init__(self, responses):
+        self.responses = {url: list(resps) for url, resps in responses.items()}
+        self.requests = []
+        self._lock = threading.Lock()
+
+        super(FakeStorageServiceClient, self).__init__(
+            api_url="https://example.org/storage/v1"
+        )
+
+    def _http_get(self, url):
+        suffix = url[len(self.api_url):]
+
+        with self._lock:
+            self.requests.append(suffix)
+            try:
+                status_code, body = self.responses[suffix].pop(0)
+            except (KeyError, IndexError):
+                return 404, "{}"
+
+        return status_code, json.dumps(body)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff():
+    with mock.patch("wellcome_storage_service.backoff_delay", return_value=0):
+        yield
+
+
+def test_gets_many_bags():
+    client = FakeStorageServiceClient(
+        {
+            "/bags/digitised/b1": [(200, {"id": "digitised/b1", "version": "v2"})],
+            "/bags/digitised/b2?version=v1": [
+                (200, {"id": "digitised/b2", "version": "v1"})
+            ],
+        }
+    )
+
+    results = dict(
+        client.get_bags_many([("digitised", "b1"), ("digitised", "b2", "v1")])
+    )
+
+    assert results == {
+        ("digitised", "b1"): {"id": "digitised/b1", "version": "v2"},
+        ("digitised", "b2", "v1"): {"id": "digitised/b2", "version": "v1"},
+    }
+
+
+def test_per_bag_errors_dont_stop_the_batch():
+    client = FakeStorageServiceClient(
+        {
+            "/bags/digitised/b1": [(200, {"id": "digitised/b1"})],
+            "/bags/digitised/b2": [(500, {})] * 10,
+            "/bags/digitised/b4": [
+                (400, {"label": "Bad Request", "description": "Invalid space"})
+            ],
+        }
+    )
+
+    results = dict(
+        client.get_bags_many(
+            [("digitised", b_number) for b_number in ("b1", "b2", "b3", "b4")]
+        )
+    )
+
+    assert results[("digitised", "b1")] == {"id": "digitised/b1"}
+    assert isinstance(results[("digitised", "b2")], ServerError)
+    assert isinstance(results[("digitised", "b3")], BagNotFound)
+    assert isinstance(results[("digitised", "b4")], UserError)
+
+
+@pytest.mark.parametrize("status_code", [429, 500, 502, 503, 504])
+def test_retries_throttled_and_server_errors(status_code):
+    client = FakeStorageServiceClient(
+        {
+            "/ingests/1234": [
+                (status_code, {}),
+                (status_code, {}),
+                (200, {"id": "1234"}),
+            ]
+        }
+    )
+
+    results = list(client.get_ingests_many(["1234"]))
+
+    assert results == [("1234", {"id": "1234"})]
+    assert client.requests == ["/ingests/1234"] * 3
+
+
+def test_gives_up_after_max_retries():
+    client = FakeStorageServiceClient({"/ingests/1234": [(503, {})] * 10})
+
+    ((ingest_id, result),) = client.get_ingests_many(["1234"], max_retries=2)
+
+    assert ingest_id == "1234"
+    assert isinstance(result, ServerError)
+    assert client.requests == ["/ingests/1234"] * 3
+
+
+def test_throttling_error_without_a_json_body_is_a_user_error():
+    client = FakeStorageServiceClient({})
+    client._http_get = lambda url: (429, "Too Many Requests")
+
+    ((_, result),) = client.get_ingests_many(["1234"], max_retries=0)
+
+    assert isinstance(result, UserError)
+    assert "429" in str(result)
+
+
+def test_does_not_retry_a_missing_ingest():
+    client = FakeStorageServiceClient({})
+
+    ((_, result),) = client.get_ingests_many(["doesnotexist"])
+
+    assert isinstance(result, IngestNotFound)
+    assert client.requests == ["/ingests/doesnotexist"]
+
+
+def test_yields_results_as_they_complete():
+    client = FakeStorageServiceClient({})
+    slow_request_started = threading.Event()
+
+    def _http_get(url):
+        if url.endswith("/slow"):
+            slow_request_started.set()
+            time.sleep(0.2)
+        return 200, json.dumps({"url": url})
+
+    client._http_get = _http_get
+
+    results = client.get_ingests_many(["slow", "fast"], max_concurrency=2)
+
+    assert next(results)[0] == "fast"
+    assert slow_request_started.is_set()
+    assert next(results)[0] == "slow"
+
+
+def test_limits_concurrent_requests():
+    client = FakeStorageServiceClient({})
+    lock = threading.Lock()
+    in_flight = [0]
+    max_in_flight = [0]
+
+    def _http_get(url):
+        with lock:
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        time.sleep(0.01)
+        with lock:
+            in_flight[0] -= 1
+        return 200, "{}"
+
+    client._http_get = _http_get
+
+    results = list(client.get_ingests_many(range(50), max_concurrency=4))
+
+    assert len(results) == 50
+    assert max_in_flight[0] == 4
+
+
+def test_rate_limits_requests():
+    client = FakeStorageServiceClient({})
+    client._http_get = lambda url: (200, "{}")
+
+    with mock.patch("wellcome_storage_service._utils.time.sleep") as sleep:
+        list(client.get_ingests_many(range(10), max_requests_per_second=5))
+
+    # The first request goes straight away, then the others are spaced out
+    # by 1/5 of a second each, so the last one waits for ~9/5 seconds.
+    waits = [call[0][0] for call in sleep.call_args_list]
+    assert len(waits) == 9
+    assert max(waits) == pytest.approx(9 * 0.2, abs=0.1)
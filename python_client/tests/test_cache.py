@@ -0,0 +1,198 @@
+import binascii
+import json
+import os
+
+import mock
+import pytest
+
+from wellcome_storage_service import (
+    BagNotFound,
+    ManifestCache,
+    StorageServiceClientBase,
+)
+
+
+API_URL = "https://example.org/storage/v1"
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return ManifestCache(directory=str(tmpdir.join("cache")))
+
+
+def test_cache_miss_returns_none(cache):
+    assert cache.get(API_URL, "digitised", "b1234", "v1") is None
+
+
+def test_can_store_and_retrieve_a_manifest(cache):
+    body = json.dumps({"id": "digitised/b1234", "version": "v1"})
+
+    cache.put(API_URL, "digitised", "b1234", "v1", body)
+
+    assert cache.get(API_URL, "digitised", "b1234", "v1") == body
+    assert cache.get(API_URL, "digitised", "b1234", "v2") is None
+    assert cache.get(API_URL, "digitised", "b5678", "v1") is None
+    assert cache.get("https://example.net/v1", "digitised", "b1234", "v1") is None
+
+
+def test_manifests_are_compressed(cache):
+    body = json.dumps({"files": ["data/b1234_%04d.jp2" % i for i in range(1000)]})
+
+    cache.put(API_URL, "digitised", "b1234", "v1", body)
+
+    (name,) = os.listdir(cache.directory)
+    assert os.stat(os.path.join(cache.directory, name)).st_size < len(body) / 5
+
+
+def test_latest_manifest_is_also_cached_under_its_version(cache):
+    body = json.dumps({"id": "digitised/b1234", "version": "v3"})
+
+    cache.put(API_URL, "digitised", "b1234", None, body, resolved_version="v3")
+
+    assert cache.get(API_URL, "digitised", "b1234", None) == body
+    assert cache.get(API_URL, "digitised", "b1234", "v3") == body
+
+
+def test_latest_manifest_expires(cache):
+    cache.put(
+        API_URL,
+        "digitised",
+        "b1234",
+        None,
+        json.dumps({"version": "v3"}),
+        resolved_version="v3",
+    )
+
+    now = os.stat(cache._path(API_URL, "digitised", "b1234", None)).st_mtime
+
+    with mock.patch("wellcome_storage_service.cache.time.time") as fake_time:
+        fake_time.return_value = now + cache.latest_ttl - 1
+        assert cache.get(API_URL, "digitised", "b1234", None) is not None
+
+        fake_time.return_value = now + cache.latest_ttl + 1
+        assert cache.get(API_URL, "digitised", "b1234", None) is None
+
+        # The specific version doesn't expire
+        assert cache.get(API_URL, "digitised", "b1234", "v3") is not None
+
+
+def _cache_size(cache):
+    return sum(
+        os.stat(os.path.join(cache.directory, name)).st_size
+        for name in os.listdir(cache.directory)
+    )
+
+
+def test_evicts_least_recently_used_manifests(cache):
+    bodies = {
+        "v%d" % i: binascii.hexlify(os.urandom(500)).decode("ascii")
+        for i in range(1, 5)
+    }
+
+    for i, version in enumerate(sorted(bodies)):
+        cache.put(API_URL, "digitised", "b1234", version, bodies[version])
+        os.utime(cache._path(API_URL, "digitised", "b1234", version), (i, i))
+
+    # The cache is now full
+    cache.max_size = _cache_size(cache)
+
+    # Reading v1 makes it the most recently used
+    assert cache.get(API_URL, "digitised", "b1234", "v1") == bodies["v1"]
+
+    cache.put(API_URL, "digitised", "b1234", "v5", "x" * 10)
+
+    assert cache.get(API_URL, "digitised", "b1234", "v1") is not None
+    assert cache.get(API_URL, "digitised", "b1234", "v2") is None
+    assert cache.get(API_URL, "digitised", "b1234", "v5") is not None
+
+    assert _cache_size(cache) <= cache.max_size
+
+
+def test_truncated_entry_is_a_miss(cache):
+    cache.put(API_URL, "digitised", "b1234", "v1", json.dumps({"version": "v1"}))
+
+    path = cache._path(API_URL, "digitised", "b1234", "v1")
+    with open(path, "r+b") as f:
+        f.truncate(10)
+
+    assert cache.get(API_URL, "digitised", "b1234", "v1") is None
+
+
+def test_clear_empties_the_cache(cache):
+    cache.put(
+        API_URL,
+        "digitised",
+        "b1234",
+        None,
+        json.dumps({"version": "v1"}),
+        resolved_version="v1",
+    )
+
+    cache.clear()
+
+    assert os.listdir(cache.directory) == []
+
+
+class CountingClient(StorageServiceClientBase):
+    def __init__(self, **kwargs):
+        self.urls = []
+        super(CountingClient, self).__init__(api_url=API_URL, **kwargs)
+
+    def _http_get(self, url):
+        self.urls.append(url)
+
+        if "doesnotexist" in url:
+            return 404, "{}"
+
+        return 200, json.dumps({"id": url, "version": "v2"})
+
+
+def test_client_uses_the_manifest_cache(cache):
+    client = CountingClient(manifest_cache=cache)
+
+    bag = client.get_bag("digitised", "b1234", version="v1")
+    assert client.get_bag("digitised", "b1234", version="v1") == bag
+
+    assert len(client.urls) == 1
+
+
+def test_client_uses_cached_latest_manifest_for_that_version(cache):
+    client = CountingClient(manifest_cache=cache)
+
+    bag = client.get_bag("digitised", "b1234")
+    assert client.get_bag("digitised", "b1234", version="v2") == bag
+
+    assert client.urls == [API_URL + "/bags/digitised/b1234"]
+
+
+def test_client_does_not_cache_errors(cache):
+    client = CountingClient(manifest_cache=cache)
+
+    for _ in range(2):
+        with pytest.raises(BagNotFound):
+            client.get_bag("digitised", "doesnotexist", version="v1")
+
+    assert len(client.urls) == 2
+    assert os.listdir(cache.directory) == []
+
+
+def test_bulk_lookups_use_the_manifest_cache(cache):
+    client = CountingClient(manifest_cache=cache)
+
+    client.get_bag("digitised", "b1", version="v1")
+
+    results = dict(
+        client.get_bags_many([("digitised", "b1", "v1"), ("digitised", "b2", "v1")])
+    )
+
+    assert len(results) == 2
+    assert len(client.urls) == 2
+
+
+def test_client_without_cache_always_fetches():
+    client = CountingClient()
+
+    client.get_bag("digitised", "b1234", version="v1")
+    client.get_bag("digitised", "b1234", version="v1")
+
+    assert len(client.urls) == 2
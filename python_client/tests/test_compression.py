@@ -0,0 +1,109 @@
+import gzip
+import io
+import os
+import zlib
+
+import pytest
+
+from wellcome_storage_service.compression import (
+    ParallelGzipWriter,
+    open_compressed_writer,
+)
+
+
+@pytest.mark.parametrize("size", [0, 1, 1000, 128 * 1024, 1000000])
+def test_parallel_gzip_roundtrips(size):
+    data = os.urandom(size // 2) + b"a" * (size - size // 2)
+    out_file = io.BytesIO()
+
+    with ParallelGzipWriter(out_file, threads=4, block_size=10000) as writer:
+        for i in range(0, size, 3333):
+            writer.write(data[i:i + 3333])
+
+    assert gzip.GzipFile(fileobj=io.BytesIO(out_file.getvalue())).read() == data
+
+
+def test_parallel_gzip_writes_a_single_member():
+    data = os.urandom(25000)
+    out_file = io.BytesIO()
+
+    writer = ParallelGzipWriter(out_file, threads=2, block_size=10000)
+    writer.write(data)
+    writer.close()
+
+    # A single gzip member, with nothing left over after it
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert decompressor.decompress(out_file.getvalue()) == data
+    assert decompressor.eof
+    assert decompressor.unused_data == b""
+
+
+def test_parallel_gzip_compresses_across_blocks():
+    data = os.urandom(1000) * 100
+    out_file = io.BytesIO()
+
+    with ParallelGzipWriter(out_file, threads=4, block_size=1000) as writer:
+        writer.write(data)
+
+    # Every block is random on its own, but each one can refer back to the
+    # end of the previous block, so the repeats are still found.
+    assert len(out_file.getvalue()) < 10000
+
+
+def test_closing_twice_is_okay():
+    out_file = io.BytesIO()
+
+    writer = ParallelGzipWriter(out_file, threads=2)
+    writer.write(b"hello world")
+    writer.close()
+    writer.close()
+
+    assert gzip.GzipFile(fileobj=io.BytesIO(out_file.getvalue())).read() == (
+        b"hello world"
+    )
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_open_gzip_writer(threads):
+    out_file = io.BytesIO()
+
+    writer = open_compressed_writer(out_file, compression="gz", threads=threads)
+    writer.write(b"hello world")
+    writer.close()
+
+    assert not out_file.closed
+    assert gzip.GzipFile(fileobj=io.BytesIO(out_file.getvalue())).read() == (
+        b"hello world"
+    )
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_open_zstd_writer(threads):
+    # zstandard only supports Python 3
+    zstandard = pytest.importorskip("zstandard")
+
+    out_file = io.BytesIO()
+
+    writer = open_compressed_writer(out_file, compression="zst", threads=threads)
+    writer.write(b"hello world")
+    writer.close()
+
+    assert not out_file.closed
+    reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(out_file.getvalue()))
+    assert reader.read() == b"hello world"
+
+
+def test_open_uncompressed_writer():
+    out_file = io.BytesIO()
+
+    writer = open_compressed_writer(out_file, compression=None)
+    writer.write(b"hello world")
+    writer.close()
+
+    assert not out_file.closed
+    assert out_file.getvalue() == b"hello world"
+
+
+def test_unsupported_compression_is_error():
+    with pytest.raises(ValueError, match="Unsupported compression: 'bz2'"):
+        open_compressed_writer(io.BytesIO(), compression="bz2")
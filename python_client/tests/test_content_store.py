@@ -0,0 +1,180 @@
+import hashlib
+import os
+import stat
+
+import mock
+import pytest
+
+from wellcome_storage_service import ContentStore, downloader
+
+
+def sha256(body):
+    return hashlib.sha256(body).hexdigest()
+
+
+@pytest.fixture
+def store(tmpdir):
+    return ContentStore(directory=str(tmpdir.join("store")))
+
+
+def _write(tmpdir, name, body):
+    path = tmpdir.join(name)
+    path.write_binary(body)
+    return str(path)
+
+
+def test_can_add_and_link_a_file(store, tmpdir):
+    src = _write(tmpdir, "a.txt", b"hello world")
+
+    store.add("SHA-256", sha256(b"hello world"), src)
+
+    assert ("SHA-256", sha256(b"hello world")) in store
+    assert store.link("SHA-256", sha256(b"hello world"), str(tmpdir.join("x/b.txt")))
+    assert tmpdir.join("x", "b.txt").read_binary() == b"hello world"
+
+
+def test_missing_file_is_not_linked(store, tmpdir):
+    out_path = _write(tmpdir, "a.txt", b"existing")
+
+    assert not store.link("SHA-256", sha256(b"hello world"), out_path)
+    assert ("SHA-256", sha256(b"hello world")) not in store
+
+    # We don't touch the existing file on a miss
+    assert tmpdir.join("a.txt").read_binary() == b"existing"
+
+
+def test_files_are_keyed_by_algorithm(store, tmpdir):
+    src = _write(tmpdir, "a.txt", b"hello world")
+    store.add("SHA-256", sha256(b"hello world"), src)
+
+    assert ("SHA-512", sha256(b"hello world")) not in store
+
+
+@pytest.mark.parametrize("checksum", ["../../etc/passwd", "", "not-hex"])
+def test_ignores_checksums_that_arent_hex(store, tmpdir, checksum):
+    src = _write(tmpdir, "a.txt", b"hello world")
+
+    store.add("SHA-256", checksum, src)
+
+    assert store.size == 0
+    assert not store.link("SHA-256", checksum, str(tmpdir.join("b.txt")))
+
+
+def test_files_in_the_store_are_read_only(store, tmpdir):
+    src = _write(tmpdir, "a.txt", b"hello world")
+    store.add("SHA-256", sha256(b"hello world"), src)
+
+    (path,) = [p for _, _, p in store._entries()]
+    assert not os.stat(path).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+
+
+def test_adding_a_file_leaves_the_original_writable(store, tmpdir):
+    src = _write(tmpdir, "a.txt", b"hello world")
+    store.add("SHA-256", sha256(b"hello world"), src)
+
+    assert os.stat(src).st_mode & stat.S_IWUSR
+
+    with open(src, "ab") as out_file:
+        out_file.write(b"!")
+
+    (path,) = [p for _, _, p in store._entries()]
+    with open(path, "rb") as in_file:
+        assert in_file.read() == b"hello world"
+
+
+def test_copies_if_it_cant_link(store, tmpdir):
+    src = _write(tmpdir, "a.txt", b"hello world")
+
+    with mock.patch("os.link", side_effect=OSError("Invalid cross-device link")):
+        store.add("SHA-256", sha256(b"hello world"), src)
+        assert store.link("SHA-256", sha256(b"hello world"), str(tmpdir.join("b.txt")))
+
+    assert tmpdir.join("b.txt").read_binary() == b"hello world"
+
+
+def test_evicts_least_recently_used_files(tmpdir):
+    store = ContentStore(directory=str(tmpdir.join("store")), max_size=250)
+    bodies = [(b"%d" % i) * 100 for i in range(3)]
+
+    for i, body in enumerate(bodies[:2]):
+        store.add("SHA-256", sha256(body), _write(tmpdir, "%d.txt" % i, body))
+        os.utime(store._path("SHA-256", sha256(body)), (1000 + i, 1000 + i))
+
+    # Using the first file makes it more recent than the second
+    assert store.link("SHA-256", sha256(bodies[0]), str(tmpdir.join("out.txt")))
+
+    store.add("SHA-256", sha256(bodies[2]), _write(tmpdir, "2.txt", bodies[2]))
+
+    assert ("SHA-256", sha256(bodies[0])) in store
+    assert ("SHA-256", sha256(bodies[1])) not in store
+    assert ("SHA-256", sha256(bodies[2])) in store
+    assert store.size == 200
+
+
+def test_can_clear_the_store(store, tmpdir):
+    store.add("SHA-256", sha256(b"a"), _write(tmpdir, "a.txt", b"a"))
+    store.clear()
+
+    assert store.size == 0
+
+
+class TestDownloadingWithAContentStore(object):
+    def _download(self, bag, out_dir, store, s3_client, **kwargs):
+        provider = downloader.S3InfrequentAccessProvider(s3_client=s3_client)
+
+        with mock.patch.object(downloader, "_choose_provider", return_value=provider):
+            with mock.patch.object(
+                provider, "get_fileobj", wraps=provider.get_fileobj
+            ) as get_fileobj:
+                results = downloader.download_bag(
+                    bag, out_dir=out_dir, content_store=store, **kwargs
+                )
+
+        downloaded = sorted(
+            call[1]["manifest_file"]["name"] for call in get_fileobj.call_args_list
+        )
+        return results, downloaded
+
+    def test_only_downloads_new_files_in_a_new_version(
+        self, make_bag, s3_client, store, tmpdir
+    ):
+        files = {"data/%d.jp2" % i: os.urandom(100) for i in range(10)}
+        v1 = make_bag(files=files, version="v1")
+
+        _, downloaded = self._download(v1, str(tmpdir.join("v1")), store, s3_client)
+        assert len(downloaded) == 11
+
+        files["data/3.jp2"] = b"a new version of page 3"
+        files["data/10.jp2"] = b"a new page"
+        v2 = make_bag(files=files, version="v2")
+
+        results, downloaded = self._download(
+            v2, str(tmpdir.join("v2")), store, s3_client
+        )
+
+        assert downloaded == ["data/10.jp2", "data/3.jp2"]
+        assert all(r.verified for r in results.values())
+        assert len(results) == 12
+
+        for name, body in files.items():
+            assert tmpdir.join("v2", name).read_binary() == body
+
+    def test_downloads_duplicate_files_once(self, make_bag, s3_client, store, tmpdir):
+        bag = make_bag(files={"data/a.txt": b"same", "data/b.txt": b"same"})
+
+        _, downloaded = self._download(
+            bag, str(tmpdir.join("out")), store, s3_client, max_workers=1
+        )
+
+        assert len([name for name in downloaded if name.startswith("data/")]) == 1
+        assert tmpdir.join("out", "data", "b.txt").read_binary() == b"same"
+
+    def test_does_not_store_a_bad_download(self, make_bag, s3_client, store, tmpdir):
+        bag = make_bag(files={"data/a.txt": b"aaa"})
+        bag["manifest"]["files"][0]["checksum"] = sha256(b"something else")
+
+        with pytest.raises(downloader.BagDownloadError):
+            self._download(bag, str(tmpdir.join("out")), store, s3_client)
+
+        assert ("SHA-256", sha256(b"something else")) not in store
+        assert ("SHA-256", sha256(b"aaa")) not in store
@@ -0,0 +1,168 @@
+import hashlib
+import json
+
+import pytest
+
+from wellcome_storage_service import (
+    StorageManifest,
+    StorageServiceClientBase,
+    diff_manifests,
+    iter_manifest_changes,
+)
+
+
+def make_bag(files, version, tag_files=None, checksum_algorithm="SHA-256"):
+    """
+    Returns a bag with the given files, which should be a dict of
+    name -> (version it was written in, contents).
+    """
+
+    def _manifest(contents):
+        return {
+            "checksumAlgorithm": checksum_algorithm,
+            "files": [
+                {
+                    "checksum": hashlib.sha256(body).hexdigest(),
+                    "name": name,
+                    "path": "%s/%s" % (file_version, name),
+                    "size": len(body),
+                    "type": "File",
+                }
+                for name, (file_version, body) in sorted(contents.items())
+            ],
+            "type": "BagManifest",
+        }
+
+    return {
+        "id": "digitised/b1234",
+        "manifest": _manifest(files),
+        "tagManifest": _manifest(tag_files or {}),
+        "version": version,
+    }
+
+
+V1 = make_bag(
+    {
+        "data/unchanged.jp2": ("v1", b"unchanged"),
+        "data/modified.xml": ("v1", b"<mets v1/>"),
+        "data/removed.jp2": ("v1", b"removed"),
+        "data/old-name.jp2": ("v1", b"moved"),
+    },
+    tag_files={"bag-info.txt": ("v1", b"Payload-Oxum: 1.1")},
+    version="v1",
+)
+
+V2 = make_bag(
+    {
+        "data/unchanged.jp2": ("v1", b"unchanged"),
+        "data/modified.xml": ("v2", b"<mets version='2'/>"),
+        "data/new-name.jp2": ("v2", b"moved"),
+        "data/added.jp2": ("v2", b"added"),
+    },
+    tag_files={"bag-info.txt": ("v2", b"Payload-Oxum: 2.2")},
+    version="v2",
+)
+
+
+@pytest.mark.parametrize("as_storage_manifest", [True, False])
+def test_diffs_two_versions(as_storage_manifest):
+    if as_storage_manifest:
+        diff = diff_manifests(
+            StorageManifest.from_bag(V1), StorageManifest.from_bag(V2)
+        )
+    else:
+        diff = diff_manifests(V1, V2)
+
+    assert [c.name for c in diff.added] == ["data/added.jp2"]
+    assert [c.name for c in diff.removed] == ["data/removed.jp2"]
+    assert sorted(c.name for c in diff.modified) == [
+        "bag-info.txt",
+        "data/modified.xml",
+    ]
+    assert [(c.old.name, c.new.name) for c in diff.moved] == [
+        ("data/old-name.jp2", "data/new-name.jp2")
+    ]
+
+    (modified_mets,) = [c for c in diff.modified if c.name == "data/modified.xml"]
+    assert modified_mets.old.path == "v1/data/modified.xml"
+    assert modified_mets.new.path == "v2/data/modified.xml"
+
+
+def test_byte_totals():
+    diff = diff_manifests(V1, V2)
+
+    assert diff.bytes_added == len(b"added")
+    assert diff.bytes_removed == len(b"removed")
+    assert diff.bytes_moved == len(b"moved")
+    assert diff.bytes_modified == len(b"<mets version='2'/>") + len(
+        b"Payload-Oxum: 2.2"
+    )
+
+    old_size = StorageManifest.from_bag(V1).total_size
+    new_size = StorageManifest.from_bag(V2).total_size
+    assert diff.size_change == new_size - old_size
+
+
+def test_identical_versions_have_no_diff():
+    diff = diff_manifests(V1, V1)
+
+    assert not diff
+    assert list(iter_manifest_changes(V1, V1)) == []
+
+
+def test_modified_files_are_streamed_before_the_end():
+    changes = iter_manifest_changes(V1, V2)
+
+    first = next(changes)
+    assert first.change == "modified"
+    assert first.name == "data/modified.xml"
+
+
+def test_duplicate_contents_are_matched_one_to_one():
+    old = make_bag({"a.txt": ("v1", b"same"), "b.txt": ("v1", b"same")}, "v1")
+    new = make_bag(
+        {"c.txt": ("v2", b"same"), "d.txt": ("v2", b"same"), "e.txt": ("v2", b"same")},
+        "v2",
+    )
+
+    diff = diff_manifests(old, new)
+
+    assert [(c.old.name, c.new.name) for c in diff.moved] == [
+        ("a.txt", "c.txt"),
+        ("b.txt", "d.txt"),
+    ]
+    assert [c.name for c in diff.added] == ["e.txt"]
+    assert diff.removed == []
+
+
+def test_cannot_diff_different_checksum_algorithms():
+    old = make_bag({"a.txt": ("v1", b"a")}, "v1", checksum_algorithm="SHA-256")
+    new = make_bag({"a.txt": ("v1", b"a")}, "v2", checksum_algorithm="SHA-512")
+
+    with pytest.raises(ValueError, match="different checksum algorithms"):
+        diff_manifests(old, new)
+
+
+def test_diffs_large_bags():
+    n = 20000
+    old = make_bag({"data/%06d.jp2" % i: ("v1", b"%d" % i) for i in range(n)}, "v1")
+    new = make_bag(
+        {"data/%06d.jp2" % i: ("v1", b"%d" % i) for i in range(1, n + 1)}, "v2"
+    )
+
+    diff = diff_manifests(old, new)
+
+    assert [c.name for c in diff.removed] == ["data/000000.jp2"]
+    assert [c.name for c in diff.added] == ["data/%06d.jp2" % n]
+
+
+def test_client_can_diff_versions():
+    class FakeClient(StorageServiceClientBase):
+        def _http_get(self, url):
+            return 200, json.dumps(V2 if url.endswith("v2") else V1)
+
+    client = FakeClient(api_url="https://example.org/storage/v1")
+
+    diff = client.diff_versions("digitised", "b1234", "v1", "v2")
+
+    assert repr(diff) == "<ManifestDiff added=1 removed=1 modified=2 moved=1>"
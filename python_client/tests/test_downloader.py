@@ -1,9 +1,17 @@
+import concurrent.futures
+import errno
+import hashlib
+import io
+import os
 import tarfile
+import time
 
 from botocore.exceptions import ClientError
+import mock
 import pytest
 
-from wellcome_storage_service import downloader
+from wellcome_storage_service import BagDownloadError, ChecksumMismatch, downloader
+from wellcome_storage_service.journal import DownloadJournal, JOURNAL_NAME
 
 
 def test_cannot_download_a_bag_with_wrong_provider(tmpdir):
@@ -126,10 +134,10 @@ class TestS3IADownload(object):
             "tagManifest": {"files": []},
         }
 
-        with pytest.raises(Exception) as err:
+        with pytest.raises(BagDownloadError) as err:
             downloader.download_bag(bag, out_dir=str(tmpdir))
 
-        assert err.value.args[0].startswith(
+        assert err.value.errors["data/b10002819.xml"].args[0].startswith(
             (
                 'Could not connect to the endpoint URL: "https://does-not-exist.s3.amazonaws.com',
                 "An error occurred (403) when calling the HeadObject operation",
@@ -152,10 +160,11 @@ class TestS3IADownload(object):
             "tagManifest": {"files": []},
         }
 
-        with pytest.raises(ClientError) as err:
+        with pytest.raises(BagDownloadError) as err:
             downloader.download_bag(bag, out_dir=str(tmpdir))
 
-        assert err.value.args[0].startswith(
+        assert isinstance(err.value.errors["data/b10002819.xml"], ClientError)
+        assert err.value.errors["data/b10002819.xml"].args[0].startswith(
             (
                 "An error occurred (404) when calling the HeadObject operation",
                 "An error occurred (NoSuchKey) when calling the GetObject operation",
@@ -177,3 +186,1255 @@ class TestS3IADownload(object):
             for tarinfo in tarred_files:
                 # All files in the compressed bag are under a directory
                 assert tarinfo.name.startswith("custom_dir/")
+
+
+class TestConcurrentDownload(object):
+    def test_downloads_every_file(self, make_bag, tmpdir):
+        files = {"data/b%04d.xml" % i: b"<xml>%d</xml>" % i for i in range(50)}
+        bag = make_bag(files)
+
+        downloader.download_bag(bag, out_dir=str(tmpdir), max_workers=4)
+
+        for name, body in files.items():
+            assert tmpdir.join(name).read_binary() == body
+        assert tmpdir.join("bagit.txt").exists()
+
+    def test_reports_every_error_together(self, make_bag, s3_client, tmpdir):
+        bag = make_bag({"data/a.txt": b"a", "data/b.txt": b"b", "data/c.txt": b"c"})
+
+        for name in ("data/a.txt", "data/c.txt"):
+            s3_client.delete_object(
+                Bucket="wellcomecollection-storage",
+                Key="digitised/b12345/v1/%s" % name,
+            )
+
+        with pytest.raises(BagDownloadError) as err:
+            downloader.download_bag(bag, out_dir=str(tmpdir))
+
+        assert set(err.value.errors) == {"data/a.txt", "data/c.txt"}
+        assert all(isinstance(e, ClientError) for e in err.value.errors.values())
+        assert str(err.value).startswith("Errors downloading 2 files from bag:")
+
+        # The files that could be downloaded are still downloaded
+        assert tmpdir.join("data/b.txt").read_binary() == b"b"
+
+    def test_truncates_long_error_messages(self):
+        errors = {"data/%d.txt" % i: ValueError("BOOM") for i in range(10)}
+
+        err = BagDownloadError(errors)
+
+        assert str(err).count("BOOM") == 5
+        assert str(err).endswith("; ...")
+
+    def test_compressed_bag_uses_concurrent_download(self, make_bag, tmpdir):
+        bag = make_bag({"data/%d.txt" % i: b"%d" % i for i in range(20)})
+        out_path = str(tmpdir.join("b12345.tar.gz"))
+
+        downloader.download_compressed_bag(bag, out_path=out_path, max_workers=3)
+
+        with tarfile.open(out_path, "r:gz") as tf:
+            names = {m.name for m in tf.getmembers() if m.isfile()}
+
+        assert names == {"b12345/data/%d.txt" % i for i in range(20)} | {
+            "b12345/bagit.txt"
+        }
+
+
+class TestRangedDownload(object):
+    def _provider(self, s3_client, **kwargs):
+        return downloader.S3InfrequentAccessProvider(
+            s3_client=s3_client,
+            chunk_size=1000,
+            multipart_threshold=10000,
+            multipart_chunksize=3000,
+            **kwargs
+        )
+
+    @pytest.mark.parametrize(
+        "size, chunk_size, expected",
+        [
+            (10, 5, [(0, 4), (5, 9)]),
+            (11, 5, [(0, 4), (5, 9), (10, 10)]),
+            (3, 5, [(0, 2)]),
+            (0, 5, []),
+        ],
+    )
+    def test_byte_ranges(self, size, chunk_size, expected):
+        assert downloader._byte_ranges(size, chunk_size) == expected
+
+    def test_downloads_large_file_in_ranges(self, make_bag, s3_client, tmpdir):
+        body = os.urandom(25000)
+        bag = make_bag({"data/video.mxf": body})
+        manifest_file = bag["manifest"]["files"][0]
+
+        provider = self._provider(s3_client)
+
+        with mock.patch.object(
+            s3_client, "get_object", wraps=s3_client.get_object
+        ) as get_object:
+            provider.download(
+                out_dir=str(tmpdir),
+                location=bag["location"],
+                manifest_file=manifest_file,
+            )
+
+        assert tmpdir.join("data/video.mxf").read_binary() == body
+
+        ranges = sorted(c[1]["Range"] for c in get_object.call_args_list)
+        assert len(ranges) == 9
+        assert "bytes=24000-24999" in ranges
+
+    def test_downloads_small_file_in_one_request(self, make_bag, s3_client, tmpdir):
+        body = os.urandom(9999)
+        bag = make_bag({"data/small.xml": body})
+        manifest_file = bag["manifest"]["files"][0]
+
+        provider = self._provider(s3_client)
+
+        with mock.patch.object(
+            s3_client, "get_object", wraps=s3_client.get_object
+        ) as get_object:
+            provider.download(
+                out_dir=str(tmpdir),
+                location=bag["location"],
+                manifest_file=manifest_file,
+            )
+
+        assert tmpdir.join("data/small.xml").read_binary() == body
+        assert get_object.call_count == 1
+        assert "Range" not in get_object.call_args[1]
+
+    def test_works_without_pwrite(self, make_bag, s3_client, tmpdir, monkeypatch):
+        monkeypatch.delattr(os, "pwrite")
+
+        body = os.urandom(12345)
+        bag = make_bag({"data/video.mxf": body})
+
+        self._provider(s3_client).download(
+            out_dir=str(tmpdir),
+            location=bag["location"],
+            manifest_file=bag["manifest"]["files"][0],
+        )
+
+        assert tmpdir.join("data/video.mxf").read_binary() == body
+
+    def test_short_read_is_error(self, make_bag, s3_client, tmpdir):
+        bag = make_bag({"data/video.mxf": os.urandom(12000)})
+        provider = self._provider(s3_client)
+
+        # Simulate a connection that drops partway through a range
+        def _truncated_range(location, manifest_file, start, end):
+            return io.BytesIO(b"x" * min(end - start + 1, 2000))
+
+        with mock.patch.object(provider, "get_range_fileobj", _truncated_range):
+            with pytest.raises(
+                IOError, match=r"Short read for bytes \d+-\d+ of data/video.mxf"
+            ):
+                provider.download(
+                    out_dir=str(tmpdir),
+                    location=bag["location"],
+                    manifest_file=bag["manifest"]["files"][0],
+                )
+
+    def test_creates_client_with_larger_pool(self, s3_client):
+        provider = downloader.S3InfrequentAccessProvider()
+
+        config = provider.s3_client.meta.config
+        assert config.max_pool_connections == downloader.DEFAULT_MAX_POOL_CONNECTIONS
+
+
+class TestChecksumVerification(object):
+    def test_returns_verification_results(self, make_bag, tmpdir):
+        bag = make_bag({"data/a.txt": b"a", "data/b.txt": b"b"})
+
+        results = downloader.download_bag(bag, out_dir=str(tmpdir))
+
+        assert set(results) == {"data/a.txt", "data/b.txt", "bagit.txt"}
+        assert all(r.verified for r in results.values())
+        assert results["data/a.txt"] == downloader.VerificationResult(
+            name="data/a.txt",
+            checksum_algorithm="SHA-256",
+            expected=hashlib.sha256(b"a").hexdigest(),
+            actual=hashlib.sha256(b"a").hexdigest(),
+        )
+
+    def test_uses_algorithm_from_each_manifest(self, make_bag, tmpdir):
+        bag = make_bag({"data/a.txt": b"a"})
+        bag["tagManifest"]["checksumAlgorithm"] = "SHA-512"
+        bag["tagManifest"]["files"][0]["checksum"] = hashlib.sha512(
+            b"BagIt-Version: 0.97\n"
+        ).hexdigest()
+
+        results = downloader.download_bag(bag, out_dir=str(tmpdir))
+
+        assert results["data/a.txt"].checksum_algorithm == "SHA-256"
+        assert results["bagit.txt"].checksum_algorithm == "SHA-512"
+        assert results["bagit.txt"].verified
+
+    def test_mismatched_checksum_is_error(self, make_bag, tmpdir):
+        bag = make_bag({"data/a.txt": b"a", "data/b.txt": b"b"})
+        bag["manifest"]["files"][0]["checksum"] = "0" * 64
+
+        with pytest.raises(BagDownloadError) as err:
+            downloader.download_bag(bag, out_dir=str(tmpdir))
+
+        assert list(err.value.errors) == ["data/a.txt"]
+
+        mismatch = err.value.errors["data/a.txt"]
+        assert isinstance(mismatch, ChecksumMismatch)
+        assert mismatch.name == "data/a.txt"
+        assert mismatch.checksum_algorithm == "SHA-256"
+        assert mismatch.expected == "0" * 64
+        assert mismatch.actual == hashlib.sha256(b"a").hexdigest()
+        assert str(mismatch).startswith("SHA-256 checksum of data/a.txt does not match")
+
+    def test_can_skip_verification(self, make_bag, tmpdir):
+        bag = make_bag({"data/a.txt": b"a"})
+        bag["manifest"]["files"][0]["checksum"] = "0" * 64
+
+        results = downloader.download_bag(
+            bag, out_dir=str(tmpdir), verify_checksums=False
+        )
+
+        assert results == {}
+        assert tmpdir.join("data/a.txt").read_binary() == b"a"
+
+    def test_skips_files_without_a_checksum(self, make_bag, tmpdir):
+        bag = make_bag({"data/a.txt": b"a"})
+        del bag["manifest"]["files"][0]["checksum"]
+
+        results = downloader.download_bag(bag, out_dir=str(tmpdir))
+
+        assert "data/a.txt" not in results
+
+    def test_verifies_ranged_downloads(self, make_bag, s3_client, tmpdir):
+        body = os.urandom(25000)
+        bag = make_bag({"data/video.mxf": body})
+        manifest_file = bag["manifest"]["files"][0]
+
+        provider = downloader.S3InfrequentAccessProvider(
+            s3_client=s3_client, multipart_threshold=10000, multipart_chunksize=3000
+        )
+
+        result = provider.download(
+            out_dir=str(tmpdir),
+            location=bag["location"],
+            manifest_file=manifest_file,
+            checksum_algorithm="SHA-256",
+        )
+        assert result.verified
+
+        with pytest.raises(ChecksumMismatch):
+            provider.download(
+                out_dir=str(tmpdir),
+                location=bag["location"],
+                manifest_file=dict(manifest_file, checksum="0" * 64),
+                checksum_algorithm="SHA-256",
+            )
+
+
+class TestResumableDownload(object):
+    def _ranges_requested(self, get_object):
+        return [c[1].get("Range") for c in get_object.call_args_list]
+
+    def test_resumes_an_interrupted_download(self, make_bag, s3_client, tmpdir):
+        files = {"data/%d.txt" % i: b"%d" % i for i in range(10)}
+        bag = make_bag(files)
+
+        s3_client.delete_object(
+            Bucket="wellcomecollection-storage", Key="digitised/b12345/v1/data/3.txt"
+        )
+
+        with pytest.raises(BagDownloadError):
+            downloader.download_bag(bag, out_dir=str(tmpdir), resume=True)
+
+        assert tmpdir.join(JOURNAL_NAME).exists()
+
+        s3_client.put_object(
+            Bucket="wellcomecollection-storage",
+            Key="digitised/b12345/v1/data/3.txt",
+            Body=b"3",
+        )
+
+        with mock.patch("boto3.client") as boto3_client:
+            boto3_client.return_value = s3_client
+
+            with mock.patch.object(
+                s3_client, "get_object", wraps=s3_client.get_object
+            ) as get_object:
+                results = downloader.download_bag(bag, out_dir=str(tmpdir), resume=True)
+
+        # Only the missing file is fetched again, but we still get results
+        # for every file in the bag.
+        assert get_object.call_count == 1
+        assert get_object.call_args[1]["Key"] == "digitised/b12345/v1/data/3.txt"
+        assert len(results) == 11
+        assert all(r.verified for r in results.values())
+
+        # Once the download is complete, the journal is cleaned up
+        assert not tmpdir.join(JOURNAL_NAME).exists()
+
+    def test_refetches_files_that_have_changed_on_disk(self, make_bag, tmpdir):
+        bag = make_bag({"data/a.txt": b"aaaa"})
+
+        journal = DownloadJournal(str(tmpdir))
+        journal.record_file(bag["manifest"]["files"][0], checksum=None)
+        journal.close()
+        tmpdir.join("data/a.txt").write_binary(b"aa", ensure=True)
+
+        downloader.download_bag(
+            bag, out_dir=str(tmpdir), resume=True, verify_checksums=False
+        )
+
+        assert tmpdir.join("data/a.txt").read_binary() == b"aaaa"
+
+    def test_skips_unverified_files_if_not_verifying(self, make_bag, tmpdir):
+        bag = make_bag({"data/a.txt": b"aaaa"})
+
+        journal = DownloadJournal(str(tmpdir))
+        journal.record_file(bag["manifest"]["files"][0], checksum=None)
+        journal.close()
+        tmpdir.join("data/a.txt").write_binary(b"AAAA", ensure=True)
+
+        downloader.download_bag(
+            bag, out_dir=str(tmpdir), resume=True, verify_checksums=False
+        )
+        assert tmpdir.join("data/a.txt").read_binary() == b"AAAA"
+
+        # But if we're verifying checksums, we can't trust the existing file
+        journal = DownloadJournal(str(tmpdir))
+        journal.record_file(bag["manifest"]["files"][0], checksum=None)
+        journal.close()
+
+        downloader.download_bag(bag, out_dir=str(tmpdir), resume=True)
+        assert tmpdir.join("data/a.txt").read_binary() == b"aaaa"
+
+    def test_continues_a_partial_file_from_the_right_offset(
+        self, make_bag, s3_client, tmpdir
+    ):
+        body = os.urandom(5000)
+        bag = make_bag({"data/a.jp2": body})
+        tmpdir.join("data/a.jp2").write_binary(body[:1234], ensure=True)
+
+        provider = downloader.S3InfrequentAccessProvider(s3_client=s3_client)
+
+        with mock.patch.object(
+            s3_client, "get_object", wraps=s3_client.get_object
+        ) as get_object:
+            result = provider.download(
+                out_dir=str(tmpdir),
+                location=bag["location"],
+                manifest_file=bag["manifest"]["files"][0],
+                checksum_algorithm="SHA-256",
+                journal=DownloadJournal(str(tmpdir)),
+            )
+
+        assert result.verified
+        assert tmpdir.join("data/a.jp2").read_binary() == body
+        assert self._ranges_requested(get_object) == ["bytes=1234-4999"]
+
+    def test_starts_again_if_partial_file_is_corrupt(self, make_bag, s3_client, tmpdir):
+        body = os.urandom(5000)
+        bag = make_bag({"data/a.jp2": body})
+        tmpdir.join("data/a.jp2").write_binary(b"x" * 1234, ensure=True)
+
+        provider = downloader.S3InfrequentAccessProvider(s3_client=s3_client)
+
+        with mock.patch.object(
+            s3_client, "get_object", wraps=s3_client.get_object
+        ) as get_object:
+            result = provider.download(
+                out_dir=str(tmpdir),
+                location=bag["location"],
+                manifest_file=bag["manifest"]["files"][0],
+                checksum_algorithm="SHA-256",
+                journal=DownloadJournal(str(tmpdir)),
+            )
+
+        assert result.verified
+        assert tmpdir.join("data/a.jp2").read_binary() == body
+        assert self._ranges_requested(get_object) == ["bytes=1234-4999", None]
+
+    @pytest.mark.parametrize("existing", [b"xx", b"xxxx"])
+    def test_ignores_unrecorded_files_if_not_verifying(
+        self, make_bag, s3_client, tmpdir, existing
+    ):
+        bag = make_bag({"data/a.txt": b"aaaa"})
+        tmpdir.join("data/a.txt").write_binary(existing, ensure=True)
+
+        provider = downloader.S3InfrequentAccessProvider(s3_client=s3_client)
+        provider.download(
+            out_dir=str(tmpdir),
+            location=bag["location"],
+            manifest_file=bag["manifest"]["files"][0],
+            journal=DownloadJournal(str(tmpdir)),
+        )
+
+        assert tmpdir.join("data/a.txt").read_binary() == b"aaaa"
+
+    def test_completes_a_file_that_was_written_but_not_recorded(
+        self, make_bag, s3_client, tmpdir
+    ):
+        bag = make_bag({"data/a.txt": b"aaaa"})
+        tmpdir.join("data/a.txt").write_binary(b"aaaa", ensure=True)
+
+        provider = downloader.S3InfrequentAccessProvider(s3_client=s3_client)
+
+        with mock.patch.object(s3_client, "get_object") as get_object:
+            result = provider.download(
+                out_dir=str(tmpdir),
+                location=bag["location"],
+                manifest_file=bag["manifest"]["files"][0],
+                checksum_algorithm="SHA-256",
+                journal=DownloadJournal(str(tmpdir)),
+            )
+
+        assert result.verified
+        assert get_object.call_count == 0
+
+    def test_resumes_a_ranged_download(self, make_bag, s3_client, tmpdir):
+        body = os.urandom(25000)
+        bag = make_bag({"data/video.mxf": body})
+        manifest_file = bag["manifest"]["files"][0]
+
+        # Simulate a previous download that got the first two ranges
+        tmpdir.join("data/video.mxf").write_binary(
+            body[:6000] + b"\x00" * 19000, ensure=True
+        )
+        journal = DownloadJournal(str(tmpdir))
+        journal.record_range("data/video.mxf", (0, 2999))
+        journal.record_range("data/video.mxf", (3000, 5999))
+
+        provider = downloader.S3InfrequentAccessProvider(
+            s3_client=s3_client, multipart_threshold=10000, multipart_chunksize=3000
+        )
+
+        with mock.patch.object(
+            s3_client, "get_object", wraps=s3_client.get_object
+        ) as get_object:
+            result = provider.download(
+                out_dir=str(tmpdir),
+                location=bag["location"],
+                manifest_file=manifest_file,
+                checksum_algorithm="SHA-256",
+                journal=journal,
+            )
+
+        assert result.verified
+        assert tmpdir.join("data/video.mxf").read_binary() == body
+
+        ranges = self._ranges_requested(get_object)
+        assert len(ranges) == 7
+        assert "bytes=0-2999" not in ranges
+        assert "bytes=3000-5999" not in ranges
+
+    def test_restarts_a_ranged_download_if_file_is_wrong_size(
+        self, make_bag, s3_client, tmpdir
+    ):
+        body = os.urandom(25000)
+        bag = make_bag({"data/video.mxf": body})
+
+        tmpdir.join("data/video.mxf").write_binary(body[:3000], ensure=True)
+        journal = DownloadJournal(str(tmpdir))
+        journal.record_range("data/video.mxf", (0, 2999))
+
+        provider = downloader.S3InfrequentAccessProvider(
+            s3_client=s3_client, multipart_threshold=10000, multipart_chunksize=3000
+        )
+        provider.download(
+            out_dir=str(tmpdir),
+            location=bag["location"],
+            manifest_file=bag["manifest"]["files"][0],
+            journal=journal,
+        )
+        journal.close()
+
+        assert tmpdir.join("data/video.mxf").read_binary() == body
+
+        # The old ranges are forgotten when the journal is reloaded
+        assert DownloadJournal(str(tmpdir)).completed_ranges("data/video.mxf") == set(
+            downloader._byte_ranges(25000, 3000)
+        )
+
+    def test_refetches_a_ranged_download_after_a_checksum_mismatch(
+        self, make_bag, s3_client, tmpdir
+    ):
+        body = os.urandom(25000)
+        bag = make_bag({"data/video.mxf": body})
+        manifest_file = bag["manifest"]["files"][0]
+
+        # Corrupt one of the ranges in the stored object
+        s3_client.put_object(
+            Bucket="wellcomecollection-storage",
+            Key="digitised/b12345/v1/data/video.mxf",
+            Body=body[:3000] + b"x" * 3000 + body[6000:],
+        )
+
+        provider = downloader.S3InfrequentAccessProvider(
+            s3_client=s3_client, multipart_threshold=10000, multipart_chunksize=3000
+        )
+
+        journal = DownloadJournal(str(tmpdir))
+        with pytest.raises(ChecksumMismatch):
+            provider.download(
+                out_dir=str(tmpdir),
+                location=bag["location"],
+                manifest_file=manifest_file,
+                checksum_algorithm="SHA-256",
+                journal=journal,
+            )
+        journal.close()
+
+        s3_client.put_object(
+            Bucket="wellcomecollection-storage",
+            Key="digitised/b12345/v1/data/video.mxf",
+            Body=body,
+        )
+
+        result = provider.download(
+            out_dir=str(tmpdir),
+            location=bag["location"],
+            manifest_file=manifest_file,
+            checksum_algorithm="SHA-256",
+            journal=DownloadJournal(str(tmpdir)),
+        )
+
+        assert result.verified
+        assert tmpdir.join("data/video.mxf").read_binary() == body
+
+    def test_starts_again_if_resumed_ranges_are_corrupt(
+        self, make_bag, s3_client, tmpdir
+    ):
+        body = os.urandom(25000)
+        bag = make_bag({"data/video.mxf": body})
+
+        tmpdir.join("data/video.mxf").write_binary(b"x" * 25000, ensure=True)
+        journal = DownloadJournal(str(tmpdir))
+        journal.record_range("data/video.mxf", (0, 2999))
+
+        provider = downloader.S3InfrequentAccessProvider(
+            s3_client=s3_client, multipart_threshold=10000, multipart_chunksize=3000
+        )
+
+        with mock.patch.object(
+            s3_client, "get_object", wraps=s3_client.get_object
+        ) as get_object:
+            result = provider.download(
+                out_dir=str(tmpdir),
+                location=bag["location"],
+                manifest_file=bag["manifest"]["files"][0],
+                checksum_algorithm="SHA-256",
+                journal=journal,
+            )
+
+        assert result.verified
+        assert tmpdir.join("data/video.mxf").read_binary() == body
+
+        # Eight ranges on the first attempt, then all nine again
+        assert get_object.call_count == 17
+
+
+class BytesProvider(downloader.AbstractProvider):
+    def __init__(self, contents, **kwargs):
+        self.contents = contents
+        super(BytesProvider, self).__init__(**kwargs)
+
+    def get_fileobj(self, location, manifest_file):
+        return io.BytesIO(self.contents[manifest_file["name"]])
+
+
+@pytest.mark.parametrize(
+    "start, end", [(0, 9), (3, 7), (10, 99), (99, 99), (0, 0), (98, 200)]
+)
+def test_default_range_fileobj_reads_part_of_the_file(start, end):
+    body = bytes(bytearray(range(100)))
+    provider = BytesProvider({"a.bin": body}, chunk_size=7)
+
+    read_file_obj = provider.get_range_fileobj(
+        location={}, manifest_file={"name": "a.bin"}, start=start, end=end
+    )
+
+    assert read_file_obj.read(1000) == body[start:end + 1]
+
+
+class TestStreamingCompressedBag(object):
+    files = {
+        "data/b12345.xml": b"<mets/>",
+        "data/objects/a.jp2": os.urandom(5000),
+        "data/objects/b.jp2": os.urandom(100),
+        "data/alto/a.xml": b"<alto/>",
+    }
+
+    def _read_archive(self, path, mode="r:gz"):
+        with tarfile.open(path, mode) as tf:
+            return {
+                m.name: (tf.extractfile(m).read() if m.isfile() else None)
+                for m in tf.getmembers()
+            }
+
+    def test_matches_non_streaming_archive(self, make_bag, tmpdir):
+        bag = make_bag(self.files)
+
+        streamed_path = str(tmpdir.join("streamed.tar.gz"))
+        downloader.download_compressed_bag(bag, out_path=streamed_path, streaming=True)
+
+        classic_path = str(tmpdir.join("classic.tar.gz"))
+        downloader.download_compressed_bag(bag, out_path=classic_path)
+
+        assert self._read_archive(streamed_path) == self._read_archive(classic_path)
+
+    def test_sets_mtime_to_bag_creation_date(self, make_bag, tmpdir):
+        bag = make_bag(self.files)
+        out_path = str(tmpdir.join("streamed.tar.gz"))
+
+        downloader.download_compressed_bag(bag, out_path=out_path, streaming=True)
+
+        with tarfile.open(out_path, "r:gz") as tf:
+            # 2019-09-12T20:26:53.094757Z
+            assert {m.mtime for m in tf.getmembers()} == {1568320013}
+
+    @pytest.mark.parametrize(
+        "created_date, expected",
+        [
+            ("2019-09-12T20:26:53.094757Z", 1568320013),
+            ("2019-09-12T20:26:53Z", 1568320013),
+        ],
+    )
+    def test_created_timestamp(self, created_date, expected):
+        bag = {"createdDate": created_date}
+        assert downloader._created_timestamp(bag) == expected
+
+    def test_created_timestamp_defaults_to_now(self):
+        with mock.patch("time.time", return_value=1234.5):
+            assert downloader._created_timestamp({}) == 1234
+
+    def test_can_use_parallel_compression(self, make_bag, tmpdir):
+        bag = make_bag(self.files)
+        out_path = str(tmpdir.join("streamed.tar.gz"))
+
+        downloader.download_compressed_bag(
+            bag, out_path=out_path, streaming=True, compress_threads=4
+        )
+
+        archive = self._read_archive(out_path)
+        assert archive["b12345/data/objects/a.jp2"] == self.files["data/objects/a.jp2"]
+
+    def test_can_stream_zstd_to_a_file_object(self, make_bag):
+        # zstandard only supports Python 3
+        zstandard = pytest.importorskip("zstandard")
+
+        bag = make_bag(self.files)
+        out_file = io.BytesIO()
+
+        downloader.stream_compressed_bag(
+            bag, out_file=out_file, compression="zst", top_level_dir="custom"
+        )
+
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            io.BytesIO(out_file.getvalue())
+        )
+        with tarfile.open(fileobj=reader, mode="r|") as tf:
+            names = [m.name for m in tf]
+
+        assert names == [
+            "custom",
+            "custom/bagit.txt",
+            "custom/data",
+            "custom/data/alto",
+            "custom/data/alto/a.xml",
+            "custom/data/b12345.xml",
+            "custom/data/objects",
+            "custom/data/objects/a.jp2",
+            "custom/data/objects/b.jp2",
+        ]
+
+    def test_streams_large_and_small_files(self, make_bag, s3_client):
+        bag = make_bag(self.files)
+        out_file = io.BytesIO()
+
+        provider = downloader.S3InfrequentAccessProvider(
+            s3_client=s3_client, chunk_size=1000
+        )
+
+        with mock.patch.object(downloader, "_choose_provider", return_value=provider):
+            with mock.patch.object(
+                provider, "get_fileobj", wraps=provider.get_fileobj
+            ) as get_fileobj:
+                downloader.stream_compressed_bag(
+                    bag, out_file=out_file, compression=None, max_workers=2
+                )
+
+        assert get_fileobj.call_count == 5
+
+        out_file.seek(0)
+        with tarfile.open(fileobj=out_file, mode="r:") as tf:
+            for name, body in self.files.items():
+                assert tf.extractfile("b12345/" + name).read() == body
+
+    def test_fetches_large_files_as_parallel_ranges(self, make_bag, s3_client):
+        bag = make_bag(self.files)
+        out_file = io.BytesIO()
+
+        provider = downloader.S3InfrequentAccessProvider(
+            s3_client=s3_client,
+            chunk_size=1000,
+            multipart_threshold=2000,
+            multipart_chunksize=1500,
+            max_range_workers=2,
+        )
+
+        with mock.patch.object(downloader, "_choose_provider", return_value=provider):
+            with mock.patch.object(
+                s3_client, "get_object", wraps=s3_client.get_object
+            ) as get_object:
+                downloader.stream_compressed_bag(
+                    bag, out_file=out_file, compression=None, max_workers=2
+                )
+
+        ranges = sorted(
+            c[1]["Range"] for c in get_object.call_args_list if "Range" in c[1]
+        )
+        assert ranges == [
+            "bytes=0-1499",
+            "bytes=1500-2999",
+            "bytes=3000-4499",
+            "bytes=4500-4999",
+        ]
+
+        out_file.seek(0)
+        with tarfile.open(fileobj=out_file, mode="r:") as tf:
+            for name, body in self.files.items():
+                assert tf.extractfile("b12345/" + name).read() == body
+
+    def test_mismatched_checksum_is_error(self, make_bag, tmpdir):
+        bag = make_bag(self.files)
+        bag["manifest"]["files"][1]["checksum"] = "0" * 64
+        out_path = tmpdir.join("streamed.tar.gz")
+
+        with pytest.raises(ChecksumMismatch):
+            downloader.download_compressed_bag(
+                bag, out_path=str(out_path), streaming=True
+            )
+
+        # The incomplete archive is cleaned up
+        assert not out_path.exists()
+
+    def test_keeps_the_original_error_if_cleaning_up_fails(self, make_bag, tmpdir):
+        bag = make_bag(self.files)
+        bag["manifest"]["files"][1]["checksum"] = "0" * 64
+
+        with mock.patch("os.unlink", side_effect=OSError(errno.EACCES, "Denied")):
+            with pytest.raises(ChecksumMismatch):
+                downloader.download_compressed_bag(
+                    bag, out_path=str(tmpdir.join("streamed.tar.gz")), streaming=True
+                )
+
+    def test_streams_files_without_a_size(self, make_bag, s3_client):
+        bag = make_bag(self.files)
+        for manifest_file in bag["manifest"]["files"] + bag["tagManifest"]["files"]:
+            del manifest_file["size"]
+
+        out_file = io.BytesIO()
+
+        provider = downloader.S3InfrequentAccessProvider(
+            s3_client=s3_client, chunk_size=1000
+        )
+
+        with mock.patch.object(downloader, "_choose_provider", return_value=provider):
+            downloader.stream_compressed_bag(bag, out_file=out_file, compression=None)
+
+        out_file.seek(0)
+        with tarfile.open(fileobj=out_file, mode="r:") as tf:
+            for name, body in self.files.items():
+                assert tf.getmember("b12345/" + name).size == len(body)
+                assert tf.extractfile("b12345/" + name).read() == body
+
+    def test_can_skip_verification(self, make_bag):
+        bag = make_bag(self.files)
+        bag["manifest"]["files"][1]["checksum"] = "0" * 64
+
+        downloader.stream_compressed_bag(
+            bag, out_file=io.BytesIO(), verify_checksums=False
+        )
+
+
+class FakeBlobServiceClient(object):
+    """
+    Enough of ``azure.storage.blob.BlobServiceClient`` to download blobs.
+    """
+
+    def __init__(self, blobs, chunk_size=4):
+        self.blobs = blobs
+        self.chunk_size = chunk_size
+        self.downloads = []
+
+    def get_blob_client(self, container, blob):
+        service = self
+
+        class _BlobClient(object):
+            def download_blob(self, offset=0, length=None):
+                service.downloads.append((container, blob, offset, length))
+
+                try:
+                    body = service.blobs[(container, blob)]
+                except KeyError:
+                    raise IOError("BlobNotFound: %s/%s" % (container, blob))
+
+                if length is not None:
+                    body = body[offset:offset + length]
+                else:
+                    body = body[offset:]
+
+                class _Downloader(object):
+                    def chunks(self):
+                        for i in range(0, len(body), service.chunk_size):
+                            yield body[i:i + service.chunk_size]
+
+                return _Downloader()
+
+        return _BlobClient()
+
+
+AZURE_LOCATION = {
+    "provider": {"id": "azure-blob-storage", "type": "Provider"},
+    "bucket": "wellcomecollection-storage-replica-netherlands",
+    "path": "digitised/b12345",
+    "type": "Location",
+}
+
+
+def _azure_replica(bag, blob_service_client):
+    """
+    Copy every file in ``bag`` into a fake Azure container.
+    """
+    for f in bag["manifest"]["files"] + bag["tagManifest"]["files"]:
+        key = (AZURE_LOCATION["bucket"], "digitised/b12345/" + f["path"])
+        blob_service_client.blobs[key] = _s3_body(bag, f)
+
+
+def _s3_body(bag, manifest_file):
+    import boto3
+
+    s3_obj = boto3.client("s3").get_object(
+        Bucket=bag["location"]["bucket"],
+        Key="%s/%s" % (bag["location"]["path"], manifest_file["path"]),
+    )
+    return s3_obj["Body"].read()
+
+
+class TestAzureBlobProvider(object):
+    def test_downloads_a_file(self, tmpdir):
+        body = os.urandom(100)
+        service = FakeBlobServiceClient(
+            {(AZURE_LOCATION["bucket"], "digitised/b12345/v1/data/a.bin"): body}
+        )
+        provider = downloader.AzureBlobProvider(blob_service_client=service)
+
+        result = provider.download(
+            out_dir=str(tmpdir),
+            location=AZURE_LOCATION,
+            manifest_file={
+                "name": "data/a.bin",
+                "path": "v1/data/a.bin",
+                "size": 100,
+                "checksum": hashlib.sha256(body).hexdigest(),
+            },
+            checksum_algorithm="SHA-256",
+        )
+
+        assert result.verified
+        assert tmpdir.join("data", "a.bin").read_binary() == body
+
+    def test_downloads_large_file_in_ranges(self, tmpdir):
+        body = os.urandom(1000)
+        service = FakeBlobServiceClient(
+            {(AZURE_LOCATION["bucket"], "digitised/b12345/v1/data/a.bin"): body},
+            chunk_size=64,
+        )
+        provider = downloader.AzureBlobProvider(
+            blob_service_client=service, multipart_threshold=500, multipart_chunksize=300
+        )
+
+        provider.download(
+            out_dir=str(tmpdir),
+            location=AZURE_LOCATION,
+            manifest_file={"name": "data/a.bin", "path": "v1/data/a.bin", "size": 1000},
+        )
+
+        assert tmpdir.join("data", "a.bin").read_binary() == body
+        assert sorted(offset for _, _, offset, _ in service.downloads) == [
+            0,
+            300,
+            600,
+            900,
+        ]
+
+    def test_chooses_azure_provider(self):
+        provider = downloader._choose_provider(AZURE_LOCATION)
+        assert isinstance(provider, downloader.AzureBlobProvider)
+
+    def test_unrecognised_container_is_error(self):
+        provider = downloader.AzureBlobProvider()
+
+        with pytest.raises(RuntimeError, match="Unrecognised Azure container"):
+            provider.get_fileobj(
+                location=dict(AZURE_LOCATION, bucket="not-our-container"),
+                manifest_file={"name": "a.txt", "path": "v1/a.txt"},
+            )
+
+
+class FlakyReader(object):
+    """
+    A file that fails after reading ``fail_after`` bytes.
+    """
+
+    def __init__(self, body, fail_after):
+        self.file_obj = io.BytesIO(body)
+        self.remaining = fail_after
+        self.closed = False
+
+    def read(self, size):
+        if self.remaining <= 0:
+            raise IOError("Connection reset by peer")
+        chunk = self.file_obj.read(min(size, self.remaining))
+        self.remaining -= len(chunk)
+        return chunk
+
+    def close(self):
+        self.closed = True
+
+
+class TestReplicaProvider(object):
+    files = {"data/a.txt": b"aaaaaaaaaa", "data/b.txt": b"bbbbbbbbbbbbbbbbbbbb"}
+
+    def _bag_with_replicas(self, make_bag):
+        bag = make_bag(files=self.files)
+        replica = make_bag(files=self.files, bucket="wellcomecollection-storage-replica")
+
+        service = FakeBlobServiceClient({})
+        _azure_replica(bag, service)
+
+        bag["replicaLocations"] = [AZURE_LOCATION, replica["location"]]
+        providers = {
+            "azure-blob-storage": downloader.AzureBlobProvider(
+                blob_service_client=service
+            )
+        }
+        return bag, service, providers
+
+    def test_reads_from_primary_if_available(self, make_bag, tmpdir):
+        bag, service, providers = self._bag_with_replicas(make_bag)
+
+        downloader.download_bag(
+            bag, out_dir=str(tmpdir), providers=providers, use_replicas=True
+        )
+
+        assert tmpdir.join("data", "b.txt").read_binary() == self.files["data/b.txt"]
+        assert service.downloads == []
+
+    def test_prefers_s3_replica_to_azure(self, make_bag, s3_client, tmpdir):
+        bag, service, providers = self._bag_with_replicas(make_bag)
+        s3_client.delete_object(
+            Bucket=bag["location"]["bucket"],
+            Key="%s/v1/data/a.txt" % bag["location"]["path"],
+        )
+
+        downloader.download_bag(
+            bag, out_dir=str(tmpdir), providers=providers, use_replicas=True
+        )
+
+        assert tmpdir.join("data", "a.txt").read_binary() == self.files["data/a.txt"]
+        assert service.downloads == []
+
+    def test_falls_back_to_azure(self, make_bag, s3_client, tmpdir):
+        bag, service, providers = self._bag_with_replicas(make_bag)
+        bag["replicaLocations"] = [AZURE_LOCATION]
+        s3_client.delete_object(
+            Bucket=bag["location"]["bucket"],
+            Key="%s/v1/data/a.txt" % bag["location"]["path"],
+        )
+
+        downloader.download_bag(
+            bag, out_dir=str(tmpdir), providers=providers, use_replicas=True
+        )
+
+        assert tmpdir.join("data", "a.txt").read_binary() == self.files["data/a.txt"]
+        assert [blob for _, blob, _, _ in service.downloads] == [
+            "digitised/b12345/v1/data/a.txt"
+        ]
+
+    def test_reports_error_if_no_replica_has_the_file(
+        self, make_bag, s3_client, tmpdir
+    ):
+        bag, service, providers = self._bag_with_replicas(make_bag)
+        bag["replicaLocations"] = [AZURE_LOCATION]
+        s3_client.delete_object(
+            Bucket=bag["location"]["bucket"],
+            Key="%s/v1/data/a.txt" % bag["location"]["path"],
+        )
+        service.blobs.clear()
+
+        with pytest.raises(BagDownloadError) as err:
+            downloader.download_bag(
+                bag, out_dir=str(tmpdir), providers=providers, use_replicas=True
+            )
+
+        # We get the error from the preferred location
+        assert isinstance(err.value.errors["data/a.txt"], ClientError)
+
+    def test_carries_on_from_the_same_byte_after_a_failed_read(
+        self, make_bag, s3_client, tmpdir
+    ):
+        bag, service, providers = self._bag_with_replicas(make_bag)
+        bag["replicaLocations"] = [AZURE_LOCATION]
+
+        primary = downloader.S3InfrequentAccessProvider(s3_client=s3_client)
+        providers["amazon-s3"] = primary
+
+        get_fileobj = primary.get_fileobj
+        flaky_readers = []
+
+        def _flaky_fileobj(location, manifest_file):
+            body = get_fileobj(location, manifest_file).read()
+            flaky_readers.append(FlakyReader(body, fail_after=7))
+            return flaky_readers[-1]
+
+        with mock.patch.object(primary, "get_fileobj", _flaky_fileobj):
+            results = downloader.download_bag(
+                bag, out_dir=str(tmpdir), providers=providers, use_replicas=True
+            )
+
+        assert results["data/b.txt"].verified
+        assert tmpdir.join("data", "b.txt").read_binary() == self.files["data/b.txt"]
+        assert (
+            AZURE_LOCATION["bucket"],
+            "digitised/b12345/v1/data/b.txt",
+            7,
+            13,
+        ) in service.downloads
+
+        # The streams that failed were closed before we moved on
+        assert all(r.closed for r in flaky_readers if r.remaining <= 0)
+
+    def test_avoids_a_location_after_it_fails(self, make_bag):
+        bag, service, providers = self._bag_with_replicas(make_bag)
+        provider = downloader.ReplicaProvider(
+            bag["replicaLocations"], providers=providers
+        )
+
+        location = bag["location"]
+        assert provider._locations(location)[0] == location
+
+        provider._record_failure(location)
+        assert provider._locations(location)[0] == bag["replicaLocations"][1]
+        assert provider._locations(location)[-1] == location
+
+        later = time.time() + downloader.DEFAULT_REPLICA_COOLDOWN + 1
+        with mock.patch("wellcome_storage_service.downloader.time.time") as now:
+            now.return_value = later
+            assert provider._locations(location)[0] == location
+
+    def test_only_reads_from_primary_by_default(self, make_bag, s3_client, tmpdir):
+        bag, service, providers = self._bag_with_replicas(make_bag)
+        s3_client.delete_object(
+            Bucket=bag["location"]["bucket"],
+            Key="%s/v1/data/a.txt" % bag["location"]["path"],
+        )
+
+        with pytest.raises(BagDownloadError):
+            downloader.download_bag(bag, out_dir=str(tmpdir), providers=providers)
+
+        assert service.downloads == []
+
+    def test_can_rank_a_replica_above_the_primary(self, make_bag, tmpdir):
+        bag, service, providers = self._bag_with_replicas(make_bag)
+
+        downloader.download_bag(
+            bag,
+            out_dir=str(tmpdir),
+            providers=providers,
+            use_replicas=True,
+            provider_costs={
+                "amazon-s3": 1,
+                ("azure-blob-storage", AZURE_LOCATION["bucket"]): 0,
+            },
+        )
+
+        assert tmpdir.join("data", "b.txt").read_binary() == self.files["data/b.txt"]
+        downloaded = {blob for _, blob, _, _ in service.downloads}
+        assert "digitised/b12345/v1/data/a.txt" in downloaded
+        assert "digitised/b12345/v1/data/b.txt" in downloaded
+
+    def test_streams_a_bag_from_replicas(self, make_bag, s3_client):
+        bag, service, providers = self._bag_with_replicas(make_bag)
+        bag["replicaLocations"] = [AZURE_LOCATION]
+        s3_client.delete_object(
+            Bucket=bag["location"]["bucket"],
+            Key="%s/v1/data/b.txt" % bag["location"]["path"],
+        )
+
+        out_file = io.BytesIO()
+        downloader.stream_compressed_bag(
+            bag, out_file=out_file, providers=providers, use_replicas=True
+        )
+
+        out_file.seek(0)
+        with tarfile.open(fileobj=out_file, mode="r:gz") as tf:
+            assert tf.extractfile("b12345/data/b.txt").read() == b"b" * 20
+
+    def test_shuts_down_the_replica_provider(self, make_bag, tmpdir):
+        bag, service, providers = self._bag_with_replicas(make_bag)
+
+        with mock.patch.object(
+            downloader.ReplicaProvider, "close", autospec=True
+        ) as close:
+            downloader.download_bag(
+                bag,
+                out_dir=str(tmpdir),
+                providers=providers,
+                use_replicas=True,
+                hedge_reads=True,
+            )
+
+        assert close.call_count == 1
+
+
+class SlowProvider(downloader.AbstractProvider):
+    """
+    Serves files from memory, waiting ``delays[bucket]`` seconds before
+    returning the first bytes from each bucket.
+    """
+
+    def __init__(self, body, delays):
+        self.body = body
+        self.delays = delays
+        self.requests = []
+        self.closed = []
+        super(SlowProvider, self).__init__()
+
+    def get_fileobj(self, location, manifest_file):
+        self.requests.append(location["bucket"])
+        time.sleep(self.delays.get(location["bucket"], 0))
+
+        provider = self
+
+        class _Body(io.BytesIO):
+            def close(self):
+                provider.closed.append(location["bucket"])
+                super(_Body, self).close()
+
+        return _Body(self.body)
+
+
+class TestHedgedReads(object):
+    primary = {"provider": {"id": "amazon-s3"}, "bucket": "primary", "path": "b1"}
+    replica = {"provider": {"id": "amazon-s3"}, "bucket": "replica", "path": "b1"}
+    manifest_file = {"name": "a.xml", "path": "v1/a.xml", "size": 7}
+
+    def _provider(self, slow_provider, **kwargs):
+        provider = downloader.ReplicaProvider(
+            [self.replica],
+            providers={"amazon-s3": slow_provider},
+            hedge_reads=True,
+            **kwargs
+        )
+
+        # Pretend we've already seen lots of fast requests
+        for _ in range(100):
+            provider.first_byte_latency.record(0.01)
+        for _ in range(100):
+            provider.hedge_budget.record_request()
+
+        return provider
+
+    def test_hedges_a_slow_request(self):
+        slow_provider = SlowProvider(b"<alto/>", delays={"primary": 1})
+        provider = self._provider(slow_provider)
+
+        started = time.time()
+        read_file_obj = provider.get_fileobj(self.primary, self.manifest_file)
+        assert read_file_obj.read() == b"<alto/>"
+
+        assert time.time() - started < 0.5
+        assert slow_provider.requests == ["primary", "replica"]
+
+        # The slow request is closed once it finishes
+        time.sleep(1)
+        assert slow_provider.closed == ["primary"]
+
+    def test_close_shuts_down_the_hedging_threads(self):
+        slow_provider = SlowProvider(b"<alto/>", delays={"primary": 1})
+
+        with self._provider(slow_provider) as provider:
+            provider.get_fileobj(self.primary, self.manifest_file).read()
+            executor = provider._hedge_executor
+            assert executor is not None
+
+        assert provider._hedge_executor is None
+        with pytest.raises(RuntimeError):
+            executor.submit(time.sleep, 0)
+
+    def test_times_a_request_from_when_it_starts(self):
+        slow_provider = SlowProvider(b"<alto/>", delays={})
+        provider = self._provider(slow_provider)
+
+        # Make the request queue behind another read
+        provider._hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        provider._hedge_executor.submit(time.sleep, 0.2)
+
+        read_file_obj = provider.get_fileobj(self.primary, self.manifest_file)
+        assert read_file_obj.read() == b"<alto/>"
+
+        assert slow_provider.requests == ["primary"]
+
+    def test_does_not_hedge_a_fast_request(self):
+        slow_provider = SlowProvider(b"<alto/>", delays={})
+        provider = self._provider(slow_provider)
+
+        read_file_obj = provider.get_fileobj(self.primary, self.manifest_file)
+        assert read_file_obj.read() == b"<alto/>"
+
+        assert slow_provider.requests == ["primary"]
+
+    def test_waits_for_enough_samples_before_hedging(self):
+        slow_provider = SlowProvider(b"<alto/>", delays={"primary": 0.2})
+        provider = downloader.ReplicaProvider(
+            [self.replica], providers={"amazon-s3": slow_provider}, hedge_reads=True
+        )
+
+        provider.get_fileobj(self.primary, self.manifest_file).read()
+
+        assert slow_provider.requests == ["primary"]
+
+    def test_limits_the_extra_request_rate(self):
+        slow_provider = SlowProvider(b"<alto/>", delays={"primary": 0.05})
+        provider = self._provider(slow_provider)
+        provider.hedge_budget = downloader.RequestBudget(ratio=0.1)
+
+        for _ in range(1000):
+            provider.first_byte_latency.record(0.01)
+
+        for _ in range(20):
+            provider.get_fileobj(self.primary, self.manifest_file).read()
+
+        assert slow_provider.requests.count("replica") == 2
+
+    def test_uses_the_hedged_request_if_the_first_fails(self):
+        slow_provider = SlowProvider(
+            b"<alto/>", delays={"primary": 0.1, "replica": 0.3}
+        )
+        provider = self._provider(slow_provider)
+
+        get_fileobj = slow_provider.get_fileobj
+
+        def _primary_fails(location, manifest_file):
+            file_obj = get_fileobj(location, manifest_file)
+            if location["bucket"] == "primary":
+                raise IOError("SlowDown")
+            return file_obj
+
+        with mock.patch.object(slow_provider, "get_fileobj", _primary_fails):
+            read_file_obj = provider.get_fileobj(self.primary, self.manifest_file)
+            assert read_file_obj.read() == b"<alto/>"
+
+        assert provider._recently_failed(self.primary)
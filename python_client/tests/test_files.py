@@ -0,0 +1,181 @@
+import io
+import os
+import tarfile
+import zipfile
+from xml.etree import ElementTree as ET
+
+import pytest
+
+from wellcome_storage_service import BagFile, StorageManifest, downloader, open_bag_file
+
+
+class RangeProvider(downloader.AbstractProvider):
+    """
+    Serves a file from memory, and records every range that's requested.
+    """
+
+    def __init__(self, body):
+        self.body = body
+        self.ranges = []
+        super(RangeProvider, self).__init__()
+
+    def get_fileobj(self, location, manifest_file):
+        raise AssertionError("BagFile should only make ranged requests")
+
+    def get_range_fileobj(self, location, manifest_file, start, end):
+        self.ranges.append((start, end))
+        return io.BytesIO(self.body[start:end + 1])
+
+
+def bag_file(body, **kwargs):
+    provider = RangeProvider(body)
+    f = BagFile(
+        provider,
+        location={},
+        manifest_file={"name": "data/a.bin", "path": "v1/data/a.bin", "size": len(body)},
+        **kwargs
+    )
+    return provider, f
+
+
+def test_reads_and_seeks_like_a_file():
+    body = os.urandom(1000)
+    _, f = bag_file(body, block_size=64)
+
+    assert f.read(10) == body[:10]
+    assert f.tell() == 10
+
+    f.seek(-100, io.SEEK_END)
+    assert f.read() == body[-100:]
+    assert f.read(10) == b""
+
+    f.seek(500)
+    f.seek(50, io.SEEK_CUR)
+    assert f.read(200) == body[550:750]
+
+    with pytest.raises(ValueError):
+        f.seek(-1)
+
+
+def test_only_fetches_the_blocks_it_needs():
+    body = os.urandom(10000)
+    provider, f = bag_file(body, block_size=100)
+
+    f.seek(5050)
+    assert f.read(100) == body[5050:5150]
+    assert provider.ranges == [(5000, 5199)]
+
+    # These bytes are already cached
+    f.seek(5100)
+    assert f.read(50) == body[5100:5150]
+    assert provider.ranges == [(5000, 5199)]
+
+
+def test_evicts_the_least_recently_used_blocks():
+    body = os.urandom(1000)
+    provider, f = bag_file(body, block_size=100, max_blocks=2)
+
+    for offset in (0, 500, 0, 900, 0, 500):
+        f.seek(offset)
+        f.read(1)
+
+    assert provider.ranges == [(0, 99), (500, 599), (900, 999), (500, 599)]
+
+
+def test_sequential_reads_fetch_ahead():
+    body = os.urandom(100000)
+    provider, f = bag_file(body, block_size=100)
+
+    assert b"".join(iter(lambda: f.read(100), b"")) == body
+
+    # We fetch up to 32 blocks at a time, rather than one block per read
+    assert len(provider.ranges) < 50
+
+
+def test_can_read_more_than_the_cache_holds():
+    body = os.urandom(1000)
+    _, f = bag_file(body, block_size=10, max_blocks=3)
+
+    assert f.read() == body
+
+
+def test_short_read_is_error():
+    body = os.urandom(1000)
+    provider, f = bag_file(body, block_size=100)
+    provider.body = body[:150]
+
+    with pytest.raises(IOError, match="Short read for bytes 100-199"):
+        f.seek(120)
+        f.read(10)
+
+
+def test_closed_file_cannot_be_read():
+    _, f = bag_file(b"hello world")
+
+    with f:
+        assert f.read(5) == b"hello"
+
+    assert f.closed
+    with pytest.raises(ValueError):
+        f.read()
+
+
+def _zip_bytes(files):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        for name, body in files.items():
+            zf.writestr(name, body)
+    return buf.getvalue()
+
+
+def test_can_read_one_file_from_a_zip_without_fetching_it_all():
+    big = os.urandom(500000)
+    body = _zip_bytes({"big.bin": big, "small.txt": b"hello world"})
+    provider, f = bag_file(body, block_size=4096)
+
+    with zipfile.ZipFile(f) as zf:
+        assert zf.read("small.txt") == b"hello world"
+
+    assert sum(end - start + 1 for start, end in provider.ranges) < len(body) / 10
+
+
+def test_can_read_a_tar_file():
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tf:
+        for name, body in [("a.txt", b"aaa"), ("b.txt", os.urandom(5000))]:
+            info = tarfile.TarInfo(name)
+            info.size = len(body)
+            tf.addfile(info, io.BytesIO(body))
+
+    _, f = bag_file(buf.getvalue(), block_size=512)
+
+    with tarfile.open(fileobj=f) as tf:
+        assert tf.extractfile("a.txt").read() == b"aaa"
+        assert len(tf.extractfile("b.txt").read()) == 5000
+
+
+@pytest.mark.parametrize("as_storage_manifest", [True, False])
+def test_opens_a_file_in_a_stored_bag(make_bag, as_storage_manifest):
+    bag = make_bag(
+        files={
+            "data/b12345.xml": b"<mets><file id='1'/><file id='2'/></mets>",
+            "data/objects/b12345.zip": _zip_bytes({"page1.txt": b"one"}),
+        }
+    )
+    if as_storage_manifest:
+        bag = StorageManifest.from_bag(bag)
+
+    with open_bag_file(bag, "data/b12345.xml") as f:
+        root = ET.parse(f).getroot()
+        assert [el.get("id") for el in root] == ["1", "2"]
+
+    with open_bag_file(bag, "data/objects/b12345.zip") as f:
+        with zipfile.ZipFile(f) as zf:
+            assert zf.read("page1.txt") == b"one"
+
+
+def test_opening_a_missing_file_is_error(make_bag):
+    bag = make_bag(files={"data/a.txt": b"a"})
+
+    with pytest.raises(IOError, match="No such file in bag"):
+        open_bag_file(bag, "data/doesnotexist.txt")
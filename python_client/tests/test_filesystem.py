@@ -0,0 +1,143 @@
+import json
+
+import fsspec
+import pytest
+
+from wellcome_storage_service import StorageServiceClientBase
+from wellcome_storage_service.filesystem import BagFileSystem, parse_bag_url
+
+
+FILES = {
+    "data/b12345.xml": b"<mets/>",
+    "data/objects/b12345_0001.jp2": b"1111",
+    "data/objects/b12345_0002.jp2": b"22222",
+    "data/alto/b12345_0001.xml": b"<alto/>",
+    "data/metadata.csv": b"id,title\n1,A book\n2,Another book\n",
+}
+
+
+class FakeClient(StorageServiceClientBase):
+    def __init__(self, bag):
+        self.bag = bag
+        self.requests = []
+        super(FakeClient, self).__init__(api_url="https://example.org/storage/v1")
+
+    def _http_get(self, url):
+        self.requests.append(url)
+        return 200, json.dumps(self.bag)
+
+
+@pytest.fixture
+def fs(make_bag, s3_client):
+    bag = make_bag(files=FILES)
+    return BagFileSystem(
+        "digitised", "b12345", client=FakeClient(bag), skip_instance_cache=True
+    )
+
+
+@pytest.mark.parametrize(
+    "url, expected",
+    [
+        (
+            "wellcome-bag://digitised/b12345/data/b12345.xml",
+            ("digitised", "b12345", None, "data/b12345.xml"),
+        ),
+        (
+            "wellcome-bag://digitised/b12345?version=v3/data/b12345.xml",
+            ("digitised", "b12345", "v3", "data/b12345.xml"),
+        ),
+        ("wellcome-bag://digitised/b12345", ("digitised", "b12345", None, "")),
+        (
+            "wellcome-bag://born-digital/PP%2FCRI%2FJ?version=v1/data/a.doc",
+            ("born-digital", "PP/CRI/J", "v1", "data/a.doc"),
+        ),
+    ],
+)
+def test_parse_bag_url(url, expected):
+    assert parse_bag_url(url) == expected
+
+
+def test_lists_directories_from_the_manifest(fs, s3_client):
+    assert fs.ls("", detail=False) == ["bagit.txt", "data"]
+    assert fs.ls("data", detail=False) == [
+        "data/alto",
+        "data/b12345.xml",
+        "data/metadata.csv",
+        "data/objects",
+    ]
+    assert fs.ls("data/objects") == [
+        {
+            "name": "data/objects/b12345_0001.jp2",
+            "size": 4,
+            "type": "file",
+            "checksum": fs.manifest.get_file("data/objects/b12345_0001.jp2").checksum,
+        },
+        {
+            "name": "data/objects/b12345_0002.jp2",
+            "size": 5,
+            "type": "file",
+            "checksum": fs.manifest.get_file("data/objects/b12345_0002.jp2").checksum,
+        },
+    ]
+
+    with pytest.raises(FileNotFoundError):
+        fs.ls("data/doesnotexist")
+
+
+def test_info(fs):
+    assert fs.info("data/b12345.xml")["size"] == 7
+    assert fs.isfile("data/b12345.xml")
+    assert fs.isdir("data/objects")
+    assert fs.isdir("")
+    assert not fs.exists("data/obj")
+
+
+def test_find_and_glob(fs):
+    assert fs.find("data/objects") == [
+        "data/objects/b12345_0001.jp2",
+        "data/objects/b12345_0002.jp2",
+    ]
+    assert fs.find("data", maxdepth=1) == ["data/b12345.xml", "data/metadata.csv"]
+    assert fs.glob("data/**/*.xml") == [
+        "data/alto/b12345_0001.xml",
+        "data/b12345.xml",
+    ]
+    assert fs.du("data/objects") == 9
+
+
+def test_reads_files(fs):
+    assert fs.cat("data/b12345.xml") == b"<mets/>"
+    assert fs.cat_file("data/objects/b12345_0002.jp2", start=1, end=3) == b"22"
+
+    with fs.open("data/metadata.csv", "r") as f:
+        assert f.readline() == "id,title\n"
+
+    with pytest.raises(FileNotFoundError):
+        fs.open("data/doesnotexist.xml")
+
+
+def test_is_read_only(fs):
+    with pytest.raises(NotImplementedError):
+        fs.open("data/new.txt", "wb")
+
+
+def test_never_lists_the_bucket(fs, s3_client):
+    s3_client.list_objects_v2 = None
+    fs.ls("data")
+    fs.find("")
+
+
+def test_opens_urls_with_fsspec(make_bag, s3_client):
+    bag = make_bag(files=FILES)
+    client = FakeClient(bag)
+
+    fsspec.register_implementation("wellcome-bag", BagFileSystem, clobber=True)
+
+    with fsspec.open(
+        "wellcome-bag://digitised/b12345?version=v1/data/b12345.xml", client=client
+    ) as f:
+        assert f.read() == b"<mets/>"
+
+    assert client.requests == [
+        "https://example.org/storage/v1/bags/digitised/b12345?version=v1"
+    ]
@@ -0,0 +1,116 @@
+import json
+import os
+import subprocess
+import sys
+
+import mock
+import pytest
+
+
+pytestmark = pytest.mark.skipif(
+    sys.version_info < (3, 7), reason="Lazy imports need Python 3.7+"
+)
+
+# A cold import takes about 30ms on a laptop.  The budget leaves plenty of
+# room for a slow CI machine, but still catches us importing the OAuth
+# libraries or the bag tools up front again, which took it to about 250ms.
+IMPORT_TIME_BUDGET = 0.15
+
+
+def loaded_modules(code):
+    out = subprocess.check_output(
+        [
+            sys.executable,
+            "-c",
+            code + "\nimport json, sys; print(json.dumps(sorted(sys.modules)))",
+        ]
+    )
+    return set(json.loads(out.decode("utf8").splitlines()[-1]))
+
+
+@pytest.mark.parametrize(
+    "module",
+    [
+        "oauthlib",
+        "requests_oauthlib",
+        "wellcome_storage_service.bag_builder",
+        "wellcome_storage_service.downloader",
+        "wellcome_storage_service.preflight",
+        "wellcome_storage_service.uploader",
+    ],
+)
+def test_importing_the_package_is_lazy(module):
+    assert module not in loaded_modules("import wellcome_storage_service")
+
+
+def test_lazy_attributes_are_imported_when_used():
+    import wellcome_storage_service
+    from wellcome_storage_service.downloader import download_bag
+
+    assert wellcome_storage_service.download_bag is download_bag
+    assert "download_bag" in dir(wellcome_storage_service)
+
+    with pytest.raises(AttributeError):
+        wellcome_storage_service.not_a_real_attribute
+
+
+def cumulative_import_time(module):
+    """
+    Returns how long (in seconds) a cold import of ``module`` takes,
+    including everything it imports, as reported by ``python -X importtime``.
+    """
+    proc = subprocess.Popen(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        stderr=subprocess.PIPE,
+    )
+    _, stderr = proc.communicate()
+    assert proc.returncode == 0, stderr
+
+    # Each line looks like "import time: self [us] | cumulative | name"
+    for line in stderr.decode("utf8").splitlines():
+        _, cumulative, name = line.split("|")
+        if name.strip() == module:
+            return int(cumulative) / 1e6
+
+    raise AssertionError("No import time for %s:\n%s" % (module, stderr))
+
+
+def test_importing_the_package_is_fast():
+    # Take the fastest of a few imports, so one slow run doesn't fail the test
+    import_time = min(
+        cumulative_import_time("wellcome_storage_service") for _ in range(3)
+    )
+
+    assert import_time < IMPORT_TIME_BUDGET
+
+
+def test_default_directories_are_worked_out_when_used():
+    from wellcome_storage_service import cache, content_store, tokens
+
+    with mock.patch.dict(os.environ, {"HOME": "/home/example"}):
+        root = "/home/example/.wellcome-storage/"
+
+        assert cache.DEFAULT_CACHE_DIR == root + "manifest-cache"
+        assert content_store.DEFAULT_STORE_DIR == root + "content-store"
+        assert tokens.DEFAULT_TOKEN_DIR == root + "tokens"
+
+    with pytest.raises(AttributeError):
+        cache.NOT_A_REAL_ATTRIBUTE
+
+
+def test_can_import_without_home():
+    env = {"PATH": "/usr/bin:/bin"}
+    subprocess.check_call(
+        [
+            sys.executable,
+            "-c",
+            "import wellcome_storage_service; "
+            "wellcome_storage_service.ManifestCache; "
+            "wellcome_storage_service.DEFAULT_CREDENTIALS_PATH; "
+            "from wellcome_storage_service import cache, content_store, tokens; "
+            "cache.DEFAULT_CACHE_DIR; "
+            "content_store.DEFAULT_STORE_DIR; "
+            "tokens.DEFAULT_TOKEN_DIR",
+        ],
+        env=env,
+    )
@@ -0,0 +1,73 @@
+from wellcome_storage_service.journal import DownloadJournal, JOURNAL_NAME
+
+
+def test_reloads_entries_from_disk(tmpdir):
+    tmpdir.join("a.txt").write_binary(b"aaaa")
+    manifest_file = {"name": "a.txt", "size": 4, "checksum": "abcd"}
+
+    journal = DownloadJournal(str(tmpdir))
+    journal.record_file(manifest_file, checksum="abcd")
+    journal.record_range("b.mxf", (0, 99))
+    journal.close()
+
+    reloaded = DownloadJournal(str(tmpdir))
+    assert reloaded.completed_file(str(tmpdir), manifest_file) == {
+        "name": "a.txt",
+        "size": 4,
+        "checksum": "abcd",
+    }
+    assert reloaded.completed_ranges("b.mxf") == {(0, 99)}
+
+
+def test_ignores_a_half_written_entry(tmpdir):
+    tmpdir.join(JOURNAL_NAME).write(
+        '{"name": "b.mxf", "range": [0, 99]}\n{"name": "b.mxf", "ran'
+    )
+
+    journal = DownloadJournal(str(tmpdir))
+    assert journal.completed_ranges("b.mxf") == {(0, 99)}
+
+
+def test_forgotten_ranges_stay_forgotten(tmpdir):
+    journal = DownloadJournal(str(tmpdir))
+    journal.record_range("b.mxf", (0, 99))
+    journal.forget_ranges("b.mxf")
+    journal.record_range("b.mxf", (100, 199))
+    journal.close()
+
+    assert DownloadJournal(str(tmpdir)).completed_ranges("b.mxf") == {(100, 199)}
+
+
+def test_file_is_not_complete_if_it_has_changed(tmpdir):
+    manifest_file = {"name": "a.txt", "size": 4, "checksum": "abcd"}
+
+    journal = DownloadJournal(str(tmpdir))
+    journal.record_file(manifest_file, checksum="abcd")
+
+    # Missing from disk
+    assert journal.completed_file(str(tmpdir), manifest_file) is None
+
+    # Wrong size on disk
+    tmpdir.join("a.txt").write_binary(b"aa")
+    assert journal.completed_file(str(tmpdir), manifest_file) is None
+
+    # Different size or checksum in the manifest
+    tmpdir.join("a.txt").write_binary(b"aaaa")
+    assert journal.completed_file(str(tmpdir), manifest_file) is not None
+    assert (
+        journal.completed_file(str(tmpdir), dict(manifest_file, checksum="efgh"))
+        is None
+    )
+    assert journal.completed_file(str(tmpdir), dict(manifest_file, size=5)) is None
+
+    # Not in the journal at all
+    assert journal.completed_file(str(tmpdir), {"name": "b.txt", "size": 4}) is None
+
+
+def test_remove_deletes_the_journal(tmpdir):
+    journal = DownloadJournal(str(tmpdir))
+    journal.record_range("b.mxf", (0, 99))
+    assert tmpdir.join(JOURNAL_NAME).exists()
+
+    journal.remove()
+    assert not tmpdir.join(JOURNAL_NAME).exists()
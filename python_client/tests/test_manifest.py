@@ -0,0 +1,262 @@
+import hashlib
+import json
+
+import pytest
+
+from wellcome_storage_service import (
+    ManifestFile,
+    StorageManifest,
+    StorageServiceClientBase,
+    StreamingBag,
+    download_bag,
+)
+
+
+def manifest_file(name, body, version="v1"):
+    return {
+        "checksum": hashlib.sha256(body).hexdigest(),
+        "name": name,
+        "path": "%s/%s" % (version, name),
+        "size": len(body),
+        "type": "File",
+    }
+
+
+BAG = {
+    "id": "digitised/b1234",
+    "space": {"id": "digitised", "type": "Space"},
+    "info": {"externalIdentifier": "b1234", "type": "BagInfo"},
+    "manifest": {
+        "checksumAlgorithm": "SHA-256",
+        "files": [
+            manifest_file("data/b1234.xml", b"<mets/>", version="v2"),
+            manifest_file("data/objects/b1234_0001.jp2", b"1111"),
+            manifest_file("data/objects/b1234_0002.jp2", b"22222"),
+            manifest_file("data/alto/b1234_0001.xml", b"<alto/>"),
+        ],
+        "type": "BagManifest",
+    },
+    "tagManifest": {
+        "checksumAlgorithm": "SHA-512",
+        "files": [
+            {
+                "checksum": hashlib.sha512(b"BagIt").hexdigest(),
+                "name": "bagit.txt",
+                "path": "v2/bagit.txt",
+                "size": 5,
+                "type": "File",
+            }
+        ],
+        "type": "BagManifest",
+    },
+    "location": {
+        "provider": {"id": "amazon-s3", "type": "Provider"},
+        "bucket": "wellcomecollection-storage",
+        "path": "digitised/b1234",
+        "type": "Location",
+    },
+    "replicaLocations": [],
+    "createdDate": "2019-09-12T20:26:53.094757Z",
+    "version": "v2",
+    "type": "Bag",
+}
+
+
+@pytest.fixture(params=["from_bag", "from_streaming_bag"])
+def storage_manifest(request):
+    if request.param == "from_bag":
+        return StorageManifest.from_bag(BAG)
+    else:
+        return StorageManifest.from_streaming_bag(StreamingBag([json.dumps(BAG)]))
+
+
+def test_round_trips_to_the_api_shape(storage_manifest):
+    assert storage_manifest.as_dict() == BAG
+
+
+def test_metadata_is_available_like_a_dict(storage_manifest):
+    assert storage_manifest["location"] == BAG["location"]
+    assert storage_manifest.get("createdDate") == BAG["createdDate"]
+    assert storage_manifest.get("doesnotexist") is None
+
+    with pytest.raises(KeyError):
+        storage_manifest["manifest"]
+
+
+def test_can_look_up_files_by_name(storage_manifest):
+    assert storage_manifest.get_file("data/objects/b1234_0002.jp2") == ManifestFile(
+        name="data/objects/b1234_0002.jp2",
+        path="v1/data/objects/b1234_0002.jp2",
+        size=5,
+        checksum=hashlib.sha256(b"22222").hexdigest(),
+    )
+    assert storage_manifest.get_file("bagit.txt").path == "v2/bagit.txt"
+    assert storage_manifest.get_file("data/doesnotexist.jp2") is None
+
+    assert "data/b1234.xml" in storage_manifest
+    assert "data/doesnotexist.jp2" not in storage_manifest
+
+
+def test_can_look_up_files_by_path(storage_manifest):
+    assert (
+        storage_manifest.get_file_by_path("v2/data/b1234.xml").name == "data/b1234.xml"
+    )
+    assert storage_manifest.get_file_by_path("v2/bagit.txt").name == "bagit.txt"
+
+    # The right name, but in the wrong version
+    assert storage_manifest.get_file_by_path("v1/data/b1234.xml") is None
+    assert storage_manifest.get_file_by_path("v2/data/doesnotexist.jp2") is None
+
+
+def test_can_iterate_over_files_with_a_prefix(storage_manifest):
+    names = [f.name for f in storage_manifest.files_with_prefix("data/objects/")]
+    assert names == ["data/objects/b1234_0001.jp2", "data/objects/b1234_0002.jp2"]
+
+    assert list(storage_manifest.files_with_prefix("data/nothing/")) == []
+    assert len(list(storage_manifest.files_with_prefix(""))) == 5
+
+
+def test_size_aggregates(storage_manifest):
+    assert len(storage_manifest) == 5
+    assert storage_manifest.total_size == 7 + 4 + 5 + 7 + 5
+    assert storage_manifest.manifest.total_size == 7 + 4 + 5 + 7
+    assert storage_manifest.size_with_prefix("data/objects/") == 4 + 5
+
+
+def test_iterates_in_manifest_order(storage_manifest):
+    assert [f.name for f in storage_manifest] == [
+        f["name"] for f in BAG["manifest"]["files"] + BAG["tagManifest"]["files"]
+    ]
+
+
+def test_can_read_raw_names_and_digests(storage_manifest):
+    table = storage_manifest.manifest
+
+    assert list(table.iter_raw()) == [
+        (f["name"].encode("utf8"), hashlib.sha256(body).digest())
+        for f, body in zip(
+            BAG["manifest"]["files"], [b"<mets/>", b"1111", b"22222", b"<alto/>"]
+        )
+    ]
+
+    assert table.file_at(1) == table.get("data/objects/b1234_0001.jp2")
+
+    with pytest.raises(IndexError):
+        table.file_at(len(table))
+
+
+def test_keeps_paths_that_dont_end_with_the_name():
+    bag = dict(BAG)
+    bag["manifest"] = {
+        "checksumAlgorithm": "SHA-256",
+        "files": [
+            {
+                "checksum": "00" * 32,
+                "name": "data/a.txt",
+                "path": "v1/data/renamed.txt",
+                "size": 1,
+                "type": "File",
+            }
+        ],
+        "type": "BagManifest",
+    }
+
+    storage_manifest = StorageManifest.from_bag(bag)
+
+    assert storage_manifest.get_file("data/a.txt").path == "v1/data/renamed.txt"
+    assert storage_manifest.get_file_by_path("v1/data/renamed.txt").name == (
+        "data/a.txt"
+    )
+    assert storage_manifest.get_file_by_path("data/a.txt") is None
+
+
+def test_handles_big_files_and_many_versions():
+    files = [
+        manifest_file("data/%03d.txt" % i, b"a", version="v%d" % i) for i in range(300)
+    ]
+    files[0]["size"] = 5 * 1024 ** 3
+
+    storage_manifest = StorageManifest.from_bag(dict(BAG, manifest={"files": files}))
+
+    assert storage_manifest.get_file("data/000.txt").size == 5 * 1024 ** 3
+    assert storage_manifest.get_file_by_path("v299/data/299.txt").name == (
+        "data/299.txt"
+    )
+    assert [f.as_dict() for f in storage_manifest.manifest] == files
+
+
+def test_can_add_files_after_looking_one_up(storage_manifest):
+    table = storage_manifest.manifest
+    assert table.get("data/b1234.xml") is not None
+
+    table.append(manifest_file("data/objects/b1234_0003.jp2", b"333"))
+
+    assert table.get("data/objects/b1234_0003.jp2").size == 3
+    assert [f.name for f in table.with_prefix("data/objects/")] == [
+        "data/objects/b1234_0001.jp2",
+        "data/objects/b1234_0002.jp2",
+        "data/objects/b1234_0003.jp2",
+    ]
+    assert "data/objects/b1234_0004.jp2" not in table
+
+
+def test_looks_up_names_outside_ascii():
+    names = [u"data/z.txt", u"data/\u00e9.txt", u"data/\U0001f600.txt", u"data/a.txt"]
+    files = [manifest_file(name, b"a") for name in names]
+
+    storage_manifest = StorageManifest.from_bag(dict(BAG, manifest={"files": files}))
+
+    for name in names:
+        assert storage_manifest.get_file(name).name == name
+    assert [f.name for f in storage_manifest.files_with_prefix(u"data/")] == sorted(
+        names
+    )
+
+
+@pytest.mark.parametrize(
+    "files, message",
+    [
+        (
+            [manifest_file("data/a.txt", b"a"), manifest_file("data/a.txt", b"b")],
+            "Duplicate file",
+        ),
+        (
+            [
+                manifest_file("data/a.txt", b"a"),
+                dict(manifest_file("data/b.txt", b"b"), checksum="abcd"),
+            ],
+            "Checksum of data/b.txt is 2 bytes, expected 32",
+        ),
+    ],
+)
+def test_rejects_bad_manifests(files, message):
+    with pytest.raises(ValueError, match=message):
+        StorageManifest.from_bag(dict(BAG, manifest={"files": files}))
+
+    bag = dict(BAG, manifest={"checksumAlgorithm": "SHA-256", "files": files})
+    with pytest.raises(ValueError, match=message):
+        StorageManifest.from_streaming_bag(StreamingBag([json.dumps(bag)]))
+
+
+def test_client_can_get_a_storage_manifest():
+    class FakeClient(StorageServiceClientBase):
+        def _http_get(self, url):
+            return 200, json.dumps(BAG)
+
+    client = FakeClient(api_url="https://example.org/storage/v1")
+
+    storage_manifest = client.get_storage_manifest("digitised", "b1234")
+
+    assert storage_manifest.as_dict() == BAG
+
+
+def test_can_download_a_storage_manifest(make_bag, tmpdir):
+    bag = make_bag(
+        files={"data/a.txt": b"aaa", "data/b.txt": b"bbbb"},
+        tag_files={"bagit.txt": b"BagIt"},
+    )
+
+    results = download_bag(StorageManifest.from_bag(bag), out_dir=str(tmpdir))
+
+    assert sorted(results) == ["bagit.txt", "data/a.txt", "data/b.txt"]
+    assert tmpdir.join("data", "b.txt").read_binary() == b"bbbb"
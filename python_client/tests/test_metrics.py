@@ -0,0 +1,225 @@
+import io
+import json
+import time
+
+import mock
+import pytest
+
+from wellcome_storage_service import (
+    Instrumentation,
+    Metrics,
+    RequestsOAuthStorageServiceClient,
+    download_bag,
+    stream_compressed_bag,
+)
+from wellcome_storage_service.metrics import Histogram, record_request
+
+
+class RecordingInstrumentation(Instrumentation):
+    def __init__(self):
+        self.requests = []
+        self.retries = []
+
+    def on_request(self, kind, duration, size=0, status_code=None, error=None):
+        self.requests.append((kind, size, status_code, error))
+
+    def on_retry(self, kind):
+        self.retries.append(kind)
+
+
+def make_client(instrumentation, responses):
+    client = RequestsOAuthStorageServiceClient(
+        api_url="https://example.org/storage/v1",
+        client_id="client_id",
+        client_secret="client_secret",
+        token_url="https://example.org/token",
+        instrumentation=instrumentation,
+    )
+
+    client.sess.fetch_token = mock.Mock(
+        return_value={"access_token": "token", "expires_at": time.time() + 3600}
+    )
+    client.sess.get = mock.Mock(
+        side_effect=[
+            mock.Mock(status_code=status_code, text=body, content=body.encode("utf8"))
+            for status_code, body in responses
+        ]
+    )
+
+    return client
+
+
+@pytest.fixture(autouse=True)
+def no_backoff():
+    with mock.patch("wellcome_storage_service.backoff_delay", return_value=0):
+        yield
+
+
+def test_histogram_percentiles():
+    histogram = Histogram(buckets=[1, 2, 4])
+
+    assert histogram.percentile(50) is None
+
+    for value in [0.5, 1.5, 1.5, 3]:
+        histogram.observe(value)
+
+    assert histogram.cumulative_counts() == [(1, 1), (2, 3), (4, 4), (float("inf"), 4)]
+    assert histogram.percentile(50) == 1.5
+    assert histogram.percentile(100) == 4
+    assert histogram.count == 4
+    assert histogram.sum == 6.5
+
+
+def test_histogram_overflow_is_reported_as_the_largest_bucket():
+    histogram = Histogram(buckets=[1, 2])
+    histogram.observe(100)
+
+    assert histogram.percentile(99) == 2
+
+
+def test_records_requests_by_kind():
+    metrics = Metrics()
+
+    metrics.on_request("api", duration=0.1, size=100, status_code=200)
+    metrics.on_request("api", duration=0.3, size=50, status_code=503)
+    metrics.on_request("download", duration=2, size=1000, error=IOError())
+    metrics.on_retry("api")
+
+    stats = metrics.as_dict()["requests"]
+
+    assert stats["api"]["count"] == 2
+    assert stats["api"]["errors"] == 1
+    assert stats["api"]["retries"] == 1
+    assert stats["api"]["bytes"] == 150
+    assert stats["download"]["errors"] == 1
+    assert stats["download"]["throughput"] > 0
+
+    assert json.loads(metrics.to_json())["requests"]["api"]["count"] == 2
+
+
+def test_summary():
+    metrics = Metrics()
+    metrics.on_request("download", duration=0.02, size=2048)
+
+    summary = metrics.summary()
+
+    assert "download: 1 requests (0 errors, 0 retries), 2.0 KB received" in summary
+
+
+def test_prometheus_format():
+    metrics = Metrics(buckets=[0.1, 1])
+    metrics.on_request("api", duration=0.5, size=10, status_code=200)
+
+    text = metrics.to_prometheus()
+
+    assert "# TYPE wellcome_storage_requests_total counter" in text
+    assert 'wellcome_storage_requests_total{kind="api"} 1' in text
+    assert 'wellcome_storage_received_bytes_total{kind="api"} 10' in text
+    assert 'wellcome_storage_request_duration_seconds_bucket{kind="api",le="0.1"} 0' in text
+    assert 'wellcome_storage_request_duration_seconds_bucket{kind="api",le="1"} 1' in text
+    assert 'wellcome_storage_request_duration_seconds_bucket{kind="api",le="+Inf"} 1' in text
+    assert 'wellcome_storage_request_duration_seconds_count{kind="api"} 1' in text
+    assert text.endswith("\n")
+
+
+def test_print_summary_at_exit():
+    metrics = Metrics()
+    out_file = mock.Mock()
+
+    with mock.patch("atexit.register") as register:
+        metrics.print_summary_at_exit(out_file=out_file)
+
+    (print_summary,), _ = register.call_args
+    print_summary()
+
+    out_file.write.assert_called_once_with(metrics.summary() + "\n")
+
+
+def test_record_request_without_instrumentation_just_calls_the_function():
+    assert record_request(None, "api", lambda: 5, size=len) == 5
+
+
+def test_record_request_records_errors():
+    instrumentation = RecordingInstrumentation()
+
+    with pytest.raises(ValueError):
+        record_request(instrumentation, "api", mock.Mock(side_effect=ValueError))
+
+    ((kind, size, status_code, error),) = instrumentation.requests
+    assert kind == "api"
+    assert isinstance(error, ValueError)
+
+
+def test_client_records_token_refreshes_and_api_calls():
+    instrumentation = RecordingInstrumentation()
+    client = make_client(instrumentation, responses=[(200, '{"id": "1234"}')])
+
+    client.get_ingest("1234")
+
+    assert instrumentation.requests == [
+        ("token", 0, None, None),
+        ("api", 14, 200, None),
+    ]
+
+
+def test_client_records_retries():
+    instrumentation = RecordingInstrumentation()
+    client = make_client(
+        instrumentation, responses=[(503, "{}"), (503, "{}"), (200, '{"id": "1"}')]
+    )
+
+    list(client.get_ingests_many(["1"]))
+
+    assert instrumentation.retries == ["api", "api"]
+    assert [r[2] for r in instrumentation.requests if r[0] == "api"] == [
+        503,
+        503,
+        200,
+    ]
+
+
+def test_download_bag_records_each_file(make_bag, s3_client, tmpdir):
+    bag = make_bag(files={"data/a.txt": b"aaa", "data/b.txt": b"bbbbb"})
+    metrics = Metrics()
+
+    download_bag(bag, out_dir=str(tmpdir), instrumentation=metrics)
+
+    stats = metrics.as_dict()["requests"]["download"]
+    assert stats["count"] == 3
+    assert stats["bytes"] == len(b"aaa") + len(b"bbbbb") + len(b"BagIt-Version: 0.97\n")
+    assert stats["errors"] == 0
+
+
+def test_download_bag_records_files_without_a_size(make_bag, s3_client, tmpdir):
+    bag = make_bag(files={"data/a.txt": b"aaa", "data/b.txt": b"bbbbb"})
+    for manifest_file in bag["manifest"]["files"]:
+        if manifest_file["name"] == "data/b.txt":
+            del manifest_file["size"]
+
+    metrics = Metrics()
+
+    download_bag(bag, out_dir=str(tmpdir), instrumentation=metrics)
+
+    assert tmpdir.join("data", "b.txt").read_binary() == b"bbbbb"
+
+    stats = metrics.as_dict()["requests"]["download"]
+    assert stats["count"] == 3
+    assert stats["bytes"] == len(b"aaa") + len(b"BagIt-Version: 0.97\n")
+    assert stats["errors"] == 0
+
+
+def test_record_request_treats_an_unknown_size_as_zero():
+    instrumentation = RecordingInstrumentation()
+
+    record_request(instrumentation, "download", lambda: 5, size=lambda _: None)
+
+    assert instrumentation.requests == [("download", 0, None, None)]
+
+
+def test_stream_compressed_bag_records_each_file(make_bag, s3_client):
+    bag = make_bag(files={"data/a.txt": b"aaa"})
+    metrics = Metrics()
+
+    stream_compressed_bag(bag, out_file=io.BytesIO(), instrumentation=metrics)
+
+    assert metrics.as_dict()["requests"]["download"]["count"] == 2
@@ -0,0 +1,415 @@
+import hashlib
+import io
+import os
+import tarfile
+
+import mock
+import pytest
+
+from wellcome_storage_service import (
+    BagNotFound,
+    FetchEntry,
+    StorageServiceClientBase,
+    build_bag,
+    verify_bag,
+)
+from wellcome_storage_service import preflight
+from wellcome_storage_service.bag_builder import hash_file
+
+
+def sha256(body):
+    return hashlib.sha256(body).hexdigest()
+
+
+OLD_FILE = b"<old mets/>"
+
+
+def _tar_gz(bag_dir, top_level_dir=None):
+    buf = io.BytesIO()
+
+    with tarfile.open(fileobj=buf, mode="w:gz") as tf:
+        for name in sorted(os.listdir(bag_dir)):
+            arcname = name if top_level_dir is None else top_level_dir + "/" + name
+            tf.add(os.path.join(bag_dir, name), arcname=arcname)
+
+    buf.seek(0)
+    return buf
+
+
+def _rewrite_tag_manifest(bag_dir):
+    names = sorted(
+        name
+        for name in os.listdir(str(bag_dir))
+        if name.endswith(".txt") and not name.startswith("tagmanifest-")
+    )
+    bag_dir.join("tagmanifest-sha256.txt").write(
+        "".join(
+            "%s  %s\n" % (hash_file(str(bag_dir.join(name)))["sha256"], name)
+            for name in names
+        )
+    )
+
+
+def _set_payload_oxum(bag_dir, payload_oxum):
+    bag_info = bag_dir.join("bag-info.txt")
+    bag_info.write(
+        bag_info.read().replace("Payload-Oxum: 1007.2", "Payload-Oxum: " + payload_oxum)
+    )
+    _rewrite_tag_manifest(bag_dir)
+
+
+@pytest.fixture
+def bag_dir(tmpdir):
+    tmpdir.join("data", "b12345.xml").write_binary(b"<mets/>", ensure=True)
+    tmpdir.join("data", "objects", "b12345_0001.jp2").write_binary(
+        os.urandom(1000), ensure=True
+    )
+    build_bag(str(tmpdir), bag_info={"External-Identifier": "b12345"}, processes=1)
+    return tmpdir
+
+
+@pytest.fixture(params=["directory", "archive"])
+def check(request):
+    """
+    Returns a function that verifies a bag, either from its directory or
+    from a tar.gz of it.
+    """
+
+    def _check(bag_dir, **kwargs):
+        if request.param == "directory":
+            return verify_bag(str(bag_dir), processes=1, **kwargs)
+        else:
+            return verify_bag(_tar_gz(str(bag_dir)), **kwargs)
+
+    return _check
+
+
+def test_a_valid_bag_has_no_problems(bag_dir, check):
+    assert check(bag_dir, external_identifier="b12345") == []
+
+
+def test_a_valid_bag_in_a_subdirectory_has_no_problems(tmpdir_factory, bag_dir):
+    wrapper = tmpdir_factory.mktemp("wrapper")
+    bag_dir.move(wrapper.join("b12345"))
+
+    assert verify_bag(str(wrapper), processes=1) == []
+
+
+def test_a_bag_inside_a_top_level_dir_in_an_archive(bag_dir):
+    archive = _tar_gz(str(bag_dir), top_level_dir="b12345")
+
+    assert verify_bag(archive, external_identifier="b12345") == []
+
+
+def test_reads_an_archive_from_a_path(tmpdir, bag_dir):
+    archive = tmpdir.join("b12345.tar.gz")
+    archive.write_binary(_tar_gz(str(bag_dir)).read())
+
+    assert verify_bag(str(archive), algorithms=["SHA-256"]) == []
+
+
+class _Pipe(object):
+    """
+    A file object we can only read once, like a pipe.
+    """
+
+    def __init__(self, body):
+        self._buf = io.BytesIO(body)
+
+    def read(self, size=-1):
+        return self._buf.read(size)
+
+
+def _hashed_algorithms(archive):
+    """
+    Verifies a bag in an archive, and returns the algorithms its files
+    were hashed with.
+    """
+    with mock.patch.object(
+        preflight, "_hash_stream", wraps=preflight._hash_stream
+    ) as hash_stream:
+        assert verify_bag(archive) == []
+
+    return {
+        tuple(algorithms) for (_, algorithms, _, _), _ in hash_stream.call_args_list
+    }
+
+
+def test_only_hashes_an_archive_with_the_bags_algorithms(bag_dir):
+    assert _hashed_algorithms(_tar_gz(str(bag_dir))) == {("sha256",)}
+
+
+def test_hashes_an_archive_we_cant_rewind_with_every_algorithm(bag_dir):
+    archive = _Pipe(_tar_gz(str(bag_dir)).read())
+
+    assert _hashed_algorithms(archive) == {preflight.SUPPORTED_ALGORITHMS}
+
+
+def test_cant_find_the_bag_root(tmpdir, check):
+    tmpdir.join("one", "bag-info.txt").write("", ensure=True)
+    tmpdir.join("two", "bag-info.txt").write("", ensure=True)
+
+    assert check(tmpdir) == ["Unable to locate root of bag"]
+
+
+def test_spots_a_duplicate_entry_in_an_archive(bag_dir):
+    buf = io.BytesIO()
+
+    with tarfile.open(fileobj=buf, mode="w:gz") as tf:
+        tf.add(str(bag_dir), arcname=".")
+        tf.add(str(bag_dir.join("bagit.txt")), arcname="bagit.txt")
+
+    buf.seek(0)
+    assert verify_bag(buf) == [
+        "The archive is malformed or has a duplicate entry (bagit.txt)"
+    ]
+
+
+def test_checks_the_external_identifier(bag_dir, check):
+    assert check(bag_dir, external_identifier="b67890") == [
+        "External identifier in bag-info.txt does not match request: "
+        "b12345 is not b67890"
+    ]
+
+
+def test_needs_a_bag_info(bag_dir, check):
+    bag_dir.join("bag-info.txt").remove()
+
+    assert check(bag_dir) == ["Unable to locate root of bag"]
+
+
+def test_spots_a_bad_external_identifier(tmpdir, check):
+    tmpdir.join("data", "b12345.xml").write_binary(b"<mets/>", ensure=True)
+    build_bag(str(tmpdir), bag_info={"External-Identifier": "b12345/"}, processes=1)
+
+    assert check(tmpdir) == [
+        "Error loading bag-info.txt: Unable to parse External-Identifier in "
+        "bag-info.txt: External identifier cannot end with a slash, was b12345/"
+    ]
+
+
+def test_needs_a_payload_manifest(bag_dir, check):
+    bag_dir.join("manifest-sha256.txt").remove()
+
+    assert check(bag_dir) == ["Could not find any payload manifests in the bag"]
+
+
+def test_needs_a_strong_checksum(tmpdir, check):
+    tmpdir.join("data", "b12345.xml").write_binary(b"<mets/>", ensure=True)
+    build_bag(
+        str(tmpdir),
+        bag_info={"External-Identifier": "b12345"},
+        algorithms=["md5"],
+        processes=1,
+    )
+
+    assert check(tmpdir) == [
+        "Payload manifests only use deprecated checksums: add a payload "
+        "manifest using SHA-256 or SHA-512"
+    ]
+
+
+@pytest.mark.parametrize(
+    "declaration, message",
+    [
+        (None, "no such file!"),
+        (b"BagIt-Version: 0.97\n", "expected 2 lines, got 1"),
+        (
+            b"BagIt-Version: 0.97\nTag-File-Character-Encoding: ISO-8859-1\n",
+            "encoding must be UTF-8",
+        ),
+        (
+            b"BagIt-Version: 097\nTag-File-Character-Encoding: UTF-8\n",
+            "version line was not correct",
+        ),
+        (b"\xff\xfe\n", "could not be decoded as UTF-8"),
+    ],
+)
+def test_checks_the_bag_declaration(bag_dir, check, declaration, message):
+    if declaration is None:
+        bag_dir.join("bagit.txt").remove()
+    else:
+        bag_dir.join("bagit.txt").write_binary(declaration)
+    _rewrite_tag_manifest(bag_dir)
+
+    assert check(bag_dir) == ["Error loading Bag Declaration (bagit.txt): " + message]
+
+
+def test_spots_a_missing_file(bag_dir, check):
+    bag_dir.join("data", "b12345.xml").remove()
+
+    assert check(bag_dir) == ["Unable to verify one file in the bag: data/b12345.xml"]
+
+
+def test_spots_files_with_the_wrong_checksum(bag_dir, check):
+    bag_dir.join("data", "b12345.xml").write_binary(b"<METS/>")
+    bag_dir.join("bag-info.txt").write("Contact-Name: Henry Wellcome\n", mode="a")
+
+    assert check(bag_dir) == [
+        "Unable to verify 2 files in the bag: bag-info.txt, data/b12345.xml"
+    ]
+
+
+def test_spots_unreferenced_files(bag_dir, check):
+    bag_dir.join("data", "extra.txt").write_binary(b"extra")
+
+    assert check(bag_dir) == [
+        "Bag contains a file which is not referenced in the manifest: data/extra.txt"
+    ]
+
+
+def test_spots_a_payload_oxum_with_the_wrong_count(bag_dir, check):
+    _set_payload_oxum(bag_dir, "1007.3")
+
+    assert check(bag_dir) == [
+        "Payload-Oxum has the wrong number of payload files: 3, but bag manifest has 2"
+    ]
+
+
+def test_spots_a_payload_oxum_with_the_wrong_size(bag_dir, check):
+    _set_payload_oxum(bag_dir, "1000.2")
+
+    assert check(bag_dir) == [
+        "Payload-Oxum has the wrong octetstream sum: 1000 bytes, but bag "
+        "actually contains 1007 bytes"
+    ]
+
+
+def test_spots_payload_files_outside_the_data_dir(bag_dir, check):
+    bag_dir.join("extra.txt").write_binary(b"extra")
+    manifest = bag_dir.join("manifest-sha256.txt")
+    manifest.write("%s  extra.txt\n" % sha256(b"extra"), mode="a")
+    _set_payload_oxum(bag_dir, "1012.3")
+
+    assert check(bag_dir) == [
+        "Not all payload files are in the data/ directory: extra.txt"
+    ]
+
+
+class FakeBagsClient(StorageServiceClientBase):
+    def __init__(self, bags):
+        self.bags = bags
+        super(FakeBagsClient, self).__init__(api_url="https://example.org/storage/v1")
+
+    def get_bag(self, space, external_identifier, version=None):
+        try:
+            return self.bags[(space, external_identifier, version)]
+        except KeyError:
+            raise BagNotFound(version)
+
+
+@pytest.fixture
+def existing_bag(make_bag):
+    return make_bag(files={"data/old.xml": OLD_FILE})
+
+
+def _fetch_bag(tmpdir, url, checksum=None, size=len(OLD_FILE)):
+    tmpdir.join("data", "b12345.xml").write_binary(b"<mets/>", ensure=True)
+    build_bag(
+        str(tmpdir),
+        bag_info={"External-Identifier": "b12345"},
+        fetch_entries=[
+            FetchEntry(
+                url=url,
+                size=size,
+                name="data/old.xml",
+                checksums={"sha256": checksum or sha256(OLD_FILE)},
+            )
+        ],
+        processes=1,
+    )
+    return tmpdir
+
+
+FETCH_URL = "s3://wellcomecollection-storage/digitised/b12345/v1/data/old.xml"
+
+
+def test_checks_fetched_files_against_existing_versions(tmpdir, existing_bag):
+    bag_dir = _fetch_bag(tmpdir, url=FETCH_URL)
+    client = FakeBagsClient({("digitised", "b12345", "v1"): existing_bag})
+
+    assert client.verify_bag("digitised", "b12345", str(bag_dir), processes=1) == []
+
+
+def test_spots_a_fetched_file_with_the_wrong_checksum(tmpdir, existing_bag):
+    bag_dir = _fetch_bag(tmpdir, url=FETCH_URL, checksum="a" * 64)
+    client = FakeBagsClient({("digitised", "b12345", "v1"): existing_bag})
+
+    assert client.verify_bag("digitised", "b12345", str(bag_dir), processes=1) == [
+        "Unable to verify one file in the bag: data/old.xml"
+    ]
+
+
+def test_uses_the_tag_manifest_algorithm_if_the_manifest_has_none(
+    tmpdir, existing_bag
+):
+    bag_dir = _fetch_bag(tmpdir, url=FETCH_URL)
+    del existing_bag["manifest"]["checksumAlgorithm"]
+    client = FakeBagsClient({("digitised", "b12345", "v1"): existing_bag})
+
+    assert client.verify_bag("digitised", "b12345", str(bag_dir), processes=1) == []
+
+
+def test_cant_verify_a_fetched_file_without_a_checksum_algorithm(
+    tmpdir, existing_bag
+):
+    bag_dir = _fetch_bag(tmpdir, url=FETCH_URL)
+    del existing_bag["manifest"]["checksumAlgorithm"]
+    del existing_bag["tagManifest"]["checksumAlgorithm"]
+    client = FakeBagsClient({("digitised", "b12345", "v1"): existing_bag})
+
+    assert client.verify_bag("digitised", "b12345", str(bag_dir), processes=1) == [
+        "Unable to verify one file in the bag: data/old.xml"
+    ]
+
+
+def test_spots_a_fetched_file_from_a_missing_version(tmpdir, existing_bag):
+    bag_dir = _fetch_bag(tmpdir, url=FETCH_URL.replace("/v1/", "/v2/"))
+    client = FakeBagsClient({("digitised", "b12345", "v1"): existing_bag})
+
+    assert client.verify_bag("digitised", "b12345", str(bag_dir), processes=1) == [
+        "Unable to verify one file in the bag: data/old.xml"
+    ]
+
+
+def test_spots_a_fetched_file_with_the_wrong_size(tmpdir, existing_bag):
+    bag_dir = _fetch_bag(tmpdir, url=FETCH_URL, size=1)
+    client = FakeBagsClient({("digitised", "b12345", "v1"): existing_bag})
+
+    assert client.verify_bag("digitised", "b12345", str(bag_dir), processes=1) == [
+        "Unable to verify one file in the bag: data/old.xml"
+    ]
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "https://example.org/digitised/b12345/v1/data/old.xml",
+        "s3://wellcomecollection-storage/digitised/b67890/v1/data/old.xml",
+        "s3://another-bucket/digitised/b12345/v1/data/old.xml",
+    ],
+)
+def test_spots_a_fetched_file_from_somewhere_else(tmpdir, existing_bag, url):
+    bag_dir = _fetch_bag(tmpdir, url=url)
+    client = FakeBagsClient({("digitised", "b12345", "v1"): existing_bag})
+
+    assert client.verify_bag("digitised", "b12345", str(bag_dir), processes=1) == [
+        "fetch.txt refers to paths in a mismatched prefix or with a non-S3 URI "
+        "scheme: data/old.xml",
+        "Unable to verify one file in the bag: data/old.xml",
+    ]
+
+
+def test_trusts_fetch_txt_without_a_client(tmpdir, check):
+    bag_dir = _fetch_bag(tmpdir, url=FETCH_URL)
+
+    assert check(bag_dir, space="digitised") == []
+
+
+def test_spots_fetched_files_that_are_also_in_the_bag(tmpdir, check):
+    bag_dir = _fetch_bag(tmpdir, url=FETCH_URL)
+    bag_dir.join("data", "old.xml").write_binary(OLD_FILE)
+
+    assert check(bag_dir) == [
+        "Files referred to in the fetch.txt also appear in the bag: data/old.xml"
+    ]
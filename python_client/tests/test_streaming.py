@@ -0,0 +1,208 @@
+import json
+
+import mock
+import pytest
+
+from wellcome_storage_service import (
+    BagNotFound,
+    ManifestEntry,
+    RequestsStorageServiceClient,
+    StorageServiceClientBase,
+    StreamingBag,
+)
+
+
+BAG = {
+    "id": "digitised/b1234",
+    "space": {"id": "digitised", "type": "Space"},
+    "info": {"externalIdentifier": "b1234", "type": "BagInfo"},
+    "manifest": {
+        "checksumAlgorithm": "SHA-256",
+        "files": [
+            {
+                "checksum": "%064x" % i,
+                "name": "data/b1234_%04d.jp2" % i,
+                "path": "v1/data/b1234_%04d.jp2" % i,
+                "size": 123456789 + i,
+                "type": "File",
+            }
+            for i in range(100)
+        ],
+        "type": "BagManifest",
+    },
+    "tagManifest": {
+        "checksumAlgorithm": "SHA-512",
+        "files": [
+            {
+                "checksum": "%0128x" % 1,
+                "name": "bag-info.txt",
+                "path": "v1/bag-info.txt",
+                "size": 12,
+                "type": "File",
+            }
+        ],
+        "type": "BagManifest",
+    },
+    "location": {
+        "provider": {"id": "amazon-s3", "type": "Provider"},
+        "bucket": "wellcomecollection-storage",
+        "path": "digitised/b1234",
+        "type": "Location",
+    },
+    "replicaLocations": [],
+    "createdDate": "2019-09-12T20:26:53.094757Z",
+    "version": "v1",
+    "type": "Bag",
+}
+
+
+def chunked(text, size):
+    return (text[i:i + size] for i in range(0, len(text), size))
+
+
+def expected_entries(bag):
+    return [
+        ManifestEntry(
+            manifest=manifest,
+            checksum_algorithm=bag[manifest]["checksumAlgorithm"],
+            file=f,
+        )
+        for manifest in ("manifest", "tagManifest")
+        for f in bag[manifest]["files"]
+    ]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 100, 1000000])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_streams_every_file_in_the_bag(chunk_size, indent):
+    text = json.dumps(BAG, indent=indent)
+
+    bag = StreamingBag(chunked(text, chunk_size))
+
+    assert list(bag) == expected_entries(BAG)
+
+
+def test_metadata_is_available_after_iterating():
+    bag = StreamingBag(chunked(json.dumps(BAG), 50))
+
+    # Fields before the manifests are available as soon as we see a file
+    next(iter(bag))
+    assert bag.metadata["info"] == BAG["info"]
+    assert "location" not in bag.metadata
+
+    metadata = bag.finish()
+
+    expected = {k: v for k, v in BAG.items() if k not in ("manifest", "tagManifest")}
+    expected["manifest"] = {"checksumAlgorithm": "SHA-256", "type": "BagManifest"}
+    expected["tagManifest"] = {"checksumAlgorithm": "SHA-512", "type": "BagManifest"}
+
+    assert metadata == expected
+    assert bag.metadata == expected
+
+
+def test_numbers_split_across_chunks_are_decoded_correctly():
+    text = json.dumps({"manifest": {"files": [{"size": 123456789}]}})
+    split_at = text.index("12345") + 3
+
+    bag = StreamingBag([text[:split_at], text[split_at:]])
+
+    assert [entry.file["size"] for entry in bag] == [123456789]
+
+
+@pytest.mark.parametrize("number", ["12.5", "1e5", "-3", "1.5E+3", "0"])
+def test_numbers_are_only_decoded_once_complete(number):
+    text = '{"manifest": {"files": []}, "count": %s, "version": "v1"}' % number
+
+    # Split the text everywhere inside the number
+    start = text.index(number)
+    for split_at in range(start + 1, start + len(number) + 1):
+        bag = StreamingBag([text[:split_at], text[split_at:]])
+        assert bag.finish()["count"] == json.loads(number)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000000])
+def test_checksum_algorithm_can_come_after_the_files(chunk_size):
+    text = json.dumps(
+        {
+            "manifest": {
+                "files": BAG["manifest"]["files"],
+                "checksumAlgorithm": "SHA-256",
+            },
+            "tagManifest": BAG["tagManifest"],
+        }
+    )
+
+    bag = StreamingBag(chunked(text, chunk_size))
+
+    assert list(bag) == expected_entries(BAG)
+
+
+def test_bag_with_no_files():
+    bag = StreamingBag(['{"manifest": {"files": []}, "version": "v1"}'])
+
+    assert list(bag) == []
+    assert bag.metadata == {"manifest": {}, "version": "v1"}
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        '{"manifest": {"files": [{"name": "a"}',
+        '{"manifest": {"files": [{"name": "a"} {"name": "b"}]}}',
+        '{"manifest": {"files": []}} extra',
+    ],
+)
+def test_malformed_response_is_an_error(text):
+    with pytest.raises(ValueError):
+        list(StreamingBag(chunked(text, 5)))
+
+
+class FakeClient(StorageServiceClientBase):
+    def _http_get(self, url):
+        if "doesnotexist" in url:
+            return 404, "{}"
+
+        return 200, json.dumps(BAG)
+
+
+def test_client_can_stream_a_bag():
+    client = FakeClient(api_url="https://example.org/storage/v1")
+
+    bag = client.iter_bag_files("digitised", "b1234")
+
+    assert list(bag) == expected_entries(BAG)
+    assert bag.metadata["version"] == "v1"
+
+
+def test_streaming_a_missing_bag_is_an_error():
+    client = FakeClient(api_url="https://example.org/storage/v1")
+
+    with pytest.raises(BagNotFound):
+        client.iter_bag_files("digitised", "doesnotexist")
+
+
+def test_requests_client_streams_the_response_body():
+    body = json.dumps(
+        {"manifest": {"files": [{"name": u"data/caf\u00e9.txt"}]}}, ensure_ascii=False
+    ).encode("utf8")
+
+    # Split the body in the middle of the two-byte encoding of the accent
+    split_at = body.index(b"\xc3") + 1
+
+    resp = mock.Mock(status_code=200, encoding=None)
+    resp.iter_content.return_value = iter([body[:split_at], body[split_at:]])
+
+    sess = mock.Mock()
+    sess.get.return_value = resp
+
+    client = RequestsStorageServiceClient(
+        api_url="https://example.org/storage/v1", sess=sess
+    )
+
+    bag = client.iter_bag_files("digitised", "b1234")
+
+    assert [entry.file["name"] for entry in bag] == [u"data/caf\u00e9.txt"]
+    sess.get.assert_called_once_with(
+        "https://example.org/storage/v1/bags/digitised/b1234", stream=True
+    )
+    resp.close.assert_called_once_with()
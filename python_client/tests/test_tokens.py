@@ -0,0 +1,203 @@
+import os
+import stat
+import threading
+import time
+
+import mock
+from oauthlib.oauth2.rfc6749.errors import TokenExpiredError
+import pytest
+
+from wellcome_storage_service import (
+    FileTokenStore,
+    MemoryTokenStore,
+    RequestsOAuthStorageServiceClient,
+)
+from wellcome_storage_service import secrets
+from wellcome_storage_service.tokens import token_is_fresh, token_key
+
+
+def make_token(access_token, expires_in=3600):
+    return {
+        "access_token": access_token,
+        "token_type": "Bearer",
+        "expires_in": expires_in,
+        "expires_at": time.time() + expires_in,
+    }
+
+
+class FakeTokenServer(object):
+    def __init__(self, expires_in=3600, delay=0):
+        self.expires_in = expires_in
+        self.delay = delay
+        self.tokens_issued = 0
+        self._lock = threading.Lock()
+
+    def fetch_token(self, **kwargs):
+        time.sleep(self.delay)
+
+        with self._lock:
+            self.tokens_issued += 1
+            return make_token(
+                "token-%d" % self.tokens_issued, expires_in=self.expires_in
+            )
+
+
+def make_client(token_server, token_store=None):
+    client = RequestsOAuthStorageServiceClient(
+        api_url="https://example.org/storage/v1",
+        client_id="client_id",
+        client_secret="client_secret",
+        token_url="https://example.org/token",
+        token_store=token_store,
+    )
+
+    client.sess.fetch_token = token_server.fetch_token
+    client.sess.get = mock.Mock(return_value=mock.Mock(status_code=200, text="{}"))
+
+    return client
+
+
+@pytest.mark.parametrize(
+    "token, is_fresh",
+    [
+        (None, False),
+        ({}, False),
+        (make_token("a"), True),
+        (make_token("a", expires_in=30), False),
+        (make_token("a", expires_in=-30), False),
+        ({"access_token": "a"}, True),
+    ],
+)
+def test_token_is_fresh(token, is_fresh):
+    assert token_is_fresh(token) == is_fresh
+
+
+def test_token_key_depends_on_client_and_server():
+    keys = {
+        token_key("client1", "https://example.org/token"),
+        token_key("client2", "https://example.org/token"),
+        token_key("client1", "https://example.net/token"),
+    }
+
+    assert len(keys) == 3
+
+
+@pytest.fixture(params=["memory", "file"])
+def store(request, tmpdir):
+    if request.param == "memory":
+        return MemoryTokenStore()
+    else:
+        return FileTokenStore(directory=str(tmpdir))
+
+
+def test_can_store_and_retrieve_tokens(store):
+    assert store.get("key1") is None
+
+    token = make_token("a")
+    store.put("key1", token)
+
+    assert store.get("key1") == token
+    assert store.get("key2") is None
+
+
+def test_file_tokens_are_only_readable_by_the_owner(tmpdir):
+    store = FileTokenStore(directory=str(tmpdir))
+    store.put("key1", make_token("a"))
+
+    (path,) = [p for p in tmpdir.listdir() if p.ext == ".json"]
+    assert stat.S_IMODE(os.stat(str(path)).st_mode) == 0o600
+
+
+def test_file_tokens_are_shared_between_stores(tmpdir):
+    FileTokenStore(directory=str(tmpdir)).put("key1", make_token("a"))
+
+    assert FileTokenStore(directory=str(tmpdir)).get("key1")["access_token"] == "a"
+
+
+def test_fetches_a_token_on_first_request():
+    token_server = FakeTokenServer()
+    client = make_client(token_server)
+
+    client.get_ingest("1234")
+    client.get_ingest("1234")
+
+    assert token_server.tokens_issued == 1
+    assert client.sess.token["access_token"] == "token-1"
+
+
+def test_refreshes_a_token_before_it_expires():
+    # Every token expires inside the refresh margin, so the second request
+    # has to get a new one.
+    token_server = FakeTokenServer(expires_in=30)
+    client = make_client(token_server)
+
+    client.get_ingest("1234")
+    client.get_ingest("1234")
+
+    assert token_server.tokens_issued == 2
+
+
+def test_refreshes_a_token_if_the_client_says_it_has_expired():
+    token_server = FakeTokenServer()
+    client = make_client(token_server)
+
+    client.get_ingest("1234")
+
+    client.sess.get.side_effect = [
+        TokenExpiredError(),
+        mock.Mock(status_code=200, text="{}"),
+    ]
+    client.get_ingest("1234")
+
+    assert token_server.tokens_issued == 2
+    assert client.sess.token["access_token"] == "token-2"
+
+
+def test_clients_share_a_token_store():
+    token_server = FakeTokenServer()
+    token_store = MemoryTokenStore()
+
+    for _ in range(3):
+        make_client(token_server, token_store=token_store).get_ingest("1234")
+
+    assert token_server.tokens_issued == 1
+
+
+def test_clients_share_a_file_token_store(tmpdir):
+    token_server = FakeTokenServer()
+
+    for _ in range(3):
+        token_store = FileTokenStore(directory=str(tmpdir))
+        make_client(token_server, token_store=token_store).get_ingest("1234")
+
+    assert token_server.tokens_issued == 1
+
+
+def test_concurrent_requests_only_fetch_one_token(tmpdir):
+    token_server = FakeTokenServer(delay=0.05)
+    token_store = FileTokenStore(directory=str(tmpdir))
+    clients = [make_client(token_server, token_store=token_store) for _ in range(5)]
+
+    threads = [
+        threading.Thread(target=client.get_ingest, args=("1234",))
+        for client in clients
+        for _ in range(4)
+    ]
+
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert token_server.tokens_issued == 1
+
+
+def test_secrets_are_only_fetched_once(monkeypatch):
+    monkeypatch.setattr(secrets, "_secrets", None)
+
+    fetch = mock.Mock(return_value={"client_id": "id", "client_secret": "secret"})
+    monkeypatch.setattr(secrets, "_fetch_secrets", fetch)
+
+    assert secrets.get_secrets() == {"client_id": "id", "client_secret": "secret"}
+    assert secrets.get_secrets() == {"client_id": "id", "client_secret": "secret"}
+    assert fetch.call_count == 1
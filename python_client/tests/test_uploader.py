@@ -0,0 +1,224 @@
+import io
+import os
+import tarfile
+
+import mock
+import pytest
+
+from wellcome_storage_service import StorageServiceClientBase, upload_bag
+from wellcome_storage_service import uploader
+from wellcome_storage_service.uploader import S3MultipartWriter
+
+
+BUCKET = "wellcomecollection-uploads"
+
+
+class FakeS3Client(object):
+    """
+    Records the parts of a multipart upload, rather than uploading them.
+    """
+
+    def __init__(self, fail_on_part=None, fail_on_abort=False):
+        self.fail_on_part = fail_on_part
+        self.fail_on_abort = fail_on_abort
+        self.parts = {}
+        self.completed = None
+        self.aborted = False
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {"UploadId": "upload-1"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_on_part:
+            raise IOError("Connection reset")
+
+        self.parts[PartNumber] = Body
+        return {"ETag": "etag-%d" % PartNumber}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.completed = MultipartUpload["Parts"]
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        if self.fail_on_abort:
+            raise IOError("Access denied")
+
+        self.aborted = True
+
+
+@pytest.fixture
+def bag_dir(tmpdir):
+    tmpdir.join("bagit.txt").write_binary(b"BagIt-Version: 0.97\n")
+    tmpdir.join("data", "b12345.xml").write_binary(b"<mets/>", ensure=True)
+    tmpdir.join("data", "objects", "b12345_0001.jp2").write_binary(
+        os.urandom(1000), ensure=True
+    )
+    return str(tmpdir)
+
+
+@pytest.fixture
+def bucket(s3_client):
+    s3_client.create_bucket(
+        Bucket=BUCKET, CreateBucketConfiguration={"LocationConstraint": "eu-west-1"}
+    )
+    return BUCKET
+
+
+def _read_tar(s3_client, key):
+    body = s3_client.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+
+    with tarfile.open(fileobj=io.BytesIO(body), mode="r:gz") as tf:
+        return {
+            member.name: tf.extractfile(member).read()
+            for member in tf.getmembers()
+            if member.isfile()
+        }
+
+
+def test_writer_splits_writes_into_parts():
+    s3_client = FakeS3Client()
+    writer = S3MultipartWriter(s3_client, bucket=BUCKET, key="a.bin", part_size=10)
+
+    for _ in range(5):
+        writer.write(b"x" * 7)
+    writer.close()
+
+    assert [len(s3_client.parts[n]) for n in sorted(s3_client.parts)] == [10, 10, 10, 5]
+    assert s3_client.completed == [
+        {"PartNumber": n, "ETag": "etag-%d" % n} for n in range(1, 5)
+    ]
+
+
+def test_writer_uploads_one_part_for_an_empty_file():
+    s3_client = FakeS3Client()
+    S3MultipartWriter(s3_client, bucket=BUCKET, key="a.bin").close()
+
+    assert s3_client.parts == {1: b""}
+
+
+def test_writer_doubles_the_part_size_to_stay_under_the_part_limit():
+    s3_client = FakeS3Client()
+
+    with mock.patch.object(uploader, "PARTS_PER_SIZE", 2):
+        writer = S3MultipartWriter(s3_client, bucket=BUCKET, key="a.bin", part_size=10)
+        writer.write(b"x" * 100)
+        writer.close()
+
+    sizes = [len(s3_client.parts[n]) for n in sorted(s3_client.parts)]
+    assert sizes == [10, 10, 20, 20, 40]
+
+
+def test_writer_holds_a_bounded_number_of_parts():
+    s3_client = FakeS3Client()
+    writer = S3MultipartWriter(
+        s3_client, bucket=BUCKET, key="a.bin", part_size=10, max_workers=2
+    )
+
+    for _ in range(100):
+        writer.write(b"x" * 10)
+        assert len(writer._pending) <= 2
+        assert len(writer._buffer) < 10
+
+    writer.close()
+
+
+def test_uploads_a_bag(s3_client, bucket, bag_dir):
+    upload_bag(bag_dir, s3_bucket=bucket, s3_key="uploads/b12345.tar.gz")
+
+    files = _read_tar(s3_client, "uploads/b12345.tar.gz")
+
+    assert sorted(files) == [
+        "bagit.txt",
+        "data/b12345.xml",
+        "data/objects/b12345_0001.jp2",
+    ]
+    assert files["data/b12345.xml"] == b"<mets/>"
+
+
+def test_can_put_the_bag_in_a_top_level_dir(s3_client, bucket, bag_dir):
+    upload_bag(
+        bag_dir,
+        s3_bucket=bucket,
+        s3_key="uploads/b12345.tar.gz",
+        top_level_dir="b12345",
+    )
+
+    assert "b12345/data/b12345.xml" in _read_tar(s3_client, "uploads/b12345.tar.gz")
+
+
+def test_uploads_a_large_bag_in_several_parts(s3_client, bucket, tmpdir):
+    big = os.urandom(12 * 1024 * 1024)
+    tmpdir.join("data", "big.bin").write_binary(big, ensure=True)
+
+    upload_bag(
+        str(tmpdir),
+        s3_bucket=bucket,
+        s3_key="uploads/big.tar.gz",
+        part_size=5 * 1024 * 1024,
+    )
+
+    assert _read_tar(s3_client, "uploads/big.tar.gz")["data/big.bin"] == big
+
+
+def test_aborts_the_upload_if_it_fails(bag_dir):
+    s3_client = FakeS3Client(fail_on_part=1)
+
+    with pytest.raises(IOError, match="Connection reset"):
+        upload_bag(bag_dir, s3_bucket=BUCKET, s3_key="a.tar.gz", s3_client=s3_client)
+
+    assert s3_client.aborted
+    assert s3_client.completed is None
+
+
+def test_raises_the_original_error_if_the_abort_fails(bag_dir, caplog):
+    s3_client = FakeS3Client(fail_on_part=1, fail_on_abort=True)
+
+    with pytest.raises(IOError, match="Connection reset"):
+        upload_bag(bag_dir, s3_bucket=BUCKET, s3_key="a.tar.gz", s3_client=s3_client)
+
+    assert "Unable to abort multipart upload upload-1" in caplog.text
+    assert "Access denied" in caplog.text
+
+
+def test_aborts_the_upload_if_the_bag_is_missing(tmpdir):
+    s3_client = FakeS3Client()
+
+    with pytest.raises(OSError):
+        upload_bag(
+            str(tmpdir.join("doesnotexist")),
+            s3_bucket=BUCKET,
+            s3_key="a.tar.gz",
+            s3_client=s3_client,
+        )
+
+    assert s3_client.aborted
+
+
+class IngestClient(StorageServiceClientBase):
+    def __init__(self):
+        self.posts = []
+        super(IngestClient, self).__init__(api_url="https://example.org/storage/v1")
+
+    def _http_post(self, url, json):
+        self.posts.append((url, json))
+        return (201, {"Location": "https://example.org/storage/v1/ingests/123"}, "")
+
+
+def test_uploads_a_bag_and_creates_an_ingest(s3_client, bucket, bag_dir):
+    client = IngestClient()
+
+    location = client.create_ingest_from_directory(
+        space="digitised",
+        external_identifier="b12345",
+        bag_dir=bag_dir,
+        s3_bucket=bucket,
+        s3_key="uploads/b12345.tar.gz",
+    )
+
+    assert location == "https://example.org/storage/v1/ingests/123"
+    assert "bagit.txt" in _read_tar(s3_client, "uploads/b12345.tar.gz")
+
+    ((url, payload),) = client.posts
+    assert url == "https://example.org/storage/v1/ingests"
+    assert payload["sourceLocation"]["bucket"] == bucket
+    assert payload["sourceLocation"]["path"] == "uploads/b12345.tar.gz"
+    assert payload["bag"]["info"]["externalIdentifier"] == "b12345"
@@ -35,3 +35,70 @@ class TestMkdirP:
         with mock.patch("wellcome_storage_service._utils.os.makedirs", m):
             with pytest.raises(OSError, match=message):
                 utils.mkdir_p(path)
+
+
+@pytest.mark.parametrize(
+    "checksum_algorithm, expected",
+    [("SHA-256", "sha256"), ("SHA-512", "sha512"), ("MD5", "md5"), ("SHA-1", "sha1")],
+)
+def test_hashlib_name(checksum_algorithm, expected):
+    assert utils.hashlib_name(checksum_algorithm) == expected
+
+
+def test_backoff_delay_is_capped():
+    for attempt in range(20):
+        assert 0 <= utils.backoff_delay(attempt, base=0.5, cap=30) <= 30
+
+
+def test_rate_limiter_spaces_out_calls():
+    now = [100.0]
+    sleeps = []
+
+    def _sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    with mock.patch("wellcome_storage_service._utils.time.time", lambda: now[0]):
+        with mock.patch("wellcome_storage_service._utils.time.sleep", _sleep):
+            limiter = utils.RateLimiter(max_per_second=4)
+
+            for _ in range(5):
+                limiter.wait()
+
+            # If we've been idle, we don't have to wait
+            now[0] += 10
+            limiter.wait()
+
+    assert sleeps == [0.25, 0.25, 0.25, 0.25]
+
+
+def test_latency_tracker_percentiles():
+    tracker = utils.LatencyTracker(window=100, min_samples=10)
+
+    for i in range(9):
+        tracker.record(i)
+    assert tracker.percentile(95) is None
+
+    for i in range(9, 200):
+        tracker.record(i)
+
+    # Only the most recent 100 samples (100..199) count
+    assert tracker.percentile(0) == 100
+    assert tracker.percentile(50) in (149, 150)
+    assert tracker.percentile(100) == 199
+
+
+def test_request_budget_caps_extra_requests():
+    budget = utils.RequestBudget(ratio=0.1, burst=2)
+
+    allowed = 0
+    for _ in range(100):
+        budget.record_request()
+        allowed += budget.try_spend()
+
+    assert allowed == 10
+
+    # Unused budget is only saved up to ``burst``
+    for _ in range(100):
+        budget.record_request()
+    assert [budget.try_spend() for _ in range(3)] == [True, True, False]
@@ -0,0 +1,269 @@
+import datetime
+import json
+import threading
+
+import mock
+import pytest
+
+from wellcome_storage_service import (
+    FinishedIngest,
+    IngestNotFound,
+    IngestWaitTimeout,
+    StorageServiceClientBase,
+)
+from wellcome_storage_service.ingests import (
+    IngestStage,
+    ingest_stages,
+    next_poll_delay,
+)
+
+
+START = 1600000000
+
+
+def iso_date(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime(
+        "%Y-%m-%dT%H:%M:%S.%fZ"
+    )
+
+
+def make_ingest(status, events, created=START):
+    return {
+        "id": "1234",
+        "status": {"id": status, "type": "Status"},
+        "createdDate": iso_date(created),
+        "events": [
+            {"description": description, "createdDate": iso_date(ts), "type": "Event"}
+            for ts, description in events
+        ],
+        "type": "Ingest",
+    }
+
+
+class FakeClock(object):
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    clock = FakeClock(now=START)
+
+    with mock.patch("wellcome_storage_service.time.time", clock.time):
+        with mock.patch("wellcome_storage_service.time.sleep", clock.sleep):
+            yield clock
+
+
+class FakeIngestsClient(StorageServiceClientBase):
+    """
+    A client for ingests that progress through the storage service over time.
+
+    ``timelines`` maps an ingest URL to a list of (timestamp, description)
+    events, and the time the ingest finishes (with the final status).
+    """
+
+    def __init__(self, clock, timelines):
+        self.clock = clock
+        self.timelines = timelines
+        self.requests = []
+        self._lock = threading.Lock()
+
+        super(FakeIngestsClient, self).__init__(api_url="https://example.org/v1")
+
+    def _http_get(self, url):
+        with self._lock:
+            self.requests.append((self.clock.now, url))
+
+        if url not in self.timelines:
+            return 404, "{}"
+
+        events, (finished_at, final_status) = self.timelines[url]
+        now = self.clock.now
+
+        events_so_far = [(ts, desc) for ts, desc in events if ts <= now]
+        if now >= finished_at:
+            status = final_status
+        elif events_so_far:
+            status = "processing"
+        else:
+            status = "accepted"
+
+        return 200, json.dumps(make_ingest(status, events_so_far))
+
+
+def test_ingest_stages_come_from_events():
+    ingest = make_ingest(
+        "succeeded",
+        # Events aren't necessarily in order in the API response
+        [
+            (START + 30, "Verification succeeded"),
+            (START + 10, "Unpacking succeeded"),
+            (START + 95, "Replicating succeeded"),
+        ],
+    )
+
+    assert ingest_stages(ingest) == [
+        IngestStage("Unpacking succeeded", START + 10, 20),
+        IngestStage("Verification succeeded", START + 30, 65),
+        IngestStage("Replicating succeeded", START + 95, None),
+    ]
+
+
+@pytest.mark.parametrize(
+    "last_event_ago, expected_delay",
+    [
+        # Busy ingests are polled at the minimum interval
+        (1, 5),
+        # Quiet ingests back off
+        (100, 25),
+        # ... up to the maximum
+        (10000, 300),
+    ],
+)
+def test_polls_quiet_ingests_less_often(last_event_ago, expected_delay):
+    now = START + 10000
+    ingest = make_ingest("processing", [(now - last_event_ago, "Unpacking started")])
+
+    delay = next_poll_delay(ingest, now=now, min_interval=5, max_interval=300)
+
+    assert expected_delay * 0.9 <= delay <= expected_delay * 1.1
+
+
+def test_waits_for_ingests_to_finish(clock):
+    client = FakeIngestsClient(
+        clock,
+        timelines={
+            "https://example.org/v1/ingests/fast": (
+                [(START + 10, "Unpacking started")],
+                (START + 20, "succeeded"),
+            ),
+            "https://example.org/v1/ingests/slow": (
+                [(START + 30, "Unpacking started"), (START + 500, "Verifying")],
+                (START + 600, "failed"),
+            ),
+        },
+    )
+
+    results = list(
+        client.wait_for_ingests(
+            [
+                "https://example.org/v1/ingests/slow",
+                "https://example.org/v1/ingests/fast",
+            ]
+        )
+    )
+
+    assert [location for location, _ in results] == [
+        "https://example.org/v1/ingests/fast",
+        "https://example.org/v1/ingests/slow",
+    ]
+
+    fast, slow = [result for _, result in results]
+    assert isinstance(fast, FinishedIngest)
+    assert fast.succeeded
+    assert fast.stages == [IngestStage("Unpacking started", START + 10, None)]
+    assert fast.duration == 10
+
+    assert not slow.succeeded
+    assert slow.status == "failed"
+    assert [s.description for s in slow.stages] == ["Unpacking started", "Verifying"]
+
+    # We found out about each ingest soon after it finished
+    assert clock.now < START + 600 + 300
+
+
+def test_backs_off_while_an_ingest_is_quiet(clock):
+    client = FakeIngestsClient(
+        clock,
+        timelines={
+            "https://example.org/v1/ingests/1": (
+                [(START, "Unpacking started")],
+                (START + 3600, "succeeded"),
+            )
+        },
+    )
+
+    list(client.wait_for_ingests(["https://example.org/v1/ingests/1"]))
+
+    # Polling at the minimum interval would take ~720 requests
+    assert len(client.requests) < 50
+
+    poll_times = [ts for ts, _ in client.requests]
+    gaps = [b - a for a, b in zip(poll_times, poll_times[1:])]
+    assert gaps[0] < 10
+    assert max(gaps) > 100
+
+
+def test_times_out(clock):
+    client = FakeIngestsClient(
+        clock,
+        timelines={
+            "https://example.org/v1/ingests/done": ([], (START, "succeeded")),
+            "https://example.org/v1/ingests/stuck": (
+                [(START, "Unpacking started")],
+                (START + 100000, "succeeded"),
+            ),
+        },
+    )
+
+    results = dict(
+        client.wait_for_ingests(
+            [
+                "https://example.org/v1/ingests/done",
+                "https://example.org/v1/ingests/stuck",
+            ],
+            timeout=60,
+        )
+    )
+
+    assert results["https://example.org/v1/ingests/done"].succeeded
+
+    stuck = results["https://example.org/v1/ingests/stuck"]
+    assert isinstance(stuck, IngestWaitTimeout)
+    assert stuck.last_status == "processing"
+    assert clock.now == START + 60
+
+
+def test_missing_ingest_does_not_stop_the_others(clock):
+    client = FakeIngestsClient(
+        clock,
+        timelines={"https://example.org/v1/ingests/1": ([], (START, "succeeded"))},
+    )
+
+    results = dict(
+        client.wait_for_ingests(
+            [
+                "https://example.org/v1/ingests/1",
+                "https://example.org/v1/ingests/doesnotexist",
+            ]
+        )
+    )
+
+    assert results["https://example.org/v1/ingests/1"].succeeded
+    assert isinstance(
+        results["https://example.org/v1/ingests/doesnotexist"], IngestNotFound
+    )
+
+
+def test_can_wait_for_lots_of_ingests(clock):
+    timelines = {
+        "https://example.org/v1/ingests/%d" % i: (
+            [(START + i, "Unpacking started")],
+            (START + 60 + i, "succeeded"),
+        )
+        for i in range(500)
+    }
+    client = FakeIngestsClient(clock, timelines=timelines)
+
+    results = dict(client.wait_for_ingests(sorted(timelines), max_concurrency=20))
+
+    assert len(results) == 500
+    assert all(r.succeeded for r in results.values())
@@ -4,8 +4,13 @@ Download the contents of a bag.  Usage:
 
     python ss_download_bag.py <SPACE> <EXTERNAL_IDENTIFIER> [<VERSION>]
 
+The bag is downloaded to a fixed directory in your temp dir, so if the
+download is interrupted, running the script again will pick up where it
+left off rather than starting from scratch.
+
 """
 
+import os
 import sys
 import tempfile
 
@@ -54,8 +59,14 @@ if __name__ == "__main__":
 
     confirm_size(storage_manifest)
 
-    out_dir = tempfile.mkdtemp()
+    out_dir = os.path.join(
+        tempfile.gettempdir(),
+        "ss_download_bag",
+        space,
+        external_identifier,
+        storage_manifest["version"],
+    )
 
-    download_bag(storage_manifest=storage_manifest, out_dir=out_dir)
+    download_bag(storage_manifest=storage_manifest, out_dir=out_dir, resume=True)
 
     print(out_dir)